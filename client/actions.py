@@ -13,6 +13,7 @@ import traceback
 import psutil
 
 from grr.client import client_utils
+from grr.client import vfs
 from grr.lib import flags
 from grr.lib import rdfvalue
 # pylint: disable=unused-import
@@ -70,6 +71,12 @@ class ActionPlugin(object):
 
   last_progress_time = 0
 
+  # The GrrMessage this action is processing, set by Execute().
+  message = None
+
+  # The I/O budget of the message, set by Execute().
+  io_throttle = None
+
   def __init__(self, grr_worker=None):
     """Initializes the action plugin.
 
@@ -132,14 +139,20 @@ class ActionPlugin(object):
       self.cpu_limit = self.message.cpu_limit
       self.network_bytes_limit = self.message.network_bytes_limit
 
+      self.io_throttle = vfs.IOThrottle(
+          bytes_per_second=self.message.io_bytes_per_second,
+          ops_per_second=self.message.io_ops_per_second,
+          progress_callback=self.Progress)
       try:
-        self.Run(args)
+        with vfs.ActionIOThrottle(self.io_throttle):
+          self.Run(args)
 
       # Ensure we always add CPU usage even if an exception occured.
       finally:
         user_end, system_end = self.proc.cpu_times()
 
         self.cpu_used = (user_end - user_start, system_end - system_start)
+        self.status.io_throttled_time = self.io_throttle.throttled_time
 
     except NetworkBytesExceededError as e:
       self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.NETWORK_LIMIT_EXCEEDED,
@@ -211,6 +224,15 @@ class ActionPlugin(object):
 
     self.response_id += 1
 
+  def HandleOwner(self):
+    """Returns the owner under which this action caches VFS handlers.
+
+    Actions of the same flow share the handlers they open, see
+    vfs.CachedVFSOpen().
+    """
+    if self.message is not None:
+      return self.message.session_id
+
   def Progress(self):
     """Indicate progress of the client action.
 
@@ -292,6 +314,24 @@ class IteratedAction(ActionPlugin):
     """Actions should override this."""
 
 
+class RequestIOThrottle(object):
+  """Charges the I/O budget of the request an action is currently serving."""
+
+  def __init__(self, action):
+    self.action = action
+
+  @property
+  def progress_callback(self):
+    if self.action.io_throttle is None:
+      return None
+    return self.action.io_throttle.progress_callback
+
+  def Charge(self, length, waited=0):
+    if self.action.io_throttle is None:
+      return 0
+    return self.action.io_throttle.Charge(length, waited=waited)
+
+
 class ClientActionWorker(threading.Thread):
   """A worker thread for the suspendable client action."""
 
@@ -318,8 +358,10 @@ class ClientActionWorker(threading.Thread):
     # Suspend right after starting.
     self.Suspend()
     try:
-      # Do the actual work.
-      self.action_obj.Iterate()
+      # Do the actual work. The worker reads on behalf of whichever request
+      # resumed it last.
+      with vfs.ActionIOThrottle(RequestIOThrottle(self.action_obj)):
+        self.action_obj.Iterate()
 
     except Exception:  # pylint: disable=broad-except
       if flags.FLAGS.debug:
@@ -2,17 +2,175 @@
 """Client actions related to searching files and directories."""
 
 
+import collections
 import functools
+import Queue
+import re
+import sre_compile
 import stat
+import threading
 
 import logging
 
 from grr.client import actions
+from grr.client import file_index
 from grr.client import vfs
 from grr.lib import rdfvalue
 from grr.lib import utils
 
 
+class DirectoryLister(object):
+  """Lists directories ahead of a walk in a small pool of threads.
+
+  On network file systems walking a tree is bound by the latency of each
+  listing. The walker asks for the directories it will visit next with
+  Prefetch() and later picks up their listings with List().
+
+  Only OS directories are listed in the background. Other handlers share
+  objects which are not thread safe, e.g. the pytsk3 filesystem of a device.
+  """
+
+  def __init__(self, threads=0, io_throttle=None, index_max_age=0,
+               stat_directories=False):
+    """Constructor.
+
+    Args:
+      threads: The number of listing threads. With no threads List() lists
+        the directory itself.
+      io_throttle: The I/O budget the listings are charged against. It may be
+        replaced between the iterations of a request.
+      index_max_age: The maximum age in seconds of listings taken from the
+        client's file index.
+      stat_directories: Should the listed directories be stat'ed as well?
+    """
+    self.io_throttle = io_throttle
+    self.index_max_age = index_max_age
+    self.stat_directories = stat_directories
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    # Events set when the listing of a pending directory is done, and the
+    # listings keyed by serialized pathspec.
+    self.pending = {}
+    self.results = {}
+    self.stopped = False
+
+    self.workers = []
+    for i in range(threads):
+      worker = threading.Thread(target=self._Worker,
+                                name="DirectoryLister%d" % i)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def _List(self, pathspec, progress_callback=None):
+    return file_index.ListDirectory(pathspec, max_age=self.index_max_age,
+                                    stat_directory=self.stat_directories,
+                                    progress_callback=progress_callback)
+
+  def _Worker(self):
+    with vfs.ActionIOThrottle(actions.RequestIOThrottle(self)):
+      while True:
+        item = self.queue.get()
+        if item is None:
+          return
+
+        key, pathspec = item
+        try:
+          result = self._List(pathspec), None
+        except (IOError, OSError) as e:
+          result = None, e
+
+        with self.lock:
+          self.results[key] = result
+          event = self.pending[key]
+        event.set()
+
+  def Prefetch(self, pathspec):
+    """Starts listing pathspec in the background."""
+    if not self.workers:
+      return
+
+    for component in pathspec:
+      if component.pathtype != rdfvalue.PathSpec.PathType.OS:
+        return
+
+    key = pathspec.SerializeToString()
+    with self.lock:
+      if self.stopped or key in self.pending:
+        return
+      self.pending[key] = threading.Event()
+      self.queue.put((key, pathspec.Copy()))
+
+  def List(self, pathspec, progress_callback=None):
+    """Returns the StatEntry of the directory, or None, and its StatEntrys.
+
+    Args:
+      pathspec: The directory to list.
+      progress_callback: Called while waiting for a background listing.
+
+    Raises:
+      IOError: or OSError if the directory can not be listed.
+    """
+    key = pathspec.SerializeToString()
+    with self.lock:
+      event = self.pending.get(key)
+
+    if event is None:
+      return self._List(pathspec, progress_callback=progress_callback)
+
+    while not event.wait(1):
+      if progress_callback:
+        progress_callback()
+
+    with self.lock:
+      del self.pending[key]
+      result, error = self.results.pop(key)
+
+    if error:
+      raise error
+
+    # The listing was dropped when the lister was stopped.
+    if result is None:
+      return self._List(pathspec, progress_callback=progress_callback)
+
+    return result
+
+  def Stop(self):
+    """Drops all queued listings and stops the threads."""
+    with self.lock:
+      self.stopped = True
+      try:
+        while True:
+          item = self.queue.get_nowait()
+          # Anyone waiting for a dropped listing lists the directory itself.
+          if item is not None:
+            key, _ = item
+            self.results[key] = None, None
+            self.pending[key].set()
+      except Queue.Empty:
+        pass
+
+      for _ in self.workers:
+        self.queue.put(None)
+
+
+class DirectoryListerCache(utils.TimeBasedCache):
+  """Keeps the listers of Find requests between their iterations."""
+
+  def KillObject(self, obj):
+    # FastStore expires the stored [timestamp, entry] pairs, the house keeper
+    # passes just the entry.
+    if isinstance(obj, list):
+      obj = obj[1]
+
+    obj.Stop()
+
+
+# Listers keyed by session and request, so the listings prefetched in one
+# iteration are used by the next.
+LISTER_CACHE = DirectoryListerCache(max_size=10, max_age=600)
+
+
 class Find(actions.IteratedAction):
   """Recurses through a directory returning files which match conditions."""
   in_rdfvalue = rdfvalue.FindSpec
@@ -26,14 +184,27 @@ class Find(actions.IteratedAction):
   # The filesystem we are limiting ourselves to, if cross_devs is false.
   filesystem_id = None
 
+  # The number of threads listing directories ahead of the walk. Each
+  # directory keeps this many of its subdirectories listing in the background.
+  LISTING_THREADS = 4
+
+  # Lists the directories, set up by Iterate().
+  lister = DirectoryLister()
+
+  def _Descend(self, file_stat):
+    """Should we walk into this directory entry?"""
+    # Do not traverse directories in a different filesystem.
+    return stat.S_ISDIR(file_stat.st_mode) and (
+        self.request.cross_devs or self.filesystem_id == file_stat.st_dev)
+
   def ListDirectory(self, pathspec, state, depth=0):
     """A Recursive generator of files."""
     # Limit recursion depth
     if depth >= self.request.max_depth: return
 
     try:
-      fd = vfs.VFSOpen(pathspec, progress_callback=self.Progress)
-      files = fd.ListFiles()
+      dir_stat, files = self.lister.List(pathspec,
+                                         progress_callback=self.Progress)
     except (IOError, OSError) as e:
       if depth == 0:
         # We failed to open the directory the server asked for because dir
@@ -49,23 +220,35 @@ class Find(actions.IteratedAction):
     # If we are not supposed to cross devices, and don't know yet
     # which device we are on, we need to find out.
     if not self.request.cross_devs and self.filesystem_id is None:
-      dir_stat = fd.Stat()
       self.filesystem_id = dir_stat.st_dev
 
     # Recover the start point for this directory from the state dict so we can
     # resume.
     start = state.get(pathspec.CollapsePath(), 0)
 
+    # List the subdirectories we will walk into while we are busy with the
+    # ones before them.
+    subdirectories = []
+    if depth + 1 < self.request.max_depth:
+      subdirectories = [file_stat.pathspec for file_stat in files[start:]
+                        if self._Descend(file_stat)]
+
+    for subdirectory in subdirectories[:self.LISTING_THREADS]:
+      self.lister.Prefetch(subdirectory)
+    next_prefetch = self.LISTING_THREADS
+
     for i, file_stat in enumerate(files):
       # Skip the files we already did before
       if i < start: continue
 
-      if stat.S_ISDIR(file_stat.st_mode):
-        # Do not traverse directories in a different filesystem.
-        if self.request.cross_devs or self.filesystem_id == file_stat.st_dev:
-          for child_stat in self.ListDirectory(file_stat.pathspec,
-                                               state, depth + 1):
-            yield child_stat
+      if self._Descend(file_stat):
+        if next_prefetch < len(subdirectories):
+          self.lister.Prefetch(subdirectories[next_prefetch])
+          next_prefetch += 1
+
+        for child_stat in self.ListDirectory(file_stat.pathspec,
+                                             state, depth + 1):
+          yield child_stat
 
       state[pathspec.CollapsePath()] = i + 1
       yield file_stat
@@ -116,52 +299,178 @@ class Find(actions.IteratedAction):
     # Content regex check
     try:
 
-      data = ""
+      overlap = 0
       with vfs.VFSOpen(file_stat.pathspec,
                        progress_callback=self.Progress) as fd:
         # Only read this much data from the file.
-        while fd.Tell() < self.request.max_data:
-          data_read = fd.read(1024000)
-          if not data_read: break
-          data += data_read
+        while fd.Tell() + overlap < self.request.max_data:
+          data = fd.ReadBuffer(overlap + 1024000)
+          if len(data) <= overlap: break
 
           # Got it.
           if self.request.data_regex.Search(data):
             return True
 
-          # Keep a bit of context from the last buffer to ensure we dont miss a
-          # match broken by buffer. We do not expect regex's to match something
-          # larger than about 100 chars.
-          data = data[-100:]
+          # Read a bit of context from the last buffer again to ensure we dont
+          # miss a match broken by buffer. We do not expect regex's to match
+          # something larger than about 100 chars.
+          overlap = min(len(data), 100)
+          fd.Seek(-overlap, 1)
 
     except (IOError, KeyError):
       pass
 
     return False
 
+  def _GetLister(self, request):
+    """Returns the DirectoryLister of this request and its cache key.
+
+    The key is None if the lister is not cached and must be stopped after
+    this iteration.
+    """
+    key = None
+    if self.message is not None:
+      key = (str(self.message.session_id),
+             request.pathspec.SerializeToString(), self.LISTING_THREADS,
+             request.index_max_age.seconds, request.cross_devs)
+      try:
+        lister = LISTER_CACHE.Get(key)
+        lister.io_throttle = self.io_throttle
+        return lister, key
+      except KeyError:
+        # Stop the expired lister, if any.
+        LISTER_CACHE.ExpireObject(key)
+
+    lister = DirectoryLister(
+        threads=self.LISTING_THREADS, io_throttle=self.io_throttle,
+        index_max_age=request.index_max_age.seconds,
+        stat_directories=not request.cross_devs)
+    if key is not None:
+      LISTER_CACHE.Put(key, lister)
+
+    return lister, key
+
   def Iterate(self, request, client_state):
     """Restores its way through the directory using an Iterator."""
     self.request = request
 
     limit = request.iterator.number
 
-    # TODO(user): What is a reasonable measure of work here?
-    for count, f in enumerate(
-        self.ListDirectory(request.pathspec, client_state)):
+    self.lister, key = self._GetLister(request)
+    try:
+      # TODO(user): What is a reasonable measure of work here?
+      for count, f in enumerate(
+          self.ListDirectory(request.pathspec, client_state)):
+
+        # Only send the reply if the file matches all criteria
+        if self.FilterFile(f):
+          self.SendReply(rdfvalue.FindSpec(hit=f))
+
+        # We only check a limited number of files in each iteration. This
+        # might result in returning an empty response - but the iterator is
+        # not yet complete. Flows must check the state of the iterator
+        # explicitly.
+        if count >= limit - 1:
+          logging.debug("Processed %s entries, quitting", count)
+          return
 
-      # Only send the reply if the file matches all criteria
-      if self.FilterFile(f):
-        self.SendReply(rdfvalue.FindSpec(hit=f))
+      # End this iterator
+      request.iterator.state = rdfvalue.Iterator.State.FINISHED
+      if key is not None:
+        LISTER_CACHE.ExpireObject(key)
+    finally:
+      if key is None:
+        self.lister.Stop()
 
-      # We only check a limited number of files in each iteration. This might
-      # result in returning an empty response - but the iterator is not yet
-      # complete. Flows must check the state of the iterator explicitly.
-      if count >= limit - 1:
-        logging.debug("Processed %s entries, quitting", count)
-        return
 
-    # End this iterator
-    request.iterator.state = rdfvalue.Iterator.State.FINISHED
+class AhoCorasick(object):
+  """Finds all occurrences of a number of literals in a single pass.
+
+  The literals are XOR encoded and stay encoded in the automaton. Each byte of
+  the data is encoded before it is looked up so the plain literals are never
+  present in our memory.
+  """
+
+  def __init__(self, literals, xor_key=0):
+    """Constructor.
+
+    Args:
+      literals: A list of bytearrays, XOR encoded with xor_key.
+      xor_key: The key the literals are encoded with.
+    """
+    self.xor_key = xor_key
+
+    # For every state the transitions, the failure link and the (index,
+    # length) of all literals ending in it.
+    self.transitions = [{}]
+    self.failures = [0]
+    self.outputs = [[]]
+
+    for index, literal in enumerate(literals):
+      if not literal:
+        continue
+
+      state = 0
+      for byte in literal:
+        next_state = self.transitions[state].get(byte)
+        if next_state is None:
+          next_state = len(self.transitions)
+          self.transitions[state][byte] = next_state
+          self.transitions.append({})
+          self.failures.append(0)
+          self.outputs.append([])
+        state = next_state
+
+      self.outputs[state].append((index, len(literal)))
+
+    # Failure links point to the longest proper suffix which is also a prefix
+    # of some literal. They are computed breadth first.
+    queue = collections.deque(self.transitions[0].values())
+    while queue:
+      state = queue.popleft()
+      for byte, next_state in self.transitions[state].iteritems():
+        queue.append(next_state)
+
+        failure = self.failures[state]
+        while failure and byte not in self.transitions[failure]:
+          failure = self.failures[failure]
+
+        failure = self.transitions[failure].get(byte, 0)
+        self.failures[next_state] = failure
+        self.outputs[next_state].extend(self.outputs[failure])
+
+    # From the initial state we can skip ahead to the next byte which starts
+    # any literal.
+    self.first_bytes = re.compile("[%s]" % "".join(
+        re.escape(chr(byte ^ xor_key)) for byte in self.transitions[0]))
+
+  def FindIter(self, data):
+    """Yields (start, end, index) for every hit in data."""
+    if not self.transitions[0]:
+      return
+
+    transitions = self.transitions
+    failures = self.failures
+    outputs = self.outputs
+    xor_key = self.xor_key
+
+    state = 0
+    offset = 0
+    while offset < len(data):
+      if not state:
+        match = self.first_bytes.search(data, offset)
+        if not match:
+          return
+        offset = match.start()
+
+      byte = ord(data[offset]) ^ xor_key
+      while state and byte not in transitions[state]:
+        state = failures[state]
+      state = transitions[state].get(byte, 0)
+
+      offset += 1
+      for index, length in outputs[state]:
+        yield (offset - length, offset, index)
 
 
 class Grep(actions.ActionPlugin):
@@ -174,23 +483,55 @@ class Grep(actions.ActionPlugin):
     for match in regex.FindIter(data):
       yield (match.start(), match.end())
 
+  def FindAll(self, automaton, regexes, data):
+    """Search the data for hits of several patterns, ordered by their end.
+
+    Args:
+      automaton: An AhoCorasick automaton of the literals.
+      regexes: A list of (pattern index, regex) tuples.
+      data: The data to search.
+
+    Returns:
+      A list of (start, end, pattern index) tuples.
+    """
+    hits = list(automaton.FindIter(data))
+    for index, regex in regexes:
+      hits.extend((start, end, index)
+                  for start, end in self.FindRegex(regex, data))
+
+    return sorted(hits, key=lambda hit: (hit[1], hit[0], hit[2]))
+
   def FindLiteral(self, pattern, data):
     """Search the data for a hit."""
     utils.XorByteArray(pattern, self.xor_in_key)
 
-    offset = 0
-    while 1:
-      # We assume here that data.find does not make a copy of pattern.
-      offset = data.find(pattern, offset)
+    try:
+      if isinstance(data, str):
+        # We assume here that data.find does not make a copy of pattern.
+        find = data.find
+      else:
+        # Buffers of mapped files have no find(). The regex engine searches
+        # them in place, compiled without going through the cache of the re
+        # module so the plain pattern is not kept around.
+        regex = sre_compile.compile(re.escape(str(pattern)))
 
-      if offset < 0:
-        break
+        def find(unused_pattern, offset):
+          match = regex.search(data, offset)
+          return match.start() if match else -1
 
-      yield (offset, offset + len(pattern))
+      offset = 0
+      while 1:
+        offset = find(pattern, offset)
 
-      offset += 1
+        if offset < 0:
+          break
 
-    utils.XorByteArray(pattern, self.xor_in_key)
+        yield (offset, offset + len(pattern))
+
+        offset += 1
+
+    finally:
+      utils.XorByteArray(pattern, self.xor_in_key)
 
   BUFF_SIZE = 1024 * 1024 * 10
   ENVELOPE_SIZE = 1000
@@ -209,6 +550,10 @@ class Grep(actions.ActionPlugin):
     is kept such that the algorithm can return bytes trailing the
     pattern even if the pattern is at the end of one block.
 
+    Several literals and regexes can be searched for in one pass. The
+    literals are matched together using an Aho-Corasick automaton and every
+    hit reports the index of the pattern it matched.
+
     One block:
     -----------------------------
     | Pre | Data         | Post |
@@ -259,7 +604,14 @@ class Grep(actions.ActionPlugin):
     self.xor_in_key = args.xor_in_key
     self.xor_out_key = args.xor_out_key
 
-    if args.regex:
+    if args.literals or args.regexes:
+      literals = [bytearray(utils.SmartStr(literal))
+                  for literal in args.literals]
+      regexes = list(enumerate(args.regexes, len(literals)))
+      find_func = functools.partial(
+          self.FindAll, AhoCorasick(literals, xor_key=self.xor_in_key),
+          regexes)
+    elif args.regex:
       find_func = functools.partial(self.FindRegex, args.regex)
     elif args.literal:
       find_func = functools.partial(self.FindLiteral,
@@ -278,16 +630,22 @@ class Grep(actions.ActionPlugin):
                     args.start_offset + args.length - fd.Tell())
       # Read some more data for the snippet.
       to_read += self.ENVELOPE_SIZE - postscript_size
-      read_data = fd.Read(to_read)
 
-      data = data[-postscript_size - self.ENVELOPE_SIZE:] + read_data
+      # The end of the last buffer is read again with the new data rather
+      # than copied in front of it, so mapped files are searched in place.
+      overlap = min(len(data), postscript_size + self.ENVELOPE_SIZE)
+      fd.Seek(-overlap, 1)
+      data = fd.ReadBuffer(overlap + to_read)
+      read_size = max(0, len(data) - overlap)
 
-      postscript_size = max(0, self.ENVELOPE_SIZE - (to_read - len(read_data)))
+      postscript_size = max(0, self.ENVELOPE_SIZE - (to_read - read_size))
       data_size = len(data) - preamble_size - postscript_size
 
       if data_size == 0 and postscript_size == 0: break
 
-      for (start, end) in find_func(data):
+      for hit in find_func(data):
+        start, end = hit[:2]
+
         # Ignore hits in the preamble.
         if end <= preamble_size:
           continue
@@ -300,15 +658,15 @@ class Grep(actions.ActionPlugin):
         if end + base_offset - preamble_size > args.start_offset + args.length:
           break
 
-        out_data = ""
-        for i in xrange(max(0, start - args.bytes_before),
-                        min(len(data), end + args.bytes_after)):
-          out_data += chr(ord(data[i]) ^ self.xor_out_key)
+        out_data = utils.Xor(data[max(0, start - args.bytes_before):
+                                  min(len(data), end + args.bytes_after)],
+                             self.xor_out_key)
 
         hits += 1
         self.SendReply(offset=base_offset + start - preamble_size,
                        data=out_data, length=len(out_data),
-                       pathspec=fd.pathspec)
+                       pathspec=fd.pathspec,
+                       pattern_index=hit[2] if len(hit) > 2 else 0)
 
         if args.mode == rdfvalue.GrepSpec.Mode.FIRST_HIT:
           return
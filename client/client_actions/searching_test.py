@@ -164,6 +164,93 @@ class FindTest(test_lib.EmptyActionTest):
     # Ensure we remove old states from client_state
     self.assertEqual(len(request.iterator.client_state.dat), 0)
 
+  def testParallelListing(self):
+    """Listing directories in the background does not change the results."""
+    pathspec = rdfvalue.PathSpec(path="/mock2/",
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+
+    def RunFind(threads, number):
+      files = []
+      request = rdfvalue.FindSpec(pathspec=pathspec, path_regex=".")
+      request.iterator.number = number
+
+      with utils.Stubber(searching.Find, "LISTING_THREADS", threads):
+        while request.iterator.state != rdfvalue.Iterator.State.FINISHED:
+          result = self.RunAction("Find", request)
+          files.extend(x.hit.pathspec.CollapsePath() for x in result
+                       if isinstance(x, rdfvalue.FindSpec))
+          request.iterator = result[-1].Copy()
+
+      return files
+
+    serial = RunFind(0, 200)
+    self.assertEqual(len(serial), 9)
+
+    # One or more threads, in one iteration or resumed after each file.
+    for threads in [1, 4]:
+      for number in [1, 200]:
+        self.assertEqual(RunFind(threads, number), serial)
+
+  def testListerKeptBetweenIterations(self):
+    """A request's lister is used by all its iterations."""
+    pathspec = rdfvalue.PathSpec(path="/mock2/",
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+    request = rdfvalue.FindSpec(pathspec=pathspec, path_regex=".")
+    request.iterator.number = 1
+
+    listers = set()
+    while request.iterator.state != rdfvalue.Iterator.State.FINISHED:
+      result = self.ExecuteAction("Find", request)
+      request.iterator = [x for x in result
+                          if isinstance(x, rdfvalue.Iterator)][0].Copy()
+      # The cache stores [timestamp, lister] pairs.
+      listers.update(data[1] for _, data in searching.LISTER_CACHE)
+
+    self.assertEqual(len(listers), 1)
+    # The lister is stopped once the request is done.
+    self.assertEqual(len(searching.LISTER_CACHE), 0)
+    self.assertTrue(listers.pop().stopped)
+
+  def testDirectoryLister(self):
+    """Errors of background listings are raised when they are picked up."""
+    lister = searching.DirectoryLister(threads=2)
+    try:
+      directory = rdfvalue.PathSpec(path="/mock2/directory1",
+                                    pathtype=rdfvalue.PathSpec.PathType.OS)
+      missing = rdfvalue.PathSpec(path="/mock2/missing",
+                                  pathtype=rdfvalue.PathSpec.PathType.OS)
+      lister.Prefetch(directory)
+      lister.Prefetch(missing)
+
+      _, files = lister.List(directory)
+      self.assertEqual(sorted(f.pathspec.Basename() for f in files),
+                       ["directory2", "file1.txt", "file2.txt"])
+      self.assertRaises(IOError, lister.List, missing)
+
+      # Nothing is left behind once the listings are picked up.
+      self.assertEqual(lister.pending, {})
+      self.assertEqual(lister.results, {})
+
+      # Other handlers are not thread safe and are listed when asked for.
+      tsk = directory.Copy()
+      tsk.Append(path="/", pathtype=rdfvalue.PathSpec.PathType.TSK)
+      lister.Prefetch(tsk)
+      self.assertEqual(lister.pending, {})
+    finally:
+      lister.Stop()
+
+    # Stopped listers list directories which are still queued themselves.
+    lister = searching.DirectoryLister()
+    lister.workers = [None]
+    lister.Prefetch(directory)
+    lister.Stop()
+    _, files = lister.List(directory)
+    self.assertEqual(len(files), 3)
+
+    # And do not take new work.
+    lister.Prefetch(directory)
+    self.assertEqual(lister.pending, {})
+
   def testFindAction2(self):
     """Test the find action path regex."""
     pathspec = rdfvalue.PathSpec(path="/mock2/",
@@ -331,6 +418,29 @@ class GrepTest(test_lib.EmptyActionTest):
     result = self.RunAction("Grep", request)
     self.assertEqual(len(result), 0)
 
+  def testGrepMultiplePatterns(self):
+    data = "X" * 10 + "HIT" + "X" * 10 + "HOT" + "X" * 10 + "HITHOT" + "X" * 10
+
+    MockVFSHandlerFind.filesystem[self.filename] = data
+
+    request = rdfvalue.GrepSpec(
+        literals=[utils.Xor("HIT", self.XOR_IN_KEY),
+                  utils.Xor("THO", self.XOR_IN_KEY)],
+        regexes=["H[O]T"],
+        xor_in_key=self.XOR_IN_KEY,
+        xor_out_key=self.XOR_OUT_KEY,
+        bytes_before=0, bytes_after=0)
+    request.target.path = self.filename
+    request.target.pathtype = rdfvalue.PathSpec.PathType.OS
+    request.start_offset = 0
+
+    result = self.RunAction("Grep", request)
+    self.assertEqual([(x.offset, x.pattern_index) for x in result],
+                     [(10, 0), (23, 2), (36, 0), (38, 1), (39, 2)])
+    for x in result:
+      self.assertEqual(utils.Xor(x.data, self.XOR_OUT_KEY),
+                       data[x.offset:x.offset + 3])
+
   def testGrepOffset(self):
     data = "X" * 10 + "HIT" + "X" * 100
 
@@ -431,6 +541,35 @@ class GrepTest(test_lib.EmptyActionTest):
       self.assertEqual(utils.Xor(result[0].data, self.XOR_OUT_KEY),
                        expected)
 
+  @SearchParams(1000, 100)
+  def testMappedBufferBoundaries(self):
+    # Use the real file system, which searches the files in place.
+    vfs.VFSInit().Run()
+    with utils.Stubber(vfs, "MAP_FILES", True):
+      self._TestMappedBufferBoundaries()
+
+  def _TestMappedBufferBoundaries(self):
+    path = os.path.join(self.temp_dir, "grepfile.txt")
+
+    for offset in xrange(-20, 20):
+      with open(path, "wb") as fd:
+        fd.write("X" * (1000 + offset) + "HIT" + "X" * 100)
+
+      for request in [
+          rdfvalue.GrepSpec(literal=utils.Xor("HIT", self.XOR_IN_KEY)),
+          rdfvalue.GrepSpec(regex="HIT")]:
+        request.xor_in_key = self.XOR_IN_KEY
+        request.xor_out_key = self.XOR_OUT_KEY
+        request.target.path = path
+        request.target.pathtype = rdfvalue.PathSpec.PathType.OS
+        request.start_offset = 0
+
+        result = self.RunAction("Grep", request)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].offset, 1000 + offset)
+        self.assertEqual(utils.Xor(result[0].data, self.XOR_OUT_KEY),
+                         "X" * 10 + "HIT" + "X" * 10)
+
   def testSnippetSize(self):
 
     data = "X" * 100 + "HIT" + "X" * 100
@@ -11,7 +11,6 @@ import platform
 import socket
 import sys
 import time
-import zlib
 
 
 import psutil
@@ -20,8 +19,10 @@ import logging
 
 from grr.client import actions
 from grr.client import client_utils_common
+from grr.client import file_index
 from grr.client import vfs
 from grr.client.client_actions import tempfiles
+from grr.lib import compression
 from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import rdfvalue
@@ -45,7 +46,8 @@ class ReadBuffer(actions.ActionPlugin):
       raise RuntimeError("Can not read buffers this large.")
 
     try:
-      fd = vfs.VFSOpen(args.pathspec, progress_callback=self.Progress)
+      fd = vfs.CachedVFSOpen(args.pathspec, self.HandleOwner(),
+                             progress_callback=self.Progress)
 
       fd.Seek(args.offset)
       offset = fd.Tell()
@@ -76,10 +78,10 @@ class TransferBuffer(actions.ActionPlugin):
       raise RuntimeError("Can not read buffers this large.")
 
     data = vfs.ReadVFS(args.pathspec, args.offset, args.length,
-                       progress_callback=self.Progress)
-    result = rdfvalue.DataBlob(
-        data=zlib.compress(data),
-        compression=rdfvalue.DataBlob.CompressionType.ZCOMPRESSION)
+                       progress_callback=self.Progress,
+                       owner=self.HandleOwner())
+    result = compression.POLICY.CompressBlob(
+        data, content_type=compression.ContentType(args.pathspec.Basename()))
 
     digest = hashlib.sha256(data).digest()
 
@@ -109,7 +111,11 @@ class HashBuffer(actions.ActionPlugin):
     if args.length > MAX_BUFFER_SIZE:
       raise RuntimeError("Can not read buffers this large.")
 
-    data = vfs.ReadVFS(args.pathspec, args.offset, args.length)
+    # The data is only hashed so it does not need to be copied out of the
+    # file mapping.
+    fd = vfs.CachedVFSOpen(args.pathspec, self.HandleOwner())
+    fd.Seek(args.offset)
+    data = fd.ReadBuffer(args.length)
 
     digest = hashlib.sha256(data).digest()
 
@@ -119,6 +125,80 @@ class HashBuffer(actions.ActionPlugin):
                    data=digest)
 
 
+class StreamFile(actions.ActionPlugin):
+  """Uploads a number of files and returns their chunk maps.
+
+  Every file is read once. Each chunk is hashed and only uploaded to the
+  TransferStore if the server does not already have it, so a whole collection
+  needs a single round trip.
+  """
+  in_rdfvalue = rdfvalue.StreamFileRequest
+  out_rdfvalue = rdfvalue.StreamFileResponse
+
+  def Run(self, args):
+    """Streams all the files in args.pathspecs."""
+    if args.chunk_size > MAX_BUFFER_SIZE:
+      raise RuntimeError("Can not read buffers this large.")
+
+    known_hashes = set(args.known_hashes[i:i + 32]
+                       for i in range(0, len(args.known_hashes), 32))
+
+    for pathspec in args.pathspecs:
+      try:
+        response = self.StreamFile(pathspec, args.chunk_size, known_hashes,
+                                   content_defined=args.content_defined)
+      except (IOError, OSError) as e:
+        response = rdfvalue.StreamFileResponse(
+            stat_entry=rdfvalue.StatEntry(pathspec=pathspec), error=str(e))
+
+      self.SendReply(response)
+
+  def StreamFile(self, pathspec, chunk_size, known_hashes,
+                 content_defined=False):
+    """Uploads the missing chunks of a file and returns its chunk map."""
+    fd = vfs.VFSOpen(pathspec, progress_callback=self.Progress)
+    response = rdfvalue.StreamFileResponse(stat_entry=fd.Stat())
+
+    if content_defined:
+      chunks = utils.ContentDefinedChunker(chunk_size).Split(fd.Read)
+    else:
+      chunks = iter(lambda: fd.Read(chunk_size), "")
+
+    content_type = compression.ContentType(pathspec.Basename())
+    hashers = dict(md5=hashlib.md5(), sha1=hashlib.sha1(),
+                   sha256=hashlib.sha256())
+    offset = 0
+    for data in chunks:
+      for hasher in hashers.values():
+        hasher.update(data)
+
+      digest = hashlib.sha256(data).digest()
+      if digest not in known_hashes:
+        # Ensure that the buffer is counted against this response. Check
+        # network send limit.
+        self.ChargeBytesToSession(len(data))
+
+        self.grr_worker.SendReply(
+            compression.POLICY.CompressBlob(data, content_type=content_type),
+            session_id=rdfvalue.SessionID("aff4:/flows/W:TransferStore"))
+
+        response.uploaded_bytes += len(data)
+
+        # Files often repeat chunks, e.g. runs of zeros.
+        known_hashes.add(digest)
+
+      response.chunks.Append(offset=offset, length=len(data), data=digest)
+      offset += len(data)
+
+      # Send heartbeats for long files.
+      self.Progress()
+
+    for name, hasher in hashers.items():
+      setattr(response.hash, name, hasher.digest())
+
+    return response
+
+
 class CopyPathToFile(actions.ActionPlugin):
   """Copy contents of a pathspec to a file on disk."""
   in_rdfvalue = rdfvalue.CopyPathToFileRequest
@@ -194,12 +274,13 @@ class ListDirectory(ReadBuffer):
   def Run(self, args):
     """Lists a directory."""
     try:
-      directory = vfs.VFSOpen(args.pathspec, progress_callback=self.Progress)
+      _, files = file_index.ListDirectory(
+          args.pathspec, max_age=args.index_max_age.seconds,
+          progress_callback=self.Progress)
     except (IOError, OSError), e:
       self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.IOERROR, e)
       return
 
-    files = list(directory.ListFiles())
     files.sort(key=lambda x: x.pathspec.path)
 
     for response in files:
@@ -214,11 +295,12 @@ class IteratedListDirectory(actions.IteratedAction):
   def Iterate(self, request, client_state):
     """Restores its way through the directory using an Iterator."""
     try:
-      fd = vfs.VFSOpen(request.pathspec, progress_callback=self.Progress)
+      _, files = file_index.ListDirectory(
+          request.pathspec, max_age=request.index_max_age.seconds,
+          progress_callback=self.Progress)
     except (IOError, OSError), e:
       self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.IOERROR, e)
       return
-    files = list(fd.ListFiles())
     files.sort(key=lambda x: x.pathspec.path)
 
     index = client_state.get("index", 0)
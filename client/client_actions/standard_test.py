@@ -314,6 +314,30 @@ class TestNetworkByteLimits(test_lib.EmptyActionTest):
     standard.vfs.ReadVFS = self.old_read
 
 
+class TestStreamFile(test_lib.EmptyActionTest):
+  """Test the StreamFile action."""
+
+  def testProgressPerChunk(self):
+    path = os.path.join(self.temp_dir, "stream")
+    with open(path, "wb") as fd:
+      fd.write("a" * 30)
+
+    # The server has the only chunk already, so nothing is uploaded.
+    request = rdfvalue.StreamFileRequest(
+        pathspecs=[rdfvalue.PathSpec(path=path,
+                                     pathtype=rdfvalue.PathSpec.PathType.OS)],
+        chunk_size=10, known_hashes=hashlib.sha256("a" * 10).digest())
+
+    progress = []
+    with utils.Stubber(standard.StreamFile, "Progress",
+                       lambda _: progress.append(1)):
+      result = self.RunAction("StreamFile", request)[0]
+
+    self.assertEqual(len(result.chunks), 3)
+    self.assertEqual(result.uploaded_bytes, 0)
+    self.assertEqual(len(progress), 3)
+
+
 def main(argv):
   test_lib.main(argv)
 
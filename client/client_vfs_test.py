@@ -6,6 +6,7 @@
 
 import os
 import stat
+import time
 
 
 import psutil
@@ -69,6 +70,43 @@ class VFSTest(test_lib.GRRBaseTest):
 
     self.TestFileHandling(fd)
 
+  def testReadBuffer(self):
+    """Regular files are read from a memory map if enabled."""
+    original_string = self.GetNumbers()
+
+    path = os.path.join(self.base_path, "morenumbers.txt")
+    fd = vfs.VFSOpen(rdfvalue.PathSpec(path=path,
+                                       pathtype=rdfvalue.PathSpec.PathType.OS))
+
+    # Files are not mapped by default.
+    fd.Seek(90)
+    self.assertEqual(fd.ReadBuffer(10), original_string[90:100])
+
+    with utils.Stubber(vfs, "MAP_FILES", True):
+      self._TestMappedReads(fd)
+
+  def _TestMappedReads(self, fd):
+    original_string = self.GetNumbers()
+
+    fd.Seek(90)
+    data = fd.ReadBuffer(10)
+    self.assertIsInstance(data, buffer)
+    self.assertEqual(str(data), original_string[90:100])
+    self.assertEqual(fd.Tell(), 100)
+
+    # Reads are cut short at the end of the file.
+    fd.Seek(-5, 2)
+    self.assertEqual(str(fd.ReadBuffer(10)), original_string[-5:])
+    self.assertEqual(fd.Tell(), len(original_string))
+    self.assertEqual(fd.ReadBuffer(10), "")
+
+    # Empty files can not be mapped and are read the normal way.
+    path = os.path.join(self.temp_dir, "empty")
+    open(path, "wb").close()
+    fd = vfs.VFSOpen(rdfvalue.PathSpec(path=path,
+                                       pathtype=rdfvalue.PathSpec.PathType.OS))
+    self.assertEqual(fd.ReadBuffer(10), "")
+
   def testOpenFilehandles(self):
     """Test that file handles are cached."""
     current_process = psutil.Process(os.getpid())
@@ -87,6 +125,116 @@ class VFSTest(test_lib.GRRBaseTest):
     # This should not create any new file handles.
     self.assertTrue(len(current_process.open_files()) - num_open_files < 5)
 
+  def testCachedVFSOpen(self):
+    """Handlers are shared by an owner and reopened when the file changes."""
+    path = os.path.join(self.temp_dir, "cached.txt")
+    with open(path, "wb") as fd:
+      fd.write("hello")
+
+    pathspec = rdfvalue.PathSpec(path=path,
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+    fd1 = vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:1")
+    self.assertIs(vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:1"), fd1)
+    self.assertIsNot(vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:2"), fd1)
+    self.assertIsNot(vfs.CachedVFSOpen(pathspec, None), fd1)
+
+    with open(path, "ab") as fd:
+      fd.write(" world")
+
+    fd2 = vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:1")
+    self.assertIsNot(fd2, fd1)
+    self.assertEqual(fd2.Read(100), "hello world")
+    self.assertEqual(vfs.ReadVFS(pathspec, 6, 5, owner="aff4:/flows/W:1"),
+                     "world")
+
+  def testCachedVFSOpenClosesExpiredHandlers(self):
+    path = os.path.join(self.temp_dir, "expired.txt")
+    with open(path, "wb") as fd:
+      fd.write("hello")
+
+    pathspec = rdfvalue.PathSpec(path=path,
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+    fd1 = vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:1")
+
+    closed = []
+    with utils.Stubber(fd1, "Close", lambda: closed.append(fd1)):
+      with test_lib.FakeTime(time.time() + vfs.HANDLE_CACHE.max_age + 1):
+        fd2 = vfs.CachedVFSOpen(pathspec, "aff4:/flows/W:1")
+
+    self.assertIsNot(fd2, fd1)
+    self.assertEqual(closed, [fd1])
+
+  def testComponentCache(self):
+    """Case corrections are cached and dropped when they go stale."""
+    directory = os.path.join(self.temp_dir, "CacheDir")
+    os.mkdir(directory)
+    with open(os.path.join(directory, "File.txt"), "wb") as fd:
+      fd.write("hello")
+
+    pathspec = rdfvalue.PathSpec(path=os.path.join(directory, "file.txt"),
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+    fd = vfs.VFSOpen(pathspec.Copy())
+    self.assertEqual(fd.pathspec.Basename(), "File.txt")
+
+    # A second open is resolved without listing any directory.
+    with utils.Stubber(files.File, "ListNames", None):
+      fd = vfs.VFSOpen(pathspec.Copy())
+      self.assertEqual(fd.pathspec.Basename(), "File.txt")
+
+    # The cached name no longer exists so it is relisted.
+    os.rename(os.path.join(directory, "File.txt"),
+              os.path.join(directory, "FILE.txt"))
+    fd = vfs.VFSOpen(pathspec.Copy())
+    self.assertEqual(fd.pathspec.Basename(), "FILE.txt")
+    self.assertEqual(fd.Read(100), "hello")
+
+  def testIOThrottle(self):
+    """Reads are charged against the client and action budgets."""
+    path = os.path.join(self.base_path, "morenumbers.txt")
+    fd = vfs.VFSOpen(rdfvalue.PathSpec(path=path,
+                                       pathtype=rdfvalue.PathSpec.PathType.OS))
+
+    sleeps = []
+    # Time stands still so the budgets are never refilled.
+    with test_lib.FakeTime(1000):
+      throttle = vfs.IOThrottle(bytes_per_second=100, ops_per_second=1)
+      with utils.Stubber(time, "sleep", sleeps.append):
+        with utils.Stubber(vfs, "CLIENT_IO_THROTTLE",
+                           vfs.IOThrottle(ops_per_second=1)):
+          with vfs.ActionIOThrottle(throttle):
+            # 200 bytes over the action budget.
+            self.assertEqual(len(fd.read(300)), 300)
+            # One read over both budgets and another 50 bytes over.
+            self.assertEqual(len(fd.Read(50)), 50)
+
+          # Outside of the action only the client budget applies.
+          fd.Read(10)
+
+    self.assertEqual(sleeps, [2, 1, 1, 2.5, 2])
+    # The action is also charged the time waited for the client budget.
+    self.assertEqual(throttle.throttled_time, 6.5)
+
+  def testIOThrottleProgress(self):
+    """Readers waiting for a budget keep heartbeating."""
+    path = os.path.join(self.base_path, "morenumbers.txt")
+    fd = vfs.VFSOpen(rdfvalue.PathSpec(path=path,
+                                       pathtype=rdfvalue.PathSpec.PathType.OS))
+
+    progress = []
+    sleeps = []
+    with test_lib.FakeTime(1000):
+      throttle = vfs.IOThrottle(bytes_per_second=100,
+                                progress_callback=lambda: progress.append(1))
+      with utils.Stubber(time, "sleep", sleeps.append):
+        with utils.Stubber(vfs, "CLIENT_IO_THROTTLE",
+                           vfs.IOThrottle(bytes_per_second=100)):
+          with vfs.ActionIOThrottle(throttle):
+            fd.Read(200)
+
+    # One second over each budget, the action heartbeats during both waits.
+    self.assertEqual(sleeps, [1, 1])
+    self.assertEqual(len(progress), 2)
+
   def testOpenFilehandlesExpire(self):
     """Test that file handles expire from cache."""
     files.FILE_HANDLE_CACHE = utils.FastStore(max_size=10)
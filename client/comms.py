@@ -74,6 +74,9 @@ class Status(object):
 
   require_fastpoll = False
 
+  # Seconds taken by the HTTP request.
+  request_time = 0
+
   # Server status code (200 is OK)
   code = 200
 
@@ -816,7 +819,8 @@ class GRRHTTPClient(object):
                             {"Content-Type": "binary/octet-stream"})
       handle = urllib2.urlopen(req)
       data = handle.read()
-      logging.debug("Request took %s Seconds", time.time() - start)
+      status.request_time = time.time() - start
+      logging.debug("Request took %s Seconds", status.request_time)
 
       self.consecutive_connection_errors = 0
 
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""An index of directory listings kept on the client.
+
+Sweeping the same directory trees again stats every file each time. When
+Client.file_index_path is set, listings of OS directories are stored in a
+local SQLite database and used again by requests which allow it.
+
+A listing is only used while the directory has the same inode and
+modification time as when it was listed, so files which were created, removed
+or renamed since are always seen. Changes to the files themselves do not show
+in the modification time of their directory, the age a request allows bounds
+how stale their stat data can be.
+
+The index holds at most Client.file_index_max_entries directories and files,
+the listings which were made the longest time ago are dropped first.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+
+
+import logging
+
+from grr.client import client_utils
+from grr.client import vfs
+from grr.lib import config_lib
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+class FileIndex(object):
+  """A SQLite database of directory listings."""
+
+  # The size of the index is checked every this many new listings.
+  EVICTION_INTERVAL = 100
+
+  def __init__(self, path, max_entries=0):
+    """Constructor.
+
+    Args:
+      path: The path of the SQLite file.
+      max_entries: The maximum number of directories and files in the index,
+        0 for no limit.
+    """
+    self.path = path
+    self.max_entries = max_entries
+    self.puts = 0
+    self.lock = threading.RLock()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    # The index is shared by the threads listing directories, access is
+    # serialized by the lock.
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.connection.executescript("""
+        CREATE TABLE IF NOT EXISTS directories (
+          path TEXT PRIMARY KEY NOT NULL,
+          st_ino INTEGER NOT NULL,
+          st_mtime INTEGER NOT NULL,
+          listed REAL NOT NULL,
+          stat BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS entries (
+          directory TEXT NOT NULL,
+          position INTEGER NOT NULL,
+          stat BLOB NOT NULL,
+          PRIMARY KEY (directory, position));
+        CREATE INDEX IF NOT EXISTS directories_listed
+          ON directories (listed);
+        """)
+
+  def Get(self, path, max_age):
+    """Returns the indexed listing of a directory.
+
+    Args:
+      path: The local path of the directory.
+      max_age: The maximum age of the listing in seconds.
+
+    Returns:
+      A tuple of the StatEntry of the directory and a list of StatEntrys of its
+      contents, or None if there is no usable listing.
+    """
+    with self.lock:
+      row = self.connection.execute(
+          "SELECT st_ino, st_mtime, listed, stat FROM directories "
+          "WHERE path = ?", (path,)).fetchone()
+      if row is None:
+        return None
+
+      st_ino, st_mtime, listed, directory_stat = row
+      try:
+        st = os.stat(path)
+      except OSError:
+        self.Delete(path)
+        return None
+
+      if (time.time() - listed > max_age or
+          st.st_ino != st_ino or int(st.st_mtime) != st_mtime or
+          # Modification times have a resolution of a second, changes made in
+          # the second the directory was listed do not show.
+          st_mtime >= int(listed)):
+        return None
+
+      entries = [rdfvalue.StatEntry(str(stat)) for stat, in
+                 self.connection.execute(
+                     "SELECT stat FROM entries WHERE directory = ? "
+                     "ORDER BY position", (path,))]
+
+    return rdfvalue.StatEntry(str(directory_stat)), entries
+
+  def Put(self, path, directory_stat, entries, listed):
+    """Stores the listing of a directory.
+
+    Args:
+      path: The local path of the directory.
+      directory_stat: The StatEntry of the directory.
+      entries: A list of StatEntrys of its contents.
+      listed: The time the listing was started at.
+    """
+    # The StatEntry truncates inode numbers, keep what Get() compares with.
+    st = os.stat(path)
+    with self.lock:
+      with self.connection:
+        self.connection.execute(
+            "DELETE FROM entries WHERE directory = ?", (path,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+            (path, st.st_ino, int(st.st_mtime), listed,
+             sqlite3.Binary(directory_stat.SerializeToString())))
+        self.connection.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?)",
+            [(path, position, sqlite3.Binary(entry.SerializeToString()))
+             for position, entry in enumerate(entries)])
+
+      self.puts += 1
+      if self.max_entries and self.puts % self.EVICTION_INTERVAL == 0:
+        self.Evict()
+
+  def Evict(self):
+    """Drops the oldest listings while the index holds too many entries.
+
+    A tenth of max_entries is freed on top, so we do not have to evict again
+    right away.
+    """
+    with self.lock:
+      directories, = self.connection.execute(
+          "SELECT COUNT(*) FROM directories").fetchone()
+      files, = self.connection.execute(
+          "SELECT COUNT(*) FROM entries").fetchone()
+
+      excess = directories + files - self.max_entries
+      if excess <= 0:
+        return
+
+      excess += self.max_entries / 10
+      paths = []
+      for path, count in self.connection.execute(
+          "SELECT path, (SELECT COUNT(*) FROM entries WHERE directory = path) "
+          "FROM directories ORDER BY listed"):
+        if excess <= 0:
+          break
+        paths.append(path)
+        excess -= count + 1
+
+      logging.debug("Evicting %d listings from the file index.", len(paths))
+      with self.connection:
+        self.connection.executemany(
+            "DELETE FROM entries WHERE directory = ?", [(p,) for p in paths])
+        self.connection.executemany(
+            "DELETE FROM directories WHERE path = ?", [(p,) for p in paths])
+
+  def Delete(self, path):
+    """Drops the listing of a directory."""
+    with self.lock:
+      with self.connection:
+        self.connection.execute(
+            "DELETE FROM entries WHERE directory = ?", (path,))
+        self.connection.execute(
+            "DELETE FROM directories WHERE path = ?", (path,))
+
+
+INDEX = None
+INDEX_LOCK = threading.Lock()
+
+
+def GetIndex():
+  """Returns the client's FileIndex, None if it is disabled or unusable."""
+  global INDEX  # pylint: disable=global-statement
+
+  path = config_lib.CONFIG["Client.file_index_path"]
+  if not path:
+    return None
+
+  with INDEX_LOCK:
+    if INDEX is None or INDEX.path != path:
+      try:
+        INDEX = FileIndex(
+            path, max_entries=config_lib.CONFIG["Client.file_index_max_entries"])
+      except (sqlite3.Error, OSError) as e:
+        logging.warning("Unable to open the file index %s: %s", path, e)
+        return None
+
+    return INDEX
+
+
+def LocalPath(pathspec):
+  """Returns the local path of an OS directory pathspec or None."""
+  if (len(pathspec) != 1 or
+      pathspec.pathtype != rdfvalue.PathSpec.PathType.OS or
+      pathspec.HasField("offset")):
+    return None
+
+  return client_utils.CanonicalPathToLocalPath(
+      utils.NormalizePath(pathspec.path))
+
+
+def ListDirectory(pathspec, max_age=0, stat_directory=False,
+                  progress_callback=None):
+  """Lists a directory, from the index if the listing is recent enough.
+
+  Args:
+    pathspec: The directory to list.
+    max_age: The maximum age in seconds of a listing from the index. 0 always
+      lists the directory.
+    stat_directory: Also return the StatEntry of the directory. It is always
+      returned for listings from the index.
+    progress_callback: A callback to indicate that the listing is still
+      working but needs more time.
+
+  Returns:
+    A tuple of the StatEntry of the directory, or None, and a list of
+    StatEntrys of its contents.
+
+  Raises:
+    IOError: or OSError if the directory can not be listed.
+  """
+  index = None
+  path = None
+  if max_age:
+    path = LocalPath(pathspec)
+    if path:
+      index = GetIndex()
+
+  if index:
+    try:
+      result = index.Get(path, max_age)
+      if result:
+        return result
+    except sqlite3.Error as e:
+      logging.warning("Unable to read the file index: %s", e)
+      index = None
+
+  listed = time.time()
+  fd = vfs.VFSOpen(pathspec, progress_callback=progress_callback)
+  directory_stat = None
+  if stat_directory or index:
+    directory_stat = fd.Stat()
+  entries = list(fd.ListFiles())
+
+  if index:
+    try:
+      index.Put(path, directory_stat, entries, listed)
+    except (sqlite3.Error, OSError) as e:
+      logging.warning("Unable to update the file index: %s", e)
+
+  return directory_stat, entries
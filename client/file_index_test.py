@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Tests for the client's file index."""
+
+
+import os
+import time
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.client import client_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.client import file_index
+from grr.client import vfs
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class FileIndexTest(test_lib.EmptyActionTest):
+  """Test the file index."""
+
+  def setUp(self):
+    super(FileIndexTest, self).setUp()
+    vfs.VFSInit().Run()
+    config_lib.CONFIG.Set("Client.file_index_path",
+                          os.path.join(self.temp_dir, "index", "index.db"))
+
+    self.directory = os.path.join(self.temp_dir, "directory")
+    os.mkdir(self.directory)
+    for name in ["a", "b"]:
+      open(os.path.join(self.directory, name), "wb").close()
+
+    # Directories modified in the second they are listed are never taken from
+    # the index.
+    os.utime(self.directory, (time.time() - 10, time.time() - 10))
+
+    self.pathspec = rdfvalue.PathSpec(path=self.directory,
+                                      pathtype=rdfvalue.PathSpec.PathType.OS)
+
+  def ListNames(self, max_age):
+    _, entries = file_index.ListDirectory(self.pathspec, max_age=max_age)
+    return sorted(entry.pathspec.Basename() for entry in entries)
+
+  def Listings(self):
+    """Returns a list of VFS opens and a Stubber which records them there."""
+    listings = []
+    original = vfs.VFSOpen
+
+    def VFSOpen(pathspec, **kwargs):
+      listings.append(pathspec)
+      return original(pathspec, **kwargs)
+
+    return listings, utils.Stubber(vfs, "VFSOpen", VFSOpen)
+
+  def testListingsAreIndexed(self):
+    listings, stubber = self.Listings()
+    with stubber:
+      self.assertEqual(self.ListNames(60), ["a", "b"])
+      self.assertEqual(self.ListNames(60), ["a", "b"])
+      self.assertEqual(len(listings), 1)
+
+      # Without an age the directory is always listed.
+      self.assertEqual(self.ListNames(0), ["a", "b"])
+      self.assertEqual(len(listings), 2)
+
+  def testChangedDirectoriesAreListed(self):
+    self.assertEqual(self.ListNames(60), ["a", "b"])
+
+    open(os.path.join(self.directory, "c"), "wb").close()
+    os.utime(self.directory, (time.time() - 5, time.time() - 5))
+    self.assertEqual(self.ListNames(60), ["a", "b", "c"])
+
+  def testOldListingsAreListed(self):
+    listings, stubber = self.Listings()
+    with stubber:
+      self.ListNames(60)
+
+      with test_lib.FakeTime(time.time() + 120):
+        self.ListNames(60)
+
+      self.assertEqual(len(listings), 2)
+
+  def testDisabledIndex(self):
+    config_lib.CONFIG.Set("Client.file_index_path", "")
+
+    listings, stubber = self.Listings()
+    with stubber:
+      self.ListNames(60)
+      self.ListNames(60)
+      self.assertEqual(len(listings), 2)
+
+  def testFindUsesIndex(self):
+    request = rdfvalue.FindSpec(pathspec=self.pathspec, path_regex=".",
+                                index_max_age=60)
+    request.iterator.number = 200
+
+    listings, stubber = self.Listings()
+    with stubber:
+      for _ in range(2):
+        result = self.RunAction("Find", request.Copy())
+        self.assertEqual(
+            sorted(x.hit.pathspec.Basename() for x in result
+                   if isinstance(x, rdfvalue.FindSpec)), ["a", "b"])
+
+      self.assertEqual(len(listings), 1)
+
+  def testOldListingsAreEvicted(self):
+    index = file_index.FileIndex(os.path.join(self.temp_dir, "evict.db"),
+                                 max_entries=10)
+    index.EVICTION_INTERVAL = 1
+
+    paths = []
+    for i in range(5):
+      path = os.path.join(self.temp_dir, "evict%d" % i)
+      os.mkdir(path)
+      paths.append(path)
+      index.Put(path, rdfvalue.StatEntry(),
+                [rdfvalue.StatEntry() for _ in range(3)], 1000 + i)
+
+    # Every listing takes 4 entries, only the two newest fit.
+    self.assertEqual(
+        sorted(path for path, in index.connection.execute(
+            "SELECT path FROM directories")), paths[3:])
+    self.assertEqual(index.connection.execute(
+        "SELECT COUNT(*) FROM entries").fetchone(), (6,))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 # Copyright 2011 Google Inc. All Rights Reserved.
 
-"""This is the GRR client for thread pools."""
+"""This is the GRR client for thread pools.
 
+The pool doubles as a load test: with --load_scenarios every client sends a
+mix of simulated responses to the server and, after --load_duration seconds,
+the client side request statistics, the change in the server metrics read
+from --server_varz and the resource use of --server_pids are reported:
 
+  poolclient --nrclients 1000 --cert_file certs --poll_interval 5 \\
+    --load_scenarios StatEntryBurst:5,FileUpload:1,HuntReply:2 \\
+    --load_duration 600 --server_varz http://localhost:44451/varz \\
+    --load_report report.json
+"""
+
+
+import json
+import os
 import pickle
+import Queue
+import random
 import threading
 import time
+import urllib2
 
 
 import logging
 
+import psutil
+
 from grr.client import client
 
 # pylint: disable=unused-import
@@ -23,7 +41,9 @@ from grr.client import vfs
 from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import registry
 from grr.lib import startup
+from grr.lib import stats
 
 flags.DEFINE_integer("nrclients", 1,
                      "Number of clients to start")
@@ -35,6 +55,38 @@ flags.DEFINE_string("cert_file", "",
 flags.DEFINE_bool("enroll_only", False,
                   "If specified, the script will enroll all clients and exit.")
 
+flags.DEFINE_list("load_scenarios", [],
+                  "Traffic to generate, as a list of Scenario:weight pairs, "
+                  "e.g. StatEntryBurst:5,FileUpload:1,HuntReply:2. Without "
+                  "scenarios the clients only poll.")
+
+flags.DEFINE_float("load_interval", 60,
+                   "Mean number of seconds between traffic bursts of each "
+                   "client.")
+
+flags.DEFINE_float("poll_interval", 0,
+                   "If set, clients poll the frontend every this many "
+                   "seconds instead of using the Client.poll_* settings.")
+
+flags.DEFINE_integer("load_duration", 0,
+                     "Stop the load test after this many seconds and write "
+                     "the report. 0 runs until interrupted.")
+
+flags.DEFINE_string("replay_file", "",
+                    "A serialized MessageList whose payloads the Replay "
+                    "scenario sends.")
+
+flags.DEFINE_list("server_varz", [],
+                  "Stats URLs of the frontends and workers under test, e.g. "
+                  "http://localhost:44451/varz.")
+
+flags.DEFINE_list("server_pids", [],
+                  "Pids of the server processes whose resource use is "
+                  "reported.")
+
+flags.DEFINE_string("load_report", "",
+                    "File to write the load test report to as JSON.")
+
 
 class PoolGRRClient(client.GRRClient, threading.Thread):
   """A GRR client for running in pool mode."""
@@ -48,6 +100,9 @@ class PoolGRRClient(client.GRRClient, threading.Thread):
     # Is this client already enrolled?
     self.enrolled = False
 
+    # The LoadReport which collects the poll results.
+    self.report = None
+
     self.common_name = self.client.communicator.common_name
     self.private_key = self.client.communicator.private_key
 
@@ -57,6 +112,9 @@ class PoolGRRClient(client.GRRClient, threading.Thread):
       if status.code == 200:
         self.enrolled = True
 
+      if self.report:
+        self.report.AddStatus(status)
+
       # Thread should stop now.
       if self.stop:
         break
@@ -68,6 +126,420 @@ class PoolGRRClient(client.GRRClient, threading.Thread):
     self.Run()
 
 
+class Scenario(object):
+  """Traffic a load test client sends to the server.
+
+  Every message is sent to the LoadTestSink well known flow unless the
+  scenario needs a real server side handler. The payloads are stamped with
+  their creation time so the sink can measure the queue latency.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  session_id = rdfvalue.SessionID("aff4:/flows/W:LoadTest")
+  priority = rdfvalue.GrrMessage.Priority.MEDIUM_PRIORITY
+
+  def Generate(self, worker):
+    """Queues the messages of one burst on the client worker.
+
+    Args:
+      worker: The GRRClientWorker of the client.
+
+    Returns:
+      The number of messages queued.
+    """
+    count = 0
+    for message_type, rdf_value in self.Messages():
+      worker.SendReply(rdf_value, session_id=self.session_id,
+                       message_type=message_type, priority=self.priority,
+                       require_fastpoll=False, blocking=False)
+      count += 1
+    return count
+
+  def Messages(self):
+    """Yields (message type, payload) tuples for one burst."""
+    raise NotImplementedError()
+
+  @staticmethod
+  def Now():
+    return rdfvalue.RDFDatetime().Now()
+
+
+class StatEntryBurst(Scenario):
+  """A directory listing."""
+
+  entries = 100
+
+  def Messages(self):
+    now = self.Now()
+    for i in range(self.entries):
+      yield (rdfvalue.GrrMessage.Type.MESSAGE,
+             rdfvalue.StatEntry(
+                 pathspec=rdfvalue.PathSpec(
+                     path="/usr/lib/loadtest/file%d" % i,
+                     pathtype=rdfvalue.PathSpec.PathType.OS),
+                 st_mode=0100644, st_size=random.randint(0, 1 << 20),
+                 st_mtime=now, st_atime=now, st_ctime=now, age=now))
+
+
+class FileUpload(Scenario):
+  """A file upload, sent as blobs to the TransferStore flow."""
+
+  session_id = rdfvalue.SessionID("aff4:/flows/W:TransferStore")
+  chunks = 10
+  chunk_size = 512 * 1024
+
+  def Messages(self):
+    for _ in range(self.chunks):
+      yield (rdfvalue.GrrMessage.Type.MESSAGE,
+             rdfvalue.DataBlob(
+                 data=os.urandom(self.chunk_size),
+                 compression=rdfvalue.DataBlob.CompressionType.UNCOMPRESSED,
+                 age=self.Now()))
+
+
+class HuntReply(Scenario):
+  """The replies of a hunt: a few results followed by a status."""
+
+  priority = rdfvalue.GrrMessage.Priority.LOW_PRIORITY
+  results = 5
+
+  def Messages(self):
+    for i in range(self.results):
+      yield (rdfvalue.GrrMessage.Type.MESSAGE,
+             rdfvalue.BufferReference(
+                 offset=i * 1024, length=1024, data=os.urandom(64),
+                 age=self.Now()))
+
+    yield (rdfvalue.GrrMessage.Type.STATUS,
+           rdfvalue.GrrStatus(status=rdfvalue.GrrStatus.ReturnedStatus.OK,
+                              age=self.Now()))
+
+
+class Replay(Scenario):
+  """Resends the payloads of the messages in --replay_file."""
+
+  recorded = None
+
+  def Messages(self):
+    if Replay.recorded is None:
+      with open(flags.FLAGS.replay_file, "rb") as fd:
+        Replay.recorded = list(rdfvalue.MessageList(fd.read()).job)
+
+    for message in self.recorded:
+      cls = rdfvalue.RDFValue.classes.get(message.args_rdf_name)
+      if cls is not None:
+        yield message.type, cls(message.args, age=self.Now())
+
+
+def ParseScenarios(specs):
+  """Parses Scenario:weight pairs into a list of (weight, Scenario()).
+
+  Args:
+    specs: A list of strings like "StatEntryBurst:5". The weight defaults to 1.
+
+  Returns:
+    A list of (weight, Scenario instance) tuples.
+
+  Raises:
+    ValueError: If a scenario is unknown or a weight is not a positive number.
+  """
+  scenarios = []
+  for spec in specs:
+    name, _, weight = spec.strip().partition(":")
+    try:
+      scenario_cls = Scenario.classes[name]
+    except KeyError:
+      raise ValueError("Unknown load scenario %s" % name)
+
+    try:
+      weight = float(weight or 1)
+    except ValueError:
+      raise ValueError("Invalid weight in load scenario %s" % spec)
+
+    if not weight > 0:
+      raise ValueError("Invalid weight in load scenario %s" % spec)
+
+    scenarios.append((weight, scenario_cls()))
+
+  return scenarios
+
+
+class LoadReport(object):
+  """Collects the results of the clients' polls."""
+
+  # Number of request times kept to compute the percentiles.
+  max_samples = 100000
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.requests = 0
+    self.errors = 0
+    self.messages_sent = 0
+    self.messages_received = 0
+    self.bytes_sent = 0
+    self.messages_generated = 0
+    self.messages_dropped = 0
+    self.request_times = []
+
+  def AddStatus(self, status):
+    if status.code == 200 and not status.request_time:
+      # No request was made, e.g. while looking for a working server url.
+      return
+
+    with self.lock:
+      self.requests += 1
+      if status.code != 200:
+        self.errors += 1
+        return
+
+      self.messages_sent += status.sent_count
+      self.messages_received += status.received_count
+      self.bytes_sent += status.sent_len
+
+      # Reservoir sampling keeps the percentiles unbiased on long runs.
+      if len(self.request_times) < self.max_samples:
+        self.request_times.append(status.request_time)
+      else:
+        index = random.randint(0, self.requests - 1)
+        if index < self.max_samples:
+          self.request_times[index] = status.request_time
+
+  def AddGenerated(self, generated=0, dropped=0):
+    with self.lock:
+      self.messages_generated += generated
+      self.messages_dropped += dropped
+
+  def Results(self):
+    """Returns the client side results as a dict."""
+    with self.lock:
+      elapsed = time.time() - self.start_time
+      times = sorted(self.request_times)
+
+      def Percentile(fraction):
+        if not times:
+          return 0
+        return times[int(round(fraction * (len(times) - 1)))] * 1e3
+
+      return dict(
+          seconds=elapsed,
+          requests=self.requests,
+          requests_per_second=self.requests / elapsed if elapsed else 0,
+          errors=self.errors,
+          messages_generated=self.messages_generated,
+          messages_dropped=self.messages_dropped,
+          messages_sent=self.messages_sent,
+          messages_received=self.messages_received,
+          bytes_sent=self.bytes_sent,
+          request_time_ms=dict(p50=Percentile(0.5), p90=Percentile(0.9),
+                               p99=Percentile(0.99), max=Percentile(1.0)))
+
+
+class LoadGenerator(threading.Thread):
+  """Makes the pool clients send the scenarios' traffic.
+
+  Each client starts a burst on average every --load_interval seconds. The
+  scenario of each burst is picked at random by weight.
+  """
+
+  def __init__(self, clients, scenarios, interval, report):
+    super(LoadGenerator, self).__init__(name="LoadGenerator")
+    self.daemon = True
+    self.clients = clients
+    self.scenarios = scenarios
+    self.interval = interval
+    self.report = report
+    self.stop = False
+
+  def Pick(self):
+    point = random.uniform(0, sum(weight for weight, _ in self.scenarios))
+    for weight, scenario in self.scenarios:
+      point -= weight
+      if point <= 0:
+        return scenario
+    return self.scenarios[-1][1]
+
+  def run(self):
+    # Spread the first bursts out so the clients don't send in lock step.
+    now = time.time()
+    due = [now + random.uniform(0, self.interval) for _ in self.clients]
+
+    while not self.stop:
+      now = time.time()
+      for i, pool_client in enumerate(self.clients):
+        if due[i] > now or not pool_client.enrolled:
+          continue
+
+        due[i] = now + random.expovariate(1.0 / self.interval)
+        try:
+          self.report.AddGenerated(
+              generated=self.Pick().Generate(pool_client.client.client_worker))
+        except Queue.Full:
+          self.report.AddGenerated(dropped=1)
+
+      time.sleep(0.1)
+
+  def Stop(self):
+    self.stop = True
+
+
+def ReadVarz(url):
+  """Returns the metrics exported by a GRR stats server."""
+  try:
+    return json.loads(urllib2.urlopen(url, timeout=10).read())
+  except (urllib2.URLError, IOError, ValueError) as e:
+    logging.warning("Unable to read stats from %s: %s", url, e)
+    return {}
+
+
+def _EventDelta(before, after):
+  count = after["counter"] - (before or {}).get("counter", 0)
+  total = after["sum"] - (before or {}).get("sum", 0)
+  return dict(count=count, mean=float(total) / count if count else 0)
+
+
+def VarzDelta(before, after, elapsed):
+  """Summarizes how the server metrics changed during the load test.
+
+  Args:
+    before: The metrics read at the start of the test.
+    after: The metrics read at the end of the test.
+    elapsed: The duration of the test in seconds.
+
+  Returns:
+    A dict of counter rates, event counts and means and gauge values. Metrics
+    which did not change or can not be read are left out.
+  """
+  results = {}
+  for name, metric in after.iteritems():
+    try:
+      delta = _MetricDelta(metric, before.get(name, {}).get("value"), elapsed)
+    except (KeyError, TypeError, AttributeError) as e:
+      logging.warning("Unable to compare metric %s: %s", name, e)
+      continue
+
+    if delta:
+      results[name] = delta
+
+  return results
+
+
+def _MetricDelta(metric, old_value, elapsed):
+  """Returns how a single metric changed, see VarzDelta()."""
+  metric_type = metric["info"]["metric_type"]
+  value = metric["value"]
+  fielded = "fields_defs" in metric["info"]
+
+  if metric_type == int(stats.MetricType.COUNTER):
+    if fielded:
+      delta = dict((field, v - (old_value or {}).get(field, 0))
+                   for field, v in value.iteritems())
+      return dict((field, dict(count=v, rate=float(v) / elapsed))
+                  for field, v in delta.iteritems() if v)
+
+    delta = value - (old_value or 0)
+    return delta and dict(count=delta, rate=float(delta) / elapsed)
+
+  if metric_type == int(stats.MetricType.EVENT):
+    if fielded:
+      delta = dict((field, _EventDelta((old_value or {}).get(field), v))
+                   for field, v in value.iteritems())
+      return dict((field, v) for field, v in delta.iteritems() if v["count"])
+
+    delta = _EventDelta(old_value, value)
+    return delta["count"] and delta
+
+  return value
+
+
+class ServerResources(object):
+  """Measures the CPU and memory used by the server processes."""
+
+  def __init__(self, pids):
+    self.processes = {}
+    for pid in pids:
+      try:
+        self.processes[int(pid)] = psutil.Process(int(pid))
+      except (psutil.Error, ValueError) as e:
+        logging.warning("Can not monitor process %s: %s", pid, e)
+
+    self.cpu_start = self._CPUTimes()
+
+  def _CPUTimes(self):
+    results = {}
+    for pid, process in self.processes.iteritems():
+      try:
+        user, system = process.cpu_times()
+        results[pid] = user + system
+      except psutil.Error:
+        pass
+    return results
+
+  def Results(self, elapsed):
+    results = {}
+    for pid, cpu_time in self._CPUTimes().iteritems():
+      try:
+        rss, _ = self.processes[pid].memory_info()
+      except psutil.Error:
+        continue
+
+      used = cpu_time - self.cpu_start.get(pid, 0)
+      results[pid] = dict(cpu_seconds=used,
+                          cpu_percent=used / elapsed * 100 if elapsed else 0,
+                          rss_mb=rss / 1024 / 1024)
+    return results
+
+
+def RunLoadTest(clients):
+  """Runs the load test on the started clients and reports the results."""
+  report = LoadReport()
+  for pool_client in clients:
+    pool_client.report = report
+
+  generator = None
+  if flags.FLAGS.load_scenarios:
+    generator = LoadGenerator(clients,
+                              ParseScenarios(flags.FLAGS.load_scenarios),
+                              flags.FLAGS.load_interval, report)
+    generator.start()
+
+  varz_before = dict((url, ReadVarz(url)) for url in flags.FLAGS.server_varz)
+  resources = ServerResources(flags.FLAGS.server_pids)
+
+  try:
+    deadline = time.time() + flags.FLAGS.load_duration
+    while not flags.FLAGS.load_duration or time.time() < deadline:
+      time.sleep(10)
+      results = report.Results()
+      logging.info("%d requests (%.1f/s), %d errors, %d messages sent, "
+                   "p50 request time %.1fms.", results["requests"],
+                   results["requests_per_second"], results["errors"],
+                   results["messages_sent"],
+                   results["request_time_ms"]["p50"])
+  except KeyboardInterrupt:
+    pass
+
+  finally:
+    if generator:
+      generator.Stop()
+
+  results = report.Results()
+  results["clients"] = len(clients)
+  results["scenarios"] = flags.FLAGS.load_scenarios
+  results["servers"] = dict(
+      (url, VarzDelta(varz_before[url], ReadVarz(url), results["seconds"]))
+      for url in flags.FLAGS.server_varz)
+  results["server_resources"] = resources.Results(results["seconds"])
+
+  if flags.FLAGS.load_report:
+    with open(flags.FLAGS.load_report, "wb") as fd:
+      json.dump(results, fd, indent=2, sort_keys=True)
+    logging.info("Load test report written to %s", flags.FLAGS.load_report)
+
+  return results
+
+
 def CreateClientPool(n):
   """Create n clients to run in a pool."""
   clients = []
@@ -113,11 +585,7 @@ def CreateClientPool(n):
           logging.info("%s: Enrolled %d/%d clients.", int(time.time()),
                        enrolled, n)
     else:
-      try:
-        while True:
-          time.sleep(100)
-      except KeyboardInterrupt:
-        pass
+      RunLoadTest(clients)
 
   finally:
     # Stop all pool clients.
@@ -162,6 +630,10 @@ def main(unused_argv):
 
   CheckLocation()
 
+  if flags.FLAGS.poll_interval:
+    config_lib.CONFIG.Set("Client.poll_min", flags.FLAGS.poll_interval)
+    config_lib.CONFIG.Set("Client.poll_max", flags.FLAGS.poll_interval)
+
   # Let the OS handler also handle sleuthkit requests since sleuthkit is not
   # thread safe.
   tsk = rdfvalue.PathSpec.PathType.TSK
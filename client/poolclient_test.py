@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Tests for the load test parts of the client pool."""
+
+
+
+from grr.client import comms
+from grr.client import poolclient
+from grr.lib import flags
+from grr.lib import stats
+from grr.lib import test_lib
+
+
+COUNTER = int(stats.MetricType.COUNTER)
+EVENT = int(stats.MetricType.EVENT)
+GAUGE = int(stats.MetricType.GAUGE)
+
+
+def Metric(metric_type, value, fields=False):
+  info = dict(metric_type=metric_type)
+  if fields:
+    info["fields_defs"] = [["name", "str"]]
+  return dict(info=info, value=value)
+
+
+class ParseScenariosTest(test_lib.GRRBaseTest):
+  """Tests the parsing of --load_scenarios."""
+
+  def testParseScenarios(self):
+    scenarios = poolclient.ParseScenarios(
+        ["StatEntryBurst:5", "FileUpload", " HuntReply:0.5"])
+
+    self.assertEqual([weight for weight, _ in scenarios], [5, 1, 0.5])
+    self.assertEqual([type(s) for _, s in scenarios],
+                     [poolclient.StatEntryBurst, poolclient.FileUpload,
+                      poolclient.HuntReply])
+
+  def testMalformedScenarios(self):
+    for spec in ["NoSuchScenario:1", "StatEntryBurst:many", "StatEntryBurst:0",
+                 "StatEntryBurst:-1", "StatEntryBurst:nan", ":1", ""]:
+      self.assertRaises(ValueError, poolclient.ParseScenarios, [spec])
+
+
+class VarzDeltaTest(test_lib.GRRBaseTest):
+  """Tests how the changes of the server metrics are summarized."""
+
+  def testCounters(self):
+    before = dict(requests=Metric(COUNTER, 100),
+                  idle=Metric(COUNTER, 7),
+                  by_flow=Metric(COUNTER, dict(a=1, b=2), fields=True))
+    after = dict(requests=Metric(COUNTER, 150),
+                 idle=Metric(COUNTER, 7),
+                 by_flow=Metric(COUNTER, dict(a=1, b=12, c=5), fields=True),
+                 new=Metric(COUNTER, 20))
+
+    self.assertEqual(poolclient.VarzDelta(before, after, 10), dict(
+        requests=dict(count=50, rate=5.0),
+        by_flow=dict(b=dict(count=10, rate=1.0), c=dict(count=5, rate=0.5)),
+        new=dict(count=20, rate=2.0)))
+
+  def testEvents(self):
+    before = dict(latency=Metric(EVENT, dict(counter=10, sum=5.0)),
+                  by_flow=Metric(EVENT, dict(a=dict(counter=1, sum=1)),
+                                 fields=True))
+    after = dict(latency=Metric(EVENT, dict(counter=14, sum=7.0)),
+                 by_flow=Metric(EVENT, dict(a=dict(counter=1, sum=1),
+                                            b=dict(counter=2, sum=3)),
+                                fields=True))
+
+    self.assertEqual(poolclient.VarzDelta(before, after, 10), dict(
+        latency=dict(count=4, mean=0.5),
+        by_flow=dict(b=dict(count=2, mean=1.5))))
+
+    # Unchanged events are left out.
+    self.assertEqual(poolclient.VarzDelta(after, after, 10), {})
+
+  def testGauges(self):
+    after = dict(threads=Metric(GAUGE, 12), empty=Metric(GAUGE, 0))
+    self.assertEqual(poolclient.VarzDelta({}, after, 10), dict(threads=12))
+
+  def testMalformedMetrics(self):
+    before = dict(requests=Metric(COUNTER, "garbage"))
+    after = dict(requests=Metric(COUNTER, 150),
+                 no_info=dict(value=3),
+                 no_value=dict(info=dict(metric_type=COUNTER)),
+                 no_sum=Metric(EVENT, dict(counter=3)),
+                 good=Metric(COUNTER, 10))
+
+    # Metrics which can not be compared are skipped.
+    self.assertEqual(poolclient.VarzDelta(before, after, 10),
+                     dict(good=dict(count=10, rate=1.0)))
+
+
+class LoadReportTest(test_lib.GRRBaseTest):
+  """Tests the client side results of a load test."""
+
+  def testResults(self):
+    report = poolclient.LoadReport()
+    for i in range(1, 101):
+      report.AddStatus(comms.Status(request_time=i / 1000.0, sent_count=2,
+                                    received_count=1, sent_len=100))
+    report.AddStatus(comms.Status(code=500, request_time=1))
+    # No request was made.
+    report.AddStatus(comms.Status())
+    report.AddGenerated(generated=10, dropped=3)
+
+    results = report.Results()
+    self.assertEqual(results["requests"], 101)
+    self.assertEqual(results["errors"], 1)
+    self.assertEqual(results["messages_sent"], 200)
+    self.assertEqual(results["messages_received"], 100)
+    self.assertEqual(results["bytes_sent"], 10000)
+    self.assertEqual(results["messages_generated"], 10)
+    self.assertEqual(results["messages_dropped"], 3)
+    self.assertAlmostEqual(results["request_time_ms"]["p50"], 51)
+    self.assertAlmostEqual(results["request_time_ms"]["max"], 100)
+
+  def testSampling(self):
+    report = poolclient.LoadReport()
+    report.max_samples = 10
+    for i in range(1, 1001):
+      report.AddStatus(comms.Status(request_time=i))
+
+    self.assertEqual(report.requests, 1000)
+    self.assertEqual(len(report.request_times), 10)
+
+  def testEmptyResults(self):
+    results = poolclient.LoadReport().Results()
+    self.assertEqual(results["requests"], 0)
+    self.assertEqual(results["request_time_ms"]["p99"], 0)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
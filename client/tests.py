@@ -9,6 +9,8 @@ This module loads and registers all the GRR library tests.
 from grr.client import client_test
 from grr.client import client_utils_test
 from grr.client import client_vfs_test
+from grr.client import file_index_test
+from grr.client import poolclient_test
 from grr.client.client_actions import action_test
 from grr.client.osx import objc_test
 from grr.client.vfs_handlers import memory_test
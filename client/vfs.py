@@ -2,7 +2,12 @@
 """This file implements a VFS abstraction on the client."""
 
 
+import functools
+import threading
+
+
 from grr.client import client_utils
+from grr.lib import config_lib
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import utils
@@ -13,6 +18,145 @@ from grr.lib import utils
 DEVICE_CACHE = utils.TimeBasedCache()
 
 
+class VFSHandleCache(utils.TimeBasedCache):
+  """A cache of opened VFS handlers.
+
+  Opening a pathspec resolves and case corrects every path component. Actions
+  which read a file one chunk at a time reuse the handler opened for the
+  previous chunk instead.
+  """
+
+  def KillObject(self, obj):
+    # FastStore expires the stored [timestamp, entry] pairs, the house keeper
+    # passes just the entry.
+    if isinstance(obj, list):
+      obj = obj[1]
+
+    fd, _ = obj
+    fd.Close()
+
+
+# Open handlers keyed by owner and requested pathspec.
+HANDLE_CACHE = VFSHandleCache(max_size=20, max_age=60)
+
+# Case corrected path components keyed by the parent's pathspec and the
+# requested name, and directory listings keyed by the directory's pathspec.
+COMPONENT_CACHE = utils.TimeBasedCache(max_size=10000, max_age=30)
+LISTING_CACHE = utils.TimeBasedCache(max_size=100, max_age=30)
+
+
+# Should handlers read files from memory maps? See Client.map_files.
+MAP_FILES = False
+
+
+class IOThrottle(object):
+  """Limits the bytes and the number of reads per second through the VFS."""
+
+  def __init__(self, bytes_per_second=0, ops_per_second=0,
+               progress_callback=None):
+    """Constructor.
+
+    Args:
+      bytes_per_second: The number of bytes which can be read per second, 0
+        for no limit.
+      ops_per_second: The number of reads per second, 0 for no limit.
+      progress_callback: Called regularly while readers sleep, e.g. an
+        action's Progress() so the nanny does not kill the client while it
+        is throttled.
+    """
+    self.bytes_bucket = utils.TokenBucket(bytes_per_second)
+    self.ops_bucket = utils.TokenBucket(ops_per_second)
+    self.progress_callback = progress_callback
+    # Total number of seconds readers waited for this throttle.
+    self.throttled_time = 0
+
+  def Charge(self, length, waited=0, progress_callback=None):
+    """Charges a read of length bytes, sleeping if we are over budget.
+
+    Args:
+      length: The number of bytes read.
+      waited: Seconds the reader already waited for other budgets, which are
+        counted in our throttled_time.
+      progress_callback: Called while sleeping, defaults to our own.
+
+    Returns:
+      The number of seconds we slept.
+    """
+    progress_callback = progress_callback or self.progress_callback
+    sleep = (self.ops_bucket.Consume(1, progress_callback=progress_callback) +
+             self.bytes_bucket.Consume(length,
+                                       progress_callback=progress_callback))
+    self.throttled_time += sleep + waited
+    return sleep
+
+
+# The budget shared by all client actions, set up by VFSInit.
+CLIENT_IO_THROTTLE = IOThrottle()
+
+# The budget of the client action running in this thread and whether we are
+# inside a read already.
+_IO_STATE = threading.local()
+
+
+class ActionIOThrottle(object):
+  """Applies an I/O budget to all VFS reads of the current thread.
+
+  The time spent waiting for the client wide budget is also counted in the
+  throttled_time of the budget.
+  """
+
+  def __init__(self, throttle):
+    self.throttle = throttle
+
+  def __enter__(self):
+    self.previous = getattr(_IO_STATE, "throttle", None)
+    _IO_STATE.throttle = self.throttle
+    return self.throttle
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    _IO_STATE.throttle = self.previous
+
+
+def _ThrottledRead(read):
+  """Wraps a VFSHandler.Read() method to charge the I/O budgets."""
+
+  @functools.wraps(read)
+  def Read(self, length):
+    # Handlers reading from their base_fd, or from themselves, are only
+    # charged once for the outermost read.
+    if getattr(_IO_STATE, "reading", False):
+      return read(self, length)
+
+    _IO_STATE.reading = True
+    try:
+      data = read(self, length)
+    finally:
+      _IO_STATE.reading = False
+
+    # The action we read for keeps heartbeating while it waits for the client
+    # wide budget.
+    throttle = getattr(_IO_STATE, "throttle", None)
+    waited = CLIENT_IO_THROTTLE.Charge(
+        len(data),
+        progress_callback=getattr(throttle, "progress_callback", None))
+    if throttle is not None:
+      throttle.Charge(len(data), waited=waited)
+
+    return data
+
+  return Read
+
+
+class VFSHandlerMetaclass(registry.MetaclassRegistry):
+  """Applies the I/O budgets to the read methods of every handler."""
+
+  def __init__(cls, name, bases, env_dict):
+    super(VFSHandlerMetaclass, cls).__init__(name, bases, env_dict)
+    for method in ["Read", "ReadBuffer"]:
+      if method in env_dict:
+        setattr(cls, method, _ThrottledRead(env_dict[method]))
+
+
 class VFSHandler(object):
   """Base class for handling objects in the VFS."""
   supported_pathtype = -1
@@ -32,7 +176,7 @@ class VFSHandler(object):
   pathspec = None
   base_fd = None
 
-  __metaclass__ = registry.MetaclassRegistry
+  __metaclass__ = VFSHandlerMetaclass
 
   def __init__(self, base_fd, pathspec=None, progress_callback=None):
     """Constructor.
@@ -79,6 +223,21 @@ class VFSHandler(object):
     """Reads some data from the file."""
     raise NotImplementedError
 
+  def ReadBuffer(self, length):
+    """Reads some data from the file without copying it where possible.
+
+    Handlers which can map their file return read-only buffer objects
+    referencing the mapping. These can be passed to hashlib, zlib and re in
+    place of a string but have no string methods, use str() to get a copy.
+
+    Args:
+      length: The number of bytes to read.
+
+    Returns:
+      A buffer or a string.
+    """
+    return self.Read(length)
+
   def Stat(self):
     """Returns a StatResponse proto about this file."""
     raise NotImplementedError
@@ -118,10 +277,21 @@ class VFSHandler(object):
     Returns:
       the best component name.
     """
+    key = (self.pathspec.SerializeToString(), component)
+    try:
+      return COMPONENT_CACHE.Get(key).Copy()
+    except KeyError:
+      pass
+
     fd = self.OpenAsContainer()
 
     # Adjust the component casing
-    file_listing = set(fd.ListNames())
+    listing_key = (fd.pathspec.SerializeToString(), fd.supported_pathtype)
+    try:
+      file_listing = LISTING_CACHE.Get(listing_key)
+    except KeyError:
+      file_listing = set(fd.ListNames())
+      LISTING_CACHE.Put(listing_key, file_listing)
 
     # First try an exact match
     if component not in file_listing:
@@ -134,9 +304,24 @@ class VFSHandler(object):
 
     new_pathspec = rdfvalue.PathSpec(path=component,
                                      pathtype=fd.supported_pathtype)
+    COMPONENT_CACHE.Put(key, new_pathspec.Copy())
 
     return new_pathspec
 
+  def ForgetComponentName(self, component):
+    """Drops the cached match for component and our cached listing.
+
+    Args:
+      component: A component name passed to MatchBestComponentName().
+
+    Returns:
+      True if a cached match was dropped.
+    """
+    LISTING_CACHE.ExpireObject((self.pathspec.SerializeToString(),
+                                self.supported_pathtype))
+    key = (self.pathspec.SerializeToString(), component)
+    return COMPONENT_CACHE.ExpireObject(key) is not None
+
   def ListFiles(self):
     """An iterator over all VFS files contained in this directory.
 
@@ -153,6 +338,7 @@ class VFSHandler(object):
   # These are file object conformant namings for library functions that
   # grr uses, and that expect to interact with 'real' file objects.
   read = utils.Proxy("Read")
+  read_buffer = utils.Proxy("ReadBuffer")
   seek = utils.Proxy("Seek")
   stat = utils.Proxy("Stat")
   tell = utils.Proxy("Tell")
@@ -196,21 +382,18 @@ class VFSHandler(object):
     path_components = ["/"] + filter(None, path_components.split("/"))
     for i, path_component in enumerate(path_components):
       try:
-        if fd:
-          new_pathspec = fd.MatchBestComponentName(path_component)
-        else:
-          new_pathspec = component
-          new_pathspec.path = path_component
-
-        # The handler for this component
         try:
-          handler = VFS_HANDLERS[new_pathspec.pathtype]
-        except KeyError:
-          raise IOError(
-              "VFS handler %d not supported." % new_pathspec.pathtype)
+          new_fd = _OpenComponent(fd, component, path_component,
+                                  progress_callback)
+        except IOError:
+          # The cached case correction may be stale, try a fresh listing.
+          if not (fd and fd.ForgetComponentName(path_component)):
+            raise
+
+          new_fd = _OpenComponent(fd, component, path_component,
+                                  progress_callback)
 
-        fd = handler(base_fd=fd, pathspec=new_pathspec,
-                     progress_callback=progress_callback)
+        fd = new_fd
       except IOError:
         # Can not open the first component, we must raise here.
         if i <= 1:
@@ -227,6 +410,25 @@ class VFSHandler(object):
     return self.metadata
 
 
+def _OpenComponent(fd, component, path_component, progress_callback):
+  """Opens the case corrected path_component below fd."""
+  if fd:
+    new_pathspec = fd.MatchBestComponentName(path_component)
+  else:
+    new_pathspec = component
+    new_pathspec.path = path_component
+
+  # The handler for this component
+  try:
+    handler = VFS_HANDLERS[new_pathspec.pathtype]
+  except KeyError:
+    raise IOError(
+        "VFS handler %d not supported." % new_pathspec.pathtype)
+
+  return handler(base_fd=fd, pathspec=new_pathspec,
+                 progress_callback=progress_callback)
+
+
 # A registry of all VFSHandler registered
 VFS_HANDLERS = {}
 
@@ -239,6 +441,14 @@ class VFSInit(registry.InitHook):
       if handler.auto_register:
         VFS_HANDLERS[handler.supported_pathtype] = handler
 
+    global CLIENT_IO_THROTTLE  # pylint: disable=global-statement
+    CLIENT_IO_THROTTLE = IOThrottle(
+        bytes_per_second=config_lib.CONFIG["Client.io_bytes_per_second"],
+        ops_per_second=config_lib.CONFIG["Client.io_ops_per_second"])
+
+    global MAP_FILES  # pylint: disable=global-statement
+    MAP_FILES = config_lib.CONFIG["Client.map_files"]
+
 
 def VFSOpen(pathspec, progress_callback=None):
   """Expands pathspec to return an expanded Path.
@@ -328,7 +538,67 @@ def VFSOpen(pathspec, progress_callback=None):
   return fd
 
 
-def ReadVFS(pathspec, offset, length, progress_callback=None):
+def _FileSignature(fd):
+  """Returns a value which changes when the file behind fd changes."""
+  try:
+    stat = fd.Stat()
+  except (IOError, OSError, NotImplementedError):
+    return None
+
+  return stat.st_size, stat.st_mtime
+
+
+def CachedVFSOpen(pathspec, owner, progress_callback=None):
+  """Opens a pathspec, reusing the handler of an earlier call by owner.
+
+  Handlers are kept in HANDLE_CACHE for a short while and are reopened if the
+  size or modification time of the file changed. The client runs one action at
+  a time so a handler is never used concurrently.
+
+  Args:
+    pathspec: The pathspec to open.
+    owner: The user of the handler, usually the session id of a flow. Only
+           calls with the same owner share handlers. If None, the handler is
+           not cached.
+    progress_callback: A callback to indicate that the open call is still
+                       working but needs more time.
+
+  Returns:
+    The open filelike object, as returned by VFSOpen().
+
+  Raises:
+    IOError: if one of the path components can not be opened.
+  """
+  if owner is None:
+    return VFSOpen(pathspec, progress_callback=progress_callback)
+
+  key = (utils.SmartStr(owner), pathspec.SerializeToString())
+  try:
+    fd, signature = HANDLE_CACHE.Get(key)
+  except KeyError:
+    # An expired handler is still in the cache, close it before it is
+    # replaced.
+    HANDLE_CACHE.ExpireObject(key)
+    fd = None
+  else:
+    if _FileSignature(fd) != signature:
+      HANDLE_CACHE.ExpireObject(key)
+      fd = None
+
+  if fd is None:
+    fd = VFSOpen(pathspec, progress_callback=progress_callback)
+    HANDLE_CACHE.Put(key, (fd, _FileSignature(fd)))
+  else:
+    # The handler chain still reports progress to the previous action.
+    handler = fd
+    while handler is not None:
+      handler.progress_callback = progress_callback
+      handler = handler.base_fd
+
+  return fd
+
+
+def ReadVFS(pathspec, offset, length, progress_callback=None, owner=None):
   """Read from the VFS and return the contents.
 
   Args:
@@ -337,10 +607,12 @@ def ReadVFS(pathspec, offset, length, progress_callback=None):
     length: number of bytes to read
     progress_callback: A callback to indicate that the open call is still
                        working but needs more time.
+    owner: If set, the handler is cached for further reads by this owner. See
+           CachedVFSOpen().
 
   Returns:
     VFS file contents
   """
-  fd = VFSOpen(pathspec, progress_callback=progress_callback)
+  fd = CachedVFSOpen(pathspec, owner, progress_callback=progress_callback)
   fd.Seek(offset)
   return fd.Read(length)
@@ -3,9 +3,11 @@
 """Implements VFSHandlers for files on the client."""
 
 import logging
+import mmap
 import os
 import platform
 import re
+import stat
 import sys
 import threading
 
@@ -26,6 +28,7 @@ class LockedFileHandle(object):
     self.lock = threading.RLock()
     self.fd = open(filename, "rb")
     self.filename = filename
+    self.mapped = None
 
   def Seek(self, offset, whence=0):
     self.fd.seek(offset, whence)
@@ -36,9 +39,40 @@ class LockedFileHandle(object):
   def Tell(self):
     return self.fd.tell()
 
+  def Map(self):
+    """Returns a read-only memory map of the file, or None.
+
+    Only non empty regular files are mapped. Devices, pipes and files the
+    OS refuses to map (e.g. files locked by another process on Windows) are
+    read the normal way.
+    """
+    if self.mapped is False:
+      return None
+
+    try:
+      st = os.fstat(self.fd.fileno())
+      if not stat.S_ISREG(st.st_mode):
+        self.mapped = False
+        return None
+
+      # Touching a mapping past the end of a file which was truncated kills
+      # the process, so files which changed size are mapped again.
+      if self.mapped is None or len(self.mapped) != st.st_size:
+        self.mapped = None
+        self.mapped = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    except (EnvironmentError, OverflowError, ValueError) as e:
+      logging.debug("Unable to map %s: %s", self.filename, e)
+      return None
+
+    return self.mapped
+
   def Close(self):
     with self.lock:
       self.fd.close()
+      # The mapping holds its own reference to the file, it is closed once
+      # the last buffer referencing it is gone.
+      self.mapped = None
 
 
 class FileHandleManager(object):
@@ -226,6 +260,24 @@ class File(vfs.VFSHandler):
 
       return data[pre_padding:]
 
+  def ReadBuffer(self, length):
+    """Reads from a memory map of the file if mapping is enabled."""
+    if not vfs.MAP_FILES or self.alignment != 1:
+      return self.Read(length)
+
+    with FileHandleManager(self.filename) as fd:
+      mapped = fd.Map()
+      offset = self.file_offset + self.offset
+
+      # The file may have grown since it was mapped.
+      if mapped is None or offset >= len(mapped):
+        return self.Read(length)
+
+      data = buffer(mapped, offset, length)
+      self.offset += len(data)
+
+      return data
+
   def Stat(self, path=None):
     """Returns stat information of a specific path.
 
@@ -27,3 +27,38 @@ config_lib.DEFINE_string(
     "AFF4.change_email", None,
     "Email used by AFF4NotificationEmailListener to notify "
     "about AFF4 changes.")
+
+config_lib.DEFINE_list(
+    "AFF4.shared_cache_subjects",
+    [r"^aff4:/C\.[0-9a-fA-F]{16}$", r"^aff4:/hunts/[^/]+$",
+     r"^aff4:/config/.+$"],
+    "Regexes of frequently read subjects whose attributes are kept in the "
+    "shared AFF4 cache until they are invalidated by a write. An empty list "
+    "disables the shared cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_max_bytes", 64 * 1024 * 1024,
+    "Approximate maximum size of the attributes held in the shared AFF4 "
+    "cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_age", 600,
+    "The number of seconds after which entries in the shared AFF4 cache are "
+    "reread even if no invalidation was seen.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_poll_interval", 2,
+    "How often (in seconds) each process polls the data store for "
+    "invalidations of the shared AFF4 cache.")
+
+config_lib.DEFINE_list(
+    "AFF4.shared_cache_uncached_attributes",
+    ["metadata:client_ip", "metadata:clock", "metadata:last", "metadata:ping"],
+    "Attributes which are written all the time, e.g. by every client poll. "
+    "They are never kept in the shared AFF4 cache but always read from the "
+    "data store, so writing only these does not invalidate cached subjects.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_channel_shards", 16,
+    "The number of data store rows the invalidations of the shared AFF4 "
+    "cache are spread over.")
@@ -88,6 +88,32 @@ config_lib.DEFINE_integer("Client.foreman_check_frequency", 1800,
 config_lib.DEFINE_float("Client.rss_max", 500,
                         "Maximum memory footprint in MB.")
 
+config_lib.DEFINE_integer("Client.io_bytes_per_second", 0,
+                          "Maximum number of bytes per second all client "
+                          "actions together read through the VFS. 0 means "
+                          "unlimited.")
+
+config_lib.DEFINE_integer("Client.io_ops_per_second", 0,
+                          "Maximum number of VFS reads per second all client "
+                          "actions together issue. 0 means unlimited.")
+
+config_lib.DEFINE_bool("Client.map_files", False,
+                       "Read regular files from memory maps when hashing and "
+                       "searching them. Files truncated by another process "
+                       "while they are mapped crash the client, and on "
+                       "Windows mapped files can not be truncated.")
+
+config_lib.DEFINE_string("Client.file_index_path", "",
+                         "SQLite file the client keeps an index of directory "
+                         "listings in. Requests may ask for listings from "
+                         "the index to speed up repeated sweeps. Empty "
+                         "disables the index.")
+
+config_lib.DEFINE_integer("Client.file_index_max_entries", 1000000,
+                          "The maximum number of directories and files in the "
+                          "client's file index. The oldest listings are "
+                          "dropped first. 0 means no limit.")
+
 config_lib.DEFINE_string(
     name="Client.tempfile_prefix",
     help="Prefix to use for temp files created by the GRR client.",
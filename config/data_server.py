@@ -37,3 +37,55 @@ config_lib.DEFINE_string("HTTPDataStore.username", "user",
 
 config_lib.DEFINE_string("HTTPDataStore.password", "user",
                          "Password for using the distributed data store.")
+
+config_lib.DEFINE_integer("Dataserver.pipeline_threads", 10,
+                          "Maximum number of threads executing command "
+                          "batches received through the pipelined protocol.")
+
+config_lib.DEFINE_integer("Dataserver.compression_threshold", 4096,
+                          "Reply frames of the pipelined protocol at least "
+                          "this large are compressed (0 disables "
+                          "compression).")
+
+config_lib.DEFINE_bool("HTTPDataStore.pipelining", False,
+                       "Use the pipelined, batched protocol to talk to the "
+                       "data servers instead of one request at a time.")
+
+config_lib.DEFINE_integer("HTTPDataStore.max_batch_size", 100,
+                          "Maximum number of commands sent in a single frame "
+                          "of the pipelined protocol.")
+
+config_lib.DEFINE_integer("HTTPDataStore.max_inflight", 1000,
+                          "Maximum number of commands without a reply per "
+                          "pipelined connection.")
+
+config_lib.DEFINE_integer("HTTPDataStore.compression_threshold", 4096,
+                          "Command frames of the pipelined protocol at least "
+                          "this large are compressed (0 disables "
+                          "compression).")
+
+config_lib.DEFINE_choice("Dataserver.sharding", "range",
+                         ["range", "consistent_hash"],
+                         "How keys are assigned to data servers when the "
+                         "server group is created: contiguous hash ranges or "
+                         "a consistent hashing ring with virtual nodes.")
+
+config_lib.DEFINE_integer("Dataserver.virtual_nodes", 128,
+                          "Number of virtual nodes per data server on the "
+                          "consistent hashing ring.")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_streams", 4,
+                          "Number of files each data server sends in "
+                          "parallel when rebalancing.")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_chunk_size", 4 * 1024 * 1024,
+                          "Size of the chunks used to copy files when "
+                          "rebalancing.")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_bandwidth", 0,
+                          "Maximum number of bytes per second each data "
+                          "server sends when rebalancing (0 is unlimited).")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_retries", 3,
+                          "Number of times a failed file copy is resumed "
+                          "before the rebalance is aborted.")
@@ -13,18 +13,69 @@ config_lib.DEFINE_integer("Worker.task_limit", 2000,
                           "Limits the number of tasks a worker retrieves "
                           "every poll")
 
+config_lib.DEFINE_float("Worker.client_queue_session_share", 0.5,
+                        "The largest fraction of the messages handed to a "
+                        "client in one poll which a single flow can take "
+                        "while messages of other flows are waiting.")
+
 config_lib.DEFINE_integer("Worker.flow_lease_time", 600,
                           "Duration of flow lease time in seconds.")
 
+config_lib.DEFINE_integer("Worker.flow_lease_batch_size", 50,
+                          "When there are more flows to process than worker "
+                          "threads, up to this many flows are leased and "
+                          "loaded together by one thread. 1 disables "
+                          "batching.")
+
 config_lib.DEFINE_integer("Worker.worker_process_count", 1,
                           "Number of worker processes to run. Each worker can "
                           "only use a single CPU, so scaling this up on "
-                          "multiprocessor systems may make sense.")
+                          "multiprocessor systems may make sense. With more "
+                          "than one process a single coordinator dispatches "
+                          "flows to a supervised pool of child processes.")
+
+config_lib.DEFINE_integer(
+    "Worker.flow_state_entry_threshold", 16 * 1024,
+    "Flow state containers which pickle to at least this many bytes are "
+    "stored in their own attributes and only rewritten when they change. "
+    "0 keeps the whole state in a single pickle.")
+
+config_lib.DEFINE_float("Worker.profile_sample_rate", 0.0,
+                        "Fraction of flow state method runs which are "
+                        "profiled with cProfile. 0 disables profiling.")
+
+config_lib.DEFINE_float("Worker.profile_slow_state_threshold", 10.0,
+                        "Profiles of sampled state methods which ran for at "
+                        "least this many seconds are written to "
+                        "Worker.profile_dir.")
+
+config_lib.DEFINE_string("Worker.profile_dir", "%(Logging.path)/profiles",
+                         "Directory for the profiles of slow flow states.")
 
 config_lib.DEFINE_integer("Worker.queue_shards", 1,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer("Worker.max_queue_shards", 32,
+                          "Workers add notification shards as the number of "
+                          "workers and pending notifications grows, up to "
+                          "this many. Set it to Worker.queue_shards to keep "
+                          "the number of shards fixed.")
+
+config_lib.DEFINE_integer("Worker.notifications_per_shard", 1000,
+                          "Notification shards are added when there are more "
+                          "pending notifications per shard than this.")
+
+config_lib.DEFINE_integer("Worker.shard_resize_interval", 600,
+                          "Notification shards are only removed if the "
+                          "number of shards did not change for this many "
+                          "seconds.")
+
+config_lib.DEFINE_integer("Worker.shard_claim_ttl", 60,
+                          "Workers which did not claim their notification "
+                          "shards for this many seconds are considered dead "
+                          "and their shards are taken over by the others.")
+
 config_lib.DEFINE_integer("Worker.notification_expiry_time", 600,
                           "The queue manager expires stale notifications "
                           "after this many seconds.")
@@ -104,6 +155,22 @@ config_lib.DEFINE_integer("Frontend.bind_port", 8080, "The port to bind.")
 config_lib.DEFINE_integer("Frontend.processes", 1,
                           "Number of processes to use for the HTTP server")
 
+config_lib.DEFINE_choice(
+    "Frontend.server_type", "threaded", ["async", "threaded"],
+    "The HTTP frontend implementation. 'async' serves all connections from an "
+    "event loop and processes requests in a fixed worker pool, 'threaded' "
+    "uses a thread per connection.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_workers", 20,
+    "Number of threads decoding and processing message bundles in the "
+    "async frontend.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_max_queue", 200,
+    "The async frontend stops accepting connections while this many requests "
+    "are waiting for or being processed by a worker.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
@@ -6,7 +6,10 @@ This contains an AFF4 data model implementation.
 
 import __builtin__
 import abc
+import collections
+import re
 import StringIO
+import threading
 import time
 import zlib
 
@@ -20,6 +23,7 @@ from grr.lib import data_store
 from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import grr_rdf
@@ -55,6 +59,283 @@ class ChunkNotFoundError(IOError):
   pass
 
 
+class SharedAttributeCache(object):
+  """A read-through cache of the attributes of frequently read subjects.
+
+  Unlike the short lived Factory cache, entries here are kept until they are
+  invalidated so only subjects matching AFF4.shared_cache_subjects are
+  cached. Every write to such a subject, whether through AFF4 or straight to
+  the data store, is published on an invalidation channel in the data store
+  which all processes poll, so cached rows are evicted everywhere shortly
+  after they change.
+
+  Attributes which are written all the time, like the ping of a client, are
+  not cached at all. Writes of only those attributes are not published.
+  """
+
+  # The data store rows holding the invalidation channel are below this URN.
+  # Each invalidated subject has its own predicate on one of the rows, and
+  # invalidations older than max_age are removed again.
+  CHANNEL_URN = "aff4:/cache_invalidations"
+  CHANNEL_PREFIX = "metadata:invalidated:"
+
+  # Polls overlap by this many seconds to tolerate clock skew between
+  # processes and delayed asynchronous writes.
+  CLOCK_SKEW = 10
+
+  # Forget about older local invalidations once there are this many.
+  MAX_RECENT_INVALIDATIONS = 10000
+
+  def __init__(self, subject_regexes, max_bytes, max_age, poll_interval,
+               uncached_attributes=(), channel_shards=1, token=None):
+    """Constructor.
+
+    Args:
+      subject_regexes: A list of regexes of subjects which may be cached.
+      max_bytes: The approximate maximum size of all cached rows.
+      max_age: Entries older than this many seconds are refreshed even if no
+        invalidation was seen.
+      poll_interval: Seconds between polls of the invalidation channel.
+      uncached_attributes: Predicates which are never cached.
+      channel_shards: The number of rows of the invalidation channel.
+      token: The token used to access the invalidation channel.
+    """
+    self.regexes = [re.compile(regex) for regex in subject_regexes]
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.poll_interval = poll_interval
+    self.uncached_attributes = frozenset(uncached_attributes)
+    self.channel_urns = ["%s/%d" % (self.CHANNEL_URN, shard)
+                         for shard in range(max(1, channel_shards))]
+    self.token = token
+
+    self.lock = threading.RLock()
+    self.poll_lock = threading.Lock()
+
+    # Cache key -> (subject, time stored, size, values), in LRU order.
+    self.entries = collections.OrderedDict()
+    # Subject -> set of cache keys.
+    self.keys_by_subject = {}
+    self.size = 0
+
+    # Every invalidation increments the epoch. A row read from the data
+    # store is only cached if its subject was not invalidated since the
+    # read started.
+    self.epoch = 0
+    self.recent_invalidations = {}
+    self.oldest_known_epoch = 0
+
+    self.last_poll = self.last_cleanup = time.time()
+
+  def IsCacheable(self, subject):
+    if not self.enabled or subject.startswith(self.CHANNEL_URN):
+      return False
+
+    for regex in self.regexes:
+      if regex.match(subject):
+        return True
+    return False
+
+  @property
+  def enabled(self):
+    return bool(self.regexes) and self.max_bytes > 0
+
+  @utils.Synchronized
+  def Epoch(self):
+    return self.epoch
+
+  def Get(self, subject, key):
+    """Returns the cached values for this key or raises KeyError."""
+    if not self.IsCacheable(subject):
+      raise KeyError(key)
+
+    self._MaybePoll()
+
+    with self.lock:
+      try:
+        _, stored, size, values = self.entries.pop(key)
+      except KeyError:
+        stats.STATS.IncrementCounter("grr_aff4_shared_cache_misses")
+        raise
+
+      if stored + self.max_age < time.time():
+        self._Unlink(subject, key, size)
+        stats.STATS.IncrementCounter("grr_aff4_shared_cache_misses")
+        raise KeyError(key)
+
+      # Reinsert to mark the entry as most recently used.
+      self.entries[key] = (subject, stored, size, values)
+
+    stats.STATS.IncrementCounter("grr_aff4_shared_cache_hits")
+    return values
+
+  @utils.Synchronized
+  def Put(self, subject, key, values, epoch):
+    """Caches values read from the data store.
+
+    Args:
+      subject: The subject the values belong to.
+      key: The cache key.
+      values: The list of (predicate, value, timestamp) read for the subject.
+      epoch: The value of Epoch() before the values were read.
+    """
+    if not self.IsCacheable(subject):
+      return
+
+    # The subject may have changed while we were reading it.
+    if (epoch < self.oldest_known_epoch or
+        self.recent_invalidations.get(subject, -1) > epoch):
+      return
+
+    values = [value for value in values
+              if value[0] not in self.uncached_attributes]
+
+    size = len(key)
+    for predicate, value, _ in values:
+      size += len(predicate) + len(utils.SmartStr(value)) + 8
+
+    if size > self.max_bytes:
+      return
+
+    old = self.entries.pop(key, None)
+    if old:
+      self._Unlink(subject, key, old[2])
+
+    self.entries[key] = (subject, time.time(), size, values)
+    self.keys_by_subject.setdefault(subject, set()).add(key)
+    self.size += size
+
+    while self.size > self.max_bytes:
+      old_key, (old_subject, _, old_size, _) = self.entries.popitem(last=False)
+      self._Unlink(old_subject, old_key, old_size)
+
+  def _Unlink(self, subject, key, size):
+    self.size -= size
+    keys = self.keys_by_subject.get(subject)
+    if keys:
+      keys.discard(key)
+      if not keys:
+        del self.keys_by_subject[subject]
+
+  @utils.Synchronized
+  def Expire(self, subjects):
+    """Evicts all entries for these subjects from the local cache."""
+    for subject in subjects:
+      self.epoch += 1
+      self.recent_invalidations[subject] = self.epoch
+
+      for key in self.keys_by_subject.pop(subject, ()):
+        entry = self.entries.pop(key, None)
+        if entry:
+          self.size -= entry[2]
+          stats.STATS.IncrementCounter("grr_aff4_shared_cache_invalidations")
+
+    if len(self.recent_invalidations) > self.MAX_RECENT_INVALIDATIONS:
+      self.recent_invalidations = {}
+      self.oldest_known_epoch = self.epoch
+
+  def Invalidate(self, subjects, attributes=None, token=None):
+    """Called after subjects were written or deleted.
+
+    Args:
+      subjects: An iterable of subjects (strings or RDFURNs).
+      attributes: The attributes which were written or deleted. None if any
+        attribute may have changed, e.g. because the subjects were deleted.
+      token: An ACL token. Defaults to the cache's token.
+    """
+    if attributes is not None and self.uncached_attributes.issuperset(
+        utils.SmartStr(attribute) for attribute in attributes):
+      return
+
+    subjects = [utils.SmartUnicode(subject) for subject in subjects]
+    subjects = [subject for subject in subjects if self.IsCacheable(subject)]
+    if not subjects:
+      return
+
+    self.Expire(subjects)
+
+    # Publish the invalidation for the other processes. This goes through the
+    # same queue as the write itself, so when we see our own invalidation on
+    # the channel the write is visible too and we expire again anything that
+    # was read in between.
+    now = int(time.time() * MICROSECONDS)
+    shards = {}
+    for subject in subjects:
+      shards.setdefault(self._ChannelURN(subject), []).append(subject)
+
+    for urn, shard_subjects in shards.iteritems():
+      data_store.DB.MultiSet(
+          urn,
+          dict((self.CHANNEL_PREFIX + utils.SmartStr(subject),
+                [utils.SmartStr(subject)]) for subject in shard_subjects),
+          timestamp=now, replace=True, sync=False, token=token or self.token)
+
+  def _ChannelURN(self, subject):
+    shard = zlib.crc32(utils.SmartStr(subject)) % len(self.channel_urns)
+    return self.channel_urns[shard]
+
+  def _MaybePoll(self):
+    now = time.time()
+    if now < self.last_poll + self.poll_interval:
+      return
+
+    # Only one thread polls, the others use the cache as it is.
+    if not self.poll_lock.acquire(False):
+      return
+
+    try:
+      start = int((self.last_poll - self.CLOCK_SKEW) * MICROSECONDS)
+      end = int((now + self.CLOCK_SKEW) * MICROSECONDS)
+      self.last_poll = now
+      self.Poll(start, end)
+
+      # Entries are refreshed after max_age anyway, so nobody needs older
+      # invalidations.
+      if now > self.last_cleanup + self.max_age:
+        self.last_cleanup = now
+        self.Cleanup(int((now - self.max_age - 2 * self.CLOCK_SKEW) *
+                         MICROSECONDS))
+    finally:
+      self.poll_lock.release()
+
+  def Poll(self, start, end):
+    """Expires all subjects invalidated between start and end (in us)."""
+    try:
+      invalidations = list(data_store.DB.MultiResolveRegex(
+          self.channel_urns, self.CHANNEL_PREFIX + ".*", token=self.token,
+          timestamp=(start, end), limit=None))
+    except data_store.Error as e:
+      # We can not tell what changed so start from scratch.
+      logging.warning("Unable to poll the AFF4 cache invalidations: %s", e)
+      self.Flush()
+      return
+
+    self.Expire(set(utils.SmartUnicode(subject)
+                    for _, values in invalidations
+                    for _, subject, _ in values))
+
+  def Cleanup(self, end):
+    """Removes invalidations published before end (in us) from the channel."""
+    try:
+      for urn, values in data_store.DB.MultiResolveRegex(
+          self.channel_urns, self.CHANNEL_PREFIX + ".*", token=self.token,
+          timestamp=(0, end), limit=None):
+        data_store.DB.DeleteAttributes(
+            urn, [predicate for predicate, _, _ in values], end=end,
+            sync=False, token=self.token)
+    except data_store.Error as e:
+      logging.warning("Unable to clean up the AFF4 cache invalidations: %s", e)
+
+  @utils.Synchronized
+  def Flush(self):
+    self.epoch += 1
+    self.entries.clear()
+    self.keys_by_subject.clear()
+    self.recent_invalidations = {}
+    self.oldest_known_epoch = self.epoch
+    self.size = 0
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
@@ -71,6 +352,17 @@ class Factory(object):
     self.root_token = rdfvalue.ACLToken(username="GRRSystem",
                                         reason="Maintenance").SetUID()
 
+    # A long lived cache for frequently read subjects.
+    self.shared_cache = SharedAttributeCache(
+        config_lib.CONFIG["AFF4.shared_cache_subjects"],
+        max_bytes=config_lib.CONFIG["AFF4.shared_cache_max_bytes"],
+        max_age=config_lib.CONFIG["AFF4.shared_cache_age"],
+        poll_interval=config_lib.CONFIG["AFF4.shared_cache_poll_interval"],
+        uncached_attributes=config_lib.CONFIG[
+            "AFF4.shared_cache_uncached_attributes"],
+        channel_shards=config_lib.CONFIG["AFF4.shared_cache_channel_shards"],
+        token=self.root_token)
+
     self.notification_rules = []
     self.notification_rules_timestamp = 0
 
@@ -97,18 +389,46 @@ class Factory(object):
                     age=NEWEST_TIME):
     """Retrieves all the attributes for all the urns."""
     urns = set([utils.SmartUnicode(u) for u in urns])
+    shared_hits = {}
     if not ignore_cache:
       for subject in list(urns):
         key = self._MakeCacheInvariant(subject, token, age)
 
         try:
-          yield subject, self.cache.Get(key)
-          urns.remove(subject)
+          values = self.cache.Get(key)
         except KeyError:
-          pass
+          try:
+            shared_hits[subject] = self.shared_cache.Get(subject, key)
+            urns.remove(subject)
+          except KeyError:
+            pass
+          continue
+
+        yield subject, values
+        urns.remove(subject)
+
+    # The shared cache does not hold the attributes which change all the time,
+    # these are always read from the data store.
+    if shared_hits:
+      uncached = {}
+      if self.shared_cache.uncached_attributes:
+        uncached = dict(data_store.DB.MultiResolveRegex(
+            shared_hits,
+            ["^%s$" % predicate
+             for predicate in self.shared_cache.uncached_attributes],
+            timestamp=self.ParseAgeSpecification(age), token=token,
+            limit=None))
+
+      for subject, values in shared_hits.iteritems():
+        values = values + uncached.get(subject, [])
+        values.sort(key=lambda x: x[-1], reverse=True)
+
+        self.cache.Put(self._MakeCacheInvariant(subject, token, age), values)
+        yield subject, values
 
     # If there are any urns left we get them from the database.
     if urns:
+      epoch = self.shared_cache.Epoch()
       for subject, values in data_store.DB.MultiResolveRegex(
           urns, AFF4_PREFIXES, timestamp=self.ParseAgeSpecification(age),
           token=token, limit=None):
@@ -118,6 +438,7 @@ class Factory(object):
 
         key = self._MakeCacheInvariant(subject, token, age)
         self.cache.Put(key, values)
+        self.shared_cache.Put(utils.SmartUnicode(subject), key, values, epoch)
 
         yield utils.SmartUnicode(subject), values
 
@@ -363,6 +684,59 @@ class Factory(object):
 
     return obj
 
+  def MultiOpenWithLock(self, urns, aff4_type=None, token=None,
+                        age=NEWEST_TIME, lease_time=100):
+    """Opens and locks a number of urns at once.
+
+    This never blocks: urns which are already locked are skipped. The data
+    store has no transactions spanning several subjects so each urn is still
+    locked separately, but the attributes of all the locked objects are read
+    in a single data store round trip.
+
+    All the leases start now. Callers which work through the objects one after
+    the other have to renew the leases of the objects still waiting.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If set, raise an InstantiationError if an object exists and is
+          not an instance of this type.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build the objects.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of locked AFF4 objects, each of which has to be closed by the
+      caller.
+    """
+    transactions = {}
+    for urn in urns:
+      try:
+        transactions[utils.SmartUnicode(urn)] = self._AcquireLock(
+            urn, token=token, blocking=False, lease_time=lease_time)
+      except LockError:
+        pass
+
+    result = []
+    try:
+      local_cache = dict(self.GetAttributes(
+          transactions, ignore_cache=True, token=token, age=age))
+
+      for urn, transaction in transactions.iteritems():
+        obj = self.Open(
+            urn, aff4_type=aff4_type, mode="rw", ignore_cache=True,
+            token=token, age=age, follow_symlinks=False,
+            local_cache={urn: local_cache.get(urn, [])})
+        obj.transaction = transaction
+        result.append(obj)
+
+    except Exception:
+      # Release all the locks, nobody else can close these objects.
+      for transaction in transactions.itervalues():
+        transaction.Abort()
+      raise
+
+    return result
+
   def _AcquireLock(self, urn, token=None, blocking=None,
                    blocking_lock_timeout=None, lease_time=None,
                    blocking_sleep_interval=None):
@@ -805,6 +1179,7 @@ class Factory(object):
     data_store.DB.Flush()
     self.cache.Flush()
     self.intermediate_cache.Flush()
+    self.shared_cache.Flush()
 
   def UpdateNotificationRules(self):
     fd = self.Open(rdfvalue.RDFURN("aff4:/config/aff4_rules"), mode="r",
@@ -2383,12 +2758,15 @@ class AFF4Image(AFF4Stream):
 
     return fd
 
+  def _LocateChunk(self, offset):
+    """Returns the chunk holding offset, the offset within it and its size."""
+    return offset / self.chunksize, offset % self.chunksize, self.chunksize
+
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
-    chunk = self.offset / self.chunksize
-    chunk_offset = self.offset % self.chunksize
+    chunk, chunk_offset, chunk_size = self._LocateChunk(self.offset)
 
-    available_to_read = min(length, self.chunksize - chunk_offset)
+    available_to_read = min(length, chunk_size - chunk_offset)
 
     retries = 0
     while retries < self.NUM_RETRIES:
@@ -2488,7 +2866,12 @@ class AFF4NotificationRule(AFF4Object):
 # Utility functions
 class AFF4InitHook(registry.InitHook):
 
-  pre = ["ACLInit", "DataStoreInit"]
+  pre = ["ACLInit", "DataStoreInit", "StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("grr_aff4_shared_cache_hits")
+    stats.STATS.RegisterCounterMetric("grr_aff4_shared_cache_misses")
+    stats.STATS.RegisterCounterMetric("grr_aff4_shared_cache_invalidations")
 
   def Run(self):
     """Delayed loading of aff4 plugins to break import cycles."""
@@ -2500,6 +2883,15 @@ class AFF4InitHook(registry.InitHook):
     FACTORY = Factory()  # pylint: disable=g-bad-name
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
 
+    if InvalidateSharedCache not in data_store.WRITE_LISTENERS:
+      data_store.WRITE_LISTENERS.append(InvalidateSharedCache)
+
+
+def InvalidateSharedCache(subjects, predicates):
+  """Evicts data store writes from the shared cache of every process."""
+  if FACTORY is not None:
+    FACTORY.shared_cache.Invalidate(subjects, attributes=predicates)
+
 
 class AFF4Filter(object):
   """A simple filtering system to be used with Query()."""
@@ -2,9 +2,11 @@
 """These are standard aff4 objects."""
 
 
+import bisect
 import hashlib
 import re
 import StringIO
+import struct
 
 from grr.lib import aff4
 from grr.lib import data_store
@@ -88,6 +90,9 @@ class BlobImage(aff4.AFF4Image):
 
   The hash stream is kept within an AFF4 Attribute, instead of another stream
   making it more efficient for smaller files.
+
+  Chunks are normally all chunksize long. Content defined images have chunks
+  of any size up to chunksize and also keep the end offset of every chunk.
   """
   # Size of a sha256 hash
   _HASH_SIZE = 32
@@ -98,6 +103,8 @@ class BlobImage(aff4.AFF4Image):
   def Initialize(self):
     super(BlobImage, self).Initialize()
     self.content_dirty = False
+    # End offsets of the chunks of content defined images, None otherwise.
+    self.chunk_ends = None
     if self.mode == "w":
       self.index = StringIO.StringIO("")
       self.finalized = False
@@ -105,12 +112,37 @@ class BlobImage(aff4.AFF4Image):
       self.index = StringIO.StringIO(self.Get(self.Schema.HASHES, ""))
       self.finalized = self.Get(self.Schema.FINALIZED, False)
 
+      # Fixed size images store an empty list, so that rewriting a content
+      # defined image with fixed size chunks does not leave its ends behind.
+      chunk_ends = str(self.Get(self.Schema.CHUNK_ENDS, ""))
+      if chunk_ends:
+        self.chunk_ends = list(struct.unpack(">%dQ" % (len(chunk_ends) / 8),
+                                             chunk_ends))
+
+  def SetContentDefined(self):
+    """Allows blobs of any size up to chunksize to be added."""
+    self.chunk_ends = []
+
   def Truncate(self, offset=0):
     if offset != 0:
       raise IOError("Non-zero truncation not supported for BlobImage")
     super(BlobImage, self).Truncate(0)
     self.index = StringIO.StringIO("")
     self.finalized = False
+    if self.chunk_ends is not None:
+      self.chunk_ends = []
+
+  def _LocateChunk(self, offset):
+    if self.chunk_ends is None:
+      return super(BlobImage, self)._LocateChunk(offset)
+
+    chunk = bisect.bisect_right(self.chunk_ends, offset)
+    if chunk >= len(self.chunk_ends):
+      # Past the end of the file.
+      return chunk, 0, 0
+
+    start = self.chunk_ends[chunk - 1] if chunk else 0
+    return chunk, offset - start, self.chunk_ends[chunk] - start
 
   def _GetChunkForWriting(self, chunk):
     """Chunks must be added using the AddBlob() method."""
@@ -158,12 +190,18 @@ class BlobImage(aff4.AFF4Image):
     self.SetChunksize(fd.chunksize)
     self.index = StringIO.StringIO(fd.index.getvalue())
     self.size = fd.size
+    self.chunk_ends = None
+    if fd.chunk_ends is not None:
+      self.chunk_ends = list(fd.chunk_ends)
 
   def Flush(self, sync=True):
     if self.content_dirty:
       self.Set(self.Schema.SIZE(self.size))
       self.Set(self.Schema.HASHES(self.index.getvalue()))
       self.Set(self.Schema.FINALIZED(self.finalized))
+      chunk_ends = self.chunk_ends or []
+      self.Set(self.Schema.CHUNK_ENDS(
+          struct.pack(">%dQ" % len(chunk_ends), *chunk_ends)))
     super(BlobImage, self).Flush(sync)
 
   def AppendContent(self, src_fd):
@@ -178,10 +216,12 @@ class BlobImage(aff4.AFF4Image):
     Raises:
       IOError: if blob has already been finalized.
     """
-    while 1:
-      blob = src_fd.read(self.chunksize)
-      if not blob:
-        break
+    if self.chunk_ends is not None:
+      blobs = utils.ContentDefinedChunker(self.chunksize).Split(src_fd.read)
+    else:
+      blobs = iter(lambda: src_fd.read(self.chunksize), "")
+
+    for blob in blobs:
       blob_hash = hashlib.sha256(blob).digest()
       blob_urn = rdfvalue.RDFURN("aff4:/blobs").Add(blob_hash.encode("hex"))
 
@@ -203,22 +243,31 @@ class BlobImage(aff4.AFF4Image):
 
     Once a blob is added that is smaller than the chunksize we finalize the
     file, since handling adding more blobs makes the code much more complex.
+    Content defined images take blobs of any size up to the chunksize.
 
     Args:
       blob_hash: sha256 binary digest
       length: int length of blob
     Raises:
-      IOError: if blob has been finalized.
+      IOError: if blob has been finalized or is larger than the chunksize.
     """
     if self.finalized and length > 0:
       raise IOError("Can't add blobs to finalized BlobImage")
 
+    if self.chunk_ends is not None:
+      if length > self.chunksize:
+        raise IOError("Blob larger than the chunksize of this BlobImage")
+      if not length:
+        return
+
     self.content_dirty = True
     self.index.seek(0, 2)
     self.index.write(blob_hash)
     self.size += length
 
-    if length < self.chunksize:
+    if self.chunk_ends is not None:
+      self.chunk_ends.append(self.size)
+    elif length < self.chunksize:
       self.finalized = True
 
   class SchemaCls(aff4.AFF4Image.SchemaCls):
@@ -238,6 +287,11 @@ class BlobImage(aff4.AFF4Image):
                                "Once a blobimage is finalized, further writes"
                                " will raise exceptions.")
 
+    CHUNK_ENDS = aff4.Attribute("aff4:chunk_ends", rdfvalue.RDFBytes,
+                                "Big endian 64 bit end offsets of the chunks "
+                                "of a content defined image, empty for images "
+                                "with fixed size chunks.")
+
 
 class HashImage(aff4.AFF4Image):
   """An AFF4 Image which refers to chunks by their hash.
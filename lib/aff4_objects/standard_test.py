@@ -2,6 +2,7 @@
 """Tests for grr.lib.aff4_objects.standard."""
 
 import hashlib
+import os
 import StringIO
 import zlib
 
@@ -54,6 +55,73 @@ class BlobImageTest(test_lib.GRRBaseTest):
     dest_fd.Seek(0)
     self.assertEqual(dest_fd.Read(5000), src_content+src_content)
 
+  def testContentDefinedChunks(self):
+    """Test reading an image with variable sized chunks."""
+    src_content = os.urandom(5000)
+
+    dest_fd = aff4.FACTORY.Create(aff4.ROOT_URN.Add("temp"),
+                                  "BlobImage", token=self.token, mode="rw")
+    dest_fd.SetChunksize(256)
+    dest_fd.SetContentDefined()
+    dest_fd.AppendContent(StringIO.StringIO(src_content))
+    dest_fd.Close()
+
+    fd = aff4.FACTORY.Open(aff4.ROOT_URN.Add("temp"), token=self.token)
+    self.assertEqual(fd.size, len(src_content))
+    self.assertEqual(fd.chunk_ends[-1], len(src_content))
+    chunk_sizes = set(end - start for start, end in zip(
+        [0] + fd.chunk_ends[:-1], fd.chunk_ends))
+    self.assertTrue(len(chunk_sizes) > 1)
+    self.assertTrue(max(chunk_sizes) <= 256)
+
+    self.assertEqual(fd.Read(10000), src_content)
+    for offset, length in [(0, 100), (255, 300), (1000, 1), (4990, 100)]:
+      fd.Seek(offset)
+      self.assertEqual(fd.Read(length), src_content[offset:offset + length])
+
+    # Blobs larger than the chunksize are rejected.
+    self.assertRaises(IOError, dest_fd.AddBlob, "\x00" * 32, 257)
+
+  def testRewriteContentDefinedWithFixedChunks(self):
+    """The chunk ends of an earlier content defined image are not used."""
+    urn = aff4.ROOT_URN.Add("temp")
+    dest_fd = aff4.FACTORY.Create(urn, "BlobImage", token=self.token,
+                                  mode="rw")
+    dest_fd.SetChunksize(256)
+    dest_fd.SetContentDefined()
+    dest_fd.AppendContent(StringIO.StringIO(os.urandom(5000)))
+    dest_fd.Close()
+
+    src_content = os.urandom(3000)
+    dest_fd = aff4.FACTORY.Create(urn, "BlobImage", token=self.token,
+                                  mode="w")
+    dest_fd.SetChunksize(256)
+    dest_fd.AppendContent(StringIO.StringIO(src_content))
+    dest_fd.Close()
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertIsNone(fd.chunk_ends)
+    self.assertEqual(fd.Read(10000), src_content)
+
+    # The same happens when copying from a fixed size image.
+    copy_urn = aff4.ROOT_URN.Add("temp2")
+    copy_fd = aff4.FACTORY.Create(copy_urn, "BlobImage", token=self.token,
+                                  mode="rw")
+    copy_fd.SetChunksize(256)
+    copy_fd.SetContentDefined()
+    copy_fd.AppendContent(StringIO.StringIO(os.urandom(5000)))
+    copy_fd.Close()
+
+    copy_fd = aff4.FACTORY.Create(copy_urn, "BlobImage", token=self.token,
+                                  mode="w")
+    copy_fd.FromBlobImage(fd)
+    copy_fd.Close()
+
+    fd = aff4.FACTORY.Open(copy_urn, token=self.token)
+    self.assertIsNone(fd.chunk_ends)
+    fd.Seek(0)
+    self.assertEqual(fd.Read(10000), src_content)
+
 
 class IndexTest(test_lib.AFF4ObjectTest):
 
@@ -15,6 +15,7 @@ from grr.lib.aff4_objects import tests
 
 from grr.lib import aff4
 from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
@@ -301,6 +302,131 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
 
     fd.Close()
 
+  def testSharedCacheIsInvalidatedByOtherProcesses(self):
+    now = time.time()
+    with test_lib.FakeTime(now):
+      aff4.FACTORY.shared_cache.last_poll = now
+      with aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
+                               token=self.token) as fd:
+        fd.Set(fd.Schema.HOSTNAME("client1"))
+
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client1")
+
+      # Another process changes the client and publishes the invalidation.
+      other_cache = aff4.SharedAttributeCache(
+          [r"^aff4:/C\..*$"], max_bytes=1024, max_age=600, poll_interval=1)
+      with utils.Stubber(data_store, "WRITE_LISTENERS",
+                         [lambda subjects, _: other_cache.Invalidate(
+                             subjects, token=self.token)]):
+        data_store.DB.Set(self.client_id, fd.Schema.HOSTNAME.predicate,
+                          rdfvalue.RDFString("client2"), token=self.token)
+
+      # The short lived cache has expired but the shared cache has not seen
+      # the invalidation yet.
+      aff4.FACTORY.cache.Flush()
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client1")
+
+    with test_lib.FakeTime(now + 10):
+      aff4.FACTORY.cache.Flush()
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client2")
+
+  def testSharedCacheDoesNotHoldUncachedAttributes(self):
+    now = time.time()
+    with test_lib.FakeTime(now):
+      aff4.FACTORY.shared_cache.last_poll = now
+      with aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
+                               token=self.token) as fd:
+        fd.Set(fd.Schema.HOSTNAME("client1"))
+        fd.Set(fd.Schema.PING(rdfvalue.RDFDatetime(1000000)))
+
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client1")
+
+      published = list(data_store.DB.MultiResolveRegex(
+          aff4.FACTORY.shared_cache.channel_urns, ".*", token=self.token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None))
+
+      # The client polls, which is not published.
+      with aff4.FACTORY.Open(self.client_id, mode="rw",
+                             token=self.token) as fd:
+        fd.Set(fd.Schema.PING(rdfvalue.RDFDatetime(2000000)))
+
+      self.assertEqual(published, list(data_store.DB.MultiResolveRegex(
+          aff4.FACTORY.shared_cache.channel_urns, ".*", token=self.token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None)))
+
+      # The ping is always read from the data store.
+      aff4.FACTORY.cache.Flush()
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client1")
+      self.assertEqual(fd.Get(fd.Schema.PING), rdfvalue.RDFDatetime(2000000))
+
+  def testSharedCacheIsInvalidatedByDataStoreWrites(self):
+    hunt_urn = rdfvalue.RDFURN("aff4:/hunts/W:CACHED")
+    now = time.time()
+    with test_lib.FakeTime(now):
+      aff4.FACTORY.shared_cache.last_poll = now
+      with aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
+                               token=self.token) as fd:
+        fd.Set(fd.Schema.HOSTNAME("client1"))
+      aff4.FACTORY.Create(hunt_urn, "AFF4MemoryStream",
+                          token=self.token).Close()
+
+      aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertIsInstance(aff4.FACTORY.Open(hunt_urn, token=self.token),
+                            aff4.AFF4MemoryStream)
+
+      published = list(data_store.DB.MultiResolveRegex(
+          aff4.FACTORY.shared_cache.channel_urns, ".*", token=self.token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None))
+
+      # Writes which bypass AFF4, like the notifications of flow runners, are
+      # seen right away.
+      data_store.DB.Set(self.client_id, fd.Schema.HOSTNAME.predicate,
+                        rdfvalue.RDFString("client2"), token=self.token)
+      data_store.DB.DeleteSubject(hunt_urn, token=self.token)
+
+      aff4.FACTORY.cache.Flush()
+      fd = aff4.FACTORY.Open(self.client_id, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "client2")
+      self.assertNotIsInstance(aff4.FACTORY.Open(hunt_urn, token=self.token),
+                               aff4.AFF4MemoryStream)
+
+      # They are published for the other processes too.
+      self.assertNotEqual(published, list(data_store.DB.MultiResolveRegex(
+          aff4.FACTORY.shared_cache.channel_urns, ".*", token=self.token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None)))
+
+  def testSharedCacheInvalidationsExpire(self):
+    cache = aff4.SharedAttributeCache(
+        [r"^aff4:/C\..*$"], max_bytes=1024, max_age=600, poll_interval=1,
+        channel_shards=4, token=self.token)
+
+    def Published():
+      return [values for _, values in data_store.DB.MultiResolveRegex(
+          cache.channel_urns, cache.CHANNEL_PREFIX + ".*", token=self.token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None)]
+
+    before = sum(len(values) for values in Published())
+    now = time.time()
+    with test_lib.FakeTime(now):
+      cache.Invalidate(["aff4:/C.%016x" % i for i in range(10)])
+
+    # The invalidations are spread over the rows of the channel.
+    self.assertGreater(len(Published()), 1)
+    self.assertEqual(sum(len(values) for values in Published()), before + 10)
+
+    with test_lib.FakeTime(now + 300):
+      cache._MaybePoll()
+    self.assertEqual(sum(len(values) for values in Published()), before + 10)
+
+    with test_lib.FakeTime(now + 700):
+      cache._MaybePoll()
+    self.assertEqual(Published(), [])
+
   def testAFF4MemoryStream(self):
     """Tests the AFF4MemoryStream."""
 
@@ -919,6 +1045,37 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
       # Check that the object is correctly opened by reading the attribute
       self.assertEqual(obj.Get(obj.Schema.HOSTNAME), "client1")
 
+  def testMultiOpenWithLockSkipsLockedObjects(self):
+    urns = [rdfvalue.RDFURN("aff4:/C.%016X" % i) for i in range(3)]
+    for i, urn in enumerate(urns):
+      client = aff4.FACTORY.Create(urn, "VFSGRRClient", mode="w",
+                                   token=self.token)
+      client.Set(client.Schema.HOSTNAME("client%d" % i))
+      client.Close()
+
+    with aff4.FACTORY.OpenWithLock(urns[0], token=self.token):
+      objs = aff4.FACTORY.MultiOpenWithLock(urns, token=self.token)
+
+    self.assertEqual(sorted(obj.urn for obj in objs), urns[1:])
+    for obj in objs:
+      self.assertTrue(obj.locked)
+      self.assertEqual(obj.Get(obj.Schema.HOSTNAME),
+                       "client%d" % urns.index(obj.urn))
+
+      def TryOpen():
+        with aff4.FACTORY.OpenWithLock(obj.urn, token=self.token,
+                                       blocking=False):
+          pass
+
+      self.assertRaises(aff4.LockError, TryOpen)
+      obj.Close()
+
+    # All the locks are released.
+    objs = aff4.FACTORY.MultiOpenWithLock(urns, token=self.token)
+    self.assertEqual(len(objs), 3)
+    for obj in objs:
+      obj.Close()
+
   def testSynchronousOpenWithLockWorksCorrectly(self):
     client = aff4.FACTORY.Create(self.client_id, "VFSGRRClient", mode="w",
                                  token=self.token)
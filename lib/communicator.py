@@ -15,6 +15,7 @@ from M2Crypto import m2
 from M2Crypto import RSA
 from M2Crypto import X509
 
+from grr.lib import compression
 from grr.lib import config_lib
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -363,10 +364,11 @@ class Communicator(object):
     signed_message_list.message_list = uncompressed_data
 
     if config_lib.CONFIG["Network.compression"] == "ZCOMPRESS":
-      compressed_data = zlib.compress(uncompressed_data)
+      compressed_data, method = compression.POLICY.Compress(
+          uncompressed_data, content_type="messages")
 
-      # Only compress if it buys us something.
-      if len(compressed_data) < len(uncompressed_data):
+      # The policy only compresses if it buys us something.
+      if method == rdfvalue.DataBlob.CompressionType.ZCOMPRESSION:
         signed_message_list.compression = (
             rdfvalue.SignedMessageList.CompressionType.ZCOMPRESSION)
         signed_message_list.message_list = compressed_data
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Chooses how to compress data before it is sent over the network.
+
+Compressing data which is already compressed (zip files, images, packed
+executables, encrypted memory) costs client CPU and saves nothing. The
+CompressionPolicy trial compresses a few small samples of each buffer and
+either stores it as is, compresses it quickly or compresses it harder
+depending on how well the samples shrank.
+"""
+
+
+import os
+import zlib
+
+
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+
+
+# Content types we keep separate statistics for. Anything else is "other".
+CONTENT_TYPES = frozenset([
+    "7z", "bz2", "cab", "dll", "doc", "docx", "evtx", "exe", "gif", "gz",
+    "jpeg", "jpg", "log", "messages", "mp3", "mp4", "pdf", "png", "pf",
+    "raw", "sys", "txt", "xml", "zip"])
+
+
+class CompressionInit(registry.InitHook):
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    fields = [("content_type", str)]
+    stats.STATS.RegisterCounterMetric(
+        "grr_compression_input_bytes", fields=fields,
+        docstring="Bytes given to the compression policy.")
+    stats.STATS.RegisterCounterMetric(
+        "grr_compression_output_bytes", fields=fields,
+        docstring="Bytes produced by the compression policy.")
+    stats.STATS.RegisterCounterMetric(
+        "grr_compression_choices", fields=fields + [("level", str)],
+        docstring="Number of buffers stored, fast or high compressed.")
+
+
+def ContentType(path):
+  """Returns the content type used for the statistics of path."""
+  extension = os.path.splitext(path or "")[1][1:].lower()
+  if extension in CONTENT_TYPES:
+    return extension
+  return "other"
+
+
+class CompressionPolicy(object):
+  """Picks a compression level for each buffer from a trial compression."""
+
+  STORE = "store"
+  FAST = "fast"
+  HIGH = "high"
+
+  LEVELS = {FAST: 1, HIGH: 6}
+
+  # Size of each trial compressed sample.
+  SAMPLE_SIZE = 1024
+
+  # Buffers smaller than this are not sampled, just compressed fast.
+  MIN_SAMPLED_SIZE = 4 * SAMPLE_SIZE
+
+  def __init__(self, store_ratio=0.9, high_ratio=0.5):
+    """Constructor.
+
+    Args:
+      store_ratio: Buffers whose samples do not shrink below this ratio are
+        stored uncompressed.
+      high_ratio: Buffers whose samples shrink below this ratio are compressed
+        at the higher level since there is much to gain.
+    """
+    self.store_ratio = store_ratio
+    self.high_ratio = high_ratio
+
+  def Choose(self, data):
+    """Returns STORE, FAST or HIGH for data."""
+    if len(data) < self.MIN_SAMPLED_SIZE:
+      return self.FAST
+
+    # Sample the start, middle and end since file headers are often
+    # compressible even when the content is not.
+    middle = (len(data) - self.SAMPLE_SIZE) / 2
+    sample = (data[:self.SAMPLE_SIZE] +
+              data[middle:middle + self.SAMPLE_SIZE] +
+              data[-self.SAMPLE_SIZE:])
+
+    ratio = len(zlib.compress(sample, 1)) / float(len(sample))
+    if ratio >= self.store_ratio:
+      return self.STORE
+    if ratio <= self.high_ratio:
+      return self.HIGH
+    return self.FAST
+
+  def Compress(self, data, content_type="other"):
+    """Compresses data according to the policy.
+
+    Args:
+      data: The data to compress.
+      content_type: The content type the statistics are recorded under.
+
+    Returns:
+      A tuple of the data to send and the DataBlob.CompressionType used.
+    """
+    level = self.Choose(data)
+    result = data
+    compression = rdfvalue.DataBlob.CompressionType.UNCOMPRESSED
+
+    if level != self.STORE:
+      compressed = zlib.compress(data, self.LEVELS[level])
+
+      # Only compress if it buys us something.
+      if len(compressed) < len(data):
+        result = compressed
+        compression = rdfvalue.DataBlob.CompressionType.ZCOMPRESSION
+      else:
+        level = self.STORE
+
+    stats.STATS.IncrementCounter("grr_compression_input_bytes",
+                                 delta=len(data), fields=[content_type])
+    stats.STATS.IncrementCounter("grr_compression_output_bytes",
+                                 delta=len(result), fields=[content_type])
+    stats.STATS.IncrementCounter("grr_compression_choices",
+                                 fields=[content_type, level])
+
+    return result, compression
+
+  def CompressBlob(self, data, content_type="other"):
+    """Returns a DataBlob holding data compressed according to the policy."""
+    result, compression = self.Compress(data, content_type=content_type)
+    return rdfvalue.DataBlob(data=result, compression=compression)
+
+
+POLICY = CompressionPolicy()
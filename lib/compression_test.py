@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Tests for the compression policy."""
+
+
+import os
+import zlib
+
+
+from grr.lib import compression
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import stats
+from grr.lib import test_lib
+
+
+class CompressionPolicyTest(test_lib.GRRBaseTest):
+  """Tests the choice of compression level."""
+
+  def testIncompressibleDataIsStored(self):
+    data = zlib.compress(os.urandom(100000))
+    policy = compression.CompressionPolicy()
+    self.assertEqual(policy.Choose(data), policy.STORE)
+
+    before = stats.STATS.GetMetricValue("grr_compression_choices",
+                                        fields=["zip", policy.STORE])
+    result, method = policy.Compress(data, content_type="zip")
+    self.assertEqual(result, data)
+    self.assertEqual(method, rdfvalue.DataBlob.CompressionType.UNCOMPRESSED)
+    self.assertEqual(stats.STATS.GetMetricValue("grr_compression_choices",
+                                                fields=["zip", policy.STORE]),
+                     before + 1)
+
+  def testCompressibleData(self):
+    policy = compression.CompressionPolicy()
+    data = "A line of a log file which repeats.\n" * 10000
+    self.assertEqual(policy.Choose(data), policy.HIGH)
+
+    blob = policy.CompressBlob(data, content_type="log")
+    self.assertEqual(blob.compression,
+                     rdfvalue.DataBlob.CompressionType.ZCOMPRESSION)
+    self.assertEqual(zlib.decompress(blob.data), data)
+
+    # Small buffers are not sampled.
+    self.assertEqual(policy.Choose("hello"), policy.FAST)
+
+  def testContentType(self):
+    self.assertEqual(compression.ContentType("/tmp/Foo.ZIP"), "zip")
+    self.assertEqual(compression.ContentType("/tmp/foo.unknown"), "other")
+    self.assertEqual(compression.ContentType("/tmp/foo"), "other")
+    self.assertEqual(compression.ContentType(None), "other")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
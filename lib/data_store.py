@@ -37,6 +37,7 @@ able to filter it directly).
 
 import abc
 import atexit
+import functools
 import re
 import sys
 import time
@@ -57,6 +58,11 @@ flags.DEFINE_bool("list_storage", False,
 # A global data store handle
 DB = None
 
+# Callables which are told about every write to the data store, whichever
+# implementation does it. They are called as listener(subjects, predicates)
+# after the write, predicates is None if all attributes may have changed.
+WRITE_LISTENERS = []
+
 # There are stub methods that don't return/yield as indicated by the docstring.
 # pylint: disable=g-doc-return-or-yield
 
@@ -103,6 +109,66 @@ class DataStore(object):
                                                     sleep_time=0.5)
     self.flusher_thread.start()
     self.monitor_thread = None
+    self._ReportWrites()
+
+  def _ReportWrites(self):
+    """Makes the write methods of this instance report to WRITE_LISTENERS.
+
+    Implementations override the write methods and their transactions commit
+    through them, so the methods are wrapped on the instance.
+    """
+
+    def Predicates(predicates):
+      # Iterators were consumed by the write, so we can not tell which
+      # predicates were written.
+      if isinstance(predicates, (list, tuple, set, frozenset, dict)):
+        return list(predicates)
+      return None
+
+    def MultiSet(subject, values, *args, **kwargs):
+      # to_delete follows timestamp, token, replace and sync.
+      to_delete = args[4] if len(args) > 4 else kwargs.get("to_delete")
+      written = Predicates(values)
+      deleted = Predicates(to_delete or [])
+      if written is None or deleted is None:
+        return [subject], None
+      return [subject], written + deleted
+
+    def DeleteAttributes(subject, predicates, *unused_args, **unused_kwargs):
+      return [subject], Predicates(predicates)
+
+    def WholeSubject(subject, *unused_args, **unused_kwargs):
+      return [subject], None
+
+    def DeleteSubjects(subjects, *unused_args, **unused_kwargs):
+      # The default implementation also reports every subject it deletes.
+      if not isinstance(subjects, (list, tuple, set, frozenset)):
+        return [], None
+      return list(subjects), None
+
+    for name, get_written in [("MultiSet", MultiSet),
+                              ("DeleteAttributes", DeleteAttributes),
+                              ("DeleteAttributesRegex", WholeSubject),
+                              ("DeleteSubject", WholeSubject),
+                              ("DeleteSubjects", DeleteSubjects)]:
+      setattr(self, name, self._ReportingMethod(getattr(self, name),
+                                                get_written))
+
+  @staticmethod
+  def _ReportingMethod(method, get_written):
+    """Wraps a write method to report what it wrote to WRITE_LISTENERS."""
+
+    @functools.wraps(method)
+    def Wrapper(*args, **kwargs):
+      result = method(*args, **kwargs)
+      if WRITE_LISTENERS:
+        subjects, predicates = get_written(*args, **kwargs)
+        if subjects:
+          for listener in WRITE_LISTENERS:
+            listener(subjects, predicates)
+      return result
+
+    return Wrapper
 
   def GetRequiredResolveAccess(self, predicate_regex):
     """Returns required level of access for resolve operations.
@@ -159,6 +225,19 @@ class DataStore(object):
   def DeleteSubject(self, subject, token=None):
     """Completely deletes all information about this subject."""
 
+  def DeleteSubjects(self, subjects, token=None):
+    """Deletes several subjects.
+
+    Data stores which can delete many subjects in one request should override
+    this.
+
+    Args:
+      subjects: A list of subjects to delete.
+      token: An ACL token.
+    """
+    for subject in subjects:
+      self.DeleteSubject(subject, token=token)
+
   def Set(self, subject, predicate, value, timestamp=None, token=None,
           replace=True, sync=True):
     """Set a single value for this subject's predicate.
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""Benchmark scenarios which run against any data store implementation.
+
+Every scenario times a single operation which is repeated by a number of
+threads. The BenchmarkRunner collects the latency of each operation and
+reports the throughput and latency percentiles of each scenario so results
+from different data stores (or deployments) can be compared.
+"""
+
+
+import json
+import os
+import random
+import threading
+import time
+
+
+import logging
+
+from grr.lib import data_store
+from grr.lib import queue_manager
+from grr.lib import rdfvalue
+from grr.lib import registry
+
+
+def Percentile(sorted_values, fraction):
+  """Returns the value below which fraction of sorted_values lie."""
+  if not sorted_values:
+    return 0
+  index = int(round(fraction * (len(sorted_values) - 1)))
+  return sorted_values[index]
+
+
+class Scenario(object):
+  """A benchmark scenario.
+
+  Scenarios are created once per run. Setup() prepares the data store, Run()
+  is the timed operation and is called concurrently from several threads with
+  the index of the operation, Teardown() removes everything written.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # A short description of what is measured.
+  description = ""
+
+  # The number of operations to run at scale 1.
+  operations = 1000
+
+  # Prefix of all subjects written by this scenario.
+  subject_prefix = "aff4:/benchmark"
+
+  def __init__(self, token=None, scale=1.0):
+    self.token = token
+    self.operations = max(1, int(self.operations * scale))
+    self.lock = threading.Lock()
+    self.subjects = set()
+    # Extra values reported with the results.
+    self.extra = {}
+
+  def Subject(self, name):
+    subject = "%s/%s/%s" % (self.subject_prefix, self.__class__.__name__,
+                            name)
+    with self.lock:
+      self.subjects.add(subject)
+    return subject
+
+  def Setup(self):
+    """Prepares the data store for the scenario."""
+
+  def Run(self, index):
+    """Runs one timed operation."""
+    raise NotImplementedError()
+
+  def Teardown(self):
+    for subject in self.subjects:
+      data_store.DB.DeleteSubject(subject, token=self.token)
+    data_store.DB.Flush()
+
+
+class SmallAttributeMultiSet(Scenario):
+  """Sets a few small attributes on many subjects."""
+
+  description = "MultiSet of 10 attributes of 100 bytes (sync)."
+  operations = 2000
+
+  def Setup(self):
+    self.value = os.urandom(100)
+
+  def Run(self, index):
+    data_store.DB.MultiSet(
+        self.Subject("row%d" % (index % 1000)),
+        dict(("metadata:attribute%d" % i, [self.value]) for i in range(10)),
+        replace=True, sync=True, token=self.token)
+
+
+class LargeBlobWrites(Scenario):
+  """Writes large values."""
+
+  description = "Set of a single 1MB value (sync)."
+  operations = 100
+
+  def Setup(self):
+    self.value = os.urandom(1024 * 1024)
+
+  def Run(self, index):
+    data_store.DB.Set(self.Subject("blob%d" % index), "aff4:content",
+                      self.value, replace=True, sync=True, token=self.token)
+
+
+class MultiResolveRegexFanout(Scenario):
+  """Reads many subjects at once."""
+
+  description = ("MultiResolveRegex of 100 random subjects out of 1000, "
+                 "10 attributes each.")
+  operations = 200
+
+  number_of_subjects = 1000
+  fanout = 100
+
+  def Setup(self):
+    value = os.urandom(100)
+    self.row_subjects = []
+    for i in range(self.number_of_subjects):
+      subject = self.Subject("row%d" % i)
+      self.row_subjects.append(subject)
+      data_store.DB.MultiSet(
+          subject,
+          dict(("metadata:attribute%d" % j, [value]) for j in range(10)),
+          replace=True, sync=False, token=self.token)
+    data_store.DB.Flush()
+    self.extra["rows_read"] = 0
+
+  def Run(self, index):
+    subjects = random.sample(self.row_subjects, self.fanout)
+    rows = 0
+    for _ in data_store.DB.MultiResolveRegex(
+        subjects, "metadata:.*", timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=self.token):
+      rows += 1
+
+    with self.lock:
+      self.extra["rows_read"] += rows
+
+
+class ContendedTransactions(Scenario):
+  """Increments a few counters under transactions."""
+
+  description = "Read-modify-write transactions on 4 subjects."
+  operations = 500
+
+  number_of_subjects = 4
+  predicate = "metadata:counter"
+
+  def Setup(self):
+    self.counters = [self.Subject("counter%d" % i)
+                     for i in range(self.number_of_subjects)]
+    self.extra["retries"] = 0
+    self.extra["lost_updates"] = 0
+
+  def Run(self, index):
+    subject = self.counters[index % self.number_of_subjects]
+    while True:
+      try:
+        transaction = data_store.DB.Transaction(subject, token=self.token)
+        value, _ = transaction.Resolve(self.predicate)
+        transaction.Set(self.predicate, str(int(value or 0) + 1))
+        transaction.Commit()
+        return
+      except data_store.TransactionError:
+        with self.lock:
+          self.extra["retries"] += 1
+        time.sleep(0.001)
+
+  def Teardown(self):
+    total = 0
+    for subject in self.counters:
+      value, _ = data_store.DB.Resolve(subject, self.predicate,
+                                       token=self.token)
+      total += int(value or 0)
+    self.extra["lost_updates"] = self.operations - total
+
+    super(ContendedTransactions, self).Teardown()
+
+
+class NotificationChurn(Scenario):
+  """Simulates the notifications written and consumed by the workers."""
+
+  description = ("Notify 10 sessions, read the queue and delete the "
+                 "notifications.")
+  operations = 500
+
+  sessions_per_operation = 10
+
+  def Setup(self):
+    self.queue = rdfvalue.RDFURN("BENCHMARK")
+
+  def Run(self, index):
+    session_ids = [
+        rdfvalue.SessionID(base="aff4:/benchmark_flows", queue=self.queue,
+                           flow_name=index * self.sessions_per_operation + i)
+        for i in range(self.sessions_per_operation)]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.MultiNotifyQueue([rdfvalue.GrrNotification(session_id=session_id)
+                              for session_id in session_ids])
+    manager.GetNotificationsByPriority(self.queue)
+    for session_id in session_ids:
+      manager.DeleteNotification(session_id)
+
+  def Teardown(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for shard in manager.GetAllNotificationShards(self.queue):
+      data_store.DB.DeleteSubject(shard, token=self.token)
+    data_store.DB.Flush()
+
+
+class BenchmarkRunner(object):
+  """Runs scenarios against the current data_store.DB."""
+
+  def __init__(self, token=None, threads=10, scale=1.0):
+    self.token = token
+    self.threads = threads
+    self.scale = scale
+
+  def RunScenario(self, scenario_cls):
+    """Runs a single scenario and returns its results as a dict."""
+    scenario = scenario_cls(token=self.token, scale=self.scale)
+    logging.info("Running %s (%d operations)", scenario_cls.__name__,
+                 scenario.operations)
+    scenario.Setup()
+
+    latencies = []
+    errors = []
+    next_index = [0]
+    lock = threading.Lock()
+
+    def Worker():
+      my_latencies = []
+      while True:
+        with lock:
+          index = next_index[0]
+          if index >= scenario.operations:
+            break
+          next_index[0] += 1
+
+        start = time.time()
+        try:
+          scenario.Run(index)
+        except Exception as e:  # pylint: disable=broad-except
+          errors.append(e)
+          continue
+        my_latencies.append(time.time() - start)
+
+      with lock:
+        latencies.extend(my_latencies)
+
+    workers = [threading.Thread(target=Worker, name="Benchmark%d" % i)
+               for i in range(self.threads)]
+    start = time.time()
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    data_store.DB.Flush()
+    elapsed = time.time() - start
+
+    scenario.Teardown()
+
+    for e in errors[:5]:
+      logging.warning("%s failed: %s", scenario_cls.__name__, e)
+
+    latencies.sort()
+    result = dict(
+        scenario=scenario_cls.__name__,
+        description=scenario.description,
+        operations=scenario.operations,
+        errors=len(errors),
+        threads=self.threads,
+        seconds=elapsed,
+        ops_per_second=len(latencies) / elapsed if elapsed else 0,
+        latency_ms=dict(
+            mean=(sum(latencies) / len(latencies) * 1e3 if latencies else 0),
+            p50=Percentile(latencies, 0.5) * 1e3,
+            p90=Percentile(latencies, 0.9) * 1e3,
+            p99=Percentile(latencies, 0.99) * 1e3,
+            max=(latencies[-1] if latencies else 0) * 1e3))
+    result.update(scenario.extra)
+
+    return result
+
+  def Run(self, scenario_names=None):
+    """Runs the named scenarios (all if None) and returns their results."""
+    if not scenario_names:
+      scenario_names = sorted(name for name in Scenario.classes
+                              if name != "Scenario")
+
+    results = []
+    for name in scenario_names:
+      try:
+        scenario_cls = Scenario.classes[name]
+      except KeyError:
+        raise ValueError("Unknown benchmark scenario %s" % name)
+
+      results.append(self.RunScenario(scenario_cls))
+
+    return results
+
+
+def WriteResults(path, runs):
+  """Writes benchmark runs to path as JSON.
+
+  Args:
+    path: The output file name.
+    runs: A list of dicts, one per benchmarked data store, each with an
+      "implementation" name and the "results" of BenchmarkRunner.Run().
+  """
+  with open(path, "wb") as fd:
+    json.dump(dict(timestamp=time.time(), runs=runs), fd, indent=2,
+              sort_keys=True)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Tests for the data store benchmark scenarios."""
+
+
+import json
+import os
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import data_store_benchmark
+from grr.lib import flags
+from grr.lib import test_lib
+
+
+class DataStoreBenchmarkTest(test_lib.GRRBaseTest):
+  """Runs all scenarios on a very small scale."""
+
+  def testPercentile(self):
+    values = range(101)
+    self.assertEqual(data_store_benchmark.Percentile(values, 0.5), 50)
+    self.assertEqual(data_store_benchmark.Percentile(values, 0.99), 99)
+    self.assertEqual(data_store_benchmark.Percentile([], 0.5), 0)
+
+  def testAllScenariosRun(self):
+    runner = data_store_benchmark.BenchmarkRunner(token=self.token, threads=4,
+                                                  scale=0.02)
+    results = runner.Run()
+
+    scenarios = set(result["scenario"] for result in results)
+    self.assertEqual(scenarios, set(["ContendedTransactions",
+                                     "LargeBlobWrites",
+                                     "MultiResolveRegexFanout",
+                                     "NotificationChurn",
+                                     "SmallAttributeMultiSet"]))
+    for result in results:
+      self.assertEqual(result["errors"], 0)
+      self.assertGreater(result["ops_per_second"], 0)
+      self.assertLessEqual(result["latency_ms"]["p50"],
+                           result["latency_ms"]["p99"])
+
+    transactions = [result for result in results
+                    if result["scenario"] == "ContendedTransactions"][0]
+    self.assertEqual(transactions["lost_updates"], 0)
+
+    path = os.path.join(self.temp_dir, "results.json")
+    data_store_benchmark.WriteResults(
+        path, [dict(implementation="FakeDataStore", results=results)])
+    written = json.load(open(path))
+    self.assertEqual(written["runs"][0]["results"], results)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -4,6 +4,7 @@
 
 import base64
 import binascii
+import collections
 import httplib
 import random
 import re
@@ -23,6 +24,7 @@ from grr.lib.data_stores import common
 
 from grr.server.data_server import auth
 from grr.server.data_server import constants
+from grr.server.data_server import pipeline
 from grr.server.data_server import utils as sutils
 
 
@@ -65,9 +67,17 @@ class HTTPDataStoreError(Error):
   pass
 
 
+class UnsupportedServiceError(HTTPDataStoreError):
+  """Raised when the data server does not know the requested protocol."""
+  pass
+
+
 class DataServerConnection(object):
   """Represents one connection to a data server."""
 
+  # Data server path that starts the data store service.
+  SERVICE_PATH = "/client/start"
+
   def __init__(self, server):
     self.conn = None
     self.sock = None
@@ -168,7 +178,7 @@ class DataServerConnection(object):
       token = auth.GenerateAuthToken(nonce, username, password)
       # We trick HTTP here and use the underlying socket to pipeline requests.
       headers = {"Content-Length": len(token)}
-      self.conn.request("POST", "/client/start", token, headers)
+      self.conn.request("POST", self.SERVICE_PATH, token, headers)
       self.sock = self.conn.sock
       # Confirm handshake.
       self.sock.setblocking(1)
@@ -176,6 +186,12 @@ class DataServerConnection(object):
       ack = self._ReadExactly(3)
       if ack == "IP\n":
         raise HTTPDataStoreError("Invalid data server username/password.")
+      if ack == "HTT":
+        # We got an HTTP error response instead of the handshake.
+        self.conn.close()
+        raise UnsupportedServiceError("Data server %s:%d does not support %s." %
+                                      (self.Address(), self.Port(),
+                                       self.SERVICE_PATH))
       if ack != "OK\n":
         return False
       logging.info("Connected to data server %s:%d", self.Address(),
@@ -259,6 +275,10 @@ class DataServerConnection(object):
           break
     return response
 
+  def SyncAndMakeRequests(self, commands):
+    """Make several requests and return the responses in the same order."""
+    return [self.SyncAndMakeRequest(command) for command in commands]
+
   @utils.Synchronized
   def Sync(self):
     self._Sync()
@@ -270,6 +290,211 @@ class DataServerConnection(object):
     self.conn.close()
 
 
+class PipelinedDataServerConnection(DataServerConnection):
+  """A connection using the pipelined, batched protocol.
+
+  Every command gets a request id. Asynchronous commands are buffered and sent
+  in batches, synchronous commands flush the buffer and wait for their own
+  reply only, so many threads can have commands in flight on the same
+  connection. Replies are read by a dedicated thread.
+  """
+
+  SERVICE_PATH = "/client/pipeline"
+
+  # Reconnect if the server did not send anything for this long while we are
+  # waiting for replies.
+  REPLY_TIMEOUT = 60
+
+  def __init__(self, server):
+    self.next_id = 0
+    # Commands without a reply, keyed by request id, in sending order.
+    self.inflight = collections.OrderedDict()
+    # Ids of the inflight commands that were not sent yet.
+    self.outgoing = []
+    # Ids of synchronous commands and the replies they are waiting for.
+    self.waiting = set()
+    self.responses = {}
+    # First error returned for an asynchronous command.
+    self.async_error = None
+    self.generation = 0
+    self.reader = pipeline.FrameReader()
+    self.closed = False
+    self.max_batch_size = config_lib.CONFIG["HTTPDataStore.max_batch_size"]
+    self.max_inflight = config_lib.CONFIG["HTTPDataStore.max_inflight"]
+    self.compression_threshold = config_lib.CONFIG[
+        "HTTPDataStore.compression_threshold"]
+    super(PipelinedDataServerConnection, self).__init__(server)
+    self.cond = threading.Condition(self.lock)
+    self.reader_thread = threading.Thread(target=self._ReadLoop,
+                                          name="DataServerReplyReader")
+    self.reader_thread.daemon = True
+    self.reader_thread.start()
+
+  def _Reconnect(self):
+    if not super(PipelinedDataServerConnection, self)._Reconnect():
+      return False
+    self.generation += 1
+    self.reader = pipeline.FrameReader()
+    # The reader thread polls the socket so it can notice Close().
+    self.sock.settimeout(SEND_TIMEOUT)
+    return True
+
+  def _SendCommands(self, request_ids):
+    """Sends the given inflight commands in as few frames as possible."""
+    for i in xrange(0, len(request_ids), self.max_batch_size):
+      batch = rdfvalue.DataStoreCommandBatch()
+      for request_id in request_ids[i:i + self.max_batch_size]:
+        batch.commands.Append(self.inflight[request_id])
+      frame = pipeline.EncodeFrame(batch.SerializeToString(),
+                                   self.compression_threshold)
+      try:
+        self.sock.sendall(frame)
+      except (socket.error, socket.timeout):
+        logging.warning("Could not send requests to server %s:%d",
+                        self.Address(), self.Port())
+        return False
+    return True
+
+  def _ReplaySync(self):
+    """Send all the commands without a reply again."""
+    if self.inflight:
+      logging.info("Replaying %d requests", len(self.inflight))
+    if not self._SendCommands(self.inflight.keys()):
+      return False
+    self.outgoing = []
+    return True
+
+  def _Flush(self):
+    """Sends the buffered commands. Must be called with the lock held."""
+    if not self.outgoing:
+      return
+    if self._SendCommands(self.outgoing):
+      self.outgoing = []
+    else:
+      # Reconnecting replays all the inflight commands.
+      self._RedoConnection()
+
+  def _Enqueue(self, command):
+    self.next_id += 1
+    command.request_id = self.next_id
+    self.inflight[self.next_id] = command
+    self.outgoing.append(self.next_id)
+    return self.next_id
+
+  def _ReadLoop(self):
+    """Reads replies and hands them to the waiting threads."""
+    last_progress = time.time()
+    while not self.closed:
+      with self.cond:
+        sock, generation, reader = self.sock, self.generation, self.reader
+        expecting = len(self.inflight) > len(self.outgoing)
+
+      try:
+        data = sock.recv(pipeline.READ_CHUNK_SIZE)
+        payloads = reader.Feed(data) if data else None
+      except socket.timeout:
+        if not expecting or time.time() - last_progress < self.REPLY_TIMEOUT:
+          if not expecting:
+            last_progress = time.time()
+          continue
+        logging.warning("No reply from server %s:%d", self.Address(),
+                        self.Port())
+        payloads = None
+      except (socket.error, pipeline.FrameError):
+        payloads = None
+
+      if self.closed:
+        return
+
+      with self.cond:
+        if payloads is None:
+          if generation == self.generation:
+            try:
+              self._RedoConnection()
+            except HTTPDataStoreError as e:
+              logging.error("Giving up on data server: %s", e)
+              return
+          last_progress = time.time()
+          continue
+
+        last_progress = time.time()
+        for payload in payloads:
+          self._HandleReplies(rdfvalue.DataStoreReplyBatch(payload))
+        self.cond.notify_all()
+
+  def _HandleReplies(self, batch):
+    for reply in batch.replies:
+      request_id = reply.request_id
+      if self.inflight.pop(request_id, None) is None:
+        # Reply to a replayed command we already have an answer for.
+        continue
+      if request_id in self.waiting:
+        self.responses[request_id] = reply.response
+      elif self.async_error is None:
+        try:
+          CheckResponseStatus(reply.response)
+        except (data_store.Error, access_control.UnauthorizedAccess) as e:
+          self.async_error = e
+
+  def _WaitFor(self, condition):
+    started = time.time()
+    while not condition():
+      self.cond.wait(1)
+      if time.time() - started >= RECONNECTION_TIMEOUT:
+        raise HTTPDataStoreError("No reply from %s:%d. Giving up." %
+                                 (self.Address(), self.Port()))
+
+  def _RaiseAsyncError(self):
+    if self.async_error is not None:
+      error, self.async_error = self.async_error, None
+      raise error
+
+  def MakeRequestAndContinue(self, command, unused_subject):
+    """Buffer the request and return without waiting for the reply."""
+    with self.cond:
+      self._Enqueue(command)
+      if len(self.outgoing) >= self.max_batch_size:
+        self._Flush()
+      if len(self.inflight) >= self.max_inflight:
+        self._Flush()
+        self._WaitFor(lambda: len(self.inflight) < self.max_inflight)
+    return None
+
+  def SyncAndMakeRequests(self, commands):
+    """Make several requests at once and wait for all the responses."""
+    with self.cond:
+      request_ids = [self._Enqueue(command) for command in commands]
+      self.waiting.update(request_ids)
+      try:
+        self._Flush()
+        self._WaitFor(lambda: all(x in self.responses for x in request_ids))
+        responses = [self.responses.pop(x) for x in request_ids]
+      finally:
+        self.waiting.difference_update(request_ids)
+        for request_id in request_ids:
+          self.responses.pop(request_id, None)
+
+    return [CheckResponseStatus(response) for response in responses]
+
+  def SyncAndMakeRequest(self, command):
+    """Make a request to the data server and return the response."""
+    return self.SyncAndMakeRequests([command])[0]
+
+  def Sync(self):
+    """Wait until all the buffered requests are acknowledged."""
+    with self.cond:
+      self._Flush()
+      self._WaitFor(lambda: not self.inflight)
+      self._RaiseAsyncError()
+
+  def NumPendingRequests(self):
+    return len(self.inflight)
+
+  def Close(self):
+    self.closed = True
+    super(PipelinedDataServerConnection, self).Close()
+
+
 class DataServer(object):
   """A DataServer object contains connections a data server."""
 
@@ -279,8 +504,19 @@ class DataServer(object):
     self.conn = httplib.HTTPConnection(self.Address(), self.Port())
     self.lock = threading.Lock()
     self.max_connections = config_lib.CONFIG["Dataserver.max_connections"]
-    # Start with a single connection.
-    self.connections = [DataServerConnection(self)]
+    self.pipelining = config_lib.CONFIG["HTTPDataStore.pipelining"]
+    self.connections = []
+    if self.pipelining:
+      # A single pipelined connection keeps many requests in flight, and
+      # using only one keeps the requests to this server ordered.
+      try:
+        self.connections = [PipelinedDataServerConnection(self)]
+      except UnsupportedServiceError as e:
+        logging.warning("%s Falling back to the legacy protocol.", e)
+        self.pipelining = False
+    if not self.connections:
+      # Start with a single connection.
+      self.connections = [DataServerConnection(self)]
 
   def Port(self):
     return self.port
@@ -304,6 +540,8 @@ class DataServer(object):
   @utils.Synchronized
   def GetConnection(self):
     """Return a connection to the data server."""
+    if self.pipelining:
+      return self.connections[0]
     best = min(self.connections, key=lambda x: x.NumPendingRequests())
     if best.NumPendingRequests():
       if len(self.connections) == self.max_connections:
@@ -562,19 +800,24 @@ class HTTPDataStore(data_store.DataStore):
                         timestamp=None, token=None, limit=None):
     """MultiResolveRegex."""
     typ = rdfvalue.DataStoreCommand.Command.MULTI_RESOLVE_REGEX
-    results = {}
+    # Group the requests by connection so that pipelined connections can
+    # have all of them in flight at the same time.
+    commands = {}
     for subject in subjects:
       request = self._MakeRequest([subject], predicate_regex,
                                   timestamp=timestamp, token=token,
                                   limit=limit)
+      cmd = rdfvalue.DataStoreCommand(command=typ, request=request)
+      commands.setdefault(self.GetServer(subject), []).append(cmd)
 
-      response = self._MakeSyncRequest(request, typ)
-
-      if response.results:
-        result_set = response.results[0]
-        values = [(pred, self._Decode(value), ts)
-                  for (pred, value, ts) in result_set.payload]
-        results[result_set.subject] = values
+    results = {}
+    for server, server_commands in commands.iteritems():
+      for response in server.SyncAndMakeRequests(server_commands):
+        if response.results:
+          result_set = response.results[0]
+          values = [(pred, self._Decode(value), ts)
+                    for (pred, value, ts) in result_set.payload]
+          results[result_set.subject] = values
 
     return results.iteritems()
 
@@ -17,6 +17,7 @@ from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 
 from grr.lib.data_stores import http_data_store
 from grr.lib.data_stores import sqlite_data_store
@@ -87,11 +88,15 @@ def tearDownModule():
 
 class HTTPDataStoreMixin(object):
 
+  # Whether to use the pipelined protocol.
+  pipelining = False
+
   def InitDatastore(self):
     global PORT
     if not PORT:
       PORT = 7000
     _SetConfig(self.temp_dir)
+    config_lib.CONFIG.Set("HTTPDataStore.pipelining", self.pipelining)
     if not STARTED_SERVER:
       _StartServer(self.temp_dir)
     else:
@@ -139,6 +144,38 @@ class HTTPDataStoreTest(HTTPDataStoreMixin,
     pass
 
 
+class PipelinedHTTPDataStoreTest(HTTPDataStoreTest):
+  """Test the remote data store using the pipelined protocol."""
+
+  pipelining = True
+
+  def testAsyncRequestsAreBatched(self):
+    for i in range(50):
+      data_store.DB.MultiSet("aff4:/pipelined/%d" % i,
+                             {"metadata:predicate": ["value%d" % i]},
+                             sync=False, token=self.token)
+    data_store.DB.Flush()
+
+    subjects = ["aff4:/pipelined/%d" % i for i in range(50)]
+    results = dict(data_store.DB.MultiResolveRegex(
+        subjects, "metadata:.*", token=self.token))
+    self.assertEqual(len(results), 50)
+    for i, subject in enumerate(subjects):
+      self.assertEqual(results[subject][0][1], "value%d" % i)
+
+  def testFallsBackToLegacyProtocol(self):
+    # Data servers without the pipelined protocol reply with a HTTP error.
+    with utils.Stubber(data_server, "EVENT_LOOP", None):
+      server = http_data_store.DataServer("127.0.0.1", PORT)
+
+    try:
+      self.assertFalse(server.pipelining)
+      self.assertIs(type(server.GetConnection()),
+                    http_data_store.DataServerConnection)
+    finally:
+      server.Close()
+
+
 class HTTPDataStoreBenchmarks(HTTPDataStoreMixin,
                               data_store_test.DataStoreBenchmarks):
   """Benchmark the HTTP remote data store abstraction."""
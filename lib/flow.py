@@ -41,7 +41,9 @@ self.state.context.args: The flow runners args. This is an instance of
 """
 
 
+import cPickle
 import functools
+import hashlib
 import operator
 import time
 
@@ -475,17 +477,24 @@ class GRRFlow(aff4.AFF4Volume):
   # state object which will be serialized between state executions.
   state = None
 
+  # Large state entries are stored in attributes with this prefix.
+  STATE_ENTRY_PREFIX = "flow_state:"
+
   runner_cls = flow_runner.FlowRunner
 
   def Initialize(self):
     """The initialization method."""
     if "r" in self.mode:
-      self.state = self.Get(self.Schema.FLOW_STATE)
-      if self.state:
-        self.Load()
+      with stats.Timed("flow_stage_latency",
+                       fields=[self.Name(), "deserialize"]):
+        self.state = self.Get(self.Schema.FLOW_STATE)
+        if self.state:
+          self.ReadExternalState()
+          self.Load()
 
-        # A convenience attribute to allow flows to access their args directly.
-        self.args = self.state.get("args")
+          # A convenience attribute to allow flows to access their args
+          # directly.
+          self.args = self.state.get("args")
 
     if self.state is None:
       self.state = self.Schema.FLOW_STATE()
@@ -549,11 +558,76 @@ class GRRFlow(aff4.AFF4Volume):
     else:
       logging.warning("%s is heartbeating while not being locked.", self.urn)
 
+  def ReadExternalState(self):
+    """Loads the state entries which are stored in their own attributes."""
+    names = self.state.GetExternalEntries()
+    if not names:
+      return
+
+    found = set()
+    for predicate, value, _ in data_store.DB.ResolveRegex(
+        self.urn, self.STATE_ENTRY_PREFIX + ".*", token=self.token,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, limit=None):
+      name = predicate[len(self.STATE_ENTRY_PREFIX):]
+      if name not in names:
+        continue
+
+      try:
+        self.state.SetExternalEntry(name, cPickle.loads(value))
+        found.add(name)
+      except Exception as e:  # pylint: disable=broad-except
+        self.state.errors = e
+
+    if len(found) != len(names):
+      self.state.errors = self.state.errors or IOError(
+          "State entries %s are missing." % sorted(set(names) - found))
+
+  def WriteExternalState(self):
+    """Writes the large state entries which changed to their own attributes.
+
+    Large containers like MultiGetFile's pending_hashes would otherwise be
+    pickled and rewritten as part of the state on every state transition.
+    """
+    threshold = config_lib.CONFIG["Worker.flow_state_entry_threshold"]
+    if not threshold:
+      return
+
+    to_write = {}
+    for name, value in self.state.LoadedItems():
+      if (name not in self.state.external_entries and
+          not isinstance(value, (dict, list, set))):
+        continue
+
+      serialized = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+      if (name not in self.state.external_entries and
+          len(serialized) < threshold):
+        continue
+
+      digest = hashlib.sha1(serialized).digest()
+      if self.state.external_entries.get(name) != digest:
+        to_write[self.STATE_ENTRY_PREFIX + name] = [serialized]
+        self.state.MarkExternal(name, digest)
+
+    removed = [name for name in self.state.external_entries
+               if name not in self.state.data]
+    for name in removed:
+      self.state.UnmarkExternal(name)
+
+    if removed:
+      data_store.DB.DeleteAttributes(
+          self.urn, [self.STATE_ENTRY_PREFIX + name for name in removed],
+          sync=False, token=self.token)
+
+    if to_write:
+      data_store.DB.MultiSet(self.urn, to_write, replace=True, sync=False,
+                             token=self.token)
+
   def WriteState(self):
     if "w" in self.mode:
       if self.state.Empty():
         raise IOError("Trying to write an empty state for flow %s." %
                       self.urn)
+      self.WriteExternalState()
       self.Set(self.Schema.FLOW_STATE(self.state))
 
   def FlushMessages(self):
@@ -564,24 +638,28 @@ class GRRFlow(aff4.AFF4Volume):
     """Flushes the flow and all its requests to the data_store."""
     # Check for Lock expiration first.
     self.CheckLease()
-    self.Save()
-    self.WriteState()
+    with stats.Timed("flow_stage_latency", fields=[self.Name(), "serialize"]):
+      self.Save()
+      self.WriteState()
     self.Load()
-    super(GRRFlow, self).Flush(sync=sync)
-    # Writing the messages queued in the queue_manager of the runner always has
-    # to be the last thing that happens or we will have a race condition.
-    self.FlushMessages()
+    with stats.Timed("flow_stage_latency", fields=[self.Name(), "flush"]):
+      super(GRRFlow, self).Flush(sync=sync)
+      # Writing the messages queued in the queue_manager of the runner always
+      # has to be the last thing that happens or we will have a race condition.
+      self.FlushMessages()
 
   def Close(self, sync=True):
     """Flushes the flow and all its requests to the data_store."""
     # Check for Lock expiration first.
     self.CheckLease()
-    self.Save()
-    self.WriteState()
-    super(GRRFlow, self).Close(sync=sync)
-    # Writing the messages queued in the queue_manager of the runner always has
-    # to be the last thing that happens or we will have a race condition.
-    self.FlushMessages()
+    with stats.Timed("flow_stage_latency", fields=[self.Name(), "serialize"]):
+      self.Save()
+      self.WriteState()
+    with stats.Timed("flow_stage_latency", fields=[self.Name(), "flush"]):
+      super(GRRFlow, self).Close(sync=sync)
+      # Writing the messages queued in the queue_manager of the runner always
+      # has to be the last thing that happens or we will have a race condition.
+      self.FlushMessages()
 
   def CreateRunner(self, parent_runner=None, runner_args=None, **kw):
     """Make a new runner."""
@@ -1069,7 +1147,8 @@ class WellKnownFlow(GRRFlow):
       priority = rdfvalue.GrrMessage.Priority.MEDIUM_PRIORITY
       with queue_manager.WellKnownQueueManager(
           token=self.token) as manager:
-        for request, responses in manager.FetchRequestsAndResponses(
+        # The manager deletes the responses once we have consumed them.
+        for _, responses in manager.FetchRequestsAndResponses(
             self.session_id):
           for msg in responses:
             # Even though we use the thread pool here, it may be exhausted so we
@@ -1080,8 +1159,6 @@ class WellKnownFlow(GRRFlow):
             thread_pool.AddTask(target=self._SafeProcessMessage,
                                 args=(msg,), name=self.__class__.__name__)
 
-          manager.DeleteFlowRequestStates(self.session_id, request)
-
     except queue_manager.MoreDataException:
       # There is more data for this flow so we have to tell the worker to
       # fetch more messages later.
@@ -1743,11 +1820,13 @@ class FrontEndServer(object):
                                 token=self.token)
 
       sessions_handled = []
+      well_known_sessions = set()
       for session_id, messages in utils.GroupBy(
           messages, operator.attrgetter("session_id")).iteritems():
 
         # Remove and handle messages to WellKnownFlows
-        messages = self.HandleWellKnownFlows(messages)
+        messages = self.HandleWellKnownFlows(
+            messages, handled_sessions=well_known_sessions)
 
         if not messages: continue
 
@@ -1757,11 +1836,28 @@ class FrontEndServer(object):
         for msg in messages:
           manager.QueueResponse(session_id, msg)
 
+      # Remove the notifications of the well known flows we just ran, for the
+      # whole bundle at once.
+      if well_known_sessions:
+        manager.MultiDeleteNotifications(well_known_sessions,
+                                         end=rdfvalue.RDFDatetime().Now())
+
     logging.debug("Received %s messages in %s sec", len(messages),
                   time.time() - now)
 
-  def HandleWellKnownFlows(self, messages):
-    """Hands off messages to well known flows."""
+  def HandleWellKnownFlows(self, messages, handled_sessions=None):
+    """Hands off messages to well known flows.
+
+    Args:
+      messages: A list of GrrMessages.
+      handled_sessions: If given, the session ids of the well known flows
+        which processed a message are added to this set and the caller is
+        responsible for deleting their notifications. Otherwise they are
+        deleted right away.
+
+    Returns:
+      The messages which need to be queued for the workers.
+    """
     result = []
     for msg in messages:
       # Regular message - queue it.
@@ -1777,8 +1873,11 @@ class FrontEndServer(object):
           flow.HeartBeat()
 
           # Remove the notification from the well known flows.
-          queue_manager.QueueManager(token=self.token).DeleteNotification(
-              msg.session_id)
+          if handled_sessions is None:
+            queue_manager.QueueManager(token=self.token).DeleteNotification(
+                msg.session_id)
+          else:
+            handled_sessions.add(msg.session_id)
 
           # TODO(user): Deprecate in favor of 'well_known_flow_requests'
           # metric.
@@ -1831,6 +1930,12 @@ class FlowInit(registry.InitHook):
         "frontend_inactive_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
+    # Latency of the read, queue, process and write stages of requests in the
+    # async frontend.
+    stats.STATS.RegisterEventMetric(
+        "frontend_stage_latency", fields=[("stage", str)])
+    stats.STATS.RegisterGaugeMetric("frontend_queue_depth", int)
+    stats.STATS.RegisterCounterMetric("frontend_throttled_count")
 
     # Counters defined here
     stats.STATS.RegisterCounterMetric("grr_flow_completed_count")
@@ -1862,3 +1967,13 @@ class FlowInit(registry.InitHook):
                                       fields=[("flow", str)])
     stats.STATS.RegisterCounterMetric("well_known_flow_requests",
                                       fields=[("flow", str)])
+
+    # Where the worker spends its time, per flow class. Stages are lease,
+    # deserialize, fetch, output, serialize, flush and process.
+    stats.STATS.RegisterEventMetric(
+        "flow_stage_latency", fields=[("flow", str), ("stage", str)],
+        units="SECONDS")
+    # Time spent in the state methods themselves.
+    stats.STATS.RegisterEventMetric(
+        "flow_state_latency", fields=[("flow", str), ("state", str)],
+        units="SECONDS")
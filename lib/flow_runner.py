@@ -55,6 +55,9 @@ queues. Child flow runners all share their parent's queue manager.
 
 """
 
+import cProfile
+import os
+import random
 import threading
 import time
 import traceback
@@ -64,6 +67,7 @@ import logging
 from grr.client import actions
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
@@ -75,6 +79,36 @@ class FlowRunnerError(Exception):
   """Raised when there is an error during state transitions."""
 
 
+def _TimedIteration(generator_factory, fields):
+  """Iterates over a generator, recording the total time spent in it.
+
+  Args:
+    generator_factory: A callable returning the iterable.
+    fields: The fields of the flow_stage_latency metric to record.
+
+  Yields:
+    The items of the iterable.
+  """
+  elapsed = 0
+  try:
+    start = time.time()
+    iterator = iter(generator_factory())
+    elapsed += time.time() - start
+
+    while True:
+      start = time.time()
+      try:
+        item = iterator.next()
+      except StopIteration:
+        return
+      finally:
+        elapsed += time.time() - start
+
+      yield item
+  finally:
+    stats.STATS.RecordEvent("flow_stage_latency", elapsed, fields=fields)
+
+
 class FlowRunner(object):
   """The flow context class for hunts.
 
@@ -91,6 +125,10 @@ class FlowRunner(object):
   process_requests_in_order = True
   queue_manager = None
 
+  # While processing completed requests, progress is written after this many
+  # responses.
+  flush_response_count = 10000
+
   client_id = None
 
   def __init__(self, flow_obj, parent_runner=None, runner_args=None,
@@ -346,7 +384,8 @@ class FlowRunner(object):
     # Notify the worker about it.
     self.QueueNotification(session_id=self.session_id, timestamp=start_time)
 
-  def ProcessCompletedRequests(self, notification, thread_pool):
+  def ProcessCompletedRequests(self, notification, thread_pool,
+                               completed_requests=None):
     """Go through the list of requests and process the completed ones.
 
     We take a snapshot in time of all requests and responses for this flow. We
@@ -362,14 +401,19 @@ class FlowRunner(object):
       notification: The notification object that triggered this processing.
       thread_pool: For regular flows, the messages have to be processed in
                    order. Thus, the thread_pool argument is only used for hunts.
+      completed_requests: The completed requests of this flow if the worker
+                   already fetched them together with those of other flows.
     """
+    if completed_requests is None:
+      completed_requests = list(self.queue_manager.FetchCompletedRequests(
+          self.session_id, timestamp=(0, notification.timestamp)))
+
     # First ensure that client messages are all removed. NOTE: We make a new
     # queue manager here because we want only the client messages to be removed
     # ASAP. This must happen before we actually run the flow to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
-          self.session_id, timestamp=(0, notification.timestamp)):
+      for request, _ in completed_requests:
         # Requests which are not destined to clients have no embedded request
         # message.
         if request.HasField("request"):
@@ -383,101 +427,104 @@ class FlowRunner(object):
       return
 
     processing = []
-    while True:
-      try:
-        # Here we only care about completed requests - i.e. those requests with
-        # responses followed by a status message.
-        for request, responses in self.queue_manager.FetchCompletedResponses(
-            self.session_id, timestamp=(0, notification.timestamp)):
-
-          if request.id == 0:
-            continue
-
-          if self.process_requests_in_order:
-            if not responses:
-              break
-
-            # We are missing a needed request - maybe its not completed yet.
-            if request.id > self.context.next_processed_request:
-              stats.STATS.IncrementCounter("grr_response_out_of_order")
-              break
-
-            # Not the request we are looking for - we have seen it before
-            # already.
-            if request.id < self.context.next_processed_request:
-              self.queue_manager.DeleteFlowRequestStates(
-                  self.session_id, request)
-              continue
-
+    unflushed_responses = 0
+    try:
+      # Here we only care about completed requests - i.e. those requests with
+      # responses followed by a status message. Responses are read in batches
+      # while we process them to keep a low memory footprint.
+      for request, responses in _TimedIteration(
+          lambda: self.queue_manager.StreamCompletedResponses(
+              self.session_id, timestamp=(0, notification.timestamp),
+              completed_requests=completed_requests),
+          fields=[self.flow_obj.Name(), "fetch"]):
+
+        if request.id == 0:
+          continue
+
+        if self.process_requests_in_order:
           if not responses:
-            continue
-
-          # Do we have all the responses here? This can happen if some of the
-          # responses were lost.
-          if len(responses) != responses[-1].response_id:
-            # If we can retransmit do so. Note, this is different from the
-            # automatic retransmission facilitated by the task scheduler (the
-            # Task.task_ttl field) which would happen regardless of these.
-            if request.transmission_count < 5:
-              stats.STATS.IncrementCounter("grr_request_retransmission_count")
-              request.transmission_count += 1
-              self.ReQueueRequest(request)
             break
 
-          # If we get here its all good - run the flow.
-          if self.IsRunning():
-            self.flow_obj.HeartBeat()
-            self._Process(request, responses, thread_pool=thread_pool,
-                          events=processing)
-
-          # Quit early if we are no longer alive.
-          else: break
-
-          # At this point we have processed this request - we can remove it and
-          # its responses from the queue.
-          self.queue_manager.DeleteFlowRequestStates(self.session_id, request)
-          self.context.next_processed_request += 1
-          self.DecrementOutstandingRequests()
-
-        # Are there any more outstanding requests?
-        if not self.OutstandingRequests():
-          # Allow the flow to cleanup
-          if self.IsRunning() and self.context.current_state != "End":
-            self.RunStateMethod("End")
-
-        # Rechecking the OutstandingRequests allows the End state (which was
-        # called above) to issue further client requests - hence postpone
-        # termination.
-        if not self.OutstandingRequests():
-          # TODO(user): Deprecate in favor of 'flow_completions' metric.
-          stats.STATS.IncrementCounter("grr_flow_completed_count")
-
-          stats.STATS.IncrementCounter("flow_completions",
-                                       fields=[self.flow_obj.Name()])
-          logging.info("Destroying session %s(%s) for client %s",
-                       self.session_id, self.flow_obj.Name(),
-                       self.args.client_id)
-
-          self.Terminate()
-
-        # We are done here.
-        return
+          # We are missing a needed request - maybe its not completed yet.
+          if request.id > self.context.next_processed_request:
+            stats.STATS.IncrementCounter("grr_response_out_of_order")
+            break
 
-      except queue_manager.MoreDataException:
-        # Join any threads.
-        for event in processing:
-          event.wait()
+          # Not the request we are looking for - we have seen it before
+          # already.
+          if request.id < self.context.next_processed_request:
+            self.queue_manager.DeleteFlowRequestStates(
+                self.session_id, request)
+            continue
 
-        # We did not read all the requests/responses in this run in order to
-        # keep a low memory footprint and have to make another pass.
-        self.FlushMessages()
-        self.flow_obj.Flush()
-        continue
+        if not responses:
+          continue
+
+        # Do we have all the responses here? This can happen if some of the
+        # responses were lost.
+        if len(responses) != responses[-1].response_id:
+          # If we can retransmit do so. Note, this is different from the
+          # automatic retransmission facilitated by the task scheduler (the
+          # Task.task_ttl field) which would happen regardless of these.
+          if request.transmission_count < 5:
+            stats.STATS.IncrementCounter("grr_request_retransmission_count")
+            request.transmission_count += 1
+            self.ReQueueRequest(request)
+          break
+
+        # If we get here its all good - run the flow.
+        if self.IsRunning():
+          self.flow_obj.HeartBeat()
+          self._Process(request, responses, thread_pool=thread_pool,
+                        events=processing)
+
+        # Quit early if we are no longer alive.
+        else: break
+
+        # At this point we have processed this request - we can remove it and
+        # its responses from the queue.
+        self.queue_manager.DeleteFlowRequestStates(self.session_id, request)
+        self.context.next_processed_request += 1
+        self.DecrementOutstandingRequests()
+
+        # Write our progress and delete the processed requests from time to
+        # time so they are not processed again if we die.
+        unflushed_responses += len(responses)
+        if unflushed_responses >= self.flush_response_count:
+          for event in processing:
+            event.wait()
+          self.FlushMessages()
+          self.flow_obj.Flush()
+          unflushed_responses = 0
+
+      # Are there any more outstanding requests?
+      if not self.OutstandingRequests():
+        # Allow the flow to cleanup
+        if self.IsRunning() and self.context.current_state != "End":
+          self.RunStateMethod("End")
+
+      # Rechecking the OutstandingRequests allows the End state (which was
+      # called above) to issue further client requests - hence postpone
+      # termination.
+      if not self.OutstandingRequests():
+        # TODO(user): Deprecate in favor of 'flow_completions' metric.
+        stats.STATS.IncrementCounter("grr_flow_completed_count")
+
+        stats.STATS.IncrementCounter("flow_completions",
+                                     fields=[self.flow_obj.Name()])
+        logging.info("Destroying session %s(%s) for client %s",
+                     self.session_id, self.flow_obj.Name(),
+                     self.args.client_id)
+
+        self.Terminate()
+
+      # We are done here.
+      return
 
-      finally:
-        # Join any threads.
-        for event in processing:
-          event.wait()
+    finally:
+      # Join any threads.
+      for event in processing:
+        event.wait()
 
   def _Process(self, request, responses, **_):
     """Flows process responses serially in the same thread."""
@@ -518,14 +565,30 @@ class FlowRunner(object):
       # Extend our lease if needed.
       self.flow_obj.HeartBeat()
       try:
-        method = getattr(self.flow_obj, method)
+        state_method = getattr(self.flow_obj, method)
       except AttributeError:
         raise FlowRunnerError("Flow %s has no state method %s" % (
             self.flow_obj.__class__.__name__, method))
 
-      method(direct_response=direct_response,
-             request=request,
-             responses=responses)
+      profiler = None
+      if random.random() < config_lib.CONFIG["Worker.profile_sample_rate"]:
+        profiler = cProfile.Profile()
+
+      start = time.time()
+      try:
+        if profiler:
+          profiler.runcall(state_method, direct_response=direct_response,
+                           request=request, responses=responses)
+        else:
+          state_method(direct_response=direct_response,
+                       request=request,
+                       responses=responses)
+      finally:
+        elapsed = time.time() - start
+        stats.STATS.RecordEvent("flow_state_latency", elapsed,
+                                fields=[self.flow_obj.Name(), method])
+        if profiler:
+          self._DumpProfile(profiler, method, elapsed)
 
     # We don't know here what exceptions can be thrown in the flow but we have
     # to continue. Thus, we catch everything.
@@ -545,6 +608,23 @@ class FlowRunner(object):
       if event:
         event.set()
 
+  def _DumpProfile(self, profiler, method, elapsed):
+    """Writes the profile of a state method if it was slow."""
+    if elapsed < config_lib.CONFIG["Worker.profile_slow_state_threshold"]:
+      return
+
+    profile_dir = config_lib.CONFIG["Worker.profile_dir"]
+    path = os.path.join(profile_dir, "%s.%s.%d.prof" % (
+        self.flow_obj.Name(), method, time.time() * 1e6))
+    try:
+      if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+      profiler.dump_stats(path)
+      logging.info("State %s of %s took %.1f seconds, profile written to %s",
+                   method, self.session_id, elapsed, path)
+    except (IOError, OSError) as e:
+      logging.warning("Unable to write profile %s: %s", path, e)
+
   def GetNextOutboundId(self):
     with self.outbound_lock:
       my_id = self.context.next_outbound_id
@@ -552,7 +632,8 @@ class FlowRunner(object):
     return my_id
 
   def CallClient(self, action_name, request=None, next_state=None,
-                 client_id=None, request_data=None, start_time=None, **kwargs):
+                 client_id=None, request_data=None, start_time=None,
+                 deadline=None, **kwargs):
     """Calls the client asynchronously.
 
     This sends a message to the client to invoke an Action. The run
@@ -581,6 +662,10 @@ class FlowRunner(object):
        start_time: Call the client at this time. This Delays the client request
          for into the future.
 
+       deadline: An RDFDatetime by which the request should be sent to the
+         client. Requests of the same priority are handed out earliest deadline
+         first.
+
        **kwargs: These args will be used to construct the client action semantic
          protobuf.
 
@@ -639,6 +724,9 @@ class FlowRunner(object):
         require_fastpoll=self.args.require_fastpoll,
         queue=client_id.Queue(), payload=request)
 
+    if deadline is not None:
+      msg.deadline = deadline
+
     if self.context.remaining_cpu_quota:
       msg.cpu_limit = int(self.context.remaining_cpu_quota)
 
@@ -657,6 +745,9 @@ class FlowRunner(object):
       if msg.network_bytes_limit == 0:
         raise FlowRunnerError("Network limit exceeded.")
 
+    msg.io_bytes_per_second = self.context.args.io_bytes_per_second
+    msg.io_ops_per_second = self.context.args.io_ops_per_second
+
     state.request = msg
 
     self.QueueRequest(state, timestamp=start_time)
@@ -785,6 +876,10 @@ class FlowRunner(object):
                           getattr(self.args, "write_intermediate_results",
                                   False))
 
+    # Child flows read from the same client so they share our I/O limits.
+    kwargs.setdefault("io_bytes_per_second", self.args.io_bytes_per_second)
+    kwargs.setdefault("io_ops_per_second", self.args.io_ops_per_second)
+
     # Create the new child flow but do not notify the user about it.
     child_urn = self.flow_obj.StartFlow(
         client_id=client_id, flow_name=flow_name,
@@ -897,7 +992,9 @@ class FlowRunner(object):
     try:
       # Close off the output collection.
       if self.output and len(self.output):
-        self.output.Close()
+        with stats.Timed("flow_stage_latency",
+                         fields=[self.flow_obj.Name(), "output"]):
+          self.output.Close()
         logging.info("%s flow results written to %s", len(self.output),
                      self.output.urn)
         self.output = None
@@ -952,6 +1049,7 @@ class FlowRunner(object):
     system_cpu_total = self.context.client_resources.cpu_usage.system_cpu_time
 
     self.context.network_bytes_sent += status.network_bytes_sent
+    self.context.client_resources.io_throttled_time += status.io_throttled_time
 
     if self.context.args.cpu_limit:
       if self.context.args.cpu_limit < (user_cpu_total + system_cpu_total):
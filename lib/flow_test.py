@@ -14,12 +14,14 @@ from grr.client import vfs
 from grr.lib import access_control
 from grr.lib import action_mocks
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import flow_runner
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import type_info
 from grr.lib import utils
@@ -130,6 +132,46 @@ class FlowCreationTest(BasicFlowTest):
     types = list(flow_obj.GetValuesForAttribute(flow_obj.Schema.TYPE))
     self.assertEqual(len(types), 1)
 
+  def testLargeStateEntriesAreStoredSeparately(self):
+    session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id, flow_name="FlowOrderTest", token=self.token)
+    big = dict((i, "x" * 100) for i in range(1000))
+
+    with test_lib.FakeTime(1000):
+      flow_obj = aff4.FACTORY.Open(session_id, mode="rw", token=self.token)
+      flow_obj.state.Register("big", big)
+      flow_obj.Close()
+
+    pickled_state, _ = data_store.DB.Resolve(
+        session_id, "aff4:flow_state", token=self.token)
+    self.assertLess(len(pickled_state), 10000)
+    _, entry_timestamp = data_store.DB.Resolve(
+        session_id, "flow_state:big", token=self.token)
+
+    # Changing other entries does not rewrite the large one.
+    with test_lib.FakeTime(2000):
+      flow_obj = aff4.FACTORY.Open(session_id, mode="rw", token=self.token)
+      self.assertEqual(flow_obj.state.big, big)
+      flow_obj.state.Register("small", 1)
+      flow_obj.Close()
+
+    _, timestamp = data_store.DB.Resolve(
+        session_id, "flow_state:big", token=self.token)
+    self.assertEqual(timestamp, entry_timestamp)
+
+    with test_lib.FakeTime(3000):
+      flow_obj = aff4.FACTORY.Open(session_id, mode="rw", token=self.token)
+      flow_obj.state.big[5] = "changed"
+      flow_obj.Close()
+
+    _, timestamp = data_store.DB.Resolve(
+        session_id, "flow_state:big", token=self.token)
+    self.assertGreater(timestamp, entry_timestamp)
+
+    flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+    self.assertEqual(flow_obj.state.big[5], "changed")
+    self.assertEqual(flow_obj.state.small, 1)
+
   def testFlowSerialization(self):
     """Check that we can unpickle flows."""
     session_id = flow.GRRFlow.StartFlow(
@@ -333,6 +375,26 @@ class FlowCreationTest(BasicFlowTest):
         count += 1
       self.assertEqual(count, 8)
 
+  def testSlowStatesAreProfiled(self):
+    profile_dir = os.path.join(self.temp_dir, "profiles")
+    config_lib.CONFIG.Set("Worker.profile_sample_rate", 1.0)
+    config_lib.CONFIG.Set("Worker.profile_slow_state_threshold", 0)
+    config_lib.CONFIG.Set("Worker.profile_dir", profile_dir)
+
+    runs = stats.STATS.GetMetricValue(
+        "flow_state_latency", fields=["DummyLogFlow", "Start"]).count
+
+    for _ in test_lib.TestFlowHelper("DummyLogFlow", action_mocks.ActionMock(),
+                                     token=self.token,
+                                     client_id=self.client_id):
+      pass
+
+    self.assertEqual(stats.STATS.GetMetricValue(
+        "flow_state_latency", fields=["DummyLogFlow", "Start"]).count,
+                     runs + 1)
+    self.assertTrue([name for name in os.listdir(profile_dir)
+                     if name.startswith("DummyLogFlow.Start.")])
+
 
 class FlowTest(BasicFlowTest):
   """Tests the Flow."""
@@ -35,6 +35,9 @@ class AdministrativeInit(registry.InitHook):
 
   def RunOnce(self):
     stats.STATS.RegisterCounterMetric("grr_client_crashes")
+    stats.STATS.RegisterEventMetric(
+        "grr_load_test_message_latency", units="SECONDS",
+        fields=[("type", str)])
 
 
 class ClientCrashEventListener(flow.EventListener):
@@ -734,6 +737,27 @@ class IgnoreResponses(flow.WellKnownFlow):
     pass
 
 
+class LoadTestSink(flow.WellKnownFlow):
+  """Receives the traffic generated by poolclient load tests.
+
+  The messages are dropped, but the time between the client creating a
+  message and this flow processing it is recorded so the load test can report
+  the end to end queue latency.
+  """
+
+  category = None
+
+  well_known_session_id = rdfvalue.SessionID("aff4:/flows/W:LoadTest")
+
+  def ProcessMessage(self, message):
+    if message.args_age:
+      latency = (int(rdfvalue.RDFDatetime().Now()) -
+                 int(message.args_age)) / 1e6
+      stats.STATS.RecordEvent("grr_load_test_message_latency",
+                              max(0, latency),
+                              fields=[message.args_rdf_name or "None"])
+
+
 class KeepAliveArgs(rdfvalue.RDFProtoStruct):
   protobuf = flows_pb2.KeepAliveArgs
 
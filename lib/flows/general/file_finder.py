@@ -139,7 +139,8 @@ class FileFinder(transfer.MultiGetFileMixin,
 
     else:
       self.GlobForPaths(self.args.paths, pathtype=self.args.pathtype,
-                        no_file_type_check=self.args.no_file_type_check)
+                        no_file_type_check=self.args.no_file_type_check,
+                        index_max_age=self.args.index_max_age)
 
   def GlobReportMatch(self, response):
     """This method is called by the glob mixin when there is a match."""
@@ -508,7 +508,7 @@ class GlobMixin(object):
   """A MixIn to implement the glob functionality."""
 
   def GlobForPaths(self, paths, pathtype="OS", root_path=None,
-                   no_file_type_check=False):
+                   no_file_type_check=False, index_max_age=0):
     """Starts the Glob.
 
     This is the main entry point for this flow mixin.
@@ -523,6 +523,8 @@ class GlobMixin(object):
       root_path: A pathspec where to start searching from.
       no_file_type_check: Work with all kinds of files - not only with regular
                           ones.
+      index_max_age: The maximum age of directory listings the client may
+                     answer from its file index, 0 always lists directories.
     """
     patterns = []
 
@@ -535,6 +537,7 @@ class GlobMixin(object):
     self.state.Register("pathtype", pathtype)
     self.state.Register("root_path", root_path)
     self.state.Register("no_file_type_check", no_file_type_check)
+    self.state.Register("index_max_age", index_max_age)
 
     # Transform the patterns by substitution of client attributes. When the
     # client has multiple values for an attribute, this generates multiple
@@ -816,7 +819,8 @@ class GlobMixin(object):
           findspec = rdfvalue.FindSpec(pathspec=base_pathspec,
                                        cross_devs=True,
                                        max_depth=depth,
-                                       path_regex=path_regex)
+                                       path_regex=path_regex,
+                                       index_max_age=self.state.index_max_age)
 
           findspec.iterator.number = self.FILE_MAX_PER_DIR
           self.CallClient("Find", findspec,
@@ -828,7 +832,8 @@ class GlobMixin(object):
               set([c.path for c in regexes_to_get])) + "$"
           findspec = rdfvalue.FindSpec(pathspec=base_pathspec,
                                        max_depth=1,
-                                       path_regex=path_regex)
+                                       path_regex=path_regex,
+                                       index_max_age=self.state.index_max_age)
 
           findspec.iterator.number = self.FILE_MAX_PER_DIR
           self.CallClient("Find", findspec,
@@ -858,7 +863,8 @@ class Glob(GlobMixin, flow.GRRFlow):
     super(Glob, self).Start()
     self.GlobForPaths(self.args.paths, pathtype=self.args.pathtype,
                       root_path=self.args.root_path,
-                      no_file_type_check=self.args.no_file_type_check)
+                      no_file_type_check=self.args.no_file_type_check,
+                      index_max_age=self.args.index_max_age)
 
   def GlobReportMatch(self, stat_response):
     """Called when we've found a matching a StatEntry."""
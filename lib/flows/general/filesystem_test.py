@@ -492,6 +492,20 @@ class TestFilesystem(test_lib.FlowTestsBaseclass):
           stat_paths = [c.pathspec.CollapsePath() for c in stat_args]
           self.assertListEqual(sorted(stat_paths), sorted(set(stat_paths)))
 
+  def testGlobUsesFileIndex(self):
+    path = os.path.join(os.path.dirname(self.base_path), "test_data/test_*")
+    client_mock = action_mocks.RecordingActionMock("Find", "StatFile")
+
+    for _ in test_lib.TestFlowHelper(
+        "Glob", client_mock, client_id=self.client_id, paths=[path],
+        index_max_age=rdfvalue.Duration("1h"), token=self.token):
+      pass
+
+    finds = client_mock.recorded_args["Find"]
+    self.assertTrue(finds)
+    for find in finds:
+      self.assertEqual(find.index_max_age, 3600)
+
   def _CheckCasing(self, path, filename):
     output_path = self.client_id.Add("fs/os").Add(os.path.join(
         self.base_path, path))
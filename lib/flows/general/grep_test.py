@@ -117,6 +117,30 @@ class TestSearchFileContentWithFixture(GrepTests):
 
     self.DeleteFile(filename)
 
+  def testSeveralPatterns(self):
+    filename = "/fs/os/c/Downloads/grepfile.txt"
+    self.CreateFile(filename, "one two three four")
+
+    output_path = "analysis/grep3"
+
+    grepspec = rdfvalue.BareGrepSpec(mode=rdfvalue.GrepSpec.Mode.ALL_HITS,
+                                     literals=["three", "two"],
+                                     regexes=["f.ur"])
+
+    for _ in test_lib.TestFlowHelper(
+        "SearchFileContent", self.client_mock, client_id=self.client_id,
+        paths=["/c/Downloads/grepfile.txt"],
+        pathtype=rdfvalue.PathSpec.PathType.OS,
+        grep=grepspec, token=self.token, output=output_path):
+      pass
+
+    fd = aff4.FACTORY.Open(self.client_id.Add(output_path), token=self.token)
+
+    self.assertEqual([(hit.offset, hit.pattern_index) for hit in fd],
+                     [(4, 1), (8, 0), (14, 2)])
+
+    self.DeleteFile(filename)
+
   def testPatternAtBufsize(self):
     old_size = searching.Grep.BUFF_SIZE
     try:
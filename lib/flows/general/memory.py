@@ -823,12 +823,17 @@ class ScanMemory(flow.GRRFlow):
     grep_request = rdfvalue.GrepSpec(target=memory_information.device,
                                      **self.args.grep.AsDict())
 
-    # For literal matches we xor the search term. This stops us matching the GRR
-    # client itself.
+    # For literal matches we xor the search terms. This stops us matching the
+    # GRR client itself.
     if self.args.grep.literal:
       grep_request.literal = utils.Xor(
           utils.SmartStr(self.args.grep.literal), self.XOR_IN_KEY)
 
+    if self.args.grep.literals:
+      grep_request.literals = [
+          utils.Xor(utils.SmartStr(literal), self.XOR_IN_KEY)
+          for literal in self.args.grep.literals]
+
     self.CallClient("Grep", request=grep_request, next_state="Done")
 
   @flow.StateHandler(next_state="End")
@@ -19,6 +19,7 @@ from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import crypto
 
 
@@ -485,6 +486,51 @@ class TestMemoryAnalysis(MemoryTest, grr_rekall_test.RekallTestSuite):
     self.assertEqual(fd[0].offset, 252)
     self.assertEqual(fd[0].data, "\n85\n86\n87\n88\n89\n90\n91\n")
 
+  def testScanMemorySeveralLiterals(self):
+    image_path = os.path.join(self.base_path, "numbers.txt")
+
+    self.CreateClient()
+    self.CreateSignedDriver()
+
+    class ClientMock(action_mocks.MemoryClientMock):
+      """A mock which returns the image as the driver path."""
+
+      def GetMemoryInformation(self, _):
+        reply = rdfvalue.MemoryInformation(
+            device=rdfvalue.PathSpec(
+                path=image_path,
+                pathtype=rdfvalue.PathSpec.PathType.OS))
+
+        reply.runs.Append(offset=0, length=1000000000)
+
+        return [reply]
+
+      def RecordCall(self, action_name, action_args):
+        requests.append(action_args)
+
+    requests = []
+    args = dict(grep=rdfvalue.BareGrepSpec(literals=["88", "99"],
+                                           mode="ALL_HITS"),
+                output="analysis/grep/testing")
+
+    for _ in test_lib.TestFlowHelper(
+        "ScanMemory", ClientMock("Grep"), client_id=self.client_id,
+        token=self.token, **args):
+      pass
+
+    # No literal is sent to the client in the clear.
+    self.assertEqual(len(requests), 1)
+    self.assertEqual(list(requests[0].literals),
+                     [utils.Xor("88", 37), utils.Xor("99", 37)])
+
+    fd = aff4.FACTORY.Open(
+        rdfvalue.RDFURN(self.client_id).Add("/analysis/grep/testing"),
+        token=self.token)
+    self.assertEqual(len(fd), 40)
+    self.assertEqual((fd[0].offset, fd[0].pattern_index), (252, 0))
+    self.assertEqual(fd[0].data, "\n85\n86\n87\n88\n89\n90\n91\n")
+    self.assertEqual((fd[1].offset, fd[1].pattern_index), (285, 1))
+
 
 class ListVADBinariesActionMock(action_mocks.ActionMock):
   """Client with real file actions and mocked-out RekallAction."""
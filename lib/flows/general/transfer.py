@@ -279,6 +279,72 @@ class MultiGetFileMixin(object):
     self.CallClient("FingerprintFile", request, next_state="ReceiveFileHash",
                     request_data=request_data)
 
+  def StartStreamedFetch(self, pathspecs, content_defined=False,
+                         request_data=None):
+    """Fetches all pathspecs with a single StreamFile client action.
+
+    The client is told about the blobs of any previous versions of these files
+    so unchanged chunks are not uploaded again.
+
+    Args:
+      pathspecs: The pathspecs of the files to fetch.
+      content_defined: Split the files at content defined boundaries.
+      request_data: Passed to ReceiveFetchedFile() for each file.
+    """
+    urns = [aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec, self.client_id)
+            for pathspec in pathspecs]
+
+    known_hashes = set()
+    for fd in aff4.FACTORY.MultiOpen(urns, mode="r", token=self.token):
+      if isinstance(fd, aff4.BlobImage):
+        # The index is a list of sha256 digests.
+        index = fd.index.getvalue()
+        known_hashes.update(index[i:i + 32] for i in range(0, len(index), 32))
+
+    self.state.files_to_fetch += len(pathspecs)
+    self.CallClient("StreamFile", pathspecs=pathspecs,
+                    chunk_size=self.CHUNK_SIZE,
+                    known_hashes="".join(sorted(known_hashes)),
+                    content_defined=content_defined,
+                    next_state="ReceiveStreamedFiles",
+                    request_data=request_data)
+
+  @flow.StateHandler()
+  def ReceiveStreamedFiles(self, responses):
+    """Builds the blob images of the files streamed by the client."""
+    if not responses.success:
+      self.Log("Failed to stream files: %s", responses.status)
+
+    request = rdfvalue.StreamFileRequest(responses.request.request.args)
+
+    for response in responses:
+      if response.error:
+        self.Log("Failed to read %s: %s", response.stat_entry.pathspec,
+                 response.error)
+        continue
+
+      file_tracker = FileTracker(response.stat_entry, self.client_id,
+                                 responses.request_data)
+      file_tracker.hash_obj = response.hash
+
+      fd = file_tracker.CreateVFSFile("VFSBlobImage", token=self.token,
+                                      chunksize=self.CHUNK_SIZE)
+      if request.content_defined:
+        fd.SetContentDefined()
+
+      for chunk in response.chunks:
+        fd.AddBlob(chunk.data, chunk.length)
+
+      fd.Set(response.hash)
+      fd.Close(sync=False)
+
+      self.Publish("FileStore.AddFileToStore", fd.urn,
+                   priority=rdfvalue.GrrMessage.Priority.LOW_PRIORITY)
+
+      self.state.files_fetched += 1
+      self.ReceiveFetchedFile(file_tracker.stat_entry, file_tracker.hash_obj,
+                              request_data=file_tracker.request_data)
+
   def ReceiveFetchedFile(self, stat_entry, file_hash, request_data=None):
     """This method will be called for each new file successfully fetched.
 
@@ -573,7 +639,8 @@ class MultiGetFile(MultiGetFileMixin, flow.GRRFlow):
 
   args_type = MultiGetFileArgs
 
-  @flow.StateHandler(next_state=["ReceiveFileHash", "StoreStat"])
+  @flow.StateHandler(next_state=["ReceiveFileHash", "StoreStat",
+                                  "ReceiveStreamedFiles"])
   def Start(self):
     """Start state of the flow."""
     super(MultiGetFile, self).Start()
@@ -581,6 +648,7 @@ class MultiGetFile(MultiGetFileMixin, flow.GRRFlow):
     self.state.use_external_stores = self.args.use_external_stores
 
     unique_paths = set()
+    pathspecs = []
     for pathspec in self.args.pathspecs:
 
       vfs_urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(
@@ -589,8 +657,14 @@ class MultiGetFile(MultiGetFileMixin, flow.GRRFlow):
       if vfs_urn not in unique_paths:
         # Only Stat/Hash each path once, input pathspecs can have dups.
         unique_paths.add(vfs_urn)
+        pathspecs.append(pathspec)
+
+        if not self.args.single_pass:
+          self.StartFileFetch(pathspec, vfs_urn)
 
-        self.StartFileFetch(pathspec, vfs_urn)
+    if self.args.single_pass and pathspecs:
+      self.StartStreamedFetch(
+          pathspecs, content_defined=self.args.content_defined_chunking)
 
   def ReceiveFetchedFile(self, stat_entry, unused_hash_obj,
                          request_data=None):
@@ -172,6 +172,49 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
     self.CompareFDs(fd1, fd2)
 
 
+  def testMultiGetFileSinglePass(self):
+    """Test MultiGetFile streaming all files in one client action."""
+    client_mock = action_mocks.ActionMock("StreamFile")
+    pathspec = rdfvalue.PathSpec(
+        pathtype=rdfvalue.PathSpec.PathType.OS,
+        path=os.path.join(self.base_path, "test_img.dd"))
+
+    args = rdfvalue.MultiGetFileArgs(pathspecs=[pathspec, pathspec],
+                                     single_pass=True)
+    with test_lib.Instrument(
+        transfer.TransferStore, "ProcessMessage") as store_instrument:
+      for _ in test_lib.TestFlowHelper("MultiGetFile", client_mock,
+                                       token=self.token,
+                                       client_id=self.client_id, args=args):
+        pass
+
+      self.assertTrue(store_instrument.call_count > 0)
+
+    # Fix path for Windows testing.
+    pathspec.path = pathspec.path.replace("\\", "/")
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec, self.client_id)
+    fd1 = aff4.FACTORY.Open(urn, token=self.token)
+    fd2 = open(pathspec.path)
+    fd2.seek(0, 2)
+
+    self.assertEqual(fd2.tell(), int(fd1.Get(fd1.Schema.SIZE)))
+    self.CompareFDs(fd1, fd2)
+
+    # Fetching the file again does not upload any chunks.
+    with test_lib.Instrument(
+        transfer.TransferStore, "ProcessMessage") as store_instrument:
+      for _ in test_lib.TestFlowHelper("MultiGetFile", client_mock,
+                                       token=self.token,
+                                       client_id=self.client_id, args=args):
+        pass
+
+      self.assertEqual(store_instrument.call_count, 0)
+
+    fd1 = aff4.FACTORY.Open(urn, token=self.token)
+    fd2.seek(0, 2)
+    self.CompareFDs(fd1, fd2)
+
+
 class FlowTestLoader(test_lib.GRRTestLoader):
   base_class = TestTransfer
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Pollers used by the event loops of the data server and the frontend.
+
+All pollers have the same interface: file descriptors are registered for
+readability and/or writability and Poll() returns a list of
+(fd, readable, writable) tuples.
+"""
+
+
+import select
+
+
+def Poller():
+  """Returns the best poller available on this platform."""
+  if hasattr(select, "epoll"):
+    return EpollPoller()
+  return SelectPoller()
+
+
+class EpollPoller(object):
+  """Poller based on epoll, used on Linux."""
+
+  def __init__(self):
+    self.epoll = select.epoll()
+
+  def _Mask(self, readable, writable):
+    mask = 0
+    if readable:
+      mask |= select.EPOLLIN
+    if writable:
+      mask |= select.EPOLLOUT
+    return mask
+
+  def Register(self, fd, readable, writable):
+    self.epoll.register(fd, self._Mask(readable, writable))
+
+  def Modify(self, fd, readable, writable):
+    self.epoll.modify(fd, self._Mask(readable, writable))
+
+  def Unregister(self, fd):
+    try:
+      self.epoll.unregister(fd)
+    except (IOError, OSError, ValueError):
+      pass
+
+  def Poll(self, timeout):
+    events = []
+    for fd, mask in self.epoll.poll(timeout):
+      # Errors and hangups are reported as readable so that the subsequent
+      # recv() notices them and closes the connection.
+      readable = bool(mask & (select.EPOLLIN | select.EPOLLERR |
+                              select.EPOLLHUP))
+      writable = bool(mask & select.EPOLLOUT)
+      events.append((fd, readable, writable))
+    return events
+
+
+class SelectPoller(object):
+  """Portable poller based on select()."""
+
+  def __init__(self):
+    self.read_fds = set()
+    self.write_fds = set()
+
+  def Register(self, fd, readable, writable):
+    self.Modify(fd, readable, writable)
+
+  def Modify(self, fd, readable, writable):
+    if readable:
+      self.read_fds.add(fd)
+    else:
+      self.read_fds.discard(fd)
+    if writable:
+      self.write_fds.add(fd)
+    else:
+      self.write_fds.discard(fd)
+
+  def Unregister(self, fd):
+    self.read_fds.discard(fd)
+    self.write_fds.discard(fd)
+
+  def Poll(self, timeout):
+    readable, writable, _ = select.select(list(self.read_fds),
+                                          list(self.write_fds), [], timeout)
+    events = dict((fd, [fd, False, False]) for fd in readable + writable)
+    for fd in readable:
+      events[fd][1] = True
+    for fd in writable:
+      events[fd][2] = True
+    return [tuple(x) for x in events.values()]
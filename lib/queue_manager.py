@@ -3,9 +3,12 @@
 
 
 
+import itertools
+import math
 import os
 import random
 import socket
+import threading
 import time
 
 import logging
@@ -26,6 +29,30 @@ class MoreDataException(Error):
   """Raised when there is more data available."""
 
 
+class _ReadAhead(object):
+  """Calls a function in a background thread, the result is collected later."""
+
+  def __init__(self, target, *args):
+    self.result = None
+    self.exception = None
+    self.thread = threading.Thread(target=self._Run, args=(target, args),
+                                   name="QueueManagerReadAhead")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _Run(self, target, args):
+    try:
+      self.result = target(*args)
+    except Exception as e:  # pylint: disable=broad-except
+      self.exception = e
+
+  def Result(self):
+    self.thread.join()
+    if self.exception is not None:
+      raise self.exception  # pylint: disable=raising-bad-type
+    return self.result
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -88,8 +115,29 @@ class QueueManager(object):
   request_limit = 1000000
   response_limit = 1000000
 
+  # Responses are read in batches of about this many responses, or this many
+  # requests if the number of responses is not known. The next batch is read
+  # while the current one is processed.
+  response_batch_size = 1000
+  request_batch_size = 100
+
   notification_shard_counter = 0
 
+  # The current shard configuration of each queue is kept in this subject
+  # below the queue.
+  SHARD_CONFIG_SUBJECT = "shards"
+  SHARD_COUNT_PREDICATE = "metadata:shard_count"
+  READABLE_SHARDS_PREDICATE = "metadata:readable_shards"
+
+  # How long a process caches the shard configuration of a queue. Writers
+  # may keep using an old shard count for this long after a resize.
+  SHARD_CONFIG_CACHE_AGE = 30
+
+  # A cache of queue -> (time fetched, (shard count, readable shards, time
+  # resized)) shared by all the queue managers in this process.
+  shard_config_cache = {}
+  shard_config_lock = threading.Lock()
+
   def __init__(self, store=None, sync=True, token=None):
     self.sync = sync
     self.token = token
@@ -101,6 +149,8 @@ class QueueManager(object):
     # We cache all these and write/delete in one operation.
     self.to_write = {}
     self.to_delete = {}
+    # Response subjects of finished requests, deleted on Flush().
+    self.subjects_to_delete = set()
 
     # A queue of client messages to remove. Keys are client ids, values are
     # lists of task ids.
@@ -114,20 +164,149 @@ class QueueManager(object):
     self.num_notification_shards = config_lib.CONFIG["Worker.queue_shards"]
 
     QueueManager.notification_shard_counter += 1
+    self.notification_shard_seed = QueueManager.notification_shard_counter
     self.notification_shard_index = (
-        QueueManager.notification_shard_counter % self.num_notification_shards)
+        self.notification_shard_seed % self.num_notification_shards)
 
-  def GetNotificationShard(self, queue):
-    if self.notification_shard_index > 0:
-      return queue.Add(str(self.notification_shard_index))
+    # Number of notifications found in each shard by the last read, keyed by
+    # shard index.
+    self.shard_occupancy = {}
+
+  def _GetShardName(self, queue, index):
+    if index > 0:
+      return queue.Add(str(index))
     else:
       return queue
 
+  def GetNotificationShardConfig(self, queue, refresh=False):
+    """Returns the shard configuration of a queue.
+
+    The number of shards is Worker.queue_shards unless it was changed online
+    by SetNotificationShardCount(). When the number of shards is reduced, the
+    removed shards stay readable until they are drained.
+
+    Args:
+      queue: The queue.
+      refresh: If True, bypass the cache.
+
+    Returns:
+      A tuple (shard count, number of readable shards, time of the last
+      resize).
+    """
+    key = utils.SmartStr(queue)
+    now = time.time()
+    with QueueManager.shard_config_lock:
+      cached = QueueManager.shard_config_cache.get(key)
+
+    if (refresh or not cached or
+        not 0 <= now - cached[0] <= self.SHARD_CONFIG_CACHE_AGE):
+      values = {}
+      for predicate, value, ts in self.data_store.ResolveRegex(
+          queue.Add(self.SHARD_CONFIG_SUBJECT), "metadata:.*",
+          timestamp=self.data_store.NEWEST_TIMESTAMP, token=self.token):
+        values[predicate] = (int(value), ts)
+
+      shard_config = None
+      if self.SHARD_COUNT_PREDICATE in values:
+        count, resized = values[self.SHARD_COUNT_PREDICATE]
+        readable, _ = values.get(self.READABLE_SHARDS_PREDICATE, (count, 0))
+        shard_config = (count, max(count, readable), resized)
+
+      cached = (now, shard_config)
+      with QueueManager.shard_config_lock:
+        QueueManager.shard_config_cache[key] = cached
+
+    if cached[1] is None:
+      return self.num_notification_shards, self.num_notification_shards, 0
+
+    return cached[1]
+
+  def SetNotificationShardCount(self, queue, count):
+    """Changes the number of notification shards of a queue online.
+
+    New notifications are written to the new number of shards once the
+    processes' cached configuration expires. Shards which are no longer
+    written to are still read until RetireNotificationShards() finds them
+    empty, so no notifications are lost.
+
+    Args:
+      queue: The queue.
+      count: The new number of shards.
+    """
+    _, readable, _ = self.GetNotificationShardConfig(queue, refresh=True)
+    self.data_store.MultiSet(
+        queue.Add(self.SHARD_CONFIG_SUBJECT),
+        {self.SHARD_COUNT_PREDICATE: [str(count)],
+         self.READABLE_SHARDS_PREDICATE: [str(max(readable, count))]},
+        replace=True, sync=True, token=self.token)
+
+    self.GetNotificationShardConfig(queue, refresh=True)
+    logging.info("Queue %s now has %d notification shards.", queue, count)
+
+  def RetireNotificationShards(self, queue):
+    """Stops reading shards removed by a resize once they are empty."""
+    count, readable, resized = self.GetNotificationShardConfig(queue,
+                                                               refresh=True)
+    if readable <= count:
+      return
+
+    # Writers may still use the old shard count until their cache expires.
+    age = (int(rdfvalue.RDFDatetime().Now()) - resized) / 1e6
+    if age < 2 * self.SHARD_CONFIG_CACHE_AGE:
+      return
+
+    retired = [self._GetShardName(queue, i) for i in range(count, readable)]
+    for _ in self.data_store.MultiResolveRegex(
+        retired, self.NOTIFY_PREDICATE_PREFIX % ".*",
+        timestamp=self.data_store.ALL_TIMESTAMPS, token=self.token, limit=1):
+      return
+
+    self.data_store.Set(queue.Add(self.SHARD_CONFIG_SUBJECT),
+                        self.READABLE_SHARDS_PREDICATE, str(count),
+                        timestamp=resized, replace=True, sync=True,
+                        token=self.token)
+    self.GetNotificationShardConfig(queue, refresh=True)
+
+  def AdjustNotificationShards(self, queue, workers=1):
+    """Resizes the notification shards of a queue to the current load.
+
+    There should be at least one shard per worker, so workers can read
+    disjoint shards, and no more than Worker.notifications_per_shard pending
+    notifications per shard. The load is estimated from the occupancy of the
+    shards read last by this queue manager. Shards are added right away but
+    only removed after Worker.shard_resize_interval.
+
+    Args:
+      queue: The queue.
+      workers: The number of workers reading the queue.
+    """
+    count, readable, resized = self.GetNotificationShardConfig(queue)
+    minimum = config_lib.CONFIG["Worker.queue_shards"]
+    maximum = max(minimum, config_lib.CONFIG["Worker.max_queue_shards"])
+
+    wanted = workers
+    if self.shard_occupancy:
+      pending = (float(sum(self.shard_occupancy.values())) /
+                 len(self.shard_occupancy) * count)
+      wanted = max(wanted, int(math.ceil(
+          pending / config_lib.CONFIG["Worker.notifications_per_shard"])))
+    wanted = min(max(wanted, minimum), maximum)
+
+    age = (int(rdfvalue.RDFDatetime().Now()) - resized) / 1e6
+    if wanted > count or (
+        wanted < count and
+        age > config_lib.CONFIG["Worker.shard_resize_interval"]):
+      self.SetNotificationShardCount(queue, wanted)
+    elif readable > count:
+      self.RetireNotificationShards(queue)
+
+  def GetNotificationShard(self, queue):
+    count, _, _ = self.GetNotificationShardConfig(queue)
+    return self._GetShardName(queue, self.notification_shard_seed % count)
+
   def GetAllNotificationShards(self, queue):
-    result = [queue]
-    for i in range(1, self.num_notification_shards):
-      result.append(queue.Add(str(i)))
-    return result
+    _, readable, _ = self.GetNotificationShardConfig(queue)
+    return [self._GetShardName(queue, i) for i in range(readable)]
 
   def Copy(self):
     """Return a copy of the queue manager.
@@ -205,16 +384,19 @@ class QueueManager(object):
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
     subject = session_id.Add("state")
-    requests = {}
-    status = {}
 
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
 
-    for predicate, serialized, _ in self.data_store.ResolveRegex(
+    return self._CompletedRequests(self.data_store.ResolveRegex(
         subject, [self.FLOW_REQUEST_REGEX, self.FLOW_STATUS_REGEX],
-        token=self.token, limit=self.request_limit, timestamp=timestamp):
+        token=self.token, limit=self.request_limit, timestamp=timestamp))
 
+  def _CompletedRequests(self, values):
+    """Yields (request, status) pairs from the values of a state subject."""
+    requests = {}
+    status = {}
+    for predicate, serialized, _ in values:
       parts = predicate.split(":", 3)
       request_id = parts[2]
       if parts[1] == "status":
@@ -227,6 +409,47 @@ class QueueManager(object):
         yield (rdfvalue.RequestState(serialized),
                rdfvalue.GrrMessage(status[request_id]))
 
+  def MultiFetchCompletedRequests(self, end_timestamps):
+    """Fetches the completed requests of several sessions at once.
+
+    Args:
+      end_timestamps: A dict mapping session ids to the newest timestamp of
+        the requests and statuses to fetch for them.
+
+    Returns:
+      A dict mapping session ids to lists of (request, status) tuples as
+      returned by FetchCompletedRequests(). Sessions with too many requests to
+      be read at once are left out and have to be fetched on their own.
+    """
+    subjects = dict((utils.SmartStr(session_id.Add("state")), session_id)
+                    for session_id in end_timestamps)
+    end = max(int(timestamp) for timestamp in end_timestamps.values())
+    limit = self.request_limit * len(subjects)
+
+    values = {}
+    total = 0
+    for subject, subject_values in self.data_store.MultiResolveRegex(
+        subjects, [self.FLOW_REQUEST_REGEX, self.FLOW_STATUS_REGEX],
+        token=self.token, limit=limit, timestamp=(0, end)):
+      session_id = subjects[utils.SmartStr(subject)]
+      session_end = int(end_timestamps[session_id])
+      values[session_id] = [value for value in subject_values
+                            if value[2] <= session_end]
+      total += len(subject_values)
+
+    # The limit applies to all subjects together so we can't tell which ones
+    # are incomplete.
+    if total >= limit:
+      return {}
+
+    result = {}
+    for session_id in end_timestamps:
+      session_values = values.get(session_id, [])
+      if len(session_values) < self.request_limit:
+        result[session_id] = list(self._CompletedRequests(session_values))
+
+    return result
+
   def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
     """Fetch only completed requests and responses up to a limit."""
     response_subjects = {}
@@ -260,11 +483,79 @@ class QueueManager(object):
     if total_size > limit:
       raise MoreDataException()
 
+  def StreamCompletedResponses(self, session_id, timestamp=None,
+                               completed_requests=None):
+    """Fetches the completed requests and their responses in batches.
+
+    Unlike FetchCompletedResponses() all completed requests are returned but
+    only about response_batch_size responses are held in memory at a time.
+
+    Args:
+      session_id: The session_id to get the requests/responses for.
+      timestamp: Tuple (start, end) with a time range. Fetched requests and
+                 responses will have timestamp in this range.
+      completed_requests: The (request, status) tuples of the session if they
+                 were already fetched with MultiFetchCompletedRequests().
+
+    Yields:
+      A tuple (request, list of responses) for each completed request in
+      ascending order of request ids.
+    """
+    if timestamp is None:
+      timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
+
+    if completed_requests is None:
+      completed_requests = self.FetchCompletedRequests(session_id,
+                                                       timestamp=timestamp)
+
+    batches = [[]]
+    batch_size = 0
+    for request, status in completed_requests:
+      if batch_size >= self.response_batch_size:
+        batches.append([])
+        batch_size = 0
+
+      batches[-1].append(request)
+      batch_size += status.response_id
+
+    return self._StreamResponses(session_id, batches, timestamp)
+
+  def _StreamResponses(self, session_id, batches, timestamp):
+    """Yields the requests in batches with their responses."""
+
+    def FetchResponses(requests):
+      subjects = [self.GetFlowResponseSubject(session_id, request.id)
+                  for request in requests]
+      return dict(
+          (utils.SmartStr(subject), values)
+          for subject, values in self.data_store.MultiResolveRegex(
+              subjects, self.FLOW_RESPONSE_REGEX, limit=self.response_limit,
+              token=self.token, timestamp=timestamp))
+
+    read_ahead = None
+    for i, requests in enumerate(batches):
+      if read_ahead is None:
+        response_data = FetchResponses(requests)
+      else:
+        response_data = read_ahead.Result()
+
+      if i + 1 < len(batches):
+        read_ahead = _ReadAhead(FetchResponses, batches[i + 1])
+      else:
+        read_ahead = None
+
+      for request in requests:
+        subject = self.GetFlowResponseSubject(session_id, request.id)
+        responses = [rdfvalue.GrrMessage(serialized) for _, serialized, _ in
+                     response_data.pop(utils.SmartStr(subject), [])]
+
+        yield (request, sorted(responses, key=lambda msg: msg.response_id))
+
   def FetchRequestsAndResponses(self, session_id, timestamp=None):
     """Fetches all outstanding requests and responses for this flow.
 
-    We first cache all requests and responses for this flow in memory to
-    prevent round trips.
+    The requests are read first, their responses are read in batches while
+    the caller iterates.
 
     Args:
       session_id: The session_id to get the requests/responses for.
@@ -289,23 +580,17 @@ class QueueManager(object):
     for predicate, serialized, _ in self.data_store.ResolveRegex(
         subject, self.FLOW_REQUEST_REGEX, token=self.token,
         limit=self.request_limit, timestamp=timestamp):
+      requests[predicate] = serialized
 
-      request_id = predicate.split(":", 1)[1]
-      requests[str(subject.Add(request_id))] = serialized
+    requests = [rdfvalue.RequestState(serialized)
+                for _, serialized in sorted(requests.items())]
+    batches = [requests[i:i + self.request_batch_size]
+               for i in range(0, len(requests), self.request_batch_size)]
 
     # And the responses for them.
-    response_data = dict(self.data_store.MultiResolveRegex(
-        requests.keys(), self.FLOW_RESPONSE_REGEX,
-        limit=self.response_limit, token=self.token,
-        timestamp=timestamp))
-
-    for urn, request_data in sorted(requests.items()):
-      request = rdfvalue.RequestState(request_data)
-      responses = []
-      for _, serialized, _ in response_data.get(urn, []):
-        responses.append(rdfvalue.GrrMessage(serialized))
-
-      yield (request, sorted(responses, key=lambda msg: msg.response_id))
+    for request, responses in self._StreamResponses(session_id, batches,
+                                                    timestamp):
+      yield request, responses
 
     if len(requests) >= self.request_limit:
       raise MoreDataException()
@@ -320,9 +605,10 @@ class QueueManager(object):
       self.DeQueueClientRequest(request_state.client_id,
                                 request_state.request.task_id)
 
-    # Efficiently drop all responses to this request.
-    response_subject = self.GetFlowResponseSubject(session_id, request_state.id)
-    self.data_store.DeleteSubject(response_subject, token=self.token)
+    # Efficiently drop all responses to this request, together with the
+    # responses of the other requests deleted before the next Flush().
+    self.subjects_to_delete.add(
+        self.GetFlowResponseSubject(session_id, request_state.id))
 
   def DestroyFlowStates(self, session_id):
     """Deletes all states in this flow and dequeue all client messages."""
@@ -355,6 +641,9 @@ class QueueManager(object):
       except data_store.Error:
         pass
 
+    if self.subjects_to_delete:
+      self.data_store.DeleteSubjects(self.subjects_to_delete, token=self.token)
+
     for client_id, messages in self.client_messages_to_delete.iteritems():
       self.Delete(client_id.Queue(), messages)
 
@@ -369,18 +658,46 @@ class QueueManager(object):
     if self.sync and session_ids:
       self.data_store.Flush()
 
-    for notification, timestamp in self.notifications:
-      self.NotifyQueue(notification, timestamp=timestamp, sync=False)
+    self._FlushNotifications()
 
     if self.sync:
       self.data_store.Flush()
 
     self.to_write = {}
     self.to_delete = {}
+    self.subjects_to_delete = set()
     self.client_messages_to_delete = {}
     self.notifications = []
     self.new_client_messages = []
 
+  def _FlushNotifications(self):
+    """Writes the queued notifications, one data store operation per queue.
+
+    Notifications for the same session and timestamp are merged since only one
+    of them would be kept by the data store anyway.
+    """
+    merged = {}
+    for notification, timestamp in self.notifications:
+      key = (notification.session_id, timestamp, notification.in_progress)
+      existing = merged.get(key)
+      if existing is None:
+        merged[key] = notification
+        continue
+
+      if notification.priority > existing.priority:
+        existing.priority = notification.priority
+      if notification.last_status > existing.last_status:
+        existing.last_status = notification.last_status
+
+    by_queue = {}
+    for (session_id, timestamp, _), notification in merged.iteritems():
+      by_queue.setdefault((session_id.Queue(), timestamp), []).append(
+          notification)
+
+    for (queue, timestamp), notifications in by_queue.iteritems():
+      self._MultiNotifyQueue(queue, notifications, timestamp=timestamp,
+                             sync=False)
+
   def QueueResponse(self, session_id, response, timestamp=None):
     """Queues the message on the flow's state."""
     if timestamp is None:
@@ -474,13 +791,22 @@ class QueueManager(object):
             queue, to_schedule, timestamp=timestamp, sync=sync,
             token=self.token)
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, shards=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: The queue.
+      shards: Indexes of the notification shards to read. By default only the
+        shard of this queue manager is read.
+
+    Returns:
+      A dict of lists of notifications keyed by priority.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
     notifications_by_priority = {}
 
-    for notification in self._GetUnsortedNotifications(queue):
+    for notification in self._GetUnsortedNotifications(queue, shards=shards):
       priority = notification.priority
       if notification.in_progress:
         priority = self.STUCK_PRIORITY
@@ -492,51 +818,76 @@ class QueueManager(object):
 
     return notifications_by_priority
 
-  def GetNotifications(self, queue):
-    notifications = self._GetUnsortedNotifications(queue)
+  def GetNotifications(self, queue, shards=None):
+    notifications = self._GetUnsortedNotifications(queue, shards=shards)
     notifications.sort(key=lambda notification: notification.priority,
                        reverse=True)
     return notifications
 
-  def _GetUnsortedNotifications(self, queue):
+  def _GetUnsortedNotifications(self, queue, shards=None):
     """Returns all the available notifications for a queue."""
-    notifications_by_session_id = {}
-    queue_shard = self.GetNotificationShard(queue)
+    if shards is None:
+      count, _, _ = self.GetNotificationShardConfig(queue)
+      shards = [self.notification_shard_seed % count]
+    queue_shards = [self._GetShardName(queue, i) for i in shards]
+    shard_indexes = dict((utils.SmartStr(queue_shard), i)
+                         for queue_shard, i in zip(queue_shards, shards))
+
+    # All shards are read in a single request.
+    self.shard_occupancy = dict((i, 0) for i in shards)
+    shard_values = []
     end_time = self.frozen_timestamp or rdfvalue.RDFDatetime().Now()
-    for predicate, serialized_notification, ts in data_store.DB.ResolveRegex(
-        queue_shard, self.NOTIFY_PREDICATE_PREFIX % ".*",
-        timestamp=(0, end_time),
-        token=self.token, limit=10000):
+    for subject, values in self.data_store.MultiResolveRegex(
+        queue_shards, self.NOTIFY_PREDICATE_PREFIX % ".*",
+        timestamp=(0, end_time), token=self.token, limit=10000):
+      self.shard_occupancy[shard_indexes[utils.SmartStr(subject)]] = len(values)
+      shard_values.append((rdfvalue.RDFURN(subject), values))
 
-      # Parse the notification.
-      try:
-        notification = rdfvalue.GrrNotification(serialized_notification)
-      except Exception:  # pylint: disable=broad-except
-        logging.exception("Can't unserialize notification, deleting it: "
-                          "predicate=%s, ts=%d", predicate, ts)
-        data_store.DB.DeleteAttributes(
-            queue_shard, [predicate], token=self.token,
-            # Make the time range narrow, but be sure to include the needed
-            # notification.
-            start=ts, end=ts)
-        continue
+    for shard_index, occupancy in self.shard_occupancy.iteritems():
+      stats.STATS.SetGaugeValue(
+          "grr_notification_shard_occupancy", occupancy,
+          fields=[utils.SmartStr(queue), str(shard_index)])
 
-      # Strip the prefix from the predicate to get the session_id.
-      session_id = predicate[len(self.NOTIFY_PREDICATE_PREFIX % ""):]
-      notification.session_id = session_id
-      notification.timestamp = ts
+    notifications_by_session_id = {}
+    for queue_shard, values in shard_values:
+      for predicate, serialized_notification, ts in values:
+        notification = self._ParseNotification(
+            queue_shard, predicate, serialized_notification, ts)
+        if notification is None:
+          continue
 
-      existing = notifications_by_session_id.get(notification.session_id)
-      if existing:
-        # If we have a notification for this session_id already, we only store
-        # the one that was scheduled last.
-        if notification.first_queued > existing.first_queued:
+        existing = notifications_by_session_id.get(notification.session_id)
+        if existing:
+          # If we have a notification for this session_id already, we only
+          # store the one that was scheduled last.
+          if notification.first_queued > existing.first_queued:
+            notifications_by_session_id[notification.session_id] = notification
+        else:
           notifications_by_session_id[notification.session_id] = notification
-      else:
-        notifications_by_session_id[notification.session_id] = notification
 
     return notifications_by_session_id.values()
 
+  def _ParseNotification(self, queue_shard, predicate,
+                         serialized_notification, ts):
+    """Parses a notification, deleting it if it is invalid."""
+    try:
+      notification = rdfvalue.GrrNotification(serialized_notification)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Can't unserialize notification, deleting it: "
+                        "predicate=%s, ts=%d", predicate, ts)
+      data_store.DB.DeleteAttributes(
+          queue_shard, [predicate], token=self.token,
+          # Make the time range narrow, but be sure to include the needed
+          # notification.
+          start=ts, end=ts)
+      return None
+
+    # Strip the prefix from the predicate to get the session_id.
+    session_id = predicate[len(self.NOTIFY_PREDICATE_PREFIX % ""):]
+    notification.session_id = session_id
+    notification.timestamp = ts
+    return notification
+
   def NotifyQueue(self, notification, **kwargs):
     """This signals that there are new messages available in a queue."""
     self._MultiNotifyQueue(notification.session_id.Queue(), [notification],
@@ -605,6 +956,24 @@ class QueueManager(object):
           queue_shard, [self.NOTIFY_PREDICATE_PREFIX % session_id],
           token=self.token, start=start, end=end)
 
+  def MultiDeleteNotifications(self, session_ids, start=None, end=None):
+    """Deletes the notifications of several sessions at once."""
+    if start is None:
+      start = 0
+    else:
+      start = int(start)
+
+    if end is None:
+      end = self.frozen_timestamp or rdfvalue.RDFDatetime().Now()
+
+    for queue, ids in utils.GroupBy(
+        set(session_ids), lambda session_id: session_id.Queue()).iteritems():
+      predicates = [self.NOTIFY_PREDICATE_PREFIX % session_id
+                    for session_id in ids]
+      for queue_shard in self.GetAllNotificationShards(queue):
+        data_store.DB.DeleteAttributes(
+            queue_shard, predicates, token=self.token, start=start, end=end)
+
   def Query(self, queue, limit=1, task_id=None):
     """Retrieves tasks from a queue without leasing them.
 
@@ -676,41 +1045,122 @@ class QueueManager(object):
       logging.warning("Datastore exception: %s", e)
       return []
 
+  @staticmethod
+  def _TaskOrder(task):
+    """The order in which tasks are leased.
+
+    Tasks are leased highest priority first. Within a priority, tasks are
+    leased by deadline; tasks without a deadline are due as soon as they
+    become available (their eta).
+
+    Args:
+      task: A GrrMessage read from a queue.
+
+    Returns:
+      A sort key.
+    """
+    return (-int(task.priority), int(task.deadline or task.eta), task.task_id)
+
+  def _SelectTasks(self, tasks, limit):
+    """Selects up to limit tasks in lease order with per-session fair share.
+
+    Priority levels are served highest first. Within a level, no session may
+    take more than Worker.client_queue_session_share of the slots still free
+    while tasks of other sessions of that level are waiting, so a large hunt
+    can not starve other flows on the same client. Slots not claimed by other
+    sessions of the level are then handed out in order before any lower
+    priority task is considered.
+
+    Args:
+      tasks: A list of GrrMessage objects.
+      limit: The maximum number of tasks to return.
+
+    Returns:
+      The selected tasks, in lease order.
+    """
+    tasks = sorted(tasks, key=self._TaskOrder)
+    if len(tasks) <= limit:
+      return tasks
+
+    share = config_lib.CONFIG["Worker.client_queue_session_share"]
+
+    selected = []
+    deferred_count = 0
+    for _, level in itertools.groupby(tasks, key=lambda task: task.priority):
+      free = limit - len(selected)
+      if free <= 0:
+        break
+
+      level = list(level)
+      session_limit = max(1, int(math.ceil(free * share)))
+
+      level_selected = []
+      deferred = []
+      per_session = {}
+      for task in level:
+        count = per_session.get(task.session_id, 0)
+        if count < session_limit and len(level_selected) < free:
+          per_session[task.session_id] = count + 1
+          level_selected.append(task)
+        else:
+          deferred.append(task)
+
+      backfill = deferred[:free - len(level_selected)]
+      if backfill:
+        level_selected.extend(backfill)
+        level_selected.sort(key=self._TaskOrder)
+      deferred_count += len(deferred) - len(backfill)
+
+      selected.extend(level_selected)
+
+    if deferred_count:
+      stats.STATS.IncrementCounter("grr_task_fair_share_deferred_count",
+                                   deferred_count)
+
+    return selected
+
   def _QueryAndOwn(self, transaction, lease_seconds=100,
                    limit=1, user=""):
     """Does the real work of self.QueryAndOwn()."""
-    tasks = []
-
     lease = long(lease_seconds * 1e6)
 
     ttl_exceeded_count = 0
 
     # Only grab attributes with timestamps in the past.
+    available = []
     for predicate, task, timestamp in transaction.ResolveRegex(
         self.TASK_PREDICATE_PREFIX % ".*",
         timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())):
       task = rdfvalue.GrrMessage(task)
+      # Tasks which can not be leased again are dropped here so they do not
+      # take slots from tasks which can.
+      if task.task_ttl <= 1:
+        transaction.DeleteAttribute(predicate)
+        ttl_exceeded_count += 1
+        stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
+        continue
+
       task.eta = timestamp
+      available.append((predicate, task))
+
+    predicates = dict((task.task_id, predicate)
+                      for predicate, task in available)
+
+    tasks = []
+    for task in self._SelectTasks([task for _, task in available], limit):
+      predicate = predicates[task.task_id]
       task.last_lease = "%s@%s:%d" % (user,
                                       socket.gethostname(),
                                       os.getpid())
       # Decrement the ttl
       task.task_ttl -= 1
-      if task.task_ttl <= 0:
-        # Remove the task if ttl is exhausted.
-        transaction.DeleteAttribute(predicate)
-        ttl_exceeded_count += 1
-        stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
-      else:
-        if task.task_ttl != rdfvalue.GrrMessage.max_ttl - 1:
-          stats.STATS.IncrementCounter("grr_task_retransmission_count")
+      if task.task_ttl != rdfvalue.GrrMessage.max_ttl - 1:
+        stats.STATS.IncrementCounter("grr_task_retransmission_count")
 
-        # Update the timestamp on the value to be in the future
-        transaction.Set(predicate, task.SerializeToString(), replace=True,
-                        timestamp=long(time.time() * 1e6) + lease)
-        tasks.append(task)
-        if len(tasks) >= limit:
-          break
+      # Update the timestamp on the value to be in the future
+      transaction.Set(predicate, task.SerializeToString(), replace=True,
+                      timestamp=long(time.time() * 1e6) + lease)
+      tasks.append(task)
 
     if ttl_exceeded_count:
       logging.info("TTL exceeded for %d messages on queue %s",
@@ -725,27 +1175,121 @@ class WellKnownQueueManager(QueueManager):
     """Well known flows do not have real requests.
 
     This manages retrieving all the responses without requiring corresponding
-    requests.
+    requests. Responses are read response_batch_size at a time and deleted
+    once the caller has consumed them, so there is no need to call
+    DeleteFlowRequestStates().
 
     Args:
       session_id: The session_id to get the requests/responses for.
 
     Yields:
       A tuple of request (None) and responses.
+
+    Raises:
+      MoreDataException: When more than request_limit responses were returned
+                         and there may be more.
     """
     subject = session_id.Add("state/request:00000000")
+    end = self.frozen_timestamp or rdfvalue.RDFDatetime().Now()
+
+    total = 0
+    while True:
+      values = sorted(self.data_store.ResolveRegex(
+          subject, self.FLOW_RESPONSE_REGEX, token=self.token,
+          limit=self.response_batch_size, timestamp=(0, end)))
+
+      for _, serialized, _ in values:
+        # The predicate format is flow:response:REQUEST_ID:RESPONSE_ID. For
+        # well known flows both request_id and response_id are randomized.
+        response = rdfvalue.GrrMessage(serialized)
+
+        yield rdfvalue.RequestState(id=0), [response]
+
+      if values:
+        self.data_store.DeleteAttributes(
+            subject, [predicate for predicate, _, _ in values], start=0,
+            end=end, sync=True, token=self.token)
+
+      total += len(values)
+      if len(values) < self.response_batch_size:
+        break
+
+      if total >= self.request_limit:
+        raise MoreDataException()
+
+  def DeleteFlowRequestStates(self, session_id, request_state):
+    """Responses of well known flows are deleted as they are fetched."""
+
+
+class NotificationShardClaim(object):
+  """Claims a disjoint subset of the notification shards of a queue.
+
+  Every worker reading the queue registers itself in the data store. A worker
+  reads the shards whose index modulo the number of live workers is its
+  position among them, so workers do not compete for the same notifications.
+  While workers join or leave the claims may briefly overlap or leave a shard
+  unread, but notifications are never lost.
+  """
+
+  WORKERS_SUBJECT = "workers"
+  WORKER_PREDICATE_PREFIX = "worker:%s"
+
+  claim_counter = 0
+
+  def __init__(self, queue, token=None, worker_id=None):
+    self.queue = queue
+    self.token = token
+    if worker_id is None:
+      NotificationShardClaim.claim_counter += 1
+      worker_id = "%s:%d:%d" % (socket.gethostname(), os.getpid(),
+                                NotificationShardClaim.claim_counter)
+    self.worker_id = worker_id
+    self.ttl = config_lib.CONFIG["Worker.shard_claim_ttl"]
+
+    self.index = 0
+    self.workers = 1
+    self.last_refresh = 0
+
+  def Refresh(self, manager):
+    """Registers this worker and finds out which workers are alive."""
+    subject = self.queue.Add(self.WORKERS_SUBJECT)
+    now = int(rdfvalue.RDFDatetime().Now())
+    manager.data_store.Set(subject, self.WORKER_PREDICATE_PREFIX %
+                           self.worker_id, self.worker_id, timestamp=now,
+                           replace=True, sync=True, token=self.token)
+
+    live = set([self.worker_id])
+    dead = []
+    for predicate, worker_id, ts in manager.data_store.ResolveRegex(
+        subject, self.WORKER_PREDICATE_PREFIX % ".*",
+        timestamp=manager.data_store.NEWEST_TIMESTAMP, token=self.token):
+      if now - ts < self.ttl * 1e6:
+        live.add(worker_id)
+      else:
+        dead.append(predicate)
+
+    if dead:
+      manager.data_store.DeleteAttributes(subject, dead, sync=False,
+                                          token=self.token)
+
+    live = sorted(live)
+    self.index = live.index(self.worker_id)
+    self.workers = len(live)
+    self.last_refresh = time.time()
 
-    # Get some requests
-    for _, serialized, _ in sorted(self.data_store.ResolveRegex(
-        subject, self.FLOW_RESPONSE_REGEX, token=self.token,
-        limit=self.request_limit,
-        timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now()))):
+  def Release(self, manager):
+    manager.data_store.DeleteAttributes(
+        self.queue.Add(self.WORKERS_SUBJECT),
+        [self.WORKER_PREDICATE_PREFIX % self.worker_id], sync=True,
+        token=self.token)
 
-      # The predicate format is flow:response:REQUEST_ID:RESPONSE_ID. For well
-      # known flows both request_id and response_id are randomized.
-      response = rdfvalue.GrrMessage(serialized)
+  def GetShards(self, manager):
+    """Returns the indexes of the shards this worker should read."""
+    if time.time() - self.last_refresh > self.ttl / 3.0:
+      self.Refresh(manager)
 
-      yield rdfvalue.RequestState(id=0), [response]
+    _, readable, _ = manager.GetNotificationShardConfig(self.queue)
+    return [i for i in range(readable) if i % self.workers == self.index]
 
 
 class QueueManagerInit(registry.InitHook):
@@ -757,3 +1301,7 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterCounterMetric("grr_task_fair_share_deferred_count")
+    stats.STATS.RegisterGaugeMetric(
+        "grr_notification_shard_occupancy", int,
+        fields=[("queue", str), ("shard", str)])
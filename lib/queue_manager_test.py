@@ -16,6 +16,7 @@ from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 
 # pylint: mode=test
 
@@ -117,6 +118,66 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     # Make sure the manager told us that more data is available.
     self.assertTrue(more_data)
 
+  def testStreamCompletedResponsesReadsInBatches(self):
+    session_id = rdfvalue.SessionID("aff4:/flows/W:stream")
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for request_id in range(1, 6):
+        manager.QueueRequest(session_id, rdfvalue.RequestState(
+            id=request_id, client_id=self.client_id,
+            next_state="TestState", session_id=session_id))
+
+        for response_id in range(1, 10):
+          manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+              request_id=request_id, response_id=response_id))
+
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=request_id, response_id=10,
+            type=rdfvalue.GrrMessage.Type.STATUS))
+
+    reads = []
+    multi_resolve_regex = data_store.DB.MultiResolveRegex
+
+    def MultiResolveRegex(subjects, *args, **kwargs):
+      reads.append(len(subjects))
+      return multi_resolve_regex(subjects, *args, **kwargs)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    # Two requests with 10 responses each fit in a batch.
+    manager.response_batch_size = 20
+    with utils.Stubber(data_store.DB, "MultiResolveRegex", MultiResolveRegex):
+      completed = list(manager.StreamCompletedResponses(session_id))
+
+    self.assertEqual([request.id for request, _ in completed], range(1, 6))
+    for _, responses in completed:
+      self.assertEqual([r.response_id for r in responses], range(1, 11))
+    self.assertEqual(reads, [2, 2, 1])
+
+    # Responses are deleted on Flush.
+    for request, _ in completed:
+      manager.DeleteFlowRequestStates(session_id, request)
+    manager.Flush()
+    self.assertEqual(list(manager.FetchRequestsAndResponses(session_id)), [])
+
+  def testWellKnownResponsesAreReadInBatches(self):
+    session_id = rdfvalue.SessionID("aff4:/flows/W:wellknown")
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for i in range(7):
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=0, response_id=i + 1, session_id=session_id))
+
+    manager = queue_manager.WellKnownQueueManager(token=self.token)
+    manager.response_batch_size = 3
+    responses = []
+    for _, batch in manager.FetchRequestsAndResponses(session_id):
+      responses.extend(batch)
+
+    self.assertEqual(sorted(r.response_id for r in responses), range(1, 8))
+
+    # The responses were deleted as they were consumed.
+    self.assertEqual(list(manager.FetchRequestsAndResponses(session_id)), [])
+
   def testDeleteFlowRequestStates(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID("aff4:/flows/W:test3")
@@ -384,6 +445,100 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual([task.priority for task in tasks],
                      [2, 2, 2, 1, 1, 1, 0, 0, 0, 0])
 
+  def testDeadlineScheduling(self):
+    test_queue = rdfvalue.RDFURN("fooDeadline")
+    now = rdfvalue.RDFDatetime().Now()
+
+    tasks = []
+    for i, delay in enumerate([300, 100, None, 200]):
+      msg = rdfvalue.GrrMessage(session_id="Test%d" % i, queue=test_queue)
+      if delay is not None:
+        msg.deadline = now + delay
+      tasks.append(msg)
+
+    # A high priority message is leased first regardless of deadlines.
+    tasks.append(rdfvalue.GrrMessage(
+        session_id="Urgent", queue=test_queue,
+        priority=rdfvalue.GrrMessage.Priority.HIGH_PRIORITY))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule(tasks)
+
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100)
+    # Messages without a deadline are due as soon as they were queued.
+    self.assertEqual([task.session_id for task in tasks],
+                     ["aff4:/Urgent", "aff4:/Test2", "aff4:/Test1",
+                      "aff4:/Test3", "aff4:/Test0"])
+
+  def testSessionFairShare(self):
+    test_queue = rdfvalue.RDFURN("fooFairShare")
+
+    # A hunt queues many messages before an interactive flow queues one.
+    tasks = [rdfvalue.GrrMessage(session_id="Hunt", request_id=i + 1,
+                                 queue=test_queue)
+             for i in range(20)]
+    tasks.append(rdfvalue.GrrMessage(session_id="Interactive",
+                                     queue=test_queue))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule(tasks)
+
+    config_lib.CONFIG.Set("Worker.client_queue_session_share", 0.5)
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=4)
+
+    self.assertEqual(len(tasks), 4)
+    sessions = [task.session_id for task in tasks]
+    self.assertEqual(sessions.count("aff4:/Hunt"), 3)
+    self.assertIn("aff4:/Interactive", sessions)
+
+    # Without competition a single session gets the whole limit.
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=4)
+    self.assertEqual([task.session_id for task in tasks], ["aff4:/Hunt"] * 4)
+
+  def testSessionFairShareKeepsPriorities(self):
+    test_queue = rdfvalue.RDFURN("fooFairSharePriority")
+
+    # An urgent hunt must not be held back for normal priority flows.
+    tasks = [rdfvalue.GrrMessage(
+        session_id="Urgent", request_id=i + 1, queue=test_queue,
+        priority=rdfvalue.GrrMessage.Priority.HIGH_PRIORITY)
+             for i in range(6)]
+    tasks += [rdfvalue.GrrMessage(session_id="Normal%d" % i, queue=test_queue)
+              for i in range(4)]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule(tasks)
+
+    config_lib.CONFIG.Set("Worker.client_queue_session_share", 0.5)
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=4)
+    self.assertEqual([task.session_id for task in tasks], ["aff4:/Urgent"] * 4)
+
+    # The share applies within a priority level.
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=4)
+    sessions = [task.session_id for task in tasks]
+    self.assertEqual(sessions[:2], ["aff4:/Urgent"] * 2)
+    self.assertEqual(len(set(sessions[2:])), 2)
+    self.assertNotIn("aff4:/Urgent", sessions[2:])
+
+  def testExpiredTasksDoNotTakeSlots(self):
+    test_queue = rdfvalue.RDFURN("fooExpiredSlots")
+
+    # Tasks which were leased for the last time sort before the live one.
+    high = rdfvalue.GrrMessage.Priority.HIGH_PRIORITY
+    tasks = [rdfvalue.GrrMessage(session_id="Expired%d" % i, task_ttl=1,
+                                 queue=test_queue, priority=high)
+             for i in range(3)]
+    tasks.append(rdfvalue.GrrMessage(session_id="Live", queue=test_queue))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule(tasks)
+
+    tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=2)
+    self.assertEqual([task.session_id for task in tasks], ["aff4:/Live"])
+
+    # The expired tasks are gone from the queue.
+    self.assertEqual(len(manager.Query(test_queue, limit=100)), 1)
+
   def testUsesFrozenTimestampWhenDeletingAndFetchingNotifications(self):
     # When used in "with" statement QueueManager uses the frozen timestamp
     # when fetching and deleting data. Test that if we have 2 managers
@@ -449,6 +604,42 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(
         len(manager.GetNotifications(rdfvalue.RDFURN("aff4:/W"))), 0)
 
+  def testNotificationsAreMergedAndWrittenPerQueue(self):
+    calls = []
+    original = queue_manager.QueueManager._MultiNotifyQueue
+
+    def RecordingMultiNotifyQueue(manager, queue, notifications, **kwargs):
+      calls.append((queue, [str(n.session_id) for n in notifications],
+                    [n.last_status for n in notifications]))
+      return original(manager, queue, notifications, **kwargs)
+
+    with utils.Stubber(queue_manager.QueueManager, "_MultiNotifyQueue",
+                       RecordingMultiNotifyQueue):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        for i in range(10):
+          manager.QueueNotification(
+              session_id=rdfvalue.SessionID("aff4:/flows/W:123456"),
+              last_status=i)
+        manager.QueueNotification(
+            session_id=rdfvalue.SessionID("aff4:/flows/W:abcdef"))
+
+    # One write for the queue, with a single notification per session.
+    self.assertEqual(len(calls), 1)
+    queue, session_ids, last_statuses = calls[0]
+    self.assertEqual(queue, rdfvalue.RDFURN("aff4:/W"))
+    self.assertEqual(sorted(session_ids),
+                     ["aff4:/flows/W:123456", "aff4:/flows/W:abcdef"])
+    self.assertIn(9, last_statuses)
+
+    self._current_mock_time += 10
+    notifications = manager.GetNotifications(rdfvalue.RDFURN("aff4:/W"))
+    self.assertEqual(len(notifications), 2)
+
+    manager.MultiDeleteNotifications(
+        [rdfvalue.SessionID("aff4:/flows/W:123456"),
+         rdfvalue.SessionID("aff4:/flows/W:abcdef")])
+    self.assertEqual(manager.GetNotifications(rdfvalue.RDFURN("aff4:/W")), [])
+
 
 class MultiShardedQueueManagerTest(QueueManagerTest):
   """Test for QueueManager with multiple notification shards enabled."""
@@ -569,6 +760,88 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
         self.assertEqual(len(notifications), 0)
 
 
+class NotificationShardingTest(test_lib.GRRBaseTest):
+  """Tests changing the number of notification shards online."""
+
+  def setUp(self):
+    super(NotificationShardingTest, self).setUp()
+    queue_manager.QueueManager.shard_config_cache.clear()
+    self.queue = rdfvalue.RDFURN("aff4:/W")
+
+  def tearDown(self):
+    queue_manager.QueueManager.shard_config_cache.clear()
+    super(NotificationShardingTest, self).tearDown()
+
+  def _Notify(self, count):
+    session_ids = []
+    for i in range(count):
+      session_id = rdfvalue.SessionID(base="aff4:/flows", queue=self.queue,
+                                      flow_name=i + 1)
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueNotification(session_id=session_id)
+      session_ids.append(session_id)
+    return session_ids
+
+  def testShardCountChangesWithoutLosingNotifications(self):
+    with test_lib.FakeTime(1000):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.SetNotificationShardCount(self.queue, 4)
+      session_ids = self._Notify(8)
+
+      # The notifications are spread over all shards and read in one go.
+      notifications = manager.GetNotifications(self.queue, shards=range(4))
+      self.assertEqual(sorted(n.session_id for n in notifications),
+                       sorted(session_ids))
+      self.assertEqual(manager.shard_occupancy, {0: 2, 1: 2, 2: 2, 3: 2})
+
+      manager.SetNotificationShardCount(self.queue, 1)
+      self.assertEqual(manager.GetNotificationShardConfig(self.queue)[:2],
+                       (1, 4))
+      self.assertEqual(len(manager.GetAllNotificationShards(self.queue)), 4)
+
+    # Retired shards are read until they are empty.
+    with test_lib.FakeTime(2000):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.RetireNotificationShards(self.queue)
+      self.assertEqual(manager.GetNotificationShardConfig(self.queue)[:2],
+                       (1, 4))
+
+      manager.MultiDeleteNotifications(session_ids)
+      manager.RetireNotificationShards(self.queue)
+      self.assertEqual(manager.GetNotificationShardConfig(self.queue)[:2],
+                       (1, 1))
+
+  def testShardsGrowWithTheNumberOfWorkers(self):
+    config_lib.CONFIG.Set("Worker.max_queue_shards", 8)
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.AdjustNotificationShards(self.queue, workers=3)
+    self.assertEqual(manager.GetNotificationShardConfig(self.queue)[0], 3)
+
+    manager.AdjustNotificationShards(self.queue, workers=20)
+    self.assertEqual(manager.GetNotificationShardConfig(self.queue)[0], 8)
+
+  def testWorkersClaimDisjointShards(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.SetNotificationShardCount(self.queue, 5)
+
+    claims = [queue_manager.NotificationShardClaim(
+        self.queue, token=self.token, worker_id="worker%d" % i)
+              for i in range(2)]
+    for claim in claims:
+      claim.Refresh(manager)
+    # The first worker only sees the second one on its next refresh.
+    claims[0].Refresh(manager)
+
+    shards = [claim.GetShards(manager) for claim in claims]
+    self.assertEqual(sorted(shards[0] + shards[1]), range(5))
+    self.assertFalse(set(shards[0]) & set(shards[1]))
+
+    # When a worker leaves, the others take over its shards.
+    claims[1].Release(manager)
+    claims[0].Refresh(manager)
+    self.assertEqual(claims[0].GetShards(manager), range(5))
+
+
 def main(argv):
   test_lib.main(argv)
 
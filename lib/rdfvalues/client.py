@@ -708,6 +708,14 @@ class FingerprintRequest(rdfvalue.RDFProtoStruct):
     self.tuples.Append(*args, **kw)
 
 
+class StreamFileRequest(rdfvalue.RDFProtoStruct):
+  protobuf = jobs_pb2.StreamFileRequest
+
+
+class StreamFileResponse(rdfvalue.RDFProtoStruct):
+  protobuf = jobs_pb2.StreamFileResponse
+
+
 class FingerprintResponse(rdfvalue.RDFProtoStruct):
   """Proto containing dicts with hashes."""
   protobuf = jobs_pb2.FingerprintResponse
@@ -10,6 +10,18 @@ class DataStoreCommand(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataStoreCommand
 
 
+class DataStoreCommandBatch(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataStoreCommandBatch
+
+
+class DataStoreReply(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataStoreReply
+
+
+class DataStoreReplyBatch(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataStoreReplyBatch
+
+
 class DataServerState(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerState
 
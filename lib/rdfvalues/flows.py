@@ -171,6 +171,21 @@ class RobustUnpickler(pickle.Unpickler):
   # pylint: enable=invalid-name, broad-except
 
 
+class ExternalStateEntry(object):
+  """Placeholder for a FlowState entry which is stored in its own attribute.
+
+  Large containers in a flow's state are written separately and only when they
+  change, the pickled FlowState keeps this placeholder with the digest of the
+  stored value instead.
+  """
+
+  def __init__(self, digest):
+    self.digest = digest
+
+  def __str__(self):
+    return "<stored separately>"
+
+
 class FlowState(rdfvalue.RDFValue):
   """The state of a running flow.
 
@@ -189,8 +204,13 @@ class FlowState(rdfvalue.RDFValue):
   # If there were errors in unpickling this object, we note them in here.
   errors = None
 
+  # Maps the names of entries stored outside of the pickle to the digest of
+  # their stored value.
+  external_entries = None
+
   def __init__(self, initializer=None, age=None):
     self.data = utils.DataObject()
+    self.external_entries = {}
     super(FlowState, self).__init__(initializer=initializer, age=age)
 
   def ParseFromString(self, string):
@@ -207,8 +227,40 @@ class FlowState(rdfvalue.RDFValue):
       except Exception as e:  # pylint: disable=broad-except
         raise rdfvalue.DecodeError(e)
 
+    self.external_entries = dict(
+        (name, value.digest) for name, value in self.data.items()
+        if isinstance(value, ExternalStateEntry))
+
   def SerializeToString(self):
-    return cPickle.dumps(self.data)
+    if not self.external_entries:
+      return cPickle.dumps(self.data)
+
+    data = utils.DataObject(self.data)
+    for name, digest in self.external_entries.items():
+      if name in data:
+        data[name] = ExternalStateEntry(digest)
+
+    return cPickle.dumps(data)
+
+  def GetExternalEntries(self):
+    """Returns the names of the entries which still need to be loaded."""
+    return [name for name in self.external_entries
+            if isinstance(self.data.get(name), ExternalStateEntry)]
+
+  def LoadedItems(self):
+    """Returns (name, value) of all entries except unloaded placeholders."""
+    return [(name, value) for name, value in self.data.items()
+            if not isinstance(value, ExternalStateEntry)]
+
+  def SetExternalEntry(self, name, value):
+    """Replaces the placeholder of an entry with its loaded value."""
+    self.data[name] = value
+
+  def MarkExternal(self, name, digest):
+    self.external_entries[name] = digest
+
+  def UnmarkExternal(self, name):
+    self.external_entries.pop(name, None)
 
   def Empty(self):
     return not bool(self.data)
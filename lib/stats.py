@@ -63,11 +63,26 @@ from grr.proto import jobs_pb2
 
 # Stats decorators
 class Timed(object):
-  """A decorator to automatically export timing info for function calls."""
+  """A decorator to automatically export timing info for function calls.
+
+  Can also be used as a context manager to time a block of code:
+
+    with stats.Timed("metric_name", fields=[...]):
+      ...
+  """
 
   def __init__(self, varname, fields=None):
     self.varname = varname
     self.fields = fields or []
+    self.start_time = None
+
+  def __enter__(self):
+    self.start_time = time.time()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    STATS.RecordEvent(self.varname, time.time() - self.start_time,
+                      fields=self.fields)
 
   def __call__(self, func):
 
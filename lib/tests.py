@@ -12,8 +12,10 @@ from grr.lib import artifact_lib_test
 from grr.lib import artifact_test
 from grr.lib import build_test
 from grr.lib import communicator_test
+from grr.lib import compression_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
+from grr.lib import data_store_benchmark_test
 from grr.lib import data_store_test
 from grr.lib import email_alerts_test
 from grr.lib import export_test
@@ -42,5 +44,7 @@ from grr.lib.data_stores import tests
 from grr.lib.flows import tests
 from grr.lib.hunts import tests
 from grr.lib.rdfvalues import tests
+from grr.tools import data_store_benchmark_test
 from grr.tools import entry_point_test
+from grr.tools import http_server_test
 # pylint: enable=unused-import
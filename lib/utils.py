@@ -4,6 +4,7 @@
 
 import __builtin__
 import base64
+import hashlib
 import os
 import pipes
 import Queue
@@ -848,6 +849,141 @@ class HeartbeatQueue(Queue.Queue):
     return message
 
 
+class TokenBucket(object):
+  """A thread safe token bucket limiting the rate of some resource use.
+
+  Tokens (e.g. bytes) are added at a fixed rate up to a maximum of burst.
+  Consuming more tokens than available puts the bucket in debt and the caller
+  sleeps until the debt is paid off, so single requests larger than the burst
+  are allowed but the average rate is still respected.
+  """
+
+  # Longest sleep between calls to the progress callback.
+  PROGRESS_INTERVAL = 1
+
+  def __init__(self, rate, burst=None):
+    """Constructor.
+
+    Args:
+      rate: Number of tokens added per second. 0 or None means unlimited.
+      burst: Maximum number of tokens that can be accumulated. Defaults to one
+        second worth of tokens.
+    """
+    self.rate = rate
+    self.burst = burst or rate
+    self.tokens = self.burst
+    self.last_refill = time.time()
+    self.lock = threading.Lock()
+
+  def _Reserve(self, amount):
+    """Takes the tokens and returns how long the caller has to wait."""
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.last_refill) * self.rate)
+      self.last_refill = now
+      self.tokens -= amount
+      if self.tokens >= 0:
+        return 0
+      return -self.tokens / float(self.rate)
+
+  def Consume(self, amount, progress_callback=None):
+    """Takes amount tokens from the bucket, sleeping if needed.
+
+    Args:
+      amount: Number of tokens to consume.
+      progress_callback: If given, long waits are split into sleeps of at most
+        PROGRESS_INTERVAL seconds and this is called after each of them.
+
+    Returns:
+      The number of seconds spent sleeping.
+    """
+    if not self.rate:
+      return 0
+
+    wait = self._Reserve(amount)
+    if progress_callback is None:
+      if wait:
+        time.sleep(wait)
+      return wait
+
+    remaining = wait
+    while remaining > 0:
+      time.sleep(min(remaining, self.PROGRESS_INTERVAL))
+      remaining -= self.PROGRESS_INTERVAL
+      progress_callback()
+
+    return wait
+
+
+class ContentDefinedChunker(object):
+  """Splits a stream into chunks at boundaries chosen by its content.
+
+  A gear rolling hash is computed over the data and a chunk ends wherever its
+  top bits are all zero. The hash only depends on the last 64 bytes, so
+  inserting or removing data only changes the chunks around the edit and the
+  rest of the file still deduplicates against older versions.
+  """
+
+  # A fixed table so all clients agree on the boundaries.
+  GEAR = [struct.unpack("<Q", hashlib.sha256(chr(i)).digest()[:8])[0]
+          for i in range(256)]
+
+  WINDOW = 64
+
+  def __init__(self, max_size, average_size=None, min_size=None):
+    """Constructor.
+
+    Args:
+      max_size: No chunk is larger than this.
+      average_size: The expected chunk size, rounded down to a power of two.
+        Defaults to a quarter of max_size.
+      min_size: No chunk other than the last is smaller than this. Defaults to
+        a quarter of average_size.
+    """
+    self.max_size = max_size
+    average_size = average_size or max(1, max_size / 4)
+    self.min_size = min_size or average_size / 4
+
+    bits = max(1, average_size.bit_length() - 1)
+    self.mask = ((1 << bits) - 1) << (64 - bits)
+
+  def FindBoundary(self, data):
+    """Returns the length of the first chunk of data."""
+    end = min(len(data), self.max_size)
+    if end <= self.min_size:
+      return end
+
+    gear = self.GEAR
+    mask = self.mask
+    min_size = self.min_size
+    rolling_hash = 0
+
+    # Earlier bytes have been shifted out of the hash by min_size.
+    for i in xrange(max(0, min_size - self.WINDOW), end):
+      rolling_hash = (
+          (rolling_hash << 1) + gear[ord(data[i])]) & 0xFFFFFFFFFFFFFFFF
+      if i >= min_size and not rolling_hash & mask:
+        return i + 1
+
+    return end
+
+  def Split(self, read):
+    """Yields the chunks of the data returned by read(length)."""
+    data = ""
+    while True:
+      new_data = read(self.max_size)
+      data += new_data
+
+      while len(data) >= self.max_size or (data and not new_data):
+        boundary = self.FindBoundary(data)
+        yield data[:boundary]
+        data = data[boundary:]
+
+      if not new_data:
+        break
+
+
 class StreamingZipWriter(object):
   """A streaming zip file writer which can copy from file like objects.
 
@@ -269,6 +269,56 @@ class UtilsTest(test_lib.GRRBaseTest):
       p1 = p1.next
     self.assertEqual(p, self.tail)
 
+  def testTokenBucket(self):
+    sleeps = []
+    with test_lib.FakeTime(1000):
+      with utils.Stubber(time, "sleep", sleeps.append):
+        bucket = utils.TokenBucket(100)
+
+        # The bucket starts full.
+        self.assertEqual(bucket.Consume(100), 0)
+
+        # Now we have to wait for the tokens to be refilled.
+        self.assertEqual(bucket.Consume(50), 0.5)
+
+        # Requests larger than the burst are allowed but put the bucket in
+        # debt.
+        self.assertEqual(bucket.Consume(300), 3.5)
+        self.assertEqual(sleeps, [0.5, 3.5])
+
+    # Unlimited buckets never sleep.
+    self.assertEqual(utils.TokenBucket(0).Consume(10 ** 9), 0)
+
+  def testTokenBucketProgress(self):
+    sleeps = []
+    with test_lib.FakeTime(1000):
+      with utils.Stubber(time, "sleep", sleeps.append):
+        bucket = utils.TokenBucket(100)
+        bucket.Consume(100)
+
+        # Long waits are split so the caller can heartbeat in between.
+        progress = []
+        self.assertEqual(
+            bucket.Consume(250, progress_callback=lambda: progress.append(1)),
+            2.5)
+        self.assertEqual(sleeps, [1, 1, 0.5])
+        self.assertEqual(len(progress), 3)
+
+  def testContentDefinedChunker(self):
+    data = os.urandom(100000)
+    chunker = utils.ContentDefinedChunker(4096)
+
+    chunks = list(chunker.Split(StringIO.StringIO(data).read))
+    self.assertEqual("".join(chunks), data)
+    self.assertTrue(max(len(chunk) for chunk in chunks) <= 4096)
+    self.assertTrue(min(len(chunk) for chunk in chunks[:-1]) >= 256)
+
+    # Inserting data only changes the chunks around it.
+    changed = data[:50000] + "inserted" + data[50000:]
+    changed_chunks = list(chunker.Split(StringIO.StringIO(changed).read))
+    self.assertEqual("".join(changed_chunks), changed)
+    self.assertTrue(len(set(chunks) - set(changed_chunks)) <= 2)
+
   def testGuessWindowsFileNameFromString(self):
     g = utils.GuessWindowsFileNameFromString
     fixture = [(r"C:\Program Files\Realtek\Audio\blah.exe -s",
@@ -2,7 +2,10 @@
 """Module with GRRWorker/GRREnroller implementation."""
 
 
+import multiprocessing
+import os
 import pdb
+import Queue
 import time
 import traceback
 
@@ -11,6 +14,7 @@ import logging
 
 from grr.lib import aff4
 from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import master
@@ -23,6 +27,7 @@ from grr.lib import server_stubs
 from grr.lib import stats
 from grr.lib import threadpool
 from grr.lib import utils
+from grr.server import stats_server
 
 
 DEFAULT_WORKER_QUEUE = rdfvalue.RDFURN("W")
@@ -80,6 +85,9 @@ class GRRWorker(object):
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
     self.lease_time = config_lib.CONFIG["Worker.flow_lease_time"]
+    self.lease_batch_size = config_lib.CONFIG["Worker.flow_lease_batch_size"]
+    self.shard_claim = queue_manager_lib.NotificationShardClaim(queue,
+                                                                token=token)
 
   def Run(self):
     """Event loop."""
@@ -103,7 +111,8 @@ class GRRWorker(object):
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
-      self.thread_pool.Join()
+      if self.thread_pool:
+        self.thread_pool.Join()
 
   def RunOnce(self):
     """Processes one set of messages from Task Scheduler.
@@ -121,10 +130,17 @@ class GRRWorker(object):
     # notifications to avoid possible race conditions.
     queue_manager.FreezeTimestamp()
 
+    # Only read the notification shards claimed by this worker.
+    shards = self.shard_claim.GetShards(queue_manager)
     notifications_by_priority = queue_manager.GetNotificationsByPriority(
-        self.queue)
+        self.queue, shards=shards)
     time_to_fetch_messages = time.time() - now
 
+    # One of the workers resizes the shards to the current load.
+    if self.shard_claim.index == 0:
+      queue_manager.AdjustNotificationShards(
+          self.queue, workers=self.shard_claim.workers)
+
     # Process stuck flows first
     stuck_flows = notifications_by_priority.pop(
         queue_manager.STUCK_PRIORITY, [])
@@ -189,6 +205,10 @@ class GRRWorker(object):
     look at the messages here at all any more - we just work from the
     completed messages in the flow RDFValue.
 
+    When there are many more flows than threads, the flows are leased and
+    loaded in batches of up to Worker.flow_lease_batch_size so the fixed data
+    store cost of each flow is shared.
+
     Args:
         active_notifications: The list of notifications.
         queue_manager: QueueManager object used to manage notifications,
@@ -199,7 +219,12 @@ class GRRWorker(object):
         The number of processed flows.
     """
     now = time.time()
+    batch_size = max(1, min(
+        self.lease_batch_size,
+        len(active_notifications) // max(1, self.thread_pool.max_threads)))
+
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -207,10 +232,28 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
-        self.thread_pool.AddTask(target=self._ProcessMessages,
-                                 args=(notification,
-                                       queue_manager.Copy()),
-                                 name=self.__class__.__name__)
+
+        # Well known flows are created rather than opened so they are not
+        # batched.
+        if (batch_size == 1 or
+            notification.session_id in self.well_known_flows):
+          self.thread_pool.AddTask(target=self._ProcessMessages,
+                                   args=(notification,
+                                         queue_manager.Copy()),
+                                   name=self.__class__.__name__)
+          continue
+
+        batch.append(notification)
+        if len(batch) >= batch_size:
+          self.thread_pool.AddTask(target=self._ProcessMessageBatch,
+                                   args=(batch, queue_manager.Copy()),
+                                   name=self.__class__.__name__)
+          batch = []
+
+    if batch:
+      self.thread_pool.AddTask(target=self._ProcessMessageBatch,
+                               args=(batch, queue_manager.Copy()),
+                               name=self.__class__.__name__)
 
     return processed
 
@@ -220,6 +263,7 @@ class GRRWorker(object):
     session_id = notification.session_id
 
     try:
+      lease_start = time.time()
       # Take a lease on the flow:
       if session_id in self.well_known_flows:
         # Well known flows are not necessarily present in the data store so
@@ -234,85 +278,17 @@ class GRRWorker(object):
             blocking=False, token=self.token)
 
       with flow_obj:
-
-        now = time.time()
         logging.debug("Got lock on %s", session_id)
+        stats.STATS.RecordEvent("flow_stage_latency", time.time() - lease_start,
+                                fields=[flow_obj.Name(), "lease"])
 
         # If we get here, we now own the flow. We can delete the notifications
         # we just retrieved but we need to make sure we don't delete any that
         # came in later.
         queue_manager.DeleteNotification(session_id, end=notification.timestamp)
 
-        # We still need to take a lock on the well known flow in the datastore,
-        # but we can run a local instance.
-        if session_id in self.well_known_flows:
-          stats.STATS.IncrementCounter("well_known_flow_requests",
-                                       fields=[str(session_id)])
-          flow_obj.ProcessRequests(self.thread_pool)
-
-        else:
-          if not isinstance(flow_obj, flow.GRRFlow):
-            logging.warn("%s is not a proper flow object (got %s)", session_id,
-                         type(flow_obj))
-            return
-
-          runner = flow_obj.GetRunner()
-          if runner.schedule_kill_notifications:
-            # Create a notification for the flow in the future that
-            # indicates that this flow is in progess. We'll delete this
-            # notification when we're done with processing completed
-            # requests. If we're stuck for some reason, the notification
-            # will be delivered later and the stuck flow will get
-            # terminated.
-            stuck_flows_timeout = rdfvalue.Duration(
-                config_lib.CONFIG["Worker.stuck_flows_timeout"])
-            kill_timestamp = (rdfvalue.RDFDatetime().Now() +
-                              stuck_flows_timeout)
-            with queue_manager_lib.QueueManager(token=self.token) as manager:
-              manager.QueueNotification(session_id=session_id,
-                                        in_progress=True,
-                                        timestamp=kill_timestamp)
-
-            # kill_timestamp may get updated via flow.HeartBeat() calls, so we
-            # have to store it in the runner context.
-            runner.context.kill_timestamp = kill_timestamp
-
-          try:
-            runner.ProcessCompletedRequests(notification, self.thread_pool)
-
-          # Something went wrong - log it in the flow.
-          except Exception as e:  # pylint: disable=broad-except
-            runner.context.state = rdfvalue.Flow.State.ERROR
-            runner.context.backtrace = traceback.format_exc()
-
-            logging.error("Flow %s: %s", flow_obj, e)
-            return
-
-          finally:
-            # Delete kill notification as the flow got processed and is not
-            # stuck.
-            with queue_manager_lib.QueueManager(token=self.token) as manager:
-              if runner.schedule_kill_notifications:
-                manager.DeleteNotification(
-                    session_id, start=runner.context.kill_timestamp,
-                    end=runner.context.kill_timestamp)
-                runner.context.kill_timestamp = None
-
-              if (runner.process_requests_in_order and
-                  notification.last_status and
-                  (runner.context.next_processed_request <=
-                   notification.last_status)):
-                # We are processing requests in order and have received a
-                # notification for a specific request but could not process
-                # that request. This might be a race condition in the data
-                # store so we reschedule the notification in the future.
-                delay = config_lib.CONFIG[
-                    "Worker.notification_retry_interval"]
-                manager.QueueNotification(
-                    notification, timestamp=notification.timestamp + delay)
-
-        logging.debug("Done processing %s: %s sec", session_id,
-                      time.time() - now)
+        if not self._ProcessFlow(flow_obj, notification):
+          return
 
       # Everything went well -> session can be run again.
       self.queued_flows.ExpireObject(session_id)
@@ -327,6 +303,432 @@ class GRRWorker(object):
       logging.exception("Error processing session %s: %s", session_id, e)
       queue_manager.DeleteNotification(session_id)
 
+  def _ProcessMessageBatch(self, notifications, queue_manager):
+    """Leases, loads and runs a batch of flows.
+
+    All flows are locked and read together and the completed requests of all
+    of them are fetched in one data store operation. Flows which are locked by
+    another worker are skipped.
+
+    The flows are then run one after the other. Before each flow runs, the
+    leases of all the flows still waiting are renewed if they are running
+    low, so flows at the end of a slow batch are not lost to other workers.
+
+    Args:
+      notifications: The notifications of the flows to run.
+      queue_manager: QueueManager object used to manage notifications.
+    """
+    notifications = dict((n.session_id, n) for n in notifications)
+
+    try:
+      lease_start = time.time()
+      flow_objs = aff4.FACTORY.MultiOpenWithLock(
+          notifications, lease_time=self.lease_time, token=self.token)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning("Unable to lease flows in a batch, retrying them one by "
+                      "one: %s", e)
+      for notification in notifications.itervalues():
+        self._ProcessMessages(notification, queue_manager)
+      return
+
+    lease_time = time.time() - lease_start
+    try:
+      locked = {}
+      for flow_obj in flow_objs:
+        session_id = rdfvalue.SessionID(flow_obj.urn)
+        locked[session_id] = notifications[session_id]
+        stats.STATS.RecordEvent("flow_stage_latency", lease_time,
+                                fields=[flow_obj.Name(), "lease"])
+
+      # We own the flows now, so their notifications can be deleted. Flows
+      # are usually notified together so there are few distinct timestamps.
+      for timestamp, batch in utils.GroupBy(
+          locked.values(), lambda n: n.timestamp).iteritems():
+        queue_manager.MultiDeleteNotifications(
+            [n.session_id for n in batch], end=timestamp)
+
+      completed_requests = queue_manager.MultiFetchCompletedRequests(
+          dict((session_id, notification.timestamp)
+               for session_id, notification in locked.iteritems()))
+
+    except Exception as e:  # pylint: disable=broad-except
+      for flow_obj in flow_objs:
+        flow_obj.transaction.Abort()
+
+      logging.warning("Unable to load flows in a batch, retrying them one by "
+                      "one: %s", e)
+      for notification in notifications.itervalues():
+        self._ProcessMessages(notification, queue_manager)
+      return
+
+    expired = set()
+    for i, flow_obj in enumerate(flow_objs):
+      session_id = rdfvalue.SessionID(flow_obj.urn)
+      expired.update(self._RenewLeases(flow_objs[i:], expired))
+      if session_id in expired:
+        continue
+
+      try:
+        with flow_obj:
+          if not self._ProcessFlow(
+              flow_obj, locked[session_id],
+              completed_requests=completed_requests.get(session_id)):
+            continue
+
+        self.queued_flows.ExpireObject(session_id)
+
+      except Exception as e:    # pylint: disable=broad-except
+        logging.exception("Error processing session %s: %s", session_id, e)
+        queue_manager.DeleteNotification(session_id)
+
+  def _RenewLeases(self, flow_objs, expired):
+    """Renews the leases of flows which are waiting to run in a batch.
+
+    Leases are only renewed once less than half of the lease time is left.
+    Flows whose lease expired may be owned by another worker by now, they are
+    notified again so their requests are not forgotten.
+
+    Args:
+      flow_objs: The flows which still have to run.
+      expired: The session ids of flows whose lease already expired.
+
+    Returns:
+      The session ids of the flows whose lease expired now.
+    """
+    newly_expired = set()
+    for flow_obj in flow_objs:
+      session_id = rdfvalue.SessionID(flow_obj.urn)
+      if session_id in expired or flow_obj.CheckLease() > self.lease_time / 2:
+        continue
+
+      try:
+        flow_obj.UpdateLease(self.lease_time)
+      except aff4.LockError:
+        logging.warning("Lease on %s expired before the flow could run.",
+                        session_id)
+        newly_expired.add(session_id)
+
+    if newly_expired:
+      with queue_manager_lib.QueueManager(token=self.token) as manager:
+        for session_id in newly_expired:
+          manager.QueueNotification(session_id=session_id)
+
+    return newly_expired
+
+  def _ProcessFlow(self, flow_obj, notification, completed_requests=None):
+    """Runs a locked flow on its completed requests.
+
+    Args:
+      flow_obj: The locked flow.
+      notification: The notification which triggered the processing.
+      completed_requests: The completed requests of the flow if they were
+        already fetched.
+
+    Returns:
+      True if the flow was processed and can be scheduled again.
+    """
+    now = time.time()
+    session_id = notification.session_id
+
+    # We still need to take a lock on the well known flow in the datastore,
+    # but we can run a local instance.
+    if session_id in self.well_known_flows:
+      stats.STATS.IncrementCounter("well_known_flow_requests",
+                                   fields=[str(session_id)])
+      flow_obj.ProcessRequests(self.thread_pool)
+
+    else:
+      if not isinstance(flow_obj, flow.GRRFlow):
+        logging.warn("%s is not a proper flow object (got %s)", session_id,
+                     type(flow_obj))
+        return False
+
+      runner = flow_obj.GetRunner()
+      if runner.schedule_kill_notifications:
+        # Create a notification for the flow in the future that indicates that
+        # this flow is in progess. We'll delete this notification when we're
+        # done with processing completed requests. If we're stuck for some
+        # reason, the notification will be delivered later and the stuck flow
+        # will get terminated. Flows of a batch only get theirs when they run,
+        # so the time spent waiting for the batch does not count.
+        stuck_flows_timeout = rdfvalue.Duration(
+            config_lib.CONFIG["Worker.stuck_flows_timeout"])
+        kill_timestamp = rdfvalue.RDFDatetime().Now() + stuck_flows_timeout
+        with queue_manager_lib.QueueManager(token=self.token) as manager:
+          manager.QueueNotification(session_id=session_id, in_progress=True,
+                                    timestamp=kill_timestamp)
+
+        # kill_timestamp may get updated via flow.HeartBeat() calls, so we
+        # have to store it in the runner context.
+        runner.context.kill_timestamp = kill_timestamp
+
+      try:
+        with stats.Timed("flow_stage_latency",
+                         fields=[flow_obj.Name(), "process"]):
+          runner.ProcessCompletedRequests(
+              notification, self.thread_pool,
+              completed_requests=completed_requests)
+
+      # Something went wrong - log it in the flow.
+      except Exception as e:  # pylint: disable=broad-except
+        runner.context.state = rdfvalue.Flow.State.ERROR
+        runner.context.backtrace = traceback.format_exc()
+
+        logging.error("Flow %s: %s", flow_obj, e)
+        return False
+
+      finally:
+        # Delete kill notification as the flow got processed and is not
+        # stuck.
+        with queue_manager_lib.QueueManager(token=self.token) as manager:
+          if runner.schedule_kill_notifications:
+            manager.DeleteNotification(
+                session_id, start=runner.context.kill_timestamp,
+                end=runner.context.kill_timestamp)
+            runner.context.kill_timestamp = None
+
+          if (runner.process_requests_in_order and
+              notification.last_status and
+              (runner.context.next_processed_request <=
+               notification.last_status)):
+            # We are processing requests in order and have received a
+            # notification for a specific request but could not process
+            # that request. This might be a race condition in the data
+            # store so we reschedule the notification in the future.
+            delay = config_lib.CONFIG[
+                "Worker.notification_retry_interval"]
+            manager.QueueNotification(
+                notification, timestamp=notification.timestamp + delay)
+
+    logging.debug("Done processing %s: %s sec", session_id,
+                  time.time() - now)
+    return True
+
+
+class _PooledWorker(GRRWorker):
+  """The worker running in a child process of a GRRWorkerPool."""
+
+  def __init__(self, done_queue, index, **kwargs):
+    super(_PooledWorker, self).__init__(**kwargs)
+    self.done_queue = done_queue
+    self.index = index
+
+  def _ProcessMessages(self, notification, queue_manager):
+    try:
+      super(_PooledWorker, self)._ProcessMessages(notification, queue_manager)
+    finally:
+      self.done_queue.put((self.index, str(notification.session_id)))
+
+
+def _RunPooledWorker(index, queue, work_queue, done_queue, threadpool_size,
+                     token):
+  """Main function of the child processes of a GRRWorkerPool."""
+  # Connections and background threads do not survive fork(), so every child
+  # opens its own data store. The configuration is inherited as is.
+  data_store.DB = data_store.DB.__class__()
+  data_store.DB.Initialize()
+
+  port = config_lib.CONFIG["Monitoring.http_port"]
+  if port:
+    stats_server.StatsServer(port + index + 1).Start()
+
+  worker_obj = _PooledWorker(
+      done_queue, index, queue=queue,
+      threadpool_prefix="grr_worker_pool%d" % index,
+      threadpool_size=threadpool_size, token=token)
+
+  parent = os.getppid()
+  while os.getppid() == parent:
+    try:
+      serialized, frozen_timestamp = work_queue.get(timeout=1)
+    except Queue.Empty:
+      continue
+
+    notification = rdfvalue.GrrNotification(serialized)
+    queue_manager = queue_manager_lib.QueueManager(token=token)
+    queue_manager.frozen_timestamp = rdfvalue.RDFDatetime(frozen_timestamp)
+    worker_obj.thread_pool.AddTask(target=worker_obj._ProcessMessages,
+                                   args=(notification, queue_manager),
+                                   name="GRRWorkerPool")
+
+  logging.info("Worker pool coordinator is gone, exiting.")
+
+
+class _WorkerProcess(object):
+  """The coordinator's view of a child process."""
+
+  def __init__(self, index):
+    self.index = index
+    self.process = None
+    self.work_queue = None
+    self.started = 0
+    # Maps session ids to the notifications dispatched to this child.
+    self.outstanding = {}
+
+
+class GRRWorkerPool(GRRWorker):
+  """A worker which processes flows in a pool of child processes.
+
+  Flow processing is CPU bound and a single process can only use one core.
+  The pool fetches notifications like a normal worker but dispatches each
+  flow to one of Worker.worker_process_count child processes, each running
+  its own thread pool. A session is always sent to the same child so its
+  flow object stays in that child's caches. Children which die are restarted
+  and their in flight sessions become available to the pool again.
+
+  Each child exports its stats on Monitoring.http_port + index + 1.
+  """
+
+  # If all children die this soon after starting, the pool gives up.
+  STARTUP_GRACE_PERIOD = 60
+
+  def __init__(self, queue=None, processes=None, threadpool_size=None,
+               token=None):
+    """Constructor.
+
+    Args:
+      queue: The queue we use to fetch new messages from.
+      processes: The number of child processes.
+      threadpool_size: The number of threads in each child.
+      token: The token to use for the worker.
+
+    Raises:
+      RuntimeError: If the token is not provided.
+    """
+    if token is None:
+      raise RuntimeError("A valid ACLToken is required.")
+
+    self.queue = queue
+    self.token = token
+    self.last_active = 0
+    self.lease_time = config_lib.CONFIG["Worker.flow_lease_time"]
+    self.shard_claim = queue_manager_lib.NotificationShardClaim(queue,
+                                                                token=token)
+    self.thread_pool = None
+
+    self.processes = (processes or
+                      config_lib.CONFIG["Worker.worker_process_count"])
+    self.threadpool_size = (threadpool_size or
+                            config_lib.CONFIG["Threadpool.size"])
+
+    self.queued_flows = utils.TimeBasedCache(
+        max_size=self.processes * self.threadpool_size, max_age=60)
+
+    self.done_queue = multiprocessing.Queue()
+    self.children = [_WorkerProcess(i) for i in range(self.processes)]
+    self.start_time = None
+    self.dead_count = 0
+
+  def Start(self):
+    self.start_time = time.time()
+    for child in self.children:
+      self._StartChild(child)
+
+  def Stop(self):
+    for child in self.children:
+      if child.process and child.process.is_alive():
+        child.process.terminate()
+    for child in self.children:
+      if child.process:
+        child.process.join()
+
+  def _StartChild(self, child):
+    child.work_queue = multiprocessing.Queue()
+    child.outstanding = {}
+    child.process = multiprocessing.Process(
+        target=_RunPooledWorker, name="GRRWorkerPool%d" % child.index,
+        args=(child.index, self.queue, child.work_queue, self.done_queue,
+              self.threadpool_size, self.token))
+    child.process.start()
+    child.started = time.time()
+    logging.debug("Started worker process %d", child.process.pid)
+
+  def Supervise(self):
+    """Restarts dead children and collects finished sessions."""
+    while True:
+      try:
+        index, session_id = self.done_queue.get_nowait()
+      except Queue.Empty:
+        break
+
+      notification = self.children[index].outstanding.pop(session_id, None)
+      if notification is not None:
+        self.queued_flows.ExpireObject(notification.session_id)
+
+    for child in self.children:
+      if child.process.is_alive():
+        continue
+
+      logging.error("Worker process %d died with %s, %d flows were in flight.",
+                    child.process.pid, child.process.exitcode,
+                    len(child.outstanding))
+      stats.STATS.IncrementCounter("grr_worker_process_restarts")
+      self.dead_count += 1
+
+      # Catch all children dying on startup and raise immediately instead of
+      # continuously respawning them.
+      if (time.time() - self.start_time < self.STARTUP_GRACE_PERIOD and
+          self.dead_count >= self.processes):
+        self.Stop()
+        raise RuntimeError("Workers did not start up, all of them died.")
+
+      # Flows the child held a lock on become available when the lease
+      # expires, the others can be dispatched again right away.
+      for notification in child.outstanding.values():
+        self.queued_flows.ExpireObject(notification.session_id)
+      self._StartChild(child)
+
+    for child in self.children:
+      stats.STATS.SetGaugeValue("grr_worker_process_outstanding",
+                                len(child.outstanding),
+                                fields=[str(child.index)])
+
+  def Run(self):
+    self.Start()
+    try:
+      super(GRRWorkerPool, self).Run()
+    finally:
+      self.Stop()
+
+  def RunOnce(self):
+    self.Supervise()
+    return super(GRRWorkerPool, self).RunOnce()
+
+  def _ChildFor(self, session_id):
+    return self.children[hash(str(session_id)) % self.processes]
+
+  def ProcessMessages(self, active_notifications, queue_manager, time_limit=0):
+    """Dispatches the flows in the notifications to the child processes.
+
+    Args:
+        active_notifications: The list of notifications.
+        queue_manager: QueueManager object used to fetch the notifications.
+        time_limit: Unused, dispatching is fast.
+
+    Returns:
+        The number of dispatched flows.
+    """
+    _ = time_limit
+    processed = 0
+    for notification in active_notifications:
+      session_id = notification.session_id
+      if session_id in self.queued_flows:
+        continue
+
+      # Children run at most threadpool_size flows at a time, anything more
+      # waits for the next poll.
+      child = self._ChildFor(session_id)
+      if len(child.outstanding) >= self.threadpool_size:
+        continue
+
+      processed += 1
+      self.queued_flows.Put(session_id, 1)
+      child.outstanding[str(session_id)] = notification
+      child.work_queue.put((notification.SerializeToString(),
+                            int(queue_manager.frozen_timestamp)))
+
+    return processed
+
 
 class GRREnroler(GRRWorker):
   """A GRR enroler.
@@ -343,3 +745,6 @@ class WorkerInit(registry.InitHook):
   def RunOnce(self):
     """Exports the vars.."""
     stats.STATS.RegisterCounterMetric("grr_flows_stuck")
+    stats.STATS.RegisterCounterMetric("grr_worker_process_restarts")
+    stats.STATS.RegisterGaugeMetric("grr_worker_process_outstanding", int,
+                                    fields=[("process", str)])
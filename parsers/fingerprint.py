@@ -204,12 +204,14 @@ class Fingerprinter(object):
     Raises:
        RuntimeError: when internal inconsistencies occur.
     """
+    # VFS handlers of mapped files hand out blocks without copying them.
+    read = getattr(self.file, 'read_buffer', self.file.read)
     while True:
       interval = self._GetNextInterval()
       if interval is None:
         break
       self.file.seek(interval.start, os.SEEK_SET)
-      block = self.file.read(interval.end - interval.start)
+      block = read(interval.end - interval.start)
       if len(block) != interval.end - interval.start:
         raise RuntimeError('Short read on file.')
       self._HashBlock(block, interval.start, interval.end)
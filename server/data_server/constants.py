@@ -9,6 +9,8 @@ MAX_RANGE = 2 ** 64
 REBALANCE_DIRECTORY = ".GRR_REBALANCE"
 TRANSACTION_FILENAME = ".TRANSACTION"
 REMOVE_FILENAME = ".TRANSACTION_REMOVE"
+# Files being received are kept here until they are complete.
+PARTIAL_DIRECTORY = ".PARTIAL"
 
 # HTTP status codes.
 RESPONSE_OK = 200
@@ -33,3 +35,4 @@ RESPONSE_IS_MASTER_SERVER = 404
 RESPONSE_INCOMPLETE_SYNC = 503
 RESPONSE_DATA_SERVER_NOT_FOUND = 409
 RESPONSE_RANGE_NOT_EMPTY = 402
+RESPONSE_CHECKSUM_MISMATCH = 412
@@ -6,6 +6,7 @@ from BaseHTTPServer import BaseHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
 import socket
 import SocketServer
+import threading
 import time
 import urlparse
 import uuid
@@ -32,6 +33,7 @@ from grr.server.data_server import auth
 from grr.server.data_server import constants
 from grr.server.data_server import errors
 from grr.server.data_server import master
+from grr.server.data_server import pipeline
 from grr.server.data_server import rebalance
 from grr.server.data_server import store
 from grr.server.data_server import utils as sutils
@@ -57,6 +59,62 @@ MAPPING = None
 CMDTABLE = None
 # Nonce store used for authentication.
 NONCE_STORE = None
+# Event loop serving the pipelined protocol.
+EVENT_LOOP = None
+
+
+def ExecuteCommand(cmd, permissions):
+  """Executes a DataStoreCommand and returns the serialized response.
+
+  Args:
+    cmd: The DataStoreCommand to execute.
+    permissions: The permissions of the client sending the command.
+
+  Returns:
+    The serialized DataStoreResponse or None if the command is unknown.
+  """
+  cmdinfo = CMDTABLE.get(cmd.command)
+  if not cmdinfo:
+    logging.error("Unrecognized command %d", cmd.command)
+    return None
+  method, perm = cmdinfo
+  if perm in permissions:
+    return method(cmd.request)
+
+  resp = rdfvalue.DataStoreResponse()
+  resp.request = cmd.request
+  resp.status = rdfvalue.DataStoreResponse.Status.AUTHORIZATION_DENIED
+  resp.status_desc = ("Operation not allowed: required %s but only have "
+                      "%s permissions" % (perm, permissions))
+  return resp.SerializeToString()
+
+
+def ExecuteCommandBatch(payload, permissions):
+  """Executes a serialized DataStoreCommandBatch in order.
+
+  Args:
+    payload: The serialized DataStoreCommandBatch.
+    permissions: The permissions of the client sending the batch.
+
+  Returns:
+    A serialized DataStoreReplyBatch with one reply per command.
+  """
+  batch = rdfvalue.DataStoreCommandBatch(payload)
+  replies = rdfvalue.DataStoreReplyBatch()
+  for cmd in batch.commands:
+    response = ExecuteCommand(cmd, permissions)
+    if response is None:
+      response = rdfvalue.DataStoreResponse(
+          status=rdfvalue.DataStoreResponse.Status.DATA_STORE_ERROR,
+          status_desc="Unrecognized command %d" % cmd.command)
+    else:
+      response = rdfvalue.DataStoreResponse(response)
+    replies.replies.Append(request_id=cmd.request_id, response=response)
+
+  stats.STATS.IncrementCounter("grr_data_server_pipelined_batches")
+  stats.STATS.IncrementCounter("grr_data_server_pipelined_commands",
+                               delta=len(batch.commands))
+  return replies.SerializeToString()
 
 
 def GetStatistics():
@@ -84,6 +142,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     # Data server reference for the master.
     self.data_server = None
     self.rebalance_id = None
+    self.pipelined = False
     BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
   def _Response(self, code, body):
@@ -139,23 +198,9 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       return ""
     cmd = rdfvalue.DataStoreCommand(cmd_str)
 
-    request = cmd.request
-    op = cmd.command
-
-    cmdinfo = CMDTABLE.get(op)
-    if not cmdinfo:
-      logging.error("Unrecognized command %d", op)
+    response = ExecuteCommand(cmd, permissions)
+    if response is None:
       return ""
-    method, perm = cmdinfo
-    if perm in permissions:
-      response = method(request)
-    else:
-      resp = rdfvalue.DataStoreResponse()
-      resp.request = cmd.request
-      resp.status = rdfvalue.DataStoreResponse.Status.AUTHORIZATION_DENIED
-      resp.status_desc = ("Operation not allowed: required %s but only have "
-                          "%s permissions" % (perm, permissions))
-      response = resp.SerializeToString()
 
     replybody = sutils.SIZE_PACKER.pack(len(response)) + response
 
@@ -276,6 +321,43 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         self.close_connection = 1
         return
 
+  def HandlePipelinedDataStoreService(self):
+    """Hands the connection over to the pipelined protocol event loop."""
+    if self.data_server:
+      self._EmptyResponse(constants.RESPONSE_NOT_A_CLIENT)
+      return
+    if not EVENT_LOOP or not hasattr(self.server, "DetachRequest"):
+      # The client will fall back to the legacy protocol.
+      self._EmptyResponse(constants.RESPONSE_NOT_FOUND)
+      return
+
+    sock = self.connection
+    sock.setblocking(1)
+
+    perms = NONCE_STORE.ValidateAuthTokenClient(self.post_data)
+    if not perms:
+      sock.sendall("IP\n")
+      sock.close()
+      self.close_connection = 1
+      return
+
+    try:
+      sock.settimeout(self.LOGIN_TIMEOUT)
+      sock.sendall("OK\n")
+    except (socket.error, socket.timeout):
+      logging.warning("Could not login client %s", self.client_address)
+      self.close_connection = 1
+      return
+
+    logging.info("Client %s has started using the pipelined protocol",
+                 self.client_address)
+    # From now on the socket belongs to the event loop and this thread is
+    # free to go.
+    self.server.DetachRequest(self.request)
+    EVENT_LOOP.AddConnection(sock, self.client_address, perms)
+    self.pipelined = True
+    self.close_connection = 1
+
   def HandleMapping(self):
     """Returns the mapping to a client or server."""
     if not MAPPING:
@@ -323,7 +405,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     index = 0
     if not MASTER:
       index = DATA_SERVER.Index()
-    moving = rebalance.ComputeRebalanceSize(mapping, index)
+    moving = rebalance.ComputeRebalanceSize(mapping, index,
+                                            old_mapping=MAPPING)
     reb.moving.Append(moving)
     body = reb.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
@@ -333,13 +416,21 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     index = 0
     if not MASTER:
       index = DATA_SERVER.Index()
-    rebalance.CopyFiles(reb, index)
+    if not rebalance.CopyFiles(reb, index, old_mapping=MAPPING):
+      self._EmptyResponse(constants.RESPONSE_FILES_NOT_COPIED)
+      return
     self._EmptyResponse(constants.RESPONSE_OK)
 
-  def HandleRebalanceCopyFile(self):
-    if not rebalance.SaveTemporaryFile(self.rfile):
-      return self._EmptyResponse(constants.RESPONSE_FILE_NOT_SAVED)
-    self._EmptyResponse(constants.RESPONSE_OK)
+  def HandleRebalanceCopyStatus(self):
+    """Tell the sender how much of a file we already have."""
+    offset = rebalance.GetPartialFileSize(self.post_data)
+    self._Response(constants.RESPONSE_OK, sutils.OFFSET_PACKER.pack(offset))
+
+  def HandleRebalanceCopyChunk(self):
+    self._EmptyResponse(rebalance.SaveChunk(self.post_data))
+
+  def HandleRebalanceCopyCommit(self):
+    self._EmptyResponse(rebalance.CommitFile(self.post_data))
 
   def HandleRebalancePhase2(self):
     """Call master to perform phase 2 of rebalancing."""
@@ -388,6 +479,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       for i, serv in enumerate(list(reb.mapping.servers)):
         MAPPING.servers[i].interval.start = serv.interval.start
         MAPPING.servers[i].interval.end = serv.interval.end
+        MAPPING.servers[i].virtual_nodes = serv.virtual_nodes
+      MAPPING.sharding = reb.mapping.sharding
       DATA_SERVER.SetMapping(MAPPING)
     # Send back server state.
     stat = GetStatistics()
@@ -488,9 +581,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     server = MASTER.HasServer(addr, port)
     if not server:
       return self._EmptyResponse(constants.RESPONSE_DATA_SERVER_NOT_FOUND)
-    # Interval range must be 0.
-    interval = server.Interval()
-    if interval.start != interval.end:
+    # The server must not be responsible for any data.
+    if not sutils.ServerIsEmpty(MAPPING, server.GetInfo()):
       return self._EmptyResponse(constants.RESPONSE_RANGE_NOT_EMPTY)
     return self._EmptyResponse(constants.RESPONSE_OK)
 
@@ -546,7 +638,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         MASTER.CancelRebalancing()
         logging.warning("Rebalancing operation %s canceled", reb.id)
       self.rebalance_id = False
-    else:
+    elif not self.pipelined:
       logging.warning("Client %s has stopped using the server",
                       self.client_address)
 
@@ -559,12 +651,16 @@ HTTP_TABLE = {
     "/server/state": DataServerHandler.HandleState,
     "/server/mapping": DataServerHandler.HandleMapping,
     "/client/start": DataServerHandler.HandleDataStoreService,
+    "/client/pipeline": DataServerHandler.HandlePipelinedDataStoreService,
     "/client/handshake": DataServerHandler.HandleClientHandshake,
     "/client/mapping": DataServerHandler.HandleMapping,
     "/rebalance/phase1": DataServerHandler.HandleRebalancePhase1,
     "/rebalance/phase2": DataServerHandler.HandleRebalancePhase2,
     "/rebalance/statistics": DataServerHandler.HandleRebalanceStatistics,
     "/rebalance/copy": DataServerHandler.HandleRebalanceCopy,
+    "/rebalance/copy-status": DataServerHandler.HandleRebalanceCopyStatus,
+    "/rebalance/copy-chunk": DataServerHandler.HandleRebalanceCopyChunk,
+    "/rebalance/copy-commit": DataServerHandler.HandleRebalanceCopyCommit,
     "/rebalance/commit": DataServerHandler.HandleRebalanceCommit,
     "/rebalance/perform": DataServerHandler.HandleRebalancePerform,
     "/rebalance/recover": DataServerHandler.HandleRebalanceRecover,
@@ -576,9 +672,7 @@ HTTP_TABLE = {
     "/servers/sync-all": DataServerHandler.HandleServerSyncAll
     }
 
-STREAMING_TABLE = {
-    "/rebalance/copy-file": DataServerHandler.HandleRebalanceCopyFile,
-    }
+STREAMING_TABLE = {}
 
 
 class ThreadedHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
@@ -586,6 +680,24 @@ class ThreadedHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
 
   daemon_threads = True
 
+  def __init__(self, *args, **kwargs):
+    self.detached = set()
+    self.detached_lock = threading.Lock()
+    HTTPServer.__init__(self, *args, **kwargs)
+
+  def DetachRequest(self, request):
+    """Marks a request socket as owned by someone else."""
+    with self.detached_lock:
+      self.detached.add(request)
+
+  def shutdown_request(self, request):  # pylint: disable=g-bad-name
+    with self.detached_lock:
+      if request in self.detached:
+        # The socket now belongs to the pipelined event loop.
+        self.detached.discard(request)
+        return
+    HTTPServer.shutdown_request(self, request)
+
 
 class StandardDataServer(object):
   """Handles the connection with the data master."""
@@ -793,6 +905,14 @@ def Start(db, port=0, is_master=False, server_cls=ThreadedHTTPServer,
 
   server_port = port or config_lib.CONFIG["Dataserver.port"]
 
+  global EVENT_LOOP
+  EVENT_LOOP = pipeline.EventLoop(
+      ExecuteCommandBatch,
+      compression_threshold=config_lib.CONFIG[
+          "Dataserver.compression_threshold"],
+      pool_size=config_lib.CONFIG["Dataserver.pipeline_threads"])
+  EVENT_LOOP.Start()
+
   if is_master:
     InitMasterServer(server_port)
   else:
@@ -807,6 +927,7 @@ def Start(db, port=0, is_master=False, server_cls=ThreadedHTTPServer,
   except socket.error:
     print "Service already running at port %s" % server_port
   finally:
+    EVENT_LOOP.Stop()
     if MASTER:
       MASTER.Stop()
     else:
@@ -91,6 +91,9 @@ class Manager(object):
     self._ShowRange(self.mapping)
 
   def _ShowRange(self, mapping):
+    if sutils.IsConsistentHashing(mapping):
+      self._ShowRing(mapping)
+      return
     for i, serv in enumerate(list(mapping.servers)):
       addr = serv.address
       port = serv.port
@@ -102,6 +105,16 @@ class Manager(object):
                                                str(start).zfill(20),
                                                str(end).zfill(20))
 
+  def _ShowRing(self, mapping):
+    """Shows how much of the consistent hashing ring each server owns."""
+    owned = [0] * len(mapping.servers)
+    for start, end, index in sutils.MappingSegments(mapping):
+      owned[index] += end - start
+    for i, serv in enumerate(list(mapping.servers)):
+      perc = float(owned[i]) / float(constants.MAX_RANGE) * 100
+      print "Server %d %s:%d %d%% (%d virtual nodes)" % (
+          i, serv.address, serv.port, perc, serv.virtual_nodes)
+
   def _ComputeMappingSize(self, mapping):
     totalsize = 0
     servers = list(mapping.servers)
@@ -133,11 +146,38 @@ class Manager(object):
                                  interval=interval)
     return new_mapping
 
+  def _ComputeMappingFromVirtualNodes(self, mapping, virtual_nodes,
+                                      sharding=None):
+    """Builds a new consistent hashing mapping with new virtual node counts."""
+    new_mapping = rdfvalue.DataServerMapping(mapping.SerializeToString())
+    new_mapping.version = mapping.version + 1
+    if sharding is not None:
+      new_mapping.sharding = sharding
+    for serv, count in zip(new_mapping.servers, virtual_nodes):
+      serv.virtual_nodes = count
+    return new_mapping
+
+  def _ShowMovedFraction(self, new_mapping):
+    perc = sutils.MovedFraction(self.mapping, new_mapping) * 100
+    print "%.1f%% of the hash range will change servers." % perc
+
   def _Rebalance(self):
     """Starts the rebalance process."""
     if not self.mapping:
       print "Server information not available"
       return
+    if sutils.IsConsistentHashing(self.mapping):
+      # Give every server the same weight on the ring. Only the virtual nodes
+      # of new (or drained) servers change, so only their data moves.
+      virtual_nodes = config_lib.CONFIG["Dataserver.virtual_nodes"]
+      new_mapping = self._ComputeMappingFromVirtualNodes(
+          self.mapping, [virtual_nodes] * len(self.mapping.servers))
+      print "The new ring will be:"
+      self._ShowRange(new_mapping)
+      self._ShowMovedFraction(new_mapping)
+      print
+      self._DoRebalance(new_mapping)
+      return
     # Compute total size of database.
     servers = list(self.mapping.servers)
     num_servers = len(servers)
@@ -149,6 +189,33 @@ class Manager(object):
     print
     self._DoRebalance(new_mapping)
 
+  def _ChangeSharding(self, sharding):
+    """Converts the server group to a different sharding scheme."""
+    if not self.mapping:
+      print "Server information not available"
+      return
+    types = {"range": rdfvalue.DataServerMapping.Sharding.RANGE,
+             "consistent_hash":
+             rdfvalue.DataServerMapping.Sharding.CONSISTENT_HASH}
+    if sharding not in types:
+      print "Unknown sharding type: %s" % sharding
+      return
+    num_servers = len(self.mapping.servers)
+    if types[sharding] == rdfvalue.DataServerMapping.Sharding.RANGE:
+      new_mapping = self._ComputeMappingFromPercentages(
+          self.mapping, [1.0 / float(num_servers)] * num_servers)
+      new_mapping.sharding = types[sharding]
+    else:
+      virtual_nodes = config_lib.CONFIG["Dataserver.virtual_nodes"]
+      new_mapping = self._ComputeMappingFromVirtualNodes(
+          self.mapping, [virtual_nodes] * num_servers,
+          sharding=types[sharding])
+    print "The new ranges will be:"
+    self._ShowRange(new_mapping)
+    self._ShowMovedFraction(new_mapping)
+    print
+    self._DoRebalance(new_mapping)
+
   def _DoRebalance(self, new_mapping):
     """Performs a new rebalancing operation with the master server."""
     print "Contacting master server to start re-sharding...",
@@ -400,6 +467,18 @@ class Manager(object):
       return
     servers = list(self.mapping.servers)
     num_servers = len(servers)
+    if sutils.IsConsistentHashing(self.mapping):
+      # Removing the virtual nodes of the server only moves its own data.
+      virtual_nodes = [serv.virtual_nodes for serv in servers]
+      virtual_nodes[index] = 0
+      new_mapping = self._ComputeMappingFromVirtualNodes(self.mapping,
+                                                         virtual_nodes)
+      print "The new ring will be:"
+      self._ShowRange(new_mapping)
+      self._ShowMovedFraction(new_mapping)
+      print
+      self._DoRebalance(new_mapping)
+      return
     # Simply set everyone else with 1/(N-1).
     target = 1.0 / float(num_servers-1)
     newperc = [target] * num_servers
@@ -421,7 +500,7 @@ class Manager(object):
     if not server:
       print "Server not found."
       return
-    if server.interval.start != server.interval.end:
+    if not sutils.ServerIsEmpty(self.mapping, server):
       print "Server has some data in it!"
       print "Giving up..."
       return
@@ -525,6 +604,8 @@ class Manager(object):
            "to others.")
     print "remserver <address> <port>\tRemove server from server group."
     print "sync\t\t\t\tSync server information between data servers."
+    print ("sharding <range|consistent_hash>\tConvert the server group to "
+           "another sharding scheme.")
 
   def _HandleCommand(self, cmd, args):
     """Execute an user command."""
@@ -565,6 +646,11 @@ class Manager(object):
         print "Invalid port number: %s" % args[1]
     elif cmd == "sync":
       self._Sync()
+    elif cmd == "sharding":
+      if len(args) != 1:
+        print "Syntax: sharding <range|consistent_hash>"
+        return True
+      self._ChangeSharding(args[0])
     else:
       print "No such command:", cmd
     return True
@@ -46,6 +46,9 @@ class DataServer(object):
     self.server_info.interval = sutils.CreateStartInterval(self.Index(),
                                                            num_servers)
 
+  def SetVirtualNodes(self, virtual_nodes):
+    self.server_info.virtual_nodes = virtual_nodes
+
   def IsRegistered(self):
     return self.registered
 
@@ -124,12 +127,17 @@ class DataMaster(object):
       # Each server information is linked to its corresponding object.
       # Updating the data server object will reflect immediately on
       # the mapping.
+      virtual_nodes = config_lib.CONFIG["Dataserver.virtual_nodes"]
       for server in self.servers:
         server.SetInitialInterval(len(self.servers))
+        server.SetVirtualNodes(virtual_nodes)
       servers_info = [server.server_info for server in self.servers]
       self.mapping = rdfvalue.DataServerMapping(version=0,
                                                 num_servers=len(self.servers),
                                                 servers=servers_info)
+      if config_lib.CONFIG["Dataserver.sharding"] == "consistent_hash":
+        self.mapping.sharding = (
+            rdfvalue.DataServerMapping.Sharding.CONSISTENT_HASH)
       self.service.SaveServerMapping(self.mapping, create_pathing=True)
     else:
       # Check mapping and configuration matching.
@@ -252,6 +260,9 @@ class DataMaster(object):
     server = DataServer("http://%s:%d" % (addr, port), len(self.servers))
     self.servers.append(server)
     server.SetInterval(constants.MAX_RANGE, constants.MAX_RANGE)
+    # Like the empty interval, no virtual nodes means no data until the next
+    # rebalance.
+    server.SetVirtualNodes(0)
     self.mapping.servers.Append(server.GetInfo())
     self.mapping.num_servers += 1
     # At this point, the new server is now part of the group.
@@ -259,9 +270,8 @@ class DataMaster(object):
 
   def RemoveServer(self, removed_server):
     """Remove a server. Returns None if server interval is not empty."""
-    interval = removed_server.Interval()
-    # Interval range must be 0.
-    if interval.start != interval.end:
+    # The server must not be responsible for any data.
+    if not sutils.ServerIsEmpty(self.mapping, removed_server.GetInfo()):
       return None
     # Update ids of other servers.
     newserverlist = []
@@ -380,6 +390,8 @@ class DataMaster(object):
     mapping = self.rebalance.mapping
     for i, serv in enumerate(list(self.mapping.servers)):
       serv.interval = mapping.servers[i].interval
+      serv.virtual_nodes = mapping.servers[i].virtual_nodes
+    self.mapping.sharding = mapping.sharding
     self.rebalance.mapping = self.mapping
     self.service.SaveServerMapping(self.mapping)
     # We can finally delete the temporary file, since we have succeeded.
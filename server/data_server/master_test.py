@@ -5,6 +5,7 @@
 
 from grr.lib import config_lib
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.lib import test_lib
 
 from grr.server.data_server import constants
@@ -135,6 +136,68 @@ class MasterTest(test_lib.GRRBaseTest):
     self.assertEqual(utils._FindServerInMapping(mapping,
                                                 constants.MAX_RANGE), 3)
 
+  def testConsistentHashingMapping(self):
+    """Check that a consistent hashing mapping moves little data."""
+    config_lib.CONFIG.Set("Dataserver.sharding", "consistent_hash")
+    config_lib.CONFIG.Set("Dataserver.virtual_nodes", 64)
+    m = master.DataMaster(7000, self.mock_service)
+    for port in [7001, 7002, 7003]:
+      m.RegisterServer("127.0.0.1", port)
+    mapping = m.LoadMapping()
+    self.assertTrue(utils.IsConsistentHashing(mapping))
+    for server in mapping.servers:
+      self.assertEqual(server.virtual_nodes, 64)
+
+    keys = ["aff4:/C.%016x" % i for i in range(1000)]
+    before = dict((key, utils.MapKeyToServer(mapping, key)) for key in keys)
+    self.assertEqual(set(before.values()), set([0, 1, 2, 3]))
+
+    # The ring segments cover the whole range.
+    segments = utils.MappingSegments(mapping)
+    self.assertEqual(segments[0][0], 0)
+    self.assertEqual(segments[-1][1], constants.MAX_RANGE)
+    for (_, end, _), (start, _, _) in zip(segments, segments[1:]):
+      self.assertEqual(end, start)
+
+    # A new server owns nothing until it gets virtual nodes.
+    new_server = m.AddServer("127.0.0.1", 7004)
+    self.assertTrue(utils.ServerIsEmpty(mapping, new_server.GetInfo()))
+    self.assertEqual(utils.MovedFraction(mapping, mapping), 0)
+    for key in keys:
+      self.assertEqual(utils.MapKeyToServer(mapping, key), before[key])
+
+    new_mapping = rdfvalue.DataServerMapping(mapping.SerializeToString())
+    new_mapping.servers[4].virtual_nodes = 64
+
+    # Only keys that go to the new server move, about 1/5 of them.
+    moved = 0
+    for key in keys:
+      where = utils.MapKeyToServer(new_mapping, key)
+      if where != before[key]:
+        self.assertEqual(where, 4)
+        moved += 1
+    self.assertGreater(moved, 100)
+    self.assertLess(moved, 300)
+
+    fraction = utils.MovedFraction(mapping, new_mapping)
+    self.assertGreater(fraction, 0.1)
+    self.assertLess(fraction, 0.3)
+    for _, _, old_owner, new_owner in utils.ComputeMovedSegments(
+        mapping, new_mapping):
+      self.assertNotEqual(old_owner, 4)
+      self.assertEqual(new_owner, 4)
+
+    # Draining a server only moves its own keys.
+    drained = rdfvalue.DataServerMapping(mapping.SerializeToString())
+    drained.servers[2].virtual_nodes = 0
+    self.assertTrue(utils.ServerIsEmpty(drained, drained.servers[2]))
+    for key in keys:
+      where = utils.MapKeyToServer(drained, key)
+      if before[key] == 2:
+        self.assertNotEqual(where, 2)
+      else:
+        self.assertEqual(where, before[key])
+
 
 def main(args):
   test_lib.main(args)
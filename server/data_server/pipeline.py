@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""Pipelined, batched protocol between the HTTP data store and data servers.
+
+The legacy protocol sends one DataStoreCommand at a time and handles every
+connection in its own thread. In the pipelined protocol every command carries
+a request_id, commands and replies are grouped into frames and frames can be
+compressed. On the server side all pipelined connections are multiplexed by a
+single EventLoop and command batches are executed in a thread pool.
+
+A frame is a FRAME_PACKER header (payload length and flags) followed by the
+payload, which is a serialized DataStoreCommandBatch (client to server) or
+DataStoreReplyBatch (server to client).
+"""
+
+
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import zlib
+
+
+import logging
+
+from grr.lib import poller
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import threadpool
+
+
+# Payload length and frame flags.
+FRAME_PACKER = struct.Struct("<IB")
+
+# Frame flags.
+FLAG_COMPRESSED = 1
+
+# Refuse frames larger than this (both ends).
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class PipelineInit(registry.InitHook):
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("grr_data_server_pipelined_connections")
+    stats.STATS.RegisterCounterMetric("grr_data_server_pipelined_batches")
+    stats.STATS.RegisterCounterMetric("grr_data_server_pipelined_commands")
+
+
+class FrameError(Exception):
+  """Raised when a frame can not be decoded."""
+
+
+def EncodeFrame(payload, compression_threshold=0):
+  """Wraps a serialized batch in a frame, compressing it if worthwhile.
+
+  Args:
+    payload: The serialized batch.
+    compression_threshold: Payloads at least this large are compressed. 0
+      disables compression.
+
+  Returns:
+    The frame as a string.
+  """
+  flags = 0
+  if compression_threshold and len(payload) >= compression_threshold:
+    compressed = zlib.compress(payload, 1)
+    # Only use the compressed payload if it actually shrank.
+    if len(compressed) < len(payload):
+      payload = compressed
+      flags |= FLAG_COMPRESSED
+
+  return FRAME_PACKER.pack(len(payload), flags) + payload
+
+
+class FrameReader(object):
+  """Reassembles frames from a stream of bytes."""
+
+  def __init__(self):
+    # Data not yet returned as a frame. The chunks are only joined once
+    # enough bytes arrived for the next header or frame, so reading a large
+    # frame in many small pieces does not copy it over and over.
+    self.chunks = []
+    self.size = 0
+    self.needed = FRAME_PACKER.size
+
+  def Feed(self, data):
+    """Adds data read from the socket.
+
+    Args:
+      data: A string read from the socket.
+
+    Returns:
+      A list of the (decompressed) payloads of all complete frames.
+
+    Raises:
+      FrameError: If the stream contains an invalid frame.
+    """
+    self.chunks.append(data)
+    self.size += len(data)
+    if self.size < self.needed:
+      return []
+
+    buf = "".join(self.chunks)
+    offset = 0
+    payloads = []
+    self.needed = FRAME_PACKER.size
+    while len(buf) - offset >= FRAME_PACKER.size:
+      length, flags = FRAME_PACKER.unpack_from(buf, offset)
+      if length > MAX_FRAME_SIZE:
+        raise FrameError("Frame of %d bytes is too large." % length)
+
+      end = offset + FRAME_PACKER.size + length
+      if len(buf) < end:
+        self.needed = FRAME_PACKER.size + length
+        break
+
+      payload = buf[offset + FRAME_PACKER.size:end]
+      offset = end
+      if flags & FLAG_COMPRESSED:
+        try:
+          payload = zlib.decompress(payload)
+        except zlib.error as e:
+          raise FrameError("Unable to decompress frame: %s" % e)
+
+      payloads.append(payload)
+
+    rest = buf[offset:]
+    self.chunks = [rest]
+    self.size = len(rest)
+    return payloads
+
+
+class _PipelinedConnection(object):
+  """State of one client connection handled by the EventLoop."""
+
+  def __init__(self, sock, address, permissions):
+    self.sock = sock
+    self.address = address
+    self.permissions = permissions
+    self.reader = FrameReader()
+    self.lock = threading.Lock()
+    # Batches waiting to be executed. Batches of the same connection are
+    # executed one at a time and in order so that a read always sees the
+    # writes that were sent before it.
+    self.pending_batches = []
+    self.executing = False
+    self.outgoing = ""
+    self.closed = False
+
+  def fileno(self):
+    return self.sock.fileno()
+
+
+class EventLoop(object):
+  """Serves all pipelined data store connections from a single thread.
+
+  The loop only does the network I/O. Decoded batches are passed to
+  execute_batch in a thread pool, and its reply is queued for writing.
+  """
+
+  def __init__(self, execute_batch, compression_threshold=0,
+               pool_size=10):
+    """Constructor.
+
+    Args:
+      execute_batch: A callable taking a serialized DataStoreCommandBatch and
+        the connection permissions, returning a serialized
+        DataStoreReplyBatch.
+      compression_threshold: Compress reply frames at least this large.
+      pool_size: Maximum number of threads executing batches.
+    """
+    self.execute_batch = execute_batch
+    self.compression_threshold = compression_threshold
+    self.connections = {}
+    self.lock = threading.RLock()
+    self.running = False
+    self.thread = None
+    self.pool = threadpool.ThreadPool.Factory("data_server_pipeline",
+                                              min_threads=1,
+                                              max_threads=pool_size)
+    # Other threads wake up the loop by writing to this pipe.
+    self.wakeup_read, self.wakeup_write = os.pipe()
+
+    self.poller = poller.Poller()
+
+    self.poller.Register(self.wakeup_read, readable=True, writable=False)
+
+  def Start(self):
+    self.pool.Start()
+    self.running = True
+    self.thread = threading.Thread(target=self._Loop,
+                                   name="DataServerEventLoop")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Stop(self):
+    self.running = False
+    self._Wakeup()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    with self.lock:
+      for conn in self.connections.values():
+        self._Close(conn)
+    self.pool.Stop()
+
+  def AddConnection(self, sock, address, permissions):
+    """Hands an authenticated socket over to the loop."""
+    sock.setblocking(0)
+    conn = _PipelinedConnection(sock, address, permissions)
+    with self.lock:
+      self.connections[conn.fileno()] = conn
+      self.poller.Register(conn.fileno(), readable=True, writable=False)
+    stats.STATS.IncrementCounter("grr_data_server_pipelined_connections")
+    self._Wakeup()
+
+  def NumConnections(self):
+    return len(self.connections)
+
+  def _Wakeup(self):
+    try:
+      os.write(self.wakeup_write, "x")
+    except OSError:
+      pass
+
+  def _Loop(self):
+    while self.running:
+      try:
+        events = self.poller.Poll(1)
+      except (IOError, OSError, select.error) as e:
+        if e.args and e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd, readable, writable in events:
+        if fd == self.wakeup_read:
+          os.read(self.wakeup_read, 4096)
+          continue
+
+        with self.lock:
+          conn = self.connections.get(fd)
+        if conn is None:
+          continue
+
+        if readable:
+          self._HandleRead(conn)
+        if writable and not conn.closed:
+          self._HandleWrite(conn)
+
+      # Replies may have been queued by the pool while we were polling.
+      with self.lock:
+        for conn in self.connections.values():
+          with conn.lock:
+            want_write = bool(conn.outgoing)
+          self.poller.Modify(conn.fileno(), readable=True,
+                             writable=want_write)
+
+  def _HandleRead(self, conn):
+    try:
+      data = conn.sock.recv(READ_CHUNK_SIZE)
+    except socket.error as e:
+      if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      data = ""
+
+    if not data:
+      logging.info("Client %s has stopped using the server", conn.address)
+      self._Close(conn)
+      return
+
+    try:
+      payloads = conn.reader.Feed(data)
+    except FrameError as e:
+      logging.warning("Invalid frame from %s: %s", conn.address, e)
+      self._Close(conn)
+      return
+
+    if payloads:
+      with conn.lock:
+        conn.pending_batches.extend(payloads)
+        if conn.executing:
+          return
+        conn.executing = True
+
+      self.pool.AddTask(target=self._ExecutePending, args=(conn,),
+                        name="DataServerBatch")
+
+  def _ExecutePending(self, conn):
+    """Executes all pending batches of a connection in order."""
+    while True:
+      with conn.lock:
+        if not conn.pending_batches or conn.closed:
+          conn.executing = False
+          return
+        payload = conn.pending_batches.pop(0)
+
+      try:
+        reply = self.execute_batch(payload, conn.permissions)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Unable to execute batch from %s: %s",
+                          conn.address, e)
+        self._Close(conn)
+        return
+
+      frame = EncodeFrame(reply, self.compression_threshold)
+      with conn.lock:
+        conn.outgoing += frame
+
+      self._Wakeup()
+
+  def _HandleWrite(self, conn):
+    with conn.lock:
+      if not conn.outgoing:
+        return
+      try:
+        sent = conn.sock.send(conn.outgoing)
+      except socket.error as e:
+        if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        sent = None
+
+      if sent is not None:
+        conn.outgoing = conn.outgoing[sent:]
+        return
+
+    # We can not tell how much of the reply was received so the client must
+    # reconnect and replay its pending requests.
+    logging.warning("Could not send reply to client %s", conn.address)
+    self._Close(conn)
+
+  def _Close(self, conn):
+    with self.lock:
+      if conn.closed:
+        return
+      conn.closed = True
+      fd = conn.fileno()
+      self.connections.pop(fd, None)
+      self.poller.Unregister(fd)
+    try:
+      conn.sock.close()
+    except socket.error:
+      pass
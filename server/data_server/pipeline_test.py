@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Tests for the framing of the pipelined data server protocol."""
+
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+
+from grr.server.data_server import pipeline
+
+
+class FrameTest(test_lib.GRRBaseTest):
+  """Tests frame encoding and reassembly."""
+
+  def testRoundTrip(self):
+    payloads = ["", "hello", "x" * 100000, "abc" * 10]
+    data = "".join(pipeline.EncodeFrame(p, compression_threshold=1024)
+                   for p in payloads)
+
+    reader = pipeline.FrameReader()
+    self.assertEqual(reader.Feed(data), payloads)
+    self.assertEqual(reader.size, 0)
+
+  def testCompression(self):
+    payload = "x" * 100000
+    frame = pipeline.EncodeFrame(payload, compression_threshold=1024)
+    self.assertLess(len(frame), len(payload))
+    _, flags = pipeline.FRAME_PACKER.unpack_from(frame)
+    self.assertTrue(flags & pipeline.FLAG_COMPRESSED)
+
+    # Small payloads are not compressed.
+    frame = pipeline.EncodeFrame("x" * 100, compression_threshold=1024)
+    _, flags = pipeline.FRAME_PACKER.unpack_from(frame)
+    self.assertFalse(flags & pipeline.FLAG_COMPRESSED)
+
+  def testPartialFrames(self):
+    data = (pipeline.EncodeFrame("first" * 1000, compression_threshold=10) +
+            pipeline.EncodeFrame("second"))
+
+    reader = pipeline.FrameReader()
+    results = []
+    for i in range(0, len(data), 7):
+      results.extend(reader.Feed(data[i:i + 7]))
+    self.assertEqual(results, ["first" * 1000, "second"])
+
+  def testLargeFrameInSmallChunks(self):
+    payload = "x" * 100000
+    data = pipeline.EncodeFrame(payload)
+
+    last = len(data) - 1
+    reader = pipeline.FrameReader()
+    for i in range(0, last, 100):
+      self.assertEqual(reader.Feed(data[i:min(i + 100, last)]), [])
+    # The chunks are kept as they arrived until the frame is complete.
+    self.assertGreater(len(reader.chunks), 100)
+
+    self.assertEqual(reader.Feed(data[last:]), [payload])
+    self.assertEqual(reader.size, 0)
+
+  def testInvalidFrame(self):
+    reader = pipeline.FrameReader()
+    frame = pipeline.FRAME_PACKER.pack(5, pipeline.FLAG_COMPRESSED) + "abcde"
+    self.assertRaises(pipeline.FrameError, reader.Feed, frame)
+
+    frame = pipeline.FRAME_PACKER.pack(pipeline.MAX_FRAME_SIZE + 1, 0)
+    self.assertRaises(pipeline.FrameError, pipeline.FrameReader().Feed, frame)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
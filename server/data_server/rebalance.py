@@ -2,9 +2,11 @@
 """Utilities for load rebalancing."""
 
 
+import bisect
+import hashlib
 import os
 import shutil
-import StringIO
+import threading
 import zlib
 
 import urllib3
@@ -12,8 +14,10 @@ from urllib3 import connectionpool
 
 import logging
 
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.data_stores import common
 
@@ -25,12 +29,47 @@ from grr.server.data_server import utils as sutils
 # Database files that cannot be copied.
 COPY_EXCEPTIONS = [store.BASE_MAP_SUBJECT]
 # Files that cannot be moved from inside the transaction directory.
-MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME]
+MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME,
+                   constants.PARTIAL_DIRECTORY]
 # Level of compression when moving Sqlite files.
 COMPRESSION_LEVEL = 3
-
-
-def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
+# How much of a file is read at once when computing its checksum.
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+class _RebalancePlan(object):
+  """Decides where the files of a data server go after rebalancing.
+
+  When the current mapping is known, only the hash segments that change
+  owner are looked at (for consistent hashing, the virtual nodes that were
+  added or removed), so the keys of all other segments are known to stay
+  without mapping them again.
+  """
+
+  def __init__(self, mapping, server_id, old_mapping=None):
+    self.mapping = mapping
+    self.server_id = server_id
+    self.moved = None
+    if old_mapping is not None:
+      self.moved = [segment for segment in
+                    sutils.ComputeMovedSegments(old_mapping, mapping)
+                    if segment[2] == server_id]
+      self.starts = [segment[0] for segment in self.moved]
+
+  def Destination(self, key):
+    """Returns the index of the server that will hold the given key."""
+    if self.moved is None:
+      return sutils.MapKeyToServer(self.mapping, key)
+    hashed = sutils.HashKey(key)
+    pos = bisect.bisect_right(self.starts, hashed) - 1
+    if pos >= 0:
+      start, end, _, new_owner = self.moved[pos]
+      if start <= hashed < end:
+        return new_owner
+    return self.server_id
+
+
+def _RecComputeRebalanceSize(plan, server_id, dspath, subpath):
   """Recursively compute the size of files that need to be moved."""
   total = 0
   fulldir = utils.JoinPath(dspath, subpath)
@@ -45,11 +84,11 @@ def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
       logging.info("Skip %s", comp)
       continue
     if os.path.isdir(path):
-      total += _RecComputeRebalanceSize(mapping, server_id, dspath,
+      total += _RecComputeRebalanceSize(plan, server_id, dspath,
                                         utils.JoinPath(subpath, comp))
     elif os.path.isfile(path):
       key = common.MakeDestinationKey(subpath, name)
-      where = sutils.MapKeyToServer(mapping, key)
+      where = plan.Destination(key)
       if where != server_id:
         logging.info("Need to move %s from %d to %d", path, server_id, where)
         total += os.path.getsize(path)
@@ -58,100 +97,114 @@ def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
   return total
 
 
-def ComputeRebalanceSize(mapping, server_id):
+def ComputeRebalanceSize(mapping, server_id, old_mapping=None):
   """Compute size of files that need to be moved."""
   loc = data_store.DB.Location()
   if not os.path.exists(loc):
     return 0
   if not os.path.isdir(loc):
     return 0
-  return _RecComputeRebalanceSize(mapping, server_id, loc, "")
-
-
-class FileCopyWrapper(object):
-  """Wraps the database file for post'ing it to the server."""
-
-  def __init__(self, rebalance, directory, filename, fullpath):
-    filesize = os.path.getsize(fullpath)
-    filecopy = rdfvalue.DataServerFileCopy(rebalance_id=rebalance.id,
-                                           directory=directory,
-                                           filename=filename,
-                                           size=filesize)
-    filecopy_str = filecopy.SerializeToString()
-    self.header = sutils.SIZE_PACKER.pack(len(filecopy_str))
-    self.header += filecopy_str
-    self.header = StringIO.StringIO(self.header)
-    self.fp = open(fullpath, "rb")
-    self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
-    # Buffered compressed data that needs to be read.
-    self.buffered = ""
-    # Flag to mark end of database file.
-    self.end_of_file = False
-    # Flag to mark if we can no longer use read().
-    self.end_of_stream = False
-    # Flag to indicate that we are going to read the header first.
-    self.read_header = True
-
-  def read(self, blocksize):  # pylint: disable=invalid-name
-    """Returns data back to the HTTP post request."""
-    if self.end_of_stream:
-      return ""
-    if self.read_header:
-      # Read from header first.
-      ret = self.header.read(blocksize)
-      if ret:
-        return ret
-      self.read_header = False
-    # Otherwise, read from the file, compress the data and return it.
-    # Note that since we add a block size marker, we need subtract marker size.
-    blocksize -= sutils.SIZE_PACKER.size
-    while not self.buffered and not self.end_of_file:
-      raw = self.fp.read(blocksize)
-      if not raw:
-        # We need to flush the compressor and send that data too.
-        self.end_of_file = True
-        self.buffered += self.compressor.flush()
-        break
-      # While compressing, we may not get anything immediatelly.
-      compressed = self.compressor.compress(raw)
-      if compressed:
-        self.buffered += compressed
-    if len(self.buffered) > blocksize:
-      ret = self.buffered[:blocksize]
-      self.buffered = self.buffered[blocksize:]
-    else:
-      ret = self.buffered
-      self.buffered = ""
-    if not ret:
-      # Once the data is exhausted, we mark the end of the stream
-      # and we simply return the 0 marker.
-      self.end_of_stream = True
-    # Return the size of the block plus the block itself.
-    return sutils.SIZE_PACKER.pack(len(ret)) + ret
+  plan = _RebalancePlan(mapping, server_id, old_mapping=old_mapping)
+  return _RecComputeRebalanceSize(plan, server_id, loc, "")
 
-  def close(self):  # pylint: disable=invalid-name
-    self.fp.close()
-    self.header.close()
 
+def _PackFileCopy(filecopy, data=""):
+  """Builds a request body with a DataServerFileCopy header and data."""
+  filecopy_str = filecopy.SerializeToString()
+  return sutils.SIZE_PACKER.pack(len(filecopy_str)) + filecopy_str + data
 
-def _SendFileToServer(pool, fullpath, subpath, basename, rebalance):
-  """Sends a specific data store file to the server."""
-  fp = FileCopyWrapper(rebalance, subpath, basename, fullpath)
 
-  try:
-    # Content-Length is 0 since we do not know the size of the compressed data.
-    # We write the compressed data by blocks.
-    headers = {"Content-Length": 0}
-    res = pool.urlopen("POST", "/rebalance/copy-file", headers=headers,
-                       body=fp)
-    if res.status != constants.RESPONSE_OK:
-      return False
-  except urllib3.exceptions.MaxRetryError:
-    logging.warning("Failed to send file %s", fullpath)
+def _UnpackFileCopy(body):
+  """Returns the DataServerFileCopy header and the data of a request body."""
+  filecopy_len = sutils.SIZE_PACKER.unpack(body[:sutils.SIZE_PACKER.size])[0]
+  end = sutils.SIZE_PACKER.size + filecopy_len
+  filecopy = rdfvalue.DataServerFileCopy(body[sutils.SIZE_PACKER.size:end])
+  return filecopy, body[end:]
+
+
+def _FileChecksum(path):
+  """Computes the SHA256 of a file."""
+  hasher = hashlib.sha256()
+  with open(path, "rb") as fp:
+    while True:
+      data = fp.read(CHECKSUM_BLOCK_SIZE)
+      if not data:
+        break
+      hasher.update(data)
+  return hasher.digest()
+
+
+class _FileTransfer(object):
+  """Sends a data store file to another data server in checksummed chunks.
+
+  The receiving server keeps what it got so far, so a failed transfer is
+  resumed from the last chunk that was received intact.
+  """
+
+  def __init__(self, pool, fullpath, subpath, basename, rebalance, bucket,
+               chunk_size):
+    self.pool = pool
+    self.fullpath = fullpath
+    self.bucket = bucket
+    self.chunk_size = chunk_size
+    self.filecopy = rdfvalue.DataServerFileCopy(
+        rebalance_id=rebalance.id, directory=subpath, filename=basename,
+        size=os.path.getsize(fullpath))
+
+  def _Post(self, path, body):
+    """Posts to the data server and returns the response or None."""
+    headers = {"Content-Length": len(body)}
+    try:
+      return self.pool.urlopen("POST", path, headers=headers, body=body)
+    except urllib3.exceptions.HTTPError:
+      logging.warning("Failed to post %s for file %s", path, self.fullpath)
+      return None
+
+  def _RemoteOffset(self):
+    """Asks the server how much of the file it already has."""
+    res = self._Post("/rebalance/copy-status", _PackFileCopy(self.filecopy))
+    if not res or res.status != constants.RESPONSE_OK:
+      return None
+    return sutils.OFFSET_PACKER.unpack(res.data)[0]
+
+  def _SendChunks(self, offset):
+    with open(self.fullpath, "rb") as fp:
+      fp.seek(offset)
+      while offset < self.filecopy.size:
+        data = fp.read(min(self.chunk_size, self.filecopy.size - offset))
+        if not data:
+          logging.warning("File %s was truncated", self.fullpath)
+          return False
+        self.bucket.Consume(len(data))
+        chunk = rdfvalue.DataServerFileCopy(self.filecopy)
+        chunk.offset = offset
+        chunk.checksum = hashlib.sha256(data).digest()
+        body = _PackFileCopy(chunk, zlib.compress(data, COMPRESSION_LEVEL))
+        res = self._Post("/rebalance/copy-chunk", body)
+        if not res or res.status != constants.RESPONSE_OK:
+          return False
+        offset += len(data)
+    return True
+
+  def _Commit(self):
+    commit = rdfvalue.DataServerFileCopy(self.filecopy)
+    commit.checksum = _FileChecksum(self.fullpath)
+    res = self._Post("/rebalance/copy-commit", _PackFileCopy(commit))
+    return res and res.status == constants.RESPONSE_OK
+
+  def Run(self, retries):
+    """Sends the file, resuming up to retries times. Returns success."""
+    for attempt in xrange(retries + 1):
+      if attempt:
+        logging.info("Resuming copy of %s (attempt %d)", self.fullpath,
+                     attempt + 1)
+      offset = self._RemoteOffset()
+      if offset is None:
+        continue
+      if self._SendChunks(offset) and self._Commit():
+        return True
+    logging.warning("Failed to send file %s", self.fullpath)
     return False
-  finally:
-    fp.close()
-  return True
 
 
 def _GetTransactionDirectory(database_dir, rebalance_id):
@@ -175,11 +228,9 @@ def _FileWithRemoveList(database_dir, rebalance):
   return utils.JoinPath(tempdir, constants.REMOVE_FILENAME)
 
 
-def _RecCopyFiles(rebalance, server_id, dspath, subpath,
-                  pool_cache, removed_list):
-  """Recursively send files for moving to the required data server."""
+def _RecFindFilesToCopy(plan, server_id, dspath, subpath, to_copy):
+  """Recursively find the files that must go to another data server."""
   fulldir = utils.JoinPath(dspath, subpath)
-  mapping = rebalance.mapping
   for comp in os.listdir(fulldir):
     if comp == constants.REBALANCE_DIRECTORY:
       continue
@@ -188,46 +239,102 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath,
     if name in COPY_EXCEPTIONS:
       continue
     if os.path.isdir(path):
-      result = _RecCopyFiles(rebalance, server_id, dspath,
-                             utils.JoinPath(subpath, comp), pool_cache,
-                             removed_list)
-      if not result:
-        return False
+      _RecFindFilesToCopy(plan, server_id, dspath,
+                          utils.JoinPath(subpath, comp), to_copy)
       continue
     if not os.path.isfile(path):
       continue
     key = common.MakeDestinationKey(subpath, name)
-    where = sutils.MapKeyToServer(mapping, key)
+    where = plan.Destination(key)
     if where != server_id:
-      server = mapping.servers[where]
-      addr = server.address
-      port = server.port
-      key = (addr, port)
-      try:
-        pool = pool_cache[key]
-      except KeyError:
-        pool = connectionpool.HTTPConnectionPool(addr, port=port)
-        pool_cache[key] = pool
-      logging.info("Need to move %s from %d to %d", key, server_id, where)
-      if not _SendFileToServer(pool, path, subpath, comp, rebalance):
-        return False
-      removed_list.append(path)
+      logging.info("Need to move %s from %d to %d", path, server_id, where)
+      to_copy.append((path, subpath, comp, where))
     else:
       logging.info("File %s stays here", path)
-  return True
 
 
-def CopyFiles(rebalance, server_id):
+class _ParallelCopier(object):
+  """Copies files to other data servers using several streams."""
+
+  def __init__(self, rebalance):
+    self.rebalance = rebalance
+    self.streams = max(1, config_lib.CONFIG["Dataserver.rebalance_streams"])
+    self.chunk_size = config_lib.CONFIG["Dataserver.rebalance_chunk_size"]
+    self.retries = config_lib.CONFIG["Dataserver.rebalance_retries"]
+    # The bandwidth limit is shared by all the streams.
+    self.bucket = utils.TokenBucket(
+        config_lib.CONFIG["Dataserver.rebalance_bandwidth"],
+        burst=self.chunk_size)
+    self.pool_cache = {}
+    self.lock = threading.Lock()
+    self.failed = threading.Event()
+    self.copied = []
+
+  def _GetPool(self, where):
+    server = self.rebalance.mapping.servers[where]
+    key = (server.address, server.port)
+    with self.lock:
+      try:
+        return self.pool_cache[key]
+      except KeyError:
+        pool = connectionpool.HTTPConnectionPool(server.address,
+                                                 port=server.port,
+                                                 maxsize=self.streams)
+        self.pool_cache[key] = pool
+        return pool
+
+  def _CopyFile(self, path, subpath, basename, where):
+    if self.failed.is_set():
+      return
+    # The thread pool only logs exceptions raised by a task, so they are
+    # recorded here for Copy() to see.
+    try:
+      transfer = _FileTransfer(self._GetPool(where), path, subpath, basename,
+                               self.rebalance, self.bucket, self.chunk_size)
+      copied = transfer.Run(self.retries)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Failed to copy %s: %s", path, e)
+      copied = False
+
+    if copied:
+      with self.lock:
+        self.copied.append(path)
+    else:
+      self.failed.set()
+
+  def Copy(self, to_copy):
+    """Copies all the files. Returns the copied paths or None on failure."""
+    pool = threadpool.ThreadPool.Factory("rebalance_copy", self.streams)
+    pool.Start()
+    try:
+      for args in to_copy:
+        if self.failed.is_set():
+          break
+        pool.AddTask(target=self._CopyFile, args=args,
+                     name="RebalanceCopy", blocking=True, inline=False)
+      pool.Join()
+    finally:
+      pool.Stop()
+      for http_pool in self.pool_cache.values():
+        http_pool.close()
+
+    if self.failed.is_set():
+      return None
+    return self.copied
+
+
+def CopyFiles(rebalance, server_id, old_mapping=None):
   """Copies data store files to the corresponding data servers."""
   loc = data_store.DB.Location()
   if not os.path.exists(loc):
     return True
   if not os.path.isdir(loc):
     return True
-  pool_cache = {}
-  removed_list = []
-  ok = _RecCopyFiles(rebalance, server_id, loc, "", pool_cache, removed_list)
-  if not ok:
+  plan = _RebalancePlan(rebalance.mapping, server_id, old_mapping=old_mapping)
+  to_copy = []
+  _RecFindFilesToCopy(plan, server_id, loc, "", to_copy)
+  removed_list = _ParallelCopier(rebalance).Copy(to_copy)
+  if removed_list is None:
     return False
   # Write list of removed files to temporary directory
   remove_file = _FileWithRemoveList(loc, rebalance)
@@ -237,17 +344,70 @@ def CopyFiles(rebalance, server_id):
   return True
 
 
-def SaveTemporaryFile(fp):
-  """Store incoming database file in a temporary directory."""
+def _PartialFilePath(loc, filecopy):
+  """Where a file being received is stored until it is complete."""
+  rebdir = _CreateDirectory(loc, filecopy.rebalance_id)
+  return utils.JoinPath(rebdir, constants.PARTIAL_DIRECTORY,
+                        filecopy.directory, filecopy.filename)
+
+
+def GetPartialFileSize(body):
+  """Returns how many bytes of an incoming file were already received."""
+  loc = data_store.DB.Location()
+  filecopy, _ = _UnpackFileCopy(body)
+  partial = _PartialFilePath(loc, filecopy)
+  try:
+    size = os.path.getsize(partial)
+  except OSError:
+    return 0
+  if size > filecopy.size:
+    # Not the file we were receiving before, start again.
+    os.unlink(partial)
+    return 0
+  return size
+
+
+def SaveChunk(body):
+  """Appends an incoming chunk to a partial file. Returns a response code."""
   loc = data_store.DB.Location()
-  if not os.path.exists(loc):
-    return False
   if not os.path.isdir(loc):
-    return False
-  # Read DataServerFileCopy object.
-  filecopy_len_str = fp.read(sutils.SIZE_PACKER.size)
-  filecopy_len = sutils.SIZE_PACKER.unpack(filecopy_len_str)[0]
-  filecopy = rdfvalue.DataServerFileCopy(fp.read(filecopy_len))
+    return constants.RESPONSE_FILE_NOT_SAVED
+  filecopy, compressed = _UnpackFileCopy(body)
+  try:
+    data = zlib.decompress(compressed)
+  except zlib.error:
+    return constants.RESPONSE_CHECKSUM_MISMATCH
+  if hashlib.sha256(data).digest() != filecopy.checksum:
+    logging.warning("Bad checksum for chunk %d of %s", filecopy.offset,
+                    filecopy.filename)
+    return constants.RESPONSE_CHECKSUM_MISMATCH
+
+  partial = _PartialFilePath(loc, filecopy)
+  try:
+    os.makedirs(os.path.dirname(partial))
+  except OSError:
+    pass
+  current = os.path.getsize(partial) if os.path.exists(partial) else 0
+  if current != filecopy.offset:
+    # Chunks must arrive in order, the sender will ask where to resume.
+    return constants.RESPONSE_FILE_NOT_SAVED
+  with open(partial, "ab") as wp:
+    wp.write(data)
+  return constants.RESPONSE_OK
+
+
+def CommitFile(body):
+  """Verifies a received file and makes it part of the rebalance."""
+  loc = data_store.DB.Location()
+  filecopy, _ = _UnpackFileCopy(body)
+  partial = _PartialFilePath(loc, filecopy)
+  if not os.path.isfile(partial):
+    return constants.RESPONSE_FILE_NOT_SAVED
+  if (os.path.getsize(partial) != filecopy.size or
+      _FileChecksum(partial) != filecopy.checksum):
+    logging.error("File %s does not match its checksum", partial)
+    os.unlink(partial)
+    return constants.RESPONSE_CHECKSUM_MISMATCH
 
   rebdir = _CreateDirectory(loc, filecopy.rebalance_id)
   filedir = utils.JoinPath(rebdir, filecopy.directory)
@@ -256,32 +416,9 @@ def SaveTemporaryFile(fp):
   except OSError:
     pass
   filepath = utils.JoinPath(filedir, filecopy.filename)
-  logging.info("Writing to file %s", filepath)
-  with open(filepath, "wb") as wp:
-    # We need to uncompress the file stream.
-    decompressor = zlib.decompressobj()
-    while True:
-      block_len_str = fp.read(sutils.SIZE_PACKER.size)
-      block_len = sutils.SIZE_PACKER.unpack(block_len_str)[0]
-      if not block_len:
-        break
-      block = fp.read(block_len)
-      to_decompress = decompressor.unconsumed_tail + block
-      while to_decompress:
-        decompressed = decompressor.decompress(to_decompress)
-        if decompressed:
-          wp.write(decompressed)
-          to_decompress = decompressor.unconsumed_tail
-        else:
-          to_decompress = ""
-    # Deal with remaining data.
-    remaining = decompressor.flush()
-    if remaining:
-      wp.write(remaining)
-  if os.path.getsize(filepath) != filecopy.size:
-    logging.error("Size of file %s is not %d", filepath, filecopy.size)
-    return False
-  return True
+  logging.info("Received file %s", filepath)
+  os.rename(partial, filepath)
+  return constants.RESPONSE_OK
 
 
 def _RecMoveFiles(tempdir, dspath, subpath):
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Tests for copying files between data servers when rebalancing."""
+
+
+import os
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import threadpool
+from grr.lib import utils
+
+from grr.server.data_server import rebalance
+
+
+class FakeServer(object):
+  address = "127.0.0.1"
+  port = 7000
+
+
+class FakeRebalance(object):
+  """Just the parts of a DataServerRebalance the copier uses."""
+
+  def __init__(self):
+    self.id = "rebalance"
+    self.mapping = utils.DataObject(servers=[FakeServer(), FakeServer()])
+
+
+class FakeTransfer(object):
+  """Copies every file except the ones named bad."""
+
+  def __init__(self, unused_pool, fullpath, *unused_args):
+    self.fullpath = fullpath
+
+  def Run(self, unused_retries):
+    if os.path.basename(self.fullpath) == "bad":
+      raise IOError("Cannot read %s" % self.fullpath)
+    return True
+
+
+class ParallelCopierTest(test_lib.GRRBaseTest):
+  """Tests the parallel copy of data store files."""
+
+  def Copy(self, names):
+    to_copy = []
+    for name in names:
+      path = os.path.join(self.temp_dir, name)
+      open(path, "wb").close()
+      to_copy.append((path, "", name, 1))
+
+    with utils.Stubber(rebalance, "_FileTransfer", FakeTransfer):
+      copied = rebalance._ParallelCopier(FakeRebalance()).Copy(to_copy)
+
+    # The streams do not outlive the copy.
+    self.assertFalse(threadpool.ThreadPool.POOLS["rebalance_copy"].started)
+    return copied
+
+  def testCopy(self):
+    self.assertEqual(sorted(self.Copy(["a", "b", "c"])),
+                     [os.path.join(self.temp_dir, name)
+                      for name in ["a", "b", "c"]])
+
+  def testFailedCopy(self):
+    # Exceptions in the copy threads fail the whole copy.
+    self.assertIsNone(self.Copy(["a", "bad", "c"]))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
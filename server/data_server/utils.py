@@ -2,8 +2,10 @@
 """Data server utilities."""
 
 
+import bisect
 import hashlib
 import struct
+import threading
 
 
 from grr.lib import rdfvalue
@@ -13,6 +15,7 @@ from grr.server.data_server import constants
 
 SIZE_PACKER = struct.Struct("I")
 PORT_PACKER = struct.Struct("I")
+OFFSET_PACKER = struct.Struct("Q")
 
 
 def CreateStartInterval(index, total):
@@ -52,8 +55,143 @@ def _BisectHashList(ls, left, right, value):
     return _BisectHashList(ls, left, middle - 1, value)
 
 
+def HashKey(key):
+  """Hashes a key into the [0, MAX_RANGE[ range."""
+  return int(hashlib.sha1(key).hexdigest()[:16], 16)
+
+
+def IsConsistentHashing(mapping):
+  return mapping.sharding == mapping.Sharding.CONSISTENT_HASH
+
+
+class HashRing(object):
+  """The consistent hashing ring of a mapping.
+
+  Every server has virtual_nodes points on the ring. The points only depend on
+  the server address and port, so adding or removing a server (or changing its
+  number of virtual nodes) only moves the keys of the affected ring segments.
+  A key belongs to the server owning the first point at or after its hash.
+  """
+
+  def __init__(self, mapping):
+    points = []
+    for index, server in enumerate(mapping.servers):
+      for vnode in xrange(server.virtual_nodes):
+        name = "%s:%d-%d" % (server.address, server.port, vnode)
+        points.append((HashKey(name), index))
+    points.sort()
+    self.tokens = [token for token, _ in points]
+    self.owners = [owner for _, owner in points]
+
+  def Lookup(self, hashed):
+    """Returns the index of the server responsible for a hashed key."""
+    if not self.tokens:
+      return None
+    pos = bisect.bisect_left(self.tokens, hashed)
+    if pos == len(self.tokens):
+      # Wrap around the ring.
+      pos = 0
+    return self.owners[pos]
+
+  def Segments(self):
+    """Returns the ring as a sorted list of (start, end, server index).
+
+    Segments are half-open intervals [start, end[ covering [0, MAX_RANGE[.
+    """
+    if not self.tokens:
+      return []
+    segments = []
+    start = 0
+    for token, owner in zip(self.tokens, self.owners):
+      # A key hashing to the token itself belongs to that token's owner.
+      end = token + 1
+      if end > start:
+        segments.append((start, end, owner))
+      start = end
+    if start < constants.MAX_RANGE:
+      # The last segment wraps around to the first point.
+      segments.append((start, constants.MAX_RANGE, self.owners[0]))
+    return segments
+
+
+# Rings are expensive to build so we keep the ones of recently used mappings.
+_RING_CACHE = {}
+_RING_CACHE_LOCK = threading.Lock()
+_RING_CACHE_SIZE = 8
+
+
+def _GetRing(mapping):
+  ring_key = tuple((server.address, server.port, server.virtual_nodes)
+                   for server in mapping.servers)
+  with _RING_CACHE_LOCK:
+    ring = _RING_CACHE.get(ring_key)
+    if ring is None:
+      ring = HashRing(mapping)
+      if len(_RING_CACHE) >= _RING_CACHE_SIZE:
+        _RING_CACHE.clear()
+      _RING_CACHE[ring_key] = ring
+    return ring
+
+
+def MappingSegments(mapping):
+  """Returns the (start, end, server index) segments of any mapping."""
+  if IsConsistentHashing(mapping):
+    return _GetRing(mapping).Segments()
+  return sorted((server.interval.start, server.interval.end, index)
+                for index, server in enumerate(mapping.servers)
+                if server.interval.start < server.interval.end)
+
+
+def ComputeMovedSegments(old_mapping, new_mapping):
+  """Computes the parts of the hash range that change server.
+
+  Args:
+    old_mapping: The current DataServerMapping.
+    new_mapping: The DataServerMapping after rebalancing.
+
+  Returns:
+    A sorted list of (start, end, old server index, new server index).
+  """
+  old_segments = MappingSegments(old_mapping)
+  new_segments = MappingSegments(new_mapping)
+  moved = []
+  i = j = 0
+  while i < len(old_segments) and j < len(new_segments):
+    old_start, old_end, old_owner = old_segments[i]
+    new_start, new_end, new_owner = new_segments[j]
+    start = max(old_start, new_start)
+    end = min(old_end, new_end)
+    if start < end and old_owner != new_owner:
+      if moved and moved[-1][1] == start and moved[-1][2:] == (old_owner,
+                                                               new_owner):
+        moved[-1] = (moved[-1][0], end, old_owner, new_owner)
+      else:
+        moved.append((start, end, old_owner, new_owner))
+    if old_end <= new_end:
+      i += 1
+    if new_end <= old_end:
+      j += 1
+  return moved
+
+
+def MovedFraction(old_mapping, new_mapping):
+  """Fraction of the hash range that changes server."""
+  moved = sum(end - start for start, end, _, _ in
+              ComputeMovedSegments(old_mapping, new_mapping))
+  return moved / float(constants.MAX_RANGE)
+
+
+def ServerIsEmpty(mapping, server):
+  """Checks if a server is not responsible for any keys in the mapping."""
+  if IsConsistentHashing(mapping):
+    return not server.virtual_nodes
+  return server.interval.start == server.interval.end
+
+
 def MapKeyToServer(mapping, key):
   """Takes some key and returns the ID of the server."""
-  hsh = int(hashlib.sha1(key).hexdigest()[:16], 16)
+  hsh = HashKey(key)
+  if IsConsistentHashing(mapping):
+    return _GetRing(mapping).Lookup(hsh)
   return _FindServerInMapping(mapping, hsh)
 
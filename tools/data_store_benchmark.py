@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Runs the data store benchmarks against one or more data stores.
+
+Each implementation in --implementations is benchmarked with the same
+scenarios and the results are written to --benchmark_output as JSON.
+HTTPDataStore is benchmarked against a data server started locally in a
+subprocess.
+"""
+
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+import logging
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import data_store_benchmark
+from grr.lib import flags
+from grr.lib import startup
+
+
+flags.DEFINE_list("implementations", [],
+                  "Data store implementations to benchmark. Defaults to "
+                  "Datastore.implementation.")
+
+flags.DEFINE_list("scenarios", [],
+                  "Scenarios to run. Defaults to all of them.")
+
+flags.DEFINE_string("benchmark_output", "data_store_benchmark.json",
+                    "File to write the results to.")
+
+flags.DEFINE_integer("threads", 10,
+                     "Number of concurrent threads in each scenario.")
+
+flags.DEFINE_float("scale", 1.0,
+                   "Multiplier for the number of operations of each "
+                   "scenario.")
+
+flags.DEFINE_integer("data_server_port", 7100,
+                     "Port of the local data server used to benchmark "
+                     "HTTPDataStore.")
+
+flags.DEFINE_string("data_server_implementation", "SqliteDataStore",
+                    "The data store used by the local data server.")
+
+
+class LocalDataServer(object):
+  """A data server running in a subprocess."""
+
+  USERNAME = "benchmark"
+  PASSWORD = "benchmark"
+
+  def __init__(self, port, implementation):
+    self.port = port
+    self.implementation = implementation
+    self.process = None
+    self.path = None
+
+  def _Parameters(self):
+    return {
+        "Dataserver.server_list": ["http://127.0.0.1:%d" % self.port],
+        "Dataserver.server_username": self.USERNAME,
+        "Dataserver.server_password": self.PASSWORD,
+        "Dataserver.client_credentials": ["%s:%s:rw" % (self.USERNAME,
+                                                        self.PASSWORD)],
+        "HTTPDataStore.username": self.USERNAME,
+        "HTTPDataStore.password": self.PASSWORD,
+    }
+
+  def Start(self, timeout=60):
+    """Starts the data server and configures this process to use it."""
+    self.path = tempfile.mkdtemp(prefix="grr_benchmark_")
+    parameters = self._Parameters()
+
+    command = [sys.executable, "-m", "grr.server.data_server.data_server",
+               "--master", "--port", str(self.port), "--path", self.path]
+    if flags.FLAGS.config:
+      command += ["--config", flags.FLAGS.config]
+    parameters["Datastore.implementation"] = self.implementation
+    for name, value in sorted(parameters.items()):
+      if isinstance(value, list):
+        value = ",".join(value)
+      command += ["-p", "%s=%s" % (name, value)]
+
+    logging.info("Starting data server: %s", " ".join(command))
+    self.process = subprocess.Popen(command)
+
+    deadline = time.time() + timeout
+    while True:
+      if self.process.poll() is not None:
+        raise RuntimeError("Data server exited with %d" %
+                           self.process.returncode)
+      try:
+        socket.create_connection(("127.0.0.1", self.port), 1).close()
+        break
+      except socket.error:
+        if time.time() > deadline:
+          self.Stop()
+          raise RuntimeError("Data server did not start.")
+        time.sleep(0.5)
+
+    for name, value in self._Parameters().items():
+      config_lib.CONFIG.Set(name, value)
+
+  def Stop(self):
+    if self.process and self.process.poll() is None:
+      self.process.terminate()
+      self.process.wait()
+    self.process = None
+
+    if self.path:
+      shutil.rmtree(self.path, True)
+      self.path = None
+
+
+def OpenDataStore(implementation):
+  try:
+    cls = data_store.DataStore.GetPlugin(implementation)
+  except KeyError:
+    raise RuntimeError("No Storage System %s found." % implementation)
+
+  db = cls()
+  db.Initialize()
+  return db
+
+
+def main(unused_argv):
+  """Main."""
+  config_lib.CONFIG.AddContext("Commandline Context")
+  startup.Init()
+
+  token = access_control.ACLToken(username="GRRSystem",
+                                  reason="Data store benchmark").SetUID()
+
+  implementations = (flags.FLAGS.implementations or
+                     [config_lib.CONFIG["Datastore.implementation"]])
+
+  runs = []
+  for implementation in implementations:
+    server = None
+    if implementation == "HTTPDataStore":
+      server = LocalDataServer(flags.FLAGS.data_server_port,
+                               flags.FLAGS.data_server_implementation)
+      server.Start()
+
+    try:
+      data_store.DB = OpenDataStore(implementation)
+      runner = data_store_benchmark.BenchmarkRunner(
+          token=token, threads=flags.FLAGS.threads, scale=flags.FLAGS.scale)
+      results = runner.Run(flags.FLAGS.scenarios)
+      data_store.DB.Flush()
+    finally:
+      if server:
+        server.Stop()
+
+    for result in results:
+      print "%-10s %-25s %10.1f ops/s  p50 %8.2fms  p99 %8.2fms" % (
+          implementation, result["scenario"], result["ops_per_second"],
+          result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+
+    runs.append(dict(implementation=implementation, results=results))
+
+  output = flags.FLAGS.benchmark_output
+  data_store_benchmark.WriteResults(output, runs)
+  print "Results written to %s" % os.path.abspath(output)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
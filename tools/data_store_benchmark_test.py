@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Smoke test for the data store benchmark tool."""
+
+
+import socket
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.tools import data_store_benchmark
+
+
+def FreePort():
+  sock = socket.socket()
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class LocalDataServerTest(test_lib.GRRBaseTest):
+  """Benchmarks can reach the data server they started."""
+
+  def setUp(self):
+    super(LocalDataServerTest, self).setUp()
+    self.old_db = data_store.DB
+
+  def tearDown(self):
+    data_store.DB = self.old_db
+    super(LocalDataServerTest, self).tearDown()
+
+  def testStartLocalDataServer(self):
+    port = FreePort()
+    server = data_store_benchmark.LocalDataServer(port, "SqliteDataStore")
+    server.Start()
+    try:
+      self.assertEqual(config_lib.CONFIG["Dataserver.server_list"],
+                       ["http://127.0.0.1:%d" % port])
+      self.assertEqual(config_lib.CONFIG["Dataserver.client_credentials"],
+                       ["benchmark:benchmark:rw"])
+
+      db = data_store_benchmark.OpenDataStore("HTTPDataStore")
+      db.Set("aff4:/benchmark", "aff4:attribute", "value", token=self.token)
+      db.Flush()
+      value, _ = db.Resolve("aff4:/benchmark", "aff4:attribute",
+                            token=self.token)
+      self.assertEqual(value, "value")
+    finally:
+      server.Stop()
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -5,14 +5,22 @@
 
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
+from email import utils as email_utils
+import errno
+import mimetools
 
 from multiprocessing import freeze_support
 from multiprocessing import Process
 import pdb
+import os
+import Queue
+import select
 import socket
 import SocketServer
 import threading
+import time
 
 
 import ipaddr
@@ -28,6 +36,7 @@ from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import master
+from grr.lib import poller
 from grr.lib import rdfvalue
 from grr.lib import startup
 from grr.lib import stats
@@ -38,33 +47,32 @@ from grr.lib import utils
 # pylint: disable=g-bad-name
 
 
+STATUS_TEXT = {200: "200 OK",
+               404: "404 Not Found",
+               406: "406 Not Acceptable",
+               500: "500 Internal Server Error",
+               501: "501 Not Implemented"}
+
+
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """GRR HTTP handler for receiving client posts."""
 
-  statustext = {200: "200 OK",
-                406: "406 Not Acceptable",
-                500: "500 Internal Server Error"}
+  statustext = STATUS_TEXT
 
   active_counter_lock = threading.Lock()
   active_counter = 0
 
   def Send(self, data, status=200, ctype="application/octet-stream",
            last_modified=0):
-
-    self.wfile.write(("HTTP/1.0 %s\r\n"
-                      "Server: BaseHTTP/0.3 Python/2.6.5\r\n"
-                      "Content-type: %s\r\n"
-                      "Content-Length: %d\r\n"
-                      "Last-Modified: %s\r\n"
-                      "\r\n"
-                      "%s") %
-                     (self.statustext[status], ctype, len(data),
-                      self.date_time_string(last_modified), data))
+    self.wfile.write(FormatResponse(data, status=status, ctype=ctype,
+                                    last_modified=last_modified))
 
   def do_GET(self):
     """Server the server pem with GET requests."""
     if self.path.startswith("/server.pem"):
       self.ServerPem()
+    else:
+      self.Send("Not found", status=404)
 
   def ServerPem(self):
     self.Send(self.server.server_cert)
@@ -94,77 +102,119 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   @stats.Timed("frontend_request_latency", fields=["http"])
   def Control(self):
     """Handle POSTS."""
-    if not master.MASTER_WATCHER.IsMaster():
-      # We shouldn't be getting requests from the client unless we
-      # are the active instance.
-      stats.STATS.IncrementCounter("frontend_inactive_request_count",
-                                   fields=["http"])
-      logging.info("Request sent to inactive frontend from %s" %
-                   self.client_address[0])
-
-    # Get the api version
-    try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
-      # The oldest api version we support if not specified.
-      api_version = 3
-
     with GRRHTTPServerHandler.active_counter_lock:
       GRRHTTPServerHandler.active_counter += 1
       stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
                                 fields=["http"])
 
     try:
-      length = int(self.headers.getheader("content-length"))
+      length = int(self.headers.getheader("content-length") or 0)
+      status, data = ProcessControlRequest(
+          self.server.frontend, self.path, self.headers,
+          self._GetPOSTData(length), self.client_address)
+      self.Send(data, status=status)
 
-      request_comms = rdfvalue.ClientCommunication(self._GetPOSTData(length))
+    finally:
+      with GRRHTTPServerHandler.active_counter_lock:
+        GRRHTTPServerHandler.active_counter -= 1
+        stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
+                                  fields=["http"])
 
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
 
-      # Reply using the same version we were requested with.
-      responses_comms = rdfvalue.ClientCommunication(
-          api_version=request_comms.api_version)
+def FormatResponse(data, status=200, ctype="application/octet-stream",
+                   last_modified=0):
+  """Formats an HTTP/1.0 response the way the clients expect it."""
+  return ("HTTP/1.0 %s\r\n"
+          "Server: BaseHTTP/0.3 Python/2.6.5\r\n"
+          "Content-type: %s\r\n"
+          "Content-Length: %d\r\n"
+          "Last-Modified: %s\r\n"
+          "\r\n"
+          "%s") % (STATUS_TEXT[status], ctype, len(data),
+                   email_utils.formatdate(last_modified, usegmt=True), data)
+
+
+def ProcessControlRequest(frontend, path, headers, data, client_address):
+  """Decodes a POSTed message bundle and produces the reply.
+
+  Args:
+    frontend: The FrontEndServer handling the messages.
+    path: The request path, which may carry the api version.
+    headers: The request headers (a mimetools.Message).
+    data: The POSTed data.
+    client_address: The (address, port) of the client.
+
+  Returns:
+    A tuple of the HTTP status and the response body.
+  """
+  if not master.MASTER_WATCHER.IsMaster():
+    # We shouldn't be getting requests from the client unless we
+    # are the active instance.
+    stats.STATS.IncrementCounter("frontend_inactive_request_count",
+                                 fields=["http"])
+    logging.info("Request sent to inactive frontend from %s" %
+                 client_address[0])
+
+  # Get the api version
+  try:
+    api_version = int(cgi.parse_qs(path.split("?")[1])["api"][0])
+  except (ValueError, KeyError, IndexError):
+    # The oldest api version we support if not specified.
+    api_version = 3
 
-      source_ip = ipaddr.IPAddress(self.client_address[0])
+  try:
+    request_comms = rdfvalue.ClientCommunication(data)
 
-      if source_ip.version == 6:
-        source_ip = source_ip.ipv4_mapped or source_ip
+    # If the client did not supply the version in the protobuf we use the get
+    # parameter.
+    if not request_comms.api_version:
+      request_comms.api_version = api_version
 
-      request_comms.orig_request = rdfvalue.HttpRequest(
-          raw_headers=utils.SmartStr(self.headers),
-          source_ip=utils.SmartStr(source_ip))
+    # Reply using the same version we were requested with.
+    responses_comms = rdfvalue.ClientCommunication(
+        api_version=request_comms.api_version)
 
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
+    source_ip = ipaddr.IPAddress(client_address[0])
 
-      logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
-                   " %d messages sent.",
-                   source, utils.SmartStr(source_ip), length, nr_messages,
-                   responses_comms.num_messages)
+    if source_ip.version == 6:
+      source_ip = source_ip.ipv4_mapped or source_ip
 
-      self.Send(responses_comms.SerializeToString())
+    request_comms.orig_request = rdfvalue.HttpRequest(
+        raw_headers=utils.SmartStr(headers),
+        source_ip=utils.SmartStr(source_ip))
 
-    except communicator.UnknownClientCert:
-      # "406 Not Acceptable: The server can only generate a response that is not
-      # accepted by the client". This is because we can not encrypt for the
-      # client appropriately.
-      self.Send("Enrollment required", status=406)
+    source, nr_messages = frontend.HandleMessageBundles(
+        request_comms, responses_comms)
 
-    except Exception as e:
-      if flags.FLAGS.debug:
-        pdb.post_mortem()
+    logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
+                 " %d messages sent.",
+                 source, utils.SmartStr(source_ip), len(data), nr_messages,
+                 responses_comms.num_messages)
 
-      logging.error("Had to respond with status 500: %s.", e)
-      self.Send("Error", status=500)
+    return 200, responses_comms.SerializeToString()
 
-    finally:
-      with GRRHTTPServerHandler.active_counter_lock:
-        GRRHTTPServerHandler.active_counter -= 1
-        stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
-                                  fields=["http"])
+  except communicator.UnknownClientCert:
+    # "406 Not Acceptable: The server can only generate a response that is not
+    # accepted by the client". This is because we can not encrypt for the
+    # client appropriately.
+    return 406, "Enrollment required"
+
+  except Exception as e:  # pylint: disable=broad-except
+    if flags.FLAGS.debug:
+      pdb.post_mortem()
+
+    logging.error("Had to respond with status 500: %s.", e)
+    return 500, "Error"
+
+
+def CreateFrontEnd():
+  return flow.FrontEndServer(
+      certificate=config_lib.CONFIG["Frontend.certificate"],
+      private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config_lib.CONFIG[
+          "Frontend.max_retransmission_time"])
 
 
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
@@ -179,16 +229,7 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = flow.FrontEndServer(
-          certificate=config_lib.CONFIG["Frontend.certificate"],
-          private_key=config_lib.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config_lib.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or CreateFrontEnd()
     self.server_cert = config_lib.CONFIG["Frontend.certificate"]
 
     (address, _) = server_address
@@ -203,10 +244,386 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
                                        **kwargs)
 
 
+class _AsyncConnection(object):
+  """The state of a client connection in the AsyncGRRHTTPServer."""
+
+  # Connection states.
+  READING = 0
+  PROCESSING = 1
+  WRITING = 2
+
+  def __init__(self, sock, address):
+    self.sock = sock
+    self.address = address
+    self.state = self.READING
+    # Received data while we are still waiting for the headers.
+    self.data = ""
+    self.method = None
+    self.path = None
+    self.headers = None
+    self.content_length = 0
+    # The body is kept in the chunks it arrived in and only joined once it is
+    # complete, so large requests are not copied on every read.
+    self.body_chunks = []
+    self.body_size = 0
+    self.outgoing = ""
+
+    # Timestamps of the request stages.
+    self.accepted = time.time()
+    self.queued = None
+    self.replied = None
+    # The last time the client sent or accepted data.
+    self.last_activity = self.accepted
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def Feed(self, data):
+    """Adds received data, returns True once the request is complete.
+
+    Args:
+      data: The received data.
+
+    Returns:
+      True if the whole request was received.
+
+    Raises:
+      ValueError: If the request can not be parsed.
+    """
+    if self.headers is not None:
+      self.body_chunks.append(data)
+      self.body_size += len(data)
+      return self.body_size >= self.content_length
+
+    self.data += data
+    end = self.data.find("\r\n\r\n")
+    if end == -1:
+      if len(self.data) > AsyncGRRHTTPServer.MAX_HEADER_SIZE:
+        raise ValueError("Request headers too large.")
+      return False
+
+    request_line, _, header_text = self.data[:end + 2].partition("\r\n")
+    words = request_line.split()
+    if len(words) != 3:
+      raise ValueError("Bad request line %r." % request_line)
+    self.method, self.path, _ = words
+
+    self.headers = mimetools.Message(cStringIO.StringIO(header_text), 0)
+    if self.method == "POST":
+      self.content_length = int(
+          self.headers.getheader("content-length") or 0)
+      if self.content_length > AsyncGRRHTTPServer.MAX_REQUEST_SIZE:
+        raise ValueError("Request too large.")
+
+    self.body_chunks = [self.data[end + 4:]]
+    self.body_size = len(self.body_chunks[0])
+    self.data = ""
+    return self.body_size >= self.content_length
+
+  @property
+  def body(self):
+    if len(self.body_chunks) != 1:
+      self.body_chunks = ["".join(self.body_chunks)]
+    return self.body_chunks[0][:self.content_length]
+
+
+class AsyncGRRHTTPServer(object):
+  """An event loop based GRR HTTP frontend.
+
+  A single thread accepts connections and does all the network I/O. Complete
+  requests are decoded, processed and encrypted by a fixed number of worker
+  threads. When too many requests are waiting for a worker we stop accepting
+  new connections, so they queue in the kernel's listen backlog instead of
+  consuming memory here.
+
+  The wire format is the same as GRRHTTPServer's.
+  """
+
+  request_queue_size = 500
+
+  MAX_HEADER_SIZE = 64 * 1024
+  MAX_REQUEST_SIZE = 256 * 1024 * 1024
+
+  # Connections which have not sent any of their request, or accepted any of
+  # our reply, in this many seconds are dropped.
+  READ_TIMEOUT = 60
+  WRITE_TIMEOUT = 60
+
+  READ_CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, server_address, frontend=None, workers=None,
+               max_queue=None):
+    self.frontend = frontend or CreateFrontEnd()
+    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+    self.num_workers = workers or config_lib.CONFIG["Frontend.async_workers"]
+    self.max_queue = max_queue or config_lib.CONFIG["Frontend.async_max_queue"]
+
+    stats.STATS.SetGaugeValue("frontend_max_active_count", self.max_queue)
+
+    (address, _) = server_address
+    if ipaddr.IPAddress(address).version == 4:
+      address_family = socket.AF_INET
+    else:
+      address_family = socket.AF_INET6
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(server_address)
+    self.socket.listen(self.request_queue_size)
+    self.socket.setblocking(0)
+
+    self.server_address = self.socket.getsockname()
+
+    # The poller, workers and wakeup pipe are created in serve_forever() so
+    # the server can be shared by several forked processes.
+    self.poller = None
+    self.wakeup_read = self.wakeup_write = None
+    self.workers = []
+    self.requests = Queue.Queue()
+
+    self.lock = threading.Lock()
+    self.connections = {}
+    # Connections with a reply ready to be written.
+    self.replies = collections.deque()
+    # Number of requests waiting for or being processed by a worker.
+    self.pending = 0
+    self.accepting = True
+    self.running = False
+
+  def serve_forever(self):
+    self.poller = poller.Poller()
+    self.wakeup_read, self.wakeup_write = os.pipe()
+    self.poller.Register(self.wakeup_read, readable=True, writable=False)
+    self.poller.Register(self.socket.fileno(), readable=True, writable=False)
+
+    self.running = True
+    for i in range(self.num_workers):
+      worker = threading.Thread(target=self._Worker,
+                                name="FrontendWorker%d" % i)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+    last_sweep = time.time()
+    try:
+      while self.running:
+        try:
+          events = self.poller.Poll(1)
+        except (IOError, OSError, select.error) as e:
+          if e.args and e.args[0] == errno.EINTR:
+            continue
+          raise
+
+        for fd, readable, writable in events:
+          if fd == self.wakeup_read:
+            os.read(self.wakeup_read, 4096)
+          elif fd == self.socket.fileno():
+            self._Accept()
+          else:
+            conn = self.connections.get(fd)
+            if conn is None:
+              continue
+            if readable and conn.state == conn.READING:
+              self._HandleRead(conn)
+            if writable and conn.state == conn.WRITING:
+              self._HandleWrite(conn)
+
+        self._QueueReplies()
+        self._ApplyBackPressure()
+
+        now = time.time()
+        if now - last_sweep > 1:
+          self._DropStaleConnections(now)
+          last_sweep = now
+    finally:
+      for _ in self.workers:
+        self.requests.put(None)
+
+  def shutdown(self):
+    self.running = False
+    if self.wakeup_write is not None:
+      self._Wakeup()
+
+  def _Wakeup(self):
+    try:
+      os.write(self.wakeup_write, "x")
+    except OSError:
+      pass
+
+  def _Accept(self):
+    while self.accepting:
+      try:
+        sock, address = self.socket.accept()
+      except socket.error as e:
+        if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        logging.warning("Unable to accept connection: %s", e)
+        return
+
+      sock.setblocking(0)
+      conn = _AsyncConnection(sock, address)
+      self.connections[conn.fileno()] = conn
+      self.poller.Register(conn.fileno(), readable=True, writable=False)
+
+  def _HandleRead(self, conn):
+    try:
+      data = conn.sock.recv(self.READ_CHUNK_SIZE)
+    except socket.error as e:
+      if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      data = ""
+
+    if not data:
+      self._Close(conn)
+      return
+
+    conn.last_activity = time.time()
+    try:
+      complete = conn.Feed(data)
+    except ValueError as e:
+      logging.info("Bad request from %s: %s", conn.address[0], e)
+      self._Close(conn)
+      return
+
+    if complete:
+      conn.state = conn.PROCESSING
+      conn.queued = time.time()
+      stats.STATS.RecordEvent("frontend_stage_latency",
+                              conn.queued - conn.accepted, fields=["read"])
+      self.poller.Modify(conn.fileno(), readable=False, writable=False)
+      with self.lock:
+        self.pending += 1
+      self.requests.put(conn)
+
+  def _Worker(self):
+    while True:
+      conn = self.requests.get()
+      if conn is None:
+        return
+
+      start = time.time()
+      stats.STATS.RecordEvent("frontend_stage_latency", start - conn.queued,
+                              fields=["queue"])
+      try:
+        conn.outgoing = self._Process(conn)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Unable to process request: %s", e)
+        conn.outgoing = FormatResponse("Error", status=500)
+
+      conn.replied = time.time()
+      stats.STATS.RecordEvent("frontend_stage_latency", conn.replied - start,
+                              fields=["process"])
+
+      with self.lock:
+        self.pending -= 1
+        self.replies.append(conn)
+      self._Wakeup()
+
+  def _Process(self, conn):
+    """Processes a complete request and returns the raw reply."""
+    if conn.method == "GET":
+      if conn.path.startswith("/server.pem"):
+        return FormatResponse(self.server_cert)
+      return FormatResponse("Not found", status=404)
+
+    if conn.method != "POST":
+      return FormatResponse("Unsupported method", status=501)
+
+    start = time.time()
+    stats.STATS.IncrementCounter("frontend_request_count", fields=["http"])
+    with self.lock:
+      stats.STATS.SetGaugeValue("frontend_active_count", self.pending,
+                                fields=["http"])
+    try:
+      status, data = ProcessControlRequest(self.frontend, conn.path,
+                                           conn.headers, conn.body,
+                                           conn.address)
+      return FormatResponse(data, status=status)
+    finally:
+      stats.STATS.RecordEvent("frontend_request_latency", time.time() - start,
+                              fields=["http"])
+
+  def _QueueReplies(self):
+    while True:
+      with self.lock:
+        if not self.replies:
+          return
+        conn = self.replies.popleft()
+
+      if conn.fileno() not in self.connections:
+        continue
+
+      if not conn.outgoing:
+        self._Close(conn)
+        continue
+
+      conn.state = conn.WRITING
+      conn.last_activity = time.time()
+      self.poller.Modify(conn.fileno(), readable=False, writable=True)
+
+  def _HandleWrite(self, conn):
+    try:
+      sent = conn.sock.send(conn.outgoing)
+    except socket.error as e:
+      if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      self._Close(conn)
+      return
+
+    conn.last_activity = time.time()
+    conn.outgoing = conn.outgoing[sent:]
+    if not conn.outgoing:
+      stats.STATS.RecordEvent("frontend_stage_latency",
+                              time.time() - conn.replied, fields=["write"])
+      # Like GRRHTTPServer we speak HTTP/1.0 and close after the reply.
+      self._Close(conn)
+
+  def _ApplyBackPressure(self):
+    with self.lock:
+      pending = self.pending
+
+    stats.STATS.SetGaugeValue("frontend_queue_depth", pending)
+    if self.accepting and pending >= self.max_queue:
+      logging.info("Frontend queue is full (%d requests), not accepting new "
+                   "connections.", pending)
+      stats.STATS.IncrementCounter("frontend_throttled_count")
+      self.accepting = False
+      self.poller.Modify(self.socket.fileno(), readable=False, writable=False)
+
+    elif not self.accepting and pending < self.max_queue:
+      self.accepting = True
+      self.poller.Modify(self.socket.fileno(), readable=True, writable=False)
+
+  def _DropStaleConnections(self, now):
+    # Connections being processed are left to the workers.
+    timeouts = {_AsyncConnection.READING: self.READ_TIMEOUT,
+                _AsyncConnection.WRITING: self.WRITE_TIMEOUT}
+    for conn in self.connections.values():
+      timeout = timeouts.get(conn.state)
+      if timeout is not None and conn.last_activity + timeout < now:
+        logging.info("Dropping idle connection from %s", conn.address[0])
+        self._Close(conn)
+
+  def _Close(self, conn):
+    fd = conn.fileno()
+    if self.connections.pop(fd, None) is None:
+      return
+    self.poller.Unregister(fd)
+    try:
+      conn.sock.close()
+    except socket.error:
+      pass
+
+
 def CreateServer(frontend=None):
   server_address = (config_lib.CONFIG["Frontend.bind_address"],
                     config_lib.CONFIG["Frontend.bind_port"])
-  httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler, frontend=frontend)
+  if config_lib.CONFIG["Frontend.server_type"] == "async":
+    httpd = AsyncGRRHTTPServer(server_address, frontend=frontend)
+  else:
+    httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler,
+                          frontend=frontend)
 
   sa = httpd.socket.getsockname()
   logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
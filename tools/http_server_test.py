@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""Tests for the event loop based HTTP frontend."""
+
+
+import httplib
+import select
+import socket
+import threading
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import poller
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.tools import http_server
+
+
+class FakeFrontEnd(object):
+  """Answers every message bundle with its own payload reversed."""
+
+  def __init__(self):
+    self.bundles = []
+
+  def HandleMessageBundles(self, request_comms, response_comms):
+    self.bundles.append(request_comms)
+    response_comms.encrypted = request_comms.encrypted[::-1]
+    return "C.1000000000000000", 1
+
+
+class AsyncGRRHTTPServerTest(test_lib.GRRBaseTest):
+  """Requests through a running AsyncGRRHTTPServer."""
+
+  def setUp(self):
+    super(AsyncGRRHTTPServerTest, self).setUp()
+    self.frontend = FakeFrontEnd()
+    self.server = http_server.AsyncGRRHTTPServer(
+        ("127.0.0.1", 0), frontend=self.frontend, workers=2, max_queue=10)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.thread.join()
+    self.server.socket.close()
+    super(AsyncGRRHTTPServerTest, self).tearDown()
+
+  def Request(self, method, path, body=None):
+    connection = httplib.HTTPConnection(*self.server.server_address,
+                                        timeout=10)
+    try:
+      connection.request(method, path, body)
+      response = connection.getresponse()
+      return response.status, response.read()
+    finally:
+      connection.close()
+
+  def testServerPem(self):
+    self.assertEqual(self.Request("GET", "/server.pem"),
+                     (200, config_lib.CONFIG["Frontend.certificate"]))
+
+  def testUnknownPath(self):
+    status, _ = self.Request("GET", "/unknown")
+    self.assertEqual(status, 404)
+
+  def testUnsupportedMethod(self):
+    status, _ = self.Request("DELETE", "/control")
+    self.assertEqual(status, 501)
+
+  def testControl(self):
+    request = rdfvalue.ClientCommunication(encrypted="hello")
+    status, data = self.Request("POST", "/control?api=3",
+                                request.SerializeToString())
+
+    self.assertEqual(status, 200)
+    self.assertEqual(rdfvalue.ClientCommunication(data).encrypted, "olleh")
+    self.assertEqual(len(self.frontend.bundles), 1)
+    self.assertEqual(self.frontend.bundles[0].api_version, 3)
+    self.assertEqual(self.frontend.bundles[0].orig_request.source_ip,
+                     "127.0.0.1")
+
+  def testRequestsInChunks(self):
+    body = rdfvalue.ClientCommunication(encrypted="x" * 100000)
+    body = body.SerializeToString()
+
+    client = socket.create_connection(self.server.server_address, 10)
+    try:
+      client.sendall("POST /control HTTP/1.0\r\n")
+      client.sendall("Content-Length: %d\r\n\r\n" % len(body))
+      for i in range(0, len(body), 1000):
+        client.sendall(body[i:i + 1000])
+
+      reply = ""
+      while True:
+        data = client.recv(65536)
+        if not data:
+          break
+        reply += data
+    finally:
+      client.close()
+
+    self.assertTrue(reply.startswith("HTTP/1.0 200 OK\r\n"))
+    self.assertEqual(self.frontend.bundles[0].encrypted, "x" * 100000)
+
+
+class AsyncConnectionTest(test_lib.GRRBaseTest):
+  """Reassembly of requests from the data received on a connection."""
+
+  def testBodyInChunks(self):
+    conn = http_server._AsyncConnection(None, ("127.0.0.1", 1234))
+    self.assertFalse(conn.Feed("POST /control HTTP/1.0\r\n"))
+    self.assertFalse(conn.Feed("Content-Length: 5000\r\n\r\nxx"))
+    for _ in range(499):
+      self.assertFalse(conn.Feed("x" * 10))
+    # The body is only joined when it is read.
+    self.assertEqual(len(conn.body_chunks), 500)
+
+    self.assertTrue(conn.Feed("x" * 8 + "trailing"))
+    self.assertEqual(conn.method, "POST")
+    self.assertEqual(conn.path, "/control")
+    self.assertEqual(conn.body, "x" * 5000)
+
+  def testRequestWithoutBody(self):
+    conn = http_server._AsyncConnection(None, ("127.0.0.1", 1234))
+    self.assertTrue(conn.Feed("GET /server.pem HTTP/1.0\r\n\r\n"))
+    self.assertEqual(conn.body, "")
+
+
+class AsyncGRRHTTPServerTimeoutTest(test_lib.GRRBaseTest):
+  """Timeouts of the connections of an AsyncGRRHTTPServer.
+
+  The server is driven by hand here so the clock can be faked.
+  """
+
+  def setUp(self):
+    super(AsyncGRRHTTPServerTimeoutTest, self).setUp()
+    self.server = http_server.AsyncGRRHTTPServer(
+        ("127.0.0.1", 0), frontend=FakeFrontEnd(), workers=1, max_queue=10)
+    self.server.poller = poller.Poller()
+    self.client = None
+
+  def tearDown(self):
+    if self.client:
+      self.client.close()
+    self.server.socket.close()
+    super(AsyncGRRHTTPServerTimeoutTest, self).tearDown()
+
+  def Connect(self):
+    self.client = socket.create_connection(self.server.server_address, 10)
+    select.select([self.server.socket], [], [], 10)
+    self.server._Accept()
+    self.assertEqual(len(self.server.connections), 1)
+    return self.server.connections.values()[0]
+
+  def Send(self, conn, data):
+    self.client.sendall(data)
+    select.select([conn.sock], [], [], 10)
+    self.server._HandleRead(conn)
+
+  def AssertClosed(self):
+    self.assertEqual(self.server.connections, {})
+    self.client.settimeout(10)
+    self.assertEqual(self.client.recv(1), "")
+
+  def testSlowRequestsAreKept(self):
+    with test_lib.FakeTime(1000):
+      conn = self.Connect()
+
+    with test_lib.FakeTime(1050):
+      self.Send(conn, "POST /control HTTP/1.0\r\n")
+
+    # The timeout counts from the last data received, not from the accept.
+    self.server._DropStaleConnections(1000 + self.server.READ_TIMEOUT + 1)
+    self.assertEqual(self.server.connections.values(), [conn])
+
+    self.server._DropStaleConnections(1050 + self.server.READ_TIMEOUT + 1)
+    self.AssertClosed()
+
+  def testStalledRepliesAreDropped(self):
+    with test_lib.FakeTime(1000):
+      conn = self.Connect()
+      self.Send(conn, "GET /server.pem HTTP/1.0\r\n\r\n")
+
+    # Requests waiting for a worker are never dropped.
+    self.assertEqual(conn.state, conn.PROCESSING)
+    self.server._DropStaleConnections(2000)
+    self.assertEqual(self.server.connections.values(), [conn])
+
+    # Do what a worker would do.
+    self.assertIs(self.server.requests.get(), conn)
+    conn.outgoing = self.server._Process(conn)
+    conn.replied = 2000
+    self.server.replies.append(conn)
+    with test_lib.FakeTime(2000):
+      self.server._QueueReplies()
+    self.assertEqual(conn.state, conn.WRITING)
+
+    # The client never reads the reply.
+    self.server._DropStaleConnections(2000 + self.server.WRITE_TIMEOUT - 1)
+    self.assertEqual(self.server.connections.values(), [conn])
+
+    self.server._DropStaleConnections(2000 + self.server.WRITE_TIMEOUT + 1)
+    self.AssertClosed()
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
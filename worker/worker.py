@@ -6,11 +6,6 @@ it specifies.
 """
 
 
-import multiprocessing
-import time
-
-import logging
-
 # pylint: disable=unused-import,g-bad-import-order
 from grr.lib import server_plugins
 # pylint: enable=unused-import,g-bad-import-order
@@ -31,50 +26,19 @@ def main(unused_argv):
   # Initialise flows
   startup.Init()
 
-  workers = {}
-  dead_count = 0
-  start_time = time.time()
-
+  token = access_control.ACLToken(username="GRRWorker")
   if config_lib.CONFIG["Worker.worker_process_count"] <= 1:
     # Special case when we only support a single worker process and don't need
     # the complexity of multiprocessing.
-    StartWorker()
+    worker_obj = worker.GRRWorker(queue=worker.DEFAULT_WORKER_QUEUE,
+                                  token=token)
   else:
-    # Run a pool of workers, reviving any that die and logging the death.
-    while True:
-      # Start any required new workers.
-      while len(workers) < config_lib.CONFIG["Worker.worker_process_count"]:
-        worker_process = multiprocessing.Process(target=StartWorker)
-        worker_process.start()
-        logging.debug("Added new worker %d", worker_process.pid)
-        workers[worker_process.name] = worker_process
-
-      # Kill off any dead workers.
-      dead_workers = []
-      for worker_name, worker_process in workers.items():
-        if not worker_process.is_alive():
-          logging.error("Worker %s is dead", worker_process.pid)
-          dead_workers.append(worker_name)
-          dead_count += 1
-      for worker_name in dead_workers:
-        del workers[worker_name]
+    # Flows are processed by a supervised pool of child processes.
+    worker_obj = worker.GRRWorkerPool(queue=worker.DEFAULT_WORKER_QUEUE,
+                                      token=token)
 
-      # Catch all workers dying on startup and raise immediately instead of
-      # continuously respawning them.
-      if (time.time() - start_time) < 60:
-        if dead_count >= config_lib.CONFIG["Worker.worker_process_count"]:
-          for worker_process in workers.values():
-            worker_process.terminate()
-          raise RuntimeError("Workers did not start up, all of them died.")
-
-      time.sleep(10)
-
-
-def StartWorker():
-  token = access_control.ACLToken(username="GRRWorker")
-  worker_obj = worker.GRRWorker(queue=worker.DEFAULT_WORKER_QUEUE,
-                                token=token)
   worker_obj.Run()
 
+
 if __name__ == "__main__":
   flags.StartMain(main)
@@ -2,6 +2,7 @@
 """Tests for the worker."""
 
 
+import Queue
 import threading
 import time
 
@@ -296,6 +297,108 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(flow_obj.state.context["current_state"],
                      "End")
 
+  def testProcessMessageBatch(self):
+    """Flows leased in a batch are all processed, locked ones are skipped."""
+    worker_obj = worker.GRRWorker(worker.DEFAULT_WORKER_QUEUE,
+                                  token=self.token)
+
+    session_ids = []
+    for i in range(5):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+      self.SendResponse(flow_obj.session_id, "Hello%d" % i)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    notifications = manager.GetNotifications(worker.DEFAULT_WORKER_QUEUE)
+    self.assertEqual(len(notifications), 5)
+
+    # Another worker holds the lock on the last flow.
+    with aff4.FACTORY.OpenWithLock(session_ids[-1], token=self.token):
+      worker_obj._ProcessMessageBatch(notifications, manager)
+
+    self.assertEqual(sorted(RESULTS), ["Hello%d" % i for i in range(4)])
+    for session_id in session_ids[:4]:
+      flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+      self.assertEqual(flow_obj.state.context.state,
+                       rdfvalue.Flow.State.TERMINATED)
+
+    # Only the notification of the locked flow is left.
+    notifications = manager.GetNotifications(worker.DEFAULT_WORKER_QUEUE)
+    self.assertEqual([n.session_id for n in notifications], session_ids[-1:])
+
+  def testProcessMessageBatchRenewsLeases(self):
+    """Flows waiting in a slow batch do not lose their lease."""
+    worker_obj = worker.GRRWorker(worker.DEFAULT_WORKER_QUEUE,
+                                  token=self.token)
+
+    clock = test_lib.FakeTime(1000)
+    with clock:
+      session_ids = []
+      for i in range(5):
+        flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+        session_ids.append(flow_obj.session_id)
+        flow_obj.Close()
+        self.SendResponse(flow_obj.session_id, "Hello%d" % i)
+
+      manager = queue_manager.QueueManager(token=self.token)
+      notifications = manager.GetNotifications(worker.DEFAULT_WORKER_QUEUE)
+
+      # Every flow takes most of the lease time, together they take much
+      # longer.
+      process_flow = worker_obj._ProcessFlow
+
+      def SlowProcessFlow(*args, **kwargs):
+        clock.time += worker_obj.lease_time * 0.8
+        return process_flow(*args, **kwargs)
+
+      with utils.Stubber(worker_obj, "_ProcessFlow", SlowProcessFlow):
+        worker_obj._ProcessMessageBatch(notifications, manager)
+
+    self.assertEqual(sorted(RESULTS), ["Hello%d" % i for i in range(5)])
+    for session_id in session_ids:
+      flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+      self.assertEqual(flow_obj.state.context.state,
+                       rdfvalue.Flow.State.TERMINATED)
+
+  def testProcessMessageBatchLeavesNoKillNotificationsForExpiredFlows(self):
+    """Flows which lose their lease in a batch can not be killed as stuck."""
+    worker_obj = worker.GRRWorker(worker.DEFAULT_WORKER_QUEUE,
+                                  token=self.token)
+
+    clock = test_lib.FakeTime(1000)
+    with clock:
+      session_ids = []
+      for i in range(3):
+        flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+        session_ids.append(flow_obj.session_id)
+        flow_obj.Close()
+        self.SendResponse(flow_obj.session_id, "Hello%d" % i)
+
+      manager = queue_manager.QueueManager(token=self.token)
+      notifications = manager.GetNotifications(worker.DEFAULT_WORKER_QUEUE)
+
+      # The first flow takes so long that the others lose their lease.
+      process_flow = worker_obj._ProcessFlow
+
+      def SlowProcessFlow(*args, **kwargs):
+        result = process_flow(*args, **kwargs)
+        clock.time += worker_obj.lease_time * 2
+        return result
+
+      with utils.Stubber(worker_obj, "_ProcessFlow", SlowProcessFlow):
+        worker_obj._ProcessMessageBatch(notifications, manager)
+
+    self.assertEqual(len(RESULTS), 1)
+
+    # The expired flows are notified again for another worker but have no
+    # kill notification.
+    with queue_manager.QueueManager(token=self.token) as manager:
+      notifications = manager.GetNotificationsByPriority(worker_obj.queue)
+      self.assertFalse(manager.STUCK_PRIORITY in notifications)
+      self.assertEqual(
+          len(manager.GetNotifications(worker.DEFAULT_WORKER_QUEUE)), 2)
+
   def testNoKillNotificationsScheduledForHunts(self):
     worker_obj = worker.GRRWorker(worker.DEFAULT_WORKER_QUEUE,
                                   token=self.token)
@@ -787,6 +890,79 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
       for (_, _, timestamp) in res:
         self.assertEqual(timestamp, frozen_timestamp)
 
+  def testWorkerPoolDispatchesSessionsToTheSameProcess(self):
+    pool = worker.GRRWorkerPool(worker.DEFAULT_WORKER_QUEUE, processes=3,
+                                threadpool_size=2, token=self.token)
+
+    class FakeProcess(object):
+      pid = 0
+      exitcode = None
+
+      def is_alive(self):
+        return True
+
+    # Do not fork, just look at what is dispatched.
+    pool.done_queue = Queue.Queue()
+    for child in pool.children:
+      child.process = FakeProcess()
+      child.work_queue = Queue.Queue()
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.FreezeTimestamp()
+    session_ids = [rdfvalue.SessionID(flow_name=i + 1)
+                   for i in range(20)]
+    notifications = [rdfvalue.GrrNotification(session_id=session_id)
+                     for session_id in session_ids]
+
+    processed = pool.ProcessMessages(notifications, manager)
+
+    # Every child only gets as many flows as it has threads.
+    self.assertEqual(processed, 6)
+    dispatched = {}
+    for child in pool.children:
+      self.assertEqual(child.work_queue.qsize(), 2)
+      while not child.work_queue.empty():
+        serialized, timestamp = child.work_queue.get()
+        self.assertEqual(timestamp, int(manager.frozen_timestamp))
+        session_id = rdfvalue.GrrNotification(serialized).session_id
+        dispatched[session_id] = child.index
+
+    # Dispatched sessions are not sent again until they are done.
+    self.assertEqual(pool.ProcessMessages(notifications, manager), 0)
+
+    session_id, index = dispatched.items()[0]
+    pool.done_queue.put((index, str(session_id)))
+    pool.Supervise()
+    self.assertEqual(pool.ProcessMessages(notifications, manager), 1)
+
+    # The session goes to the same child again.
+    serialized, _ = pool.children[index].work_queue.get_nowait()
+    self.assertEqual(rdfvalue.GrrNotification(serialized).session_id,
+                     session_id)
+
+  def testWorkerPoolPassesThreadpoolSizeToChildren(self):
+    pool = worker.GRRWorkerPool(worker.DEFAULT_WORKER_QUEUE, processes=1,
+                                threadpool_size=7, token=self.token)
+
+    started = []
+
+    class FakeProcess(object):
+      pid = 0
+
+      def __init__(self, target=None, name=None, args=()):
+        started.append((target, name, args))
+
+      def start(self):
+        pass
+
+    with utils.Stubber(worker.multiprocessing, "Process", FakeProcess):
+      pool.Start()
+
+    self.assertEqual(len(started), 1)
+    target, _, args = started[0]
+    self.assertIs(target, worker._RunPooledWorker)
+    self.assertEqual(args[4], 7)
+
 
 def main(_):
   test_lib.main()